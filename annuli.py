@@ -69,6 +69,7 @@ import json_parse
 import methods
 import mining
 import photometry
+import seeing
 import subprocess
 
 class NotEnoughImages(ValueError):
@@ -87,6 +88,8 @@ parser.add_option('--overwrite', action = 'store_true', dest = 'overwrite',
 parser.add_option(photometry.parser.get_option('--margin'))
 parser.add_option(photometry.parser.get_option('--gain'))
 parser.add_option(photometry.parser.get_option('--cores'))
+parser.add_option(photometry.parser.get_option('--header-index'))
+parser.add_option(photometry.parser.get_option('--quality-db'))
 parser.add_option(photometry.parser.get_option('--verbose'))
 
 qphot_group = optparse.OptionGroup(parser, "Initial Photometry",
@@ -201,6 +204,7 @@ search_group.add_option('--width', action = 'store', type = 'float',
 
 search_group.add_option(photometry.parser.get_option('--snr-percentile'))
 search_group.add_option(photometry.parser.get_option('--mean'))
+search_group.add_option(photometry.parser.get_option('--detector'))
 parser.add_option_group(search_group)
 
 const_group = optparse.OptionGroup(parser, "Stars eligibility",
@@ -286,6 +290,12 @@ def main(arguments = None):
         logging_level = logging.DEBUG
     logging.basicConfig(format = style.LOG_FORMAT, level = logging_level)
 
+    # Cache the headers of the FITS images in the persistent header index
+    fitsimage.set_header_index(options.header_index)
+
+    # ... and read the FWHM of the images from the quality metrics store
+    seeing.set_quality_db(options.quality_db)
+
     # Print the help and abort the execution if there are not two positional
     # arguments left after parsing the options, as the user must specify at
     # least one (only one?) input FITS file and the output JSON file.
@@ -351,7 +361,10 @@ def main(arguments = None):
 
     phot_args = ['--maximum', options.maximum,
                  '--margin', options.margin,
+                 '--detector', options.detector,
                  '--cores', options.ncores,
+                 '--header-index', options.header_index,
+                 '--quality-db', options.quality_db,
                  '--min-sky', options.min,
                  '--objectk', options.objectk,
                  '--filterk', options.filterk,
@@ -501,13 +514,9 @@ def main(arguments = None):
         msg = "%sCalculating the median FWHM for this filter..."
         print msg % style.prefix ,
 
-        pfilter_fwhms = []
-        for img in files[pfilter]:
-            img_fwhm = photometry.get_fwhm(img, options)
-            logging.debug("%s: FWHM = %.3f" % (img.path, img_fwhm))
-            pfilter_fwhms.append(img_fwhm)
-
-        fwhm = numpy.median(pfilter_fwhms)
+        paths = [img.path for img in files[pfilter]]
+        pfilter_fwhms = photometry.get_fwhms(paths, options)
+        fwhm = numpy.median(pfilter_fwhms.values())
         print ' done.'
 
         # FWHM to range of pixels conversion
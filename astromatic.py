@@ -21,12 +21,13 @@
 from __future__ import division
 
 import collections
-import functools
 import hashlib
 import os
 import os.path
 import re
 import math
+import numpy
+import pyfits
 import tempfile
 import subprocess
 
@@ -41,6 +42,9 @@ SEXTRACTOR_STARNNW = os.path.join(CONFIG_FILES_DIR, 'sextractor.nnw')
 SEXTRACTOR_COMMANDS = 'sextractor', 'sex' # may be any of these
 SEXTRACTOR_REQUIRED_VERSION = (2, 19, 5)
 
+# The first bytes of a FITS file, such as a FITS_LDAC catalog
+FITS_MAGIC = 'SIMPLE  ='
+
 class SExtractorNotInstalled(StandardError):
     pass
 
@@ -111,6 +115,97 @@ class Coordinates(collections.namedtuple('Coordinates', "ra dec pm_ra pm_dec")):
         return self.__class__(ra, dec, None, None)
 
 
+class CoordinatesArray(object):
+    """ The celestial coordinates of many astronomical objects, as arrays.
+
+    A struct-of-arrays alternative to a list of Coordinates objects: 'ra',
+    'dec', 'pm_ra' and 'pm_dec' are one-dimensional NumPy arrays, with one
+    element per astronomical object, so that operations on all the objects
+    (such as the proper-motion correction) are done with a single NumPy
+    operation. Unknown proper motions (None in Coordinates) are stored as NaN.
+
+    Iterating over a CoordinatesArray yields Coordinates objects, and indexing
+    it with an integer returns a Coordinates object too, so it can be used in
+    place of a list of them. Slices, integer arrays and boolean masks return a
+    new CoordinatesArray with the selected objects.
+
+    """
+
+    def __init__(self, ra, dec, pm_ra = None, pm_dec = None):
+
+        def as_array(values):
+            if values is None:
+                return numpy.zeros(len(self.ra))
+            if not isinstance(values, numpy.ndarray):
+                values = [numpy.nan if x is None else x for x in values]
+            return numpy.array(values, dtype = numpy.float64).reshape(-1)
+
+        self.ra  = numpy.array(ra,  dtype = numpy.float64).reshape(-1)
+        self.dec = numpy.array(dec, dtype = numpy.float64).reshape(-1)
+        self.pm_ra  = as_array(pm_ra)
+        self.pm_dec = as_array(pm_dec)
+
+        sizes = set(len(x) for x in (self.ra, self.dec, self.pm_ra, self.pm_dec))
+        if len(sizes) != 1:
+            raise ValueError("all arrays must have the same length")
+
+        # Whether each object has a known, non-zero proper motion: this is
+        # computed only once, as it does not change.
+        self.pm_mask = (numpy.nan_to_num(self.pm_ra)  != 0) | \
+                       (numpy.nan_to_num(self.pm_dec) != 0)
+        self.has_pm = bool(self.pm_mask.any())
+
+    @classmethod
+    def from_coordinates(cls, coordinates):
+        """ Return a CoordinatesArray from an iterable of Coordinates objects.
+
+        If 'coordinates' is already a CoordinatesArray, it is returned as is.
+
+        """
+
+        if isinstance(coordinates, cls):
+            return coordinates
+
+        coordinates = list(coordinates)
+        columns = [[coord[index] for coord in coordinates] for index in xrange(4)]
+        return cls(*columns)
+
+    def __len__(self):
+        return len(self.ra)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, numpy.integer)):
+
+            def to_python(value):
+                return None if numpy.isnan(value) else float(value)
+
+            return Coordinates(float(self.ra[key]), float(self.dec[key]),
+                               to_python(self.pm_ra[key]),
+                               to_python(self.pm_dec[key]))
+
+        return self.__class__(self.ra[key], self.dec[key],
+                              self.pm_ra[key], self.pm_dec[key])
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def get_exact_coordinates(self, year, epoch = 2000):
+        """ Determine exact positions by applying proper motion correction.
+
+        The vectorized version of Coordinates.get_exact_coordinates(): return
+        a new CoordinatesArray with the positions of all the objects at the
+        given date, and a proper motion of zero. No correction is applied to
+        the objects whose proper motion is unknown (NaN).
+
+        """
+
+        elapsed = year - epoch
+        ra  = self.ra  + numpy.nan_to_num(self.pm_ra)  * (elapsed / 3600)
+        dec = self.dec + numpy.nan_to_num(self.pm_dec) * (elapsed / 3600)
+        return self.__class__(ra, dec)
+
+
 class Star(collections.namedtuple('_Star', "img_coords, sky_coords, area, "
            "mag, saturated, snr, fwhm, elongation")):
     """ An immutable class with a source detected by SExtractor. """
@@ -160,8 +255,42 @@ class Star(collections.namedtuple('_Star', "img_coords, sky_coords, area, "
         return self.sky_coords.dec
 
 
-class Catalog(tuple):
-    """ High-level interface to a SExtractor catalog """
+class Catalog(collections.Sequence):
+    """ High-level interface to a SExtractor catalog.
+
+    The sources detected by SExtractor are stored in a NumPy structured array,
+    with one record per source and the fields listed in Catalog.DTYPE, so that
+    operations on all of them (e.g., selecting those not too close to the edges
+    of the image, or the unsaturated ones) are done with a single NumPy
+    operation. Indexing a Catalog with the name of a field returns the column
+    as a read-only NumPy array: catalog['snr'], for example, is the
+    signal-to-noise ratio of all the sources.
+
+    A Catalog is also an immutable sequence of Star objects: iterating over it,
+    or indexing it with an integer, builds the Star of each source, while
+    slices, integer arrays and boolean masks return a new Catalog with the
+    selected sources.
+
+    """
+
+    DTYPE = numpy.dtype([('x', numpy.float64),
+                         ('y', numpy.float64),
+                         ('alpha', numpy.float64),
+                         ('delta', numpy.float64),
+                         ('area', numpy.int64),
+                         ('mag', numpy.float64),
+                         ('saturated', numpy.bool_),
+                         ('snr', numpy.float64),
+                         ('fwhm', numpy.float64),
+                         ('elongation', numpy.float64)])
+
+    # The SExtractor parameters that must be present in the catalog
+    PARAMETERS = ('X_IMAGE', 'Y_IMAGE', 'ALPHA_SKY', 'DELTA_SKY',
+                  'ISOAREAF_IMAGE', 'MAG_AUTO', 'FLUX_ISO', 'FLUXERR_ISO',
+                  'FLUX_RADIUS', 'FLAGS', 'ELONGATION')
+
+    # The binary table with the sources in a FITS_LDAC catalog
+    LDAC_OBJECTS = 'LDAC_OBJECTS'
 
     @staticmethod
     def _find_column(contents, parameter):
@@ -237,39 +366,109 @@ class Catalog(tuple):
         and perhaps FLAGS = 8+16+32 = 56. [End of quote]
 
         A flag is saturated, therefore, if 4 was one of the values that were
-        added to calculate it. In order to test this, the flag is represented
-        as a binary string and we check whether the third bit (2**(3-1) == 4)
-        from the left equals one.
+        added to calculate it, which means that its third least significant
+        bit (2**(3-1) == 4) is set.
 
         Since the value of the flag is determined by the first eight powers of
         two, its minimum valid value is zero and the maximum (2**8)-1 = 255.
         The ValueError exception is raised if the decimal value of the flag
         is outside of this range.
 
+        'flag_value' may also be a NumPy array with the flags of many objects,
+        in which case a boolean array is returned, and ValueError raised if any
+        of the flags is out of range.
+
         """
 
-        if not 0 <= flag_value <= 255:
+        flags = numpy.asarray(flag_value, dtype = numpy.int64)
+        if ((flags < 0) | (flags > 255)).any():
             msg = "flag value out of range [0, 255]"
             raise ValueError(msg)
 
-        # Convert from, for example, '0b1' to '1', and then fill in with as
-        # many zeros are needed to represent the flag as an eight-bit binary
-        # number ('00000001'), so that we can always check the value of the
-        # third least significant bit.
-        return int(bin(flag_value)[2:].zfill(8)[-3]) == 1
+        saturated = (flags & 4) != 0
+        if not saturated.ndim:
+            return bool(saturated)
+        return saturated
+
+    @classmethod
+    def _read_ascii(cls, path):
+        """ Return the parameters of a SExtractor ASCII_HEAD catalog.
+
+        Return a dictionary that maps each of the Catalog.PARAMETERS to a NumPy
+        array with its value for all the objects in the catalog. The catalog
+        must have been saved in the SExtractor ASCII_HEAD format, as the comment
+        lines listing column labels are needed in order to detect in which
+        column each parameter is; ValueError is raised otherwise.
+
+        """
+
+        header = []
+        lines = []
+        with open(path, 'rt') as fd:
+            for line in fd:
+                if line.startswith('#'):
+                    header.append(line.split())
+                elif line.strip():
+                    lines.append(line)
+
+        indexes = [cls._find_column(header, name) for name in cls.PARAMETERS]
+
+        # Parse all the values at once, instead of line by line. The number of
+        # columns is that of the first row, as vector parameters (such as
+        # FLUX_APER(3)) take up several columns but only one comment line.
+        if lines:
+            ncolumns = len(lines[0].split())
+            values = numpy.array(''.join(lines).split(), dtype = numpy.float64)
+            if len(values) != len(lines) * ncolumns:
+                msg = "%s: rows with a different number of columns" % path
+                raise ValueError(msg)
+            table = values.reshape(len(lines), ncolumns)
+        else:
+            table = numpy.empty((0, max(indexes) + 1))
+
+        return dict((name, table[:, index])
+                    for name, index in zip(cls.PARAMETERS, indexes))
+
+    @classmethod
+    def _read_ldac(cls, path):
+        """ Return the parameters of a SExtractor FITS_LDAC catalog.
+
+        The binary counterpart of Catalog._read_ascii(). The LDAC_OBJECTS table
+        is memory-mapped, so the columns are read without having to parse them.
+        ValueError is raised if the table or any of the parameters is missing.
+
+        """
+
+        with pyfits.open(path, memmap = True) as handler:
+            try:
+                table = handler[cls.LDAC_OBJECTS].data
+            except KeyError:
+                msg = "%s: table '%s' not found" % (path, cls.LDAC_OBJECTS)
+                raise ValueError(msg)
+
+            names = set(name.upper() for name in table.columns.names)
+            columns = {}
+            for name in cls.PARAMETERS:
+                if name not in names:
+                    msg = "parameter '%s' not found" % name
+                    raise ValueError(msg)
+                # Copy to native byte order, before the file is closed
+                columns[name] = numpy.array(table.field(name),
+                                            dtype = numpy.float64)
+        return columns
 
     @classmethod
     def _load_stars(cls, path):
         """ Load a SExtractor catalog into memory.
 
-        The method parses a SExtractor catalog and returns a generator of Star
-        objects, once for each detected object. It is mandatory, or ValueError
-        will be raised otherwise, that the following parameters are present in
-        the catalog: X_IMAGE, Y_IMAGE, ALPHA_SKY, DELTA_SKY, ISOAREAF_IMAGE,
-        MAG_AUTO, FLUX_ISO, FLUXERR_ISO, FLUX_RADIUS and ELONGATION. Also, the
-        catalog must have been saved in the SExtractor ASCII_HEAD format, as
-        the comment lines listing column labels are needed in order to detect
-        in which column each parameter is.
+        The method parses a SExtractor catalog and returns a NumPy structured
+        array, of type Catalog.DTYPE, with one record per detected object. The
+        catalog may have been saved in the SExtractor ASCII_HEAD or FITS_LDAC
+        format, which is detected from the first bytes of the file. It is
+        mandatory, or ValueError will be raised otherwise, that the following
+        parameters are present in the catalog: X_IMAGE, Y_IMAGE, ALPHA_SKY,
+        DELTA_SKY, ISOAREAF_IMAGE, MAG_AUTO, FLUX_ISO, FLUXERR_ISO, FLAGS,
+        FLUX_RADIUS and ELONGATION.
 
         The FWHM is derived from the FLUX_RADIUS parameter, which estimates the
         radius of the circle centered on the barycenter that encloses about
@@ -284,54 +483,45 @@ class Catalog(tuple):
 
         """
 
-        with open(path, 'rt') as fd:
-            contents = [line.split() for line in fd]
-
-        get_index = functools.partial(cls._find_column, contents)
-        x_index = get_index('X_IMAGE')
-        y_index = get_index('Y_IMAGE')
-        alpha_index = get_index('ALPHA_SKY')
-        delta_index = get_index('DELTA_SKY')
-        area_index = get_index('ISOAREAF_IMAGE')
-        mag_index = get_index('MAG_AUTO')
-        flux_index = get_index('FLUX_ISO')
-        fluxerr_index = get_index('FLUXERR_ISO')
-        flux_radius_index = get_index('FLUX_RADIUS')
-        flags_index = get_index('FLAGS')
-        elong_index = get_index('ELONGATION')
+        with open(path, 'rb') as fd:
+            is_fits = fd.read(len(FITS_MAGIC)) == FITS_MAGIC
 
-        for line in contents:
-            if line[0][0] != '#': # ignore comments
-
-                def get_param(index, type_ = float):
-                    """ Get the index-th element of 'line', cast to 'type_'"""
-                    return type_(line[index])
-
-                x = get_param(x_index)
-                y = get_param(y_index)
-                alpha = get_param(alpha_index)
-                delta = get_param(delta_index)
-                area = get_param(area_index, type_ = int)
-                mag = get_param(mag_index)
-                flux = get_param(flux_index)
-                fluxerr = get_param(fluxerr_index)
-                flux_radius = get_param(flux_radius_index)
-                flags = get_param(flags_index, type_ = int)
-                elongation = get_param(elong_index)
-
-                saturated = Catalog.flag_saturated(flags)
-                snr = flux / fluxerr
-                fwhm = flux_radius * 2
-
-                args = (x, y, alpha, delta, area, mag, saturated, snr,
-                        fwhm, elongation)
-
-                yield Star(*args)
-
-    def __new__(cls, path):
-        stars = cls._load_stars(path)
-        catalog = super(Catalog, cls).__new__(cls, stars)
-        catalog._path = path
+        if is_fits:
+            columns = cls._read_ldac(path)
+        else:
+            columns = cls._read_ascii(path)
+
+        stars = numpy.empty(len(columns['X_IMAGE']), dtype = cls.DTYPE)
+        stars['x'] = columns['X_IMAGE']
+        stars['y'] = columns['Y_IMAGE']
+        stars['alpha'] = columns['ALPHA_SKY']
+        stars['delta'] = columns['DELTA_SKY']
+        stars['area'] = columns['ISOAREAF_IMAGE']
+        stars['mag'] = columns['MAG_AUTO']
+        stars['saturated'] = cls.flag_saturated(columns['FLAGS'])
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            stars['snr'] = columns['FLUX_ISO'] / columns['FLUXERR_ISO']
+        stars['fwhm'] = columns['FLUX_RADIUS'] * 2
+        stars['elongation'] = columns['ELONGATION']
+        return stars
+
+    def __init__(self, path):
+        self._path = path
+        self._stars = self._load_stars(path)
+        self._stars.flags.writeable = False
+
+    @classmethod
+    def from_array(cls, stars):
+        """ Create a Catalog from a NumPy structured array.
+
+        'stars' must have the dtype Catalog.DTYPE. As with from_sequence(), the
+        returned instance does not have the 'path' attribute.
+
+        """
+
+        catalog = cls.__new__(cls)
+        catalog._stars = stars
+        catalog._stars.flags.writeable = False
         return catalog
 
     @property
@@ -339,6 +529,33 @@ class Catalog(tuple):
         """ Read-only 'path' attribute """
         return self._path
 
+    @property
+    def stars(self):
+        """ The read-only NumPy structured array with the sources. """
+        return self._stars
+
+    def __len__(self):
+        return len(self._stars)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self._stars[key]
+        if isinstance(key, (int, long, numpy.integer)):
+            return Star(*self._stars[key].item())
+        return self.from_array(self._stars[key])
+
+    def __iter__(self):
+        for record in self._stars.tolist():
+            yield Star(*record)
+
+    def __eq__(self, other):
+        if not isinstance(other, Catalog) or len(self) != len(other):
+            return False
+        return bool((self._stars == other._stars).all())
+
+    def __ne__(self, other):
+        return not self == other
+
     @classmethod
     def from_sequence(cls, *stars):
         """ Create a Catalog from a sequence of Stars.
@@ -351,17 +568,60 @@ class Catalog(tuple):
 
         """
 
-        return super(Catalog, cls).__new__(cls, stars)
+        records = [(star.x, star.y, star.alpha, star.delta, star.area,
+                    star.mag, star.saturated, star.snr, star.fwhm,
+                    star.elongation) for star in stars]
+        return cls.from_array(numpy.array(records, dtype = cls.DTYPE))
 
     def get_sky_coordinates(self):
-         """ Return a list with the celestial coordinates of the stars.
+         """ Return the celestial coordinates of the stars.
 
          Return the right ascension and declination of each astronomical source
-         in the SExtractor catalog, as a list of Coordinates objects.
+         in the SExtractor catalog, as a CoordinatesArray.
 
          """
-         return [star.sky_coords for star in self]
+         return CoordinatesArray(self['alpha'], self['delta'])
+
+
+# The MD5 hash objects of the SExtractor configuration files, keyed by their
+# path, size, modification time and mode, so that they are read only once.
+_config_md5s = {}
+
+def _config_md5():
+    """ Return the MD5 hash object of the SExtractor configuration files.
+
+    The files are read only the first time that this function is called, and
+    again only if any of them is modified (or replaced by another file, if the
+    module-level variables are changed). A copy of the hash object is returned,
+    so that it can be updated with the overriding command-line options.
+
+    """
 
+    sex_files = (SEXTRACTOR_CONFIG, SEXTRACTOR_PARAMS,
+                 SEXTRACTOR_FILTER, SEXTRACTOR_STARNNW)
+
+    try:
+        key = []
+        for path in sex_files:
+            stat = os.stat(path)
+            key.append((path, stat.st_size, stat.st_mtime, stat.st_mode))
+        key = tuple(key)
+    except OSError:
+        key = None # open() below raises IOError
+
+    try:
+        return _config_md5s[key].copy()
+    except KeyError:
+        pass
+
+    md5 = hashlib.md5()
+    for path in sex_files:
+        with open(path, 'rt') as fd:
+            for line in fd:
+                md5.update(line)
+
+    _config_md5s[key] = md5
+    return md5.copy()
 
 def sextractor_md5sum(options = None):
     """ Return the MD5 hash of the SExtractor configuration.
@@ -397,15 +657,7 @@ def sextractor_md5sum(options = None):
 
     """
 
-    sex_files = (SEXTRACTOR_CONFIG, SEXTRACTOR_PARAMS,
-                 SEXTRACTOR_FILTER, SEXTRACTOR_STARNNW)
-
-    md5 = hashlib.md5()
-    for path in sex_files:
-        with open(path, 'rt') as fd:
-            for line in fd:
-                md5.update(line)
-
+    md5 = _config_md5()
     if options:
         # CPython returns the elements of a dictionary in an arbitrary order,
         # so it is necessary to sort the items to guarantee that two different
@@ -428,10 +680,10 @@ def sextractor_version():
     as a tuple (major, minor, micro), such as (2, 8, 6). SExtractorNotInstalled
     is raised if its executable cannot be found in the current environment.
 
-    """
+    The version is only determined once per process, as SExtractor is run
+    just the first time that this function is called.
 
-    # For example: "SExtractor version 2.8.6 (2009-04-09)"
-    PATTERN = "^SExtractor version (\d\.\d{1,2}\.\d{1,2}) \(\d{4}-\d{2}-\d{2}\)$"
+    """
 
     for executable in SEXTRACTOR_COMMANDS:
         if methods.which(executable):
@@ -440,6 +692,20 @@ def sextractor_version():
         msg = "SExtractor not found in the current environment"
         raise SExtractorNotInstalled(msg)
 
+    return _sextractor_version(executable)
+
+@methods.memoize
+def _sextractor_version(executable):
+    """ Run 'executable --version' and return the SExtractor version.
+
+    Memoized, so that the executable is only run once per process; see
+    sextractor_version(), which is the function that should be used.
+
+    """
+
+    # For example: "SExtractor version 2.8.6 (2009-04-09)"
+    PATTERN = "^SExtractor version (\d\.\d{1,2}\.\d{1,2}) \(\d{4}-\d{2}-\d{2}\)$"
+
     try:
         with tempfile.TemporaryFile() as fd:
             args = [executable, '--version']
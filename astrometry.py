@@ -21,11 +21,13 @@
 
 from __future__ import division
 
+import collections
 import logging
 import multiprocessing
 import optparse
 import os
 import os.path
+import pyfits
 import shutil
 import sys
 import tempfile
@@ -42,11 +44,16 @@ else:
     import subprocess
 
 # LEMON modules
+import astrometrycache
+import crossmatch
 import customparser
 import defaults
 import fitsimage
 import keywords
 import methods
+import offsets
+import prefetch
+import registration
 import style
 
 description = """
@@ -66,6 +73,176 @@ ASTROMETRY_COMMAND = 'solve-field'
 # See http://stackoverflow.com/a/3217427/184363
 queue = methods.Queue()
 
+# The astrometrycache.AstrometryCache where the solutions are looked up before
+# running Astrometry.net, and stored afterwards. Disabled by default; main()
+# enables it with set_solution_cache() (see --astrometry-cache).
+_solution_cache = None
+
+def set_solution_cache(directory, max_size):
+    """ Cache the astrometric solutions in 'directory', up to 'max_size' bytes.
+
+    Return the astrometrycache.AstrometryCache used from now on. If 'directory'
+    is None or an empty string, the cache is disabled and None is returned.
+    This must be done before the pool of workers is created, so that they
+    inherit the cache and its hits and misses are counted.
+
+    """
+
+    global _solution_cache
+    if directory:
+        _solution_cache = astrometrycache.AstrometryCache(directory, max_size)
+    else:
+        _solution_cache = None
+    return _solution_cache
+
+def solution_settings(ra, dec, radius, solve_field_options):
+    """ Return the settings with which Astrometry.net solves an image.
+
+    Return a string that identifies the arguments, other than the image and
+    the time limit, with which astrometry_net() is called: the coordinates
+    'ra' and 'dec' (None if the image is solved blindly), the radius of the
+    search and the dictionary of additional options for solve-field.
+
+    """
+
+    solve_field_options = sorted(solve_field_options.items())
+    args = ra, dec, radius, solve_field_options
+    return "ra=%r;dec=%r;radius=%r;options=%r" % args
+
+# The options of solve-field that set the bounds of the pixel scale
+SCALE_OPTIONS = ('--scale-units', '--scale-low', '--scale-high')
+
+# The relative margin, on each side, of the pixel scale given as a hint
+SCALE_TOLERANCE = 0.1
+
+# The field of view of a solved image: the right ascension and declination of
+# its center and the radius (the angular distance from the center to the
+# farthest corner), in decimal degrees, and the pixel scale, in arcseconds.
+Field = collections.namedtuple('Field', 'ra dec radius scale')
+
+# What is known in advance about the solution of an image, taken from the
+# images already solved: the coordinates of its center, the radius of the
+# search and the pixel scale, plus the time limit of the attempt.
+Hints = collections.namedtuple('Hints', 'ra dec radius scale timeout')
+
+def solved_field(path):
+    """ Return the Field of view of an astrometrically solved FITS image.
+
+    Raises fitsimage.NoWCSInformationError if the header of the image does not
+    contain an astrometric solution.
+
+    """
+
+    img = fitsimage.FITSImage(path)
+    ra, dec = img.center_wcs()
+    xmax, ymax = img.x_size + 0.5, img.y_size + 0.5
+    corners = img.pix2world([0.5, xmax, 0.5, xmax], [0.5, 0.5, ymax, ymax])
+    radius = crossmatch.angular_distance(ra, dec, *corners).max()
+
+    # The mean size, along both axes, of the pixel at the center
+    x, y = img.center
+    ras, decs = img.pix2world([x, x + 1, x], [y, y, y + 1])
+    sizes = crossmatch.angular_distance(ras[0], decs[0], ras[1:], decs[1:])
+    return Field(ra, dec, float(radius), float(sizes.mean() * 3600))
+
+def header_coordinates(path, options):
+    """ Return the coordinates of the field center read from the FITS header.
+
+    Return a two-element tuple with the right ascension and declination, in
+    decimal degrees, read from the options.rak and options.deck keywords, or
+    None if they cannot be read or the images are solved with --blind.
+
+    """
+
+    if options.blind:
+        return None
+    try:
+        img = fitsimage.FITSImage(path)
+        return img.ra(options.rak), img.dec(options.deck)
+    except (ValueError, KeyError):
+        return None
+
+def seed_order(paths, options):
+    """ Sort the FITS images, putting first those most likely to be solved.
+
+    These are the images whose approximate coordinates can be read from the
+    FITS header (see header_coordinates()), as Astrometry.net then only needs
+    to search the indexes around them. The relative order of the images is
+    otherwise preserved.
+
+    """
+
+    known = [header_coordinates(path, options) is not None for path in paths]
+    order = sorted(xrange(len(paths)), key = lambda index: not known[index])
+    return [paths[index] for index in order]
+
+def neighbour_hints(paths, fields, options):
+    """ Return the Hints of each image, taken from its solved neighbours.
+
+    'paths' is the list of FITS images in the order in which they were
+    observed (or given as input), and 'fields' a dictionary that maps the
+    images already solved to their Field of view. For each unsolved image,
+    the nearest solved image in 'paths' is found, and its center, pixel scale
+    and, as search radius, twice the radius of its field (so that all the
+    overlapping fields are searched), are used as the hints. If the
+    coordinates read from the header of the image are more than options.radius
+    degrees away from the center of the neighbour, the image is of another
+    field, so those coordinates and options.radius are used instead. The time
+    limit is options.hint_timeout, but never more than options.timeout.
+    Returns a dictionary that maps each
+    unsolved image to its Hints, if there is any solved image at all.
+
+    """
+
+    solved = [index for index, path in enumerate(paths) if path in fields]
+    hints = {}
+    if not solved:
+        return hints
+
+    for index, path in enumerate(paths):
+        if path in fields:
+            continue
+        nearest = min(solved, key = lambda other: abs(other - index))
+        field = fields[paths[nearest]]
+        ra, dec, radius = field.ra, field.dec, 2 * field.radius
+
+        coordinates = header_coordinates(path, options)
+        if coordinates is not None:
+            distance = crossmatch.angular_distance(field.ra, field.dec,
+                                                   *coordinates)
+            if distance > options.radius:
+                ra, dec = coordinates
+                radius = options.radius
+
+        timeout = min(options.hint_timeout, options.timeout)
+        args = ra, dec, radius, field.scale, timeout
+        hints[path] = Hints(*args)
+    return hints
+
+def apply_solution(img, dest_path, cards):
+    """ Copy a FITS image, adding to its header an astrometric solution.
+
+    Copy 'img', a fitsimage.FITSImage, to 'dest_path' (decompressing it, if
+    needed), replacing any file already there, and write to its header the
+    cards of the astrometric solution stored in the cache: a sequence of
+    three-element tuples, with the keyword, value and comment of each card.
+
+    """
+
+    if os.path.exists(dest_path):
+        os.unlink(dest_path)
+
+    if img.compression:
+        img.decompress(dest_path)
+    else:
+        methods.link_or_copy(img.path, dest_path)
+        methods.owner_writable(dest_path, True) # chmod u+w
+
+    output_img = fitsimage.FITSImage(dest_path)
+    with output_img.header_edit() as header:
+        for keyword, value, comment in cards:
+            header.update(keyword, value, comment = comment)
+
 class AstrometryNetNotInstalled(StandardError):
     """ Raised if Astrometry.net is not installed on the system """
     pass
@@ -255,42 +432,47 @@ def astrometry_net(path, ra = None, dec = None, radius = 1,
         null_fd.close()
         methods.clean_tmp_files(output_dir)
 
-@methods.print_exception_traceback
-def parallel_astrometry(args):
-    """ Function argument of map_async() to do astrometry in parallel.
-
-    This will be the first argument passed to multiprocessing.Pool.map_async(),
-    which chops the iterable into a number of chunks that are submitted to the
-    process pool as separate tasks. 'args' must be a three-element tuple with
-    (1) a string with the path to the FITS image, (2) a string with the path to
-    the output directory and (3) 'options', the optparse.Values object returned
-    by optparse.OptionParser.parse_args().
-
-    This function does astrometry on each FITS image with the astrometry_net()
-    function. The output FITS files, containing the WCS headers calculated by
-    Astrometry.net, are written to the output directory with the same basename
-    as the original files but with the string options.suffix appended before
-    the file extension.
+def solve(img, dest_path, options, hints = None):
+    """ Find the astrometric solution of a FITS image with Astrometry.net.
 
-    The path to each solved image is put, as a string, into the module-level
-    'queue' object, a process shared queue. If the image cannot be solved, None
-    is put instead. Note that the contents of the shared queue are necessary so
-    that the progress bar can be updated to reflect the number of input images
-    that have been processed so far. Apart from that, you most probably do not
-    need to do anything with these paths, as the output files are written to
-    the output directory by astrometry_net().
+    Solve 'img', a fitsimage.FITSImage, with astrometry_net(), unless the
+    solution is already in the cache, and write the solved image to
+    'dest_path'. 'options' is the optparse.Values object returned by
+    optparse.OptionParser.parse_args(). If 'hints', a Hints namedtuple, is
+    given, its coordinates, search radius, pixel scale and time limit are used
+    instead of those of 'options'. Return a two-element tuple: (1) the cards
+    of the WCS header (see astrometrycache.header_cards()) and (2) whether
+    they were found in the cache. If the image cannot be solved, a warning is
+    issued (unless 'hints' was given, as the image is then tried again without
+    them) and None is returned.
 
     """
 
-    path, output_dir, options = args
-
-    img = fitsimage.FITSImage(path)
-    # Add the suffix to the basename of the FITS image
-    root, ext = os.path.splitext(os.path.basename(path))
-    output_filename = root + options.suffix + ext
-    dest_path = os.path.join(output_dir, output_filename)
-
-    if options.blind:
+    path = img.path
+    radius = options.radius
+    timeout = options.timeout
+    solve_field_options = options.solve_field_options
+
+    if hints is not None:
+        ra, dec = hints.ra, hints.dec
+        radius = hints.radius
+        # The hints never allow more time than the user did (--timeout)
+        timeout = min(hints.timeout, options.timeout)
+        msg = "%s: using α = %s, δ = %s, radius = %s (hints)"
+        logging.debug(msg % (path, ra, dec, radius))
+
+        # Unless the pixel scale was given with -o, by the user
+        if hints.scale and not set(SCALE_OPTIONS) & set(solve_field_options):
+            solve_field_options = dict(solve_field_options)
+            low = hints.scale * (1 - SCALE_TOLERANCE)
+            high = hints.scale * (1 + SCALE_TOLERANCE)
+            solve_field_options['--scale-units'] = 'arcsecperpix'
+            solve_field_options['--scale-low'] = '%f' % low
+            solve_field_options['--scale-high'] = '%f' % high
+            msg = "%s: pixel scale between %f and %f arcsec (hints)"
+            logging.debug(msg % (path, low, high))
+
+    elif options.blind:
         msg = "%s: solving the image blindly (--blind option)"
         logging.debug(msg % img.path)
         ra = dec = None
@@ -313,27 +495,79 @@ def parallel_astrometry(args):
 
     kwargs = dict(ra = ra,
                   dec = dec,
-                  radius = options.radius,
+                  radius = radius,
                   verbosity = options.verbose,
-                  timeout = options.timeout,
-                  options = options.solve_field_options)
+                  timeout = timeout,
+                  options = solve_field_options)
+
+    # Look up the image in the cache of astrometric solutions: 'cards' is a
+    # list of the cards of the WCS header, or None if the image did not solve
+    # the last time that it was tried, with the same options.
+    cache_key = None
+    cached = False
+    if _solution_cache is not None:
+        args = ra, dec, radius, solve_field_options
+        settings = solution_settings(*args)
+        cache_key = _solution_cache.key(img.data_sha1sum, settings)
+        try:
+            args = cache_key, timeout
+            cards = _solution_cache.get_solution(*args)
+            cached = True
+            logging.debug("%s: astrometric solution found in cache" % path)
+        except KeyError:
+            logging.debug("%s: astrometric solution not in cache" % path)
+
+    def store(method, *args):
+        """ Store the result in the cache, ignoring any error. """
+        if cache_key is None:
+            return
+        try:
+            getattr(_solution_cache, method)(cache_key, *args)
+        except (IOError, OSError), e:
+            msg = "%s: cannot store astrometric solution in cache (%s)"
+            logging.debug(msg % (path, str(e)))
+
+    def unsolved(msg):
+        """ Warn that the image did not solve, unless it will be retried. """
+        if hints is None:
+            warnings.warn(msg + " Ignored.", RuntimeWarning)
+        else:
+            logging.info(msg + " Retrying without hints.")
+
+    if cached and cards is None:
+        unsolved("%s did not solve (cached, see --astrometry-cache)." % path)
+        return None
+
+    elif cached:
+        apply_solution(img, dest_path, cards)
+        msg = "%s: cached solution written to %s" % (path, dest_path)
+        logging.debug(msg)
+        return cards, cached
 
     try:
-        output_path = astrometry_net(img.path, **kwargs)
+        # Solve the local copy of the image, if it has been prefetched,
+        # and decompressed (Astrometry.net cannot read compressed images)
+        with prefetch.acquire(img.path) as local_path, \
+             fitsimage.FITSImage(local_path).plain_copy() as local_path:
+            output_path = astrometry_net(local_path, **kwargs)
+            input_header = pyfits.getheader(local_path)
 
     except AstrometryNetUnsolvedField, e:
 
         # A subclass of AstrometryNetUnsolvedField
         if isinstance(e, AstrometryNetTimeoutExpired):
-            msg = "%s exceeded the timeout limit. Ignored."
+            msg = "%s exceeded the timeout limit."
+            store('add_unsolved', timeout)
         else:
-            msg = "%s did not solve. Ignored."
+            msg = "%s did not solve."
+            store('add_unsolved')
+
+        unsolved(msg % img.path)
+        return None
 
-        msg %= img.path
-        warnings.warn(msg, RuntimeWarning)
-        queue.put(None)
-        logging.debug("%s: None put into global queue" % path)
-        return
+    output_header = pyfits.getheader(output_path)
+    cards = astrometrycache.header_cards(input_header, output_header)
+    store('add_solution', cards)
 
     try:
         shutil.move(output_path, dest_path)
@@ -342,22 +576,163 @@ def parallel_astrometry(args):
         logging.debug("%s: can't solve image (%s)" % (path, str(e)))
         methods.clean_tmp_files(output_path)
 
+    return cards, cached
+
+
+class WCSReference(offsets.ReferenceImage):
+    """ A solved FITS image, whose WCS is propagated to the other images.
+
+    The ReferenceImage (see offsets.py) against which the other images are
+    registered, together with 'cards', the cards of its astrometric solution
+    (see astrometrycache.header_cards()), which are moved and rotated to
+    those of each image instead of solving it with Astrometry.net.
+
+    """
+
+    def __init__(self, path, cards, maximum, coaddk = keywords.coaddk):
+        super(WCSReference, self).__init__(path, maximum, coaddk = coaddk)
+        self.cards = list(cards)
+
+    def propagate(self, img, options):
+        """ Return the cards of the WCS of a FITS image.
+
+        Register 'img', a fitsimage.FITSImage, against the reference, and
+        transform the WCS of the reference accordingly (see
+        registration.transform_wcs()). 'options' is the optparse.Values object
+        returned by optparse.OptionParser.parse_args(). Raises ValueError if
+        fewer than options.min_matches stars can be matched, or if the root
+        mean square of the residuals of the fit is larger than options.max_rms
+        pixels, as then the image must be solved by Astrometry.net instead.
+
+        """
+
+        args = img, options.maximum, options.match_radius
+        kwargs = dict(rotation = True, coaddk = options.coaddk)
+        dx, dy, angle, peak, nmatches, rms = self.register(*args, **kwargs)
+
+        msg = "%s: %d stars matched (rms = %.3f pixels)"
+        logging.debug(msg % (img.path, nmatches, rms))
+        msg = "%s: offsets = (%.3f, %.3f) pixels, rotation = %.4f degrees"
+        logging.debug(msg % (img.path, dx, dy, angle))
+
+        if nmatches < options.min_matches:
+            msg = "only %d stars matched, fewer than %d"
+            raise ValueError(msg % (nmatches, options.min_matches))
+        if rms > options.max_rms:
+            msg = "rms of the fit = %.3f pixels, larger than %.3f"
+            raise ValueError(msg % (rms, options.max_rms))
+
+        wcs = dict((keyword, value) for keyword, value, _ in self.cards)
+        try:
+            wcs = registration.transform_wcs(wcs, self.pivot, dx, dy, angle)
+        except KeyError, e:
+            raise ValueError("keyword %s not in the WCS header" % e)
+        return [(keyword, wcs.get(keyword, value), comment)
+                for keyword, value, comment in self.cards]
+
+
+# The WCSReference whose astrometric solution is propagated to the rest of the
+# images (see --propagate). It is set by main() before the pool of workers is
+# created, so that they inherit it; if None, all the images are solved.
+wcs_reference = None
+
+def astrometry(path, output_dir, options, hints = None):
+    """ Do astrometry on a FITS image, writing the result to 'output_dir'.
+
+    The output image has the same basename as the input one, but with the
+    string options.suffix appended before the file extension. Its WCS header
+    is propagated from 'wcs_reference', if set and the image can be registered
+    against it, and otherwise computed by Astrometry.net (see solve(), to
+    which 'hints' is passed). Return a two-element tuple with the path to the
+    output image and the cards of its astrometric solution, or None if the
+    image could not be solved.
+
+    """
+
+    img = fitsimage.FITSImage(path)
+    # Add the suffix to the basename of the FITS image. The image written by
+    # Astrometry.net is never compressed, even if the input image was.
+    root, ext = fitsimage.splitext(os.path.basename(path))
+    output_filename = root + options.suffix + ext
+    dest_path = os.path.join(output_dir, output_filename)
+
+    cards = None
+    if wcs_reference is not None:
+        try:
+            cards = wcs_reference.propagate(img, options)
+            apply_solution(img, dest_path, cards)
+            msg = "%s: WCS propagated from %s"
+            logging.debug(msg % (path, wcs_reference.path))
+            msg2 = "[Astrometry] WCS propagated from %s" % wcs_reference.path
+        except ValueError, e:
+            msg = "%s: cannot propagate WCS (%s), using Astrometry.net"
+            logging.info(msg % (path, str(e)))
+
+    if cards is None:
+        result = solve(img, dest_path, options, hints = hints)
+        if result is None:
+            return None
+        cards, cached = result
+        msg2 = "[Astrometry] WCS solution found by Astrometry.net"
+        if cached:
+            msg2 += " (cached)"
+
     output_img = fitsimage.FITSImage(dest_path)
 
     debug_args = path, output_img.path
     logging.debug("%s: updating header of output image (%s)" % debug_args)
     msg1 = "Astrometry done via LEMON on %s" % methods.utctime()
-    msg2 = "[Astrometry] WCS solution found by Astrometry.net"
     msg3 = "[Astrometry] Original image: %s" % img.path
 
-    output_img.add_history(msg1)
-    output_img.add_history(msg2)
-    output_img.add_history(msg3)
+    with output_img.header_edit() as header:
+        header.add_history(msg1)
+        header.add_history(msg2)
+        header.add_history(msg3)
     logging.debug("%s: header of output image (%s) updated" % debug_args)
+    return output_img.path, cards
+
+@methods.print_exception_traceback
+def parallel_astrometry(args):
+    """ Function argument of map_async() to do astrometry in parallel.
+
+    This will be the first argument passed to multiprocessing.Pool.map_async(),
+    which chops the iterable into a number of chunks that are submitted to the
+    process pool as separate tasks. 'args' must be a four-element tuple with
+    (1) a string with the path to the FITS image, (2) a string with the path to
+    the output directory, (3) 'options', the optparse.Values object returned
+    by optparse.OptionParser.parse_args() and (4) the Hints with which the
+    image is solved, or None.
+
+    This function does astrometry on each FITS image with the astrometry()
+    function. The output FITS files, containing the WCS headers calculated by
+    Astrometry.net (or propagated from the reference image), are written to
+    the output directory with the same basename as the original files but with
+    the string options.suffix appended before the file extension.
+
+    The path to each solved image is put, as a string, into the module-level
+    'queue' object, a process shared queue. If the image cannot be solved, None
+    is put instead -- unless it was tried with hints, as it is then retried
+    without them. Note that the contents of the shared queue are necessary so
+    that the progress bar can be updated to reflect the number of input images
+    that have been processed so far. The path to the solved image (or None) is
+    also returned, so that the Field of view of each solved image can be used
+    as hints for the rest.
+
+    """
 
-    queue.put(output_img.path)
+    path, hints = args[0], args[3]
+    result = astrometry(*args)
+    if result is None:
+        if hints is None:
+            queue.put(None)
+            logging.debug("%s: None put into global queue" % path)
+        return None
+
+    output_path = result[0]
+    queue.put(output_path)
     msg = "{0}: astrometry result ({1!r}) put into global queue"
-    logging.debug(msg.format(*debug_args))
+    logging.debug(msg.format(path, output_path))
+    return output_path
 
 
 parser = customparser.get_parser(description)
@@ -390,6 +765,24 @@ parser.add_option('--timeout', action = 'store', type = 'int',
                   "spent on an image: this option can reduce this value but "
                   "not increase it. [default: %default]")
 
+parser.add_option('--schedule', action = 'store_true', dest = 'schedule',
+                  help = "solve first as many images as cores, those whose "
+                  "coordinates can be read from the FITS header, and then the "
+                  "rest using as hints the center, field of view and pixel "
+                  "scale of the nearest (in the order in which they were "
+                  "given) solved image. This restricts the search to a much "
+                  "smaller region and range of scales, so most images are "
+                  "solved much faster. Those that are not solved in "
+                  "--hint-timeout seconds are tried again at the end, "
+                  "without the hints, so that no solution is lost")
+
+parser.add_option('--hint-timeout', action = 'store', type = 'int',
+                  dest = 'hint_timeout', default = 60,
+                  help = "the maximum number of seconds that may be spent "
+                  "attempting to solve an image with the hints of --schedule, "
+                  "before it is deferred to be tried again without them. "
+                  "It is never longer than --timeout [default: %default]")
+
 parser.add_option('--suffix', action = 'store', type = 'str',
                   dest = 'suffix', default = 'a',
                   help = "string to be appended to output images, before "
@@ -399,6 +792,32 @@ parser.add_option('--cores', action = 'store', type = 'int',
                   dest = 'ncores', default = defaults.ncores,
                   help = defaults.desc['ncores'])
 
+parser.add_option('--header-index', action = 'store', type = 'str',
+                  dest = 'header_index', default = defaults.header_index,
+                  help = defaults.desc['header_index'])
+
+parser.add_option('--astrometry-cache', action = 'store', type = 'str',
+                  dest = 'astrometry_cache',
+                  default = defaults.astrometry_cache,
+                  help = defaults.desc['astrometry_cache'])
+
+parser.add_option('--astrometry-cache-size', action = 'store', type = 'int',
+                  dest = 'astrometry_cache_size',
+                  default = defaults.astrometry_cache_size,
+                  help = defaults.desc['astrometry_cache_size'])
+
+parser.add_option('--prefetch', action = 'store', type = 'int',
+                  dest = 'prefetch', default = defaults.prefetch,
+                  help = defaults.desc['prefetch'])
+
+parser.add_option('--scratch-dir', action = 'store', type = 'str',
+                  dest = 'scratch_dir', default = defaults.scratch_dir,
+                  help = defaults.desc['scratch_dir'])
+
+parser.add_option('--scratch-budget', action = 'store', type = 'int',
+                  dest = 'scratch_budget', default = defaults.scratch_budget,
+                  help = defaults.desc['scratch_budget'])
+
 parser.add_option('-o', action = 'callback', type = 'str',
                   dest = 'solve_field_options', default = {},
                   callback = customparser.additional_options_callback,
@@ -416,6 +835,52 @@ parser.add_option('-v', '--verbose', action = 'count',
                   "rest are passed down to Astrometry.net, causing it to be "
                   "increasingly chattier as more -v flags are given.")
 
+propagation_group = optparse.OptionGroup(parser, "WCS Propagation",
+              "Images of the same field, taken with the same "
+              "instrument, differ only by a translation and (maybe) a "
+              "small rotation, so it is not necessary to solve them "
+              "all with Astrometry.net. Instead, with --propagate, the "
+              "first input image that can be solved is used as the "
+              "reference: each of the other images is registered "
+              "against it, matching the stars detected in both, and "
+              "its WCS is computed by moving and rotating that of the "
+              "reference. Astrometry.net is used only for the images "
+              "whose stars cannot be matched well enough.")
+
+propagation_group.add_option('--propagate', action = 'store_true',
+                             dest = 'propagate',
+                             help = "propagate the astrometric solution of "
+                             "the first image that is solved to the rest of "
+                             "the images, instead of solving each of them")
+
+propagation_group.add_option('--min-matches', action = 'store', type = 'int',
+                             dest = 'min_matches', default = 10,
+                             help = "the minimum number of stars that must be "
+                             "matched between an image and the reference for "
+                             "the WCS to be propagated [default: %default]")
+
+propagation_group.add_option('--max-rms', action = 'store', type = 'float',
+                             dest = 'max_rms', default = 1.0,
+                             help = "the maximum root mean square, in pixels, "
+                             "of the distances between the matched stars, "
+                             "once the image is registered, for the WCS to be "
+                             "propagated [default: %default]")
+
+propagation_group.add_option('--match-radius', action = 'store',
+                             type = 'float', dest = 'match_radius',
+                             default = 10,
+                             help = "the maximum distance, in pixels, between "
+                             "two stars of the image and the reference, once "
+                             "the offsets found by the phase correlation are "
+                             "applied, for them to be matched "
+                             "[default: %default]")
+
+propagation_group.add_option('--maximum', action = 'store', type = 'int',
+                             dest = 'maximum', default = defaults.maximum,
+                             help = defaults.desc['maximum'])
+
+parser.add_option_group(propagation_group)
+
 key_group = optparse.OptionGroup(parser, "FITS Keywords",
                                  keywords.group_description)
 
@@ -427,6 +892,10 @@ key_group.add_option('--deck', action = 'store', type = 'str',
                      dest = 'deck', default = keywords.deck,
                      help = keywords.desc['deck'])
 
+key_group.add_option('--coaddk', action = 'store', type = 'str',
+                     dest = 'coaddk', default = keywords.coaddk,
+                     help = keywords.desc['coaddk'])
+
 parser.add_option_group(key_group)
 customparser.clear_metavars(parser)
 
@@ -460,6 +929,13 @@ def main(arguments = None):
         logging_level = logging.DEBUG
     logging.basicConfig(format = style.LOG_FORMAT, level = logging_level)
 
+    # Cache the headers of the FITS images in the persistent header index
+    fitsimage.set_header_index(options.header_index)
+
+    # ... and the astrometric solutions, so that images are not solved twice
+    max_size = options.astrometry_cache_size * 1024 ** 2
+    solution_cache = set_solution_cache(options.astrometry_cache, max_size)
+
     # Print the help and abort the execution if there are not two positional
     # arguments left after parsing the options, as the user must specify at
     # least one (only one?) input FITS file and the output directory
@@ -483,22 +959,123 @@ def main(arguments = None):
     msg = "%sDoing astrometry on the %d paths given as input."
     print msg % (style.prefix, len(input_paths))
 
+    # With --propagate, solve the input images, in the order in which they
+    # were given, until one of them is solved: its WCS is then propagated
+    # to the rest of the images. The images tried are put into the queue, as
+    # the workers do, so that they are counted in the progress bar.
+    global wcs_reference
+    wcs_reference = reference_output = None
+    pending_paths = list(input_paths)
+    if options.propagate:
+        print "%sSolving the reference image..." % style.prefix ,
+        sys.stdout.flush()
+        while pending_paths:
+            path = pending_paths.pop(0)
+            result = astrometry(path, output_dir, options)
+            if result is None:
+                queue.put(None)
+                continue
+            reference_output, cards = result
+            queue.put(reference_output)
+            wcs_reference = WCSReference(path, cards, options.maximum,
+                                         coaddk = options.coaddk)
+            break
+        print 'done.'
+
+        if wcs_reference is not None:
+            msg = "%sPropagating the WCS of %s to the other images."
+            print msg % (style.prefix, wcs_reference.path)
+            nsources = len(wcs_reference.sources[0])
+            msg = "%s: %d stars detected on the reference image"
+            logging.info(msg % (wcs_reference.path, nsources))
+        else:
+            msg = "%sNo image could be solved, nothing to propagate."
+            print msg % style.prefix
+
+    # With --schedule, the images most likely to be solved are solved first,
+    # one per core, so that their fields of view can be used as hints for
+    # the rest; those that do not solve with the hints are tried again, with
+    # the original options, at the end.
+    if options.schedule:
+        pending_paths = seed_order(pending_paths, options)
+
+    # Read the next images in advance while the workers solve the previous
+    # ones. The Prefetcher must be installed before the pool is created, so
+    # that the workers inherit it, and started afterwards.
+    budget = options.scratch_budget * 1024 ** 2
+    prefetcher = prefetch.Prefetcher(pending_paths, options.prefetch,
+                                     scratch_dir = options.scratch_dir,
+                                     budget = budget)
+    prefetch.set_prefetcher(prefetcher)
+
     pool = multiprocessing.Pool(options.ncores)
-    map_async_args = ((path, output_dir, options) for path in input_paths)
-    result = pool.map_async(parallel_astrometry, map_async_args)
-
-    while not result.ready():
-        time.sleep(1)
-        methods.show_progress(queue.qsize() / len(input_paths) * 100)
-        # Do not update the progress bar when debugging; instead, print it
-        # on a new line each time. This prevents the next logging message,
-        # if any, from being printed on the same line that the bar.
-        if logging_level < logging.WARNING:
-            print
-
-    result.get() # reraise exceptions of the remote call, if any
+    prefetcher.start()
+
+    def run(paths, hints):
+        """ Solve the images in parallel, updating the progress bar. """
+
+        map_async_args = ((path, output_dir, options, hints.get(path))
+                          for path in paths)
+        result = pool.map_async(parallel_astrometry, map_async_args)
+
+        while not result.ready():
+            time.sleep(1)
+            methods.show_progress(queue.qsize() / len(input_paths) * 100)
+            # Do not update the progress bar when debugging; instead, print
+            # it on a new line each time. This prevents the next logging
+            # message, if any, from being printed on the same line that the
+            # bar.
+            if logging_level < logging.WARNING:
+                print
+
+        return result.get() # reraise exceptions of the remote call, if any
+
+    try:
+        if not options.schedule:
+            run(pending_paths, {})
+
+        else:
+            seed_paths = pending_paths[:options.ncores]
+            other_paths = pending_paths[options.ncores:]
+            output_paths = run(seed_paths, {})
+
+            # The fields of view of the solved images, including the
+            # reference of --propagate, if any
+            fields = {}
+            solved = zip(seed_paths, output_paths)
+            if wcs_reference is not None:
+                solved.append((wcs_reference.path, reference_output))
+            for path, output_path in solved:
+                if output_path is None:
+                    continue
+                try:
+                    fields[path] = solved_field(output_path)
+                except fitsimage.NoWCSInformationError:
+                    pass
+
+            hints = neighbour_hints(input_paths, fields, options)
+            msg = "%s: hints: α = %s, δ = %s, radius = %.4f, scale = %.4f"
+            for path in other_paths:
+                if path in hints:
+                    logging.debug(msg % ((path,) + hints[path][:4]))
+
+            output_paths = run(other_paths, hints)
+            retry_paths = [path for path, output_path
+                           in zip(other_paths, output_paths)
+                           if output_path is None and path in hints]
+            if retry_paths:
+                logging.info("%d images did not solve with the hints, "
+                             "trying again without them" % len(retry_paths))
+                run(retry_paths, {})
+    finally:
+        prefetcher.stop()
+        prefetch.set_prefetcher(None)
+
     methods.show_progress(100) # in case the queue was ready too soon
     print
+    prefetcher.log_stats()
+    if solution_cache is not None:
+        solution_cache.log_stats()
 
     # Results in the process shared queue were only necessary to accurately
     # update the progress bar. They are no longer needed, so empty it now.
@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A persistent, content-addressed cache of astrometric solutions.
+
+Astrometry.net may need minutes to solve an image, or to give up on it, and
+the 'astrometry' command solves all the input images every time that it is
+run, even if it crashed halfway through or most of them were already solved.
+This module stores, for each image, the keywords that Astrometry.net added to
+its header (the WCS solution), in a JSON file under a key derived from the
+contents of the image (the SHA-1 hash of its pixels, so that they are found
+even if the image is copied, renamed or its header is modified) and from the
+options with which solve-field was run, as the solution depends on them.
+
+Images that cannot be solved are stored too, so that they are not tried again
+until the options change -- or, for those that exceeded the time limit, until
+a longer one is used. As with the SExtractor catalogs (see catalogcache.py),
+the total size of the cache is bounded, deleting the least recently used
+solutions when it is exceeded.
+
+"""
+
+from __future__ import division
+
+import hashlib
+import json
+import os
+import tempfile
+
+# LEMON modules
+import catalogcache
+import methods
+
+# The keywords of the header written by Astrometry.net that are not stored
+IGNORED_KEYWORDS = ('', 'COMMENT', 'HISTORY')
+
+# The types of the values of the cards that can be stored
+VALUE_TYPES = (bool, int, long, float, basestring)
+
+def header_cards(input_header, output_header):
+    """ Return the cards that were added to a header, or whose value changed.
+
+    Compare two FITS headers (pyfits.Header objects) and return a list of
+    three-element tuples, with the keyword, value and comment of each card of
+    'output_header' that is not in 'input_header', or whose value is not the
+    same. Commentary cards (COMMENT, HISTORY and blank keywords) are ignored,
+    and so are those with no value or a value that cannot be serialized.
+
+    """
+
+    cards = []
+    for card in output_header.cards:
+        keyword = card.keyword
+        if keyword in IGNORED_KEYWORDS:
+            continue
+        if not isinstance(card.value, VALUE_TYPES):
+            continue
+        if keyword in input_header and input_header[keyword] == card.value:
+            continue
+        cards.append((keyword, card.value, card.comment))
+    return cards
+
+def _str(value):
+    """ Return a unicode string, as loaded by JSON, as a str. """
+    return str(value) if isinstance(value, unicode) else value
+
+
+class AstrometryCache(catalogcache.CatalogCache):
+    """ A directory of astrometric solutions, with a maximum size in bytes. """
+
+    EXTENSION = '.json'
+    NAME = "Astrometry.net solution cache"
+
+    @staticmethod
+    def key(sha1sum, settings):
+        """ Return the key under which an astrometric solution is stored.
+
+        'sha1sum' is the SHA-1 hash of the pixels of the FITS image (see
+        FITSImage.data_sha1sum), and 'settings' a string that describes the
+        options with which Astrometry.net was run, such as the coordinates
+        and radius of the search and any additional option for solve-field.
+
+        """
+
+        return '%s_%s' % (sha1sum, hashlib.md5(settings).hexdigest())
+
+    def _store(self, key, record):
+        """ Serialize 'record' to a JSON file and store it under 'key'. """
+
+        fd, path = tempfile.mkstemp(suffix = self.EXTENSION)
+        try:
+            with os.fdopen(fd, 'wt') as json_fd:
+                json.dump(record, json_fd)
+            return self.add(key, path)
+        except (IOError, OSError):
+            methods.clean_tmp_files(path)
+            raise
+
+    def add_solution(self, key, cards):
+        """ Store the cards of a solution, as returned by header_cards(). """
+        return self._store(key, dict(solved = True, cards = list(cards)))
+
+    def add_unsolved(self, key, timeout = None):
+        """ Record that an image could not be solved.
+
+        'timeout' is the time limit, in seconds, that was exceeded, or None if
+        Astrometry.net gave up on the image before that. In the former case,
+        the image is tried again if a longer (or no) time limit is used.
+
+        """
+
+        return self._store(key, dict(solved = False, timeout = timeout))
+
+    def get_solution(self, key, timeout = None):
+        """ Return the cards of the astrometric solution stored under 'key'.
+
+        Return a list of three-element tuples, with the keyword, value and
+        comment of each card, or None if the image could not be solved. Raises
+        KeyError if there is nothing under 'key', or if the image exceeded
+        a time limit shorter than 'timeout' (None meaning no limit at all), as
+        it may be solved if given more time.
+
+        """
+
+        # Hits and misses are counted only once the record has been read: an
+        # image that may be solved if given more time is a miss, not a hit.
+        path = self._lookup(key)
+        try:
+            if path is None:
+                raise KeyError(key)
+            try:
+                with open(path, 'rt') as fd:
+                    record = json.load(fd)
+            except (IOError, ValueError):
+                raise KeyError(key)
+
+            if not record['solved']:
+                limit = record['timeout']
+                if limit is not None and (timeout is None or timeout > limit):
+                    raise KeyError(key)
+        except KeyError:
+            self._count(False)
+            raise
+
+        self._count(True)
+        if record['solved']:
+            return [tuple(_str(x) for x in card) for card in record['cards']]
+        return None
@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A persistent, content-addressed cache of SExtractor catalogs.
+
+Running SExtractor on an image takes seconds, and the same images are given to
+it over and over again: by seeing, by photometry and every time that any of
+these commands is run again. This module offers a directory where catalogs are
+stored under a key derived from the contents of the image (its SHA-1 hash),
+the SExtractor configuration (the MD5 hash returned by sextractor_md5sum()) and
+the saturation level, so that a catalog is found as long as the same image is
+given to SExtractor with the same configuration, even if it has been copied or
+renamed in between. The total size of the catalogs is bounded: when it is
+exceeded, the least recently used catalogs are deleted.
+
+The number of hits and misses is kept in shared memory, so that those of the
+workers of a multiprocessing pool are also counted: the CatalogCache must be
+created before the pool, whose workers inherit it.
+
+"""
+
+from __future__ import division
+
+import ctypes
+import logging
+import multiprocessing
+import os
+import os.path
+import shutil
+import tempfile
+
+# LEMON modules
+import methods
+
+class CatalogCache(object):
+    """ A directory of SExtractor catalogs, with a maximum size in bytes. """
+
+    # The extension of the catalogs stored in the cache, and its name in the
+    # log messages
+    EXTENSION = '.cat'
+    NAME = "SExtractor catalog cache"
+
+    def __init__(self, directory, max_size):
+        """ Use 'directory' as the cache, creating it if it does not exist. """
+
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self._lock = multiprocessing.Lock()
+        self._hits = multiprocessing.RawValue(ctypes.c_long, 0)
+        self._misses = multiprocessing.RawValue(ctypes.c_long, 0)
+
+    def __repr__(self):
+        args = self.__class__.__name__, self.directory, self.max_size
+        return "%s(%r, %r)" % args
+
+    @property
+    def hits(self):
+        """ The number of catalogs that were found in the cache. """
+        return self._hits.value
+
+    @property
+    def misses(self):
+        """ The number of catalogs that were not found in the cache. """
+        return self._misses.value
+
+    @property
+    def hit_rate(self):
+        """ The fraction of catalogs that were found in the cache, or None. """
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    @staticmethod
+    def key(sha1sum, sex_md5sum, satur_level):
+        """ Return the key under which a SExtractor catalog is stored.
+
+        'sha1sum' is the SHA-1 hash of the FITS image, 'sex_md5sum' that of the
+        SExtractor configuration (see astromatic.sextractor_md5sum()), and
+        'satur_level' the saturation level with which SExtractor was run.
+
+        """
+
+        return '%s_%s_%s' % (sha1sum, sex_md5sum, satur_level)
+
+    def _path(self, key):
+        """ Return the path to the catalog stored under 'key'. """
+        return os.path.join(self.directory, key + self.EXTENSION)
+
+    def get(self, key):
+        """ Return the path to the catalog stored under 'key', or None.
+
+        The modification time of the catalog is updated, as the least recently
+        used catalogs are the first ones to be deleted when the cache exceeds
+        its maximum size.
+
+        """
+
+        path = self._lookup(key)
+        self._count(path is not None)
+        return path
+
+    def _lookup(self, key):
+        """ Like get(), but without updating the hit and miss counters. """
+
+        path = self._path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def _count(self, found):
+        """ Count a hit if 'found' is True, and a miss otherwise. """
+
+        with self._lock:
+            if found:
+                self._hits.value += 1
+            else:
+                self._misses.value += 1
+
+    def add(self, key, catalog_path):
+        """ Move a catalog to the cache and return its new path.
+
+        The catalog at 'catalog_path' is moved to the cache, where it is stored
+        under 'key', replacing any other catalog with the same key. Then, the
+        least recently used catalogs are deleted until the maximum size of the
+        cache is not exceeded -- but never the one that has just been added.
+
+        """
+
+        # Move to a temporary name (starting with a dot, so that it is ignored
+        # by methods.evict_lru()) and then rename, so that a partial catalog
+        # is never seen by other processes.
+        kwargs = dict(prefix = '.', suffix = self.EXTENSION,
+                      dir = self.directory)
+        fd, tmp_path = tempfile.mkstemp(**kwargs)
+        os.close(fd)
+        try:
+            shutil.move(catalog_path, tmp_path)
+            path = self._path(key)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            methods.clean_tmp_files(tmp_path)
+            raise
+
+        msg = "%s: stored in the %s"
+        logging.debug(msg % (path, self.NAME))
+        methods.evict_lru(self.directory, self.max_size, keep = path)
+        return path
+
+    def log_stats(self):
+        """ Log, at the INFO level, the hit and miss statistics. """
+
+        if self.hit_rate is None:
+            return
+        msg = "%s: %d hits, %d misses (hit rate: %.1f%%)"
+        args = self.NAME, self.hits, self.misses, self.hit_rate * 100
+        logging.info(msg % args)
@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Vectorized computation of the centroids of astronomical objects.
+
+This module refines the positions of many astronomical objects at once, with
+NumPy, instead of letting IRAF's qphot do it object by object. A square stamp
+of 'cbox' pixels is extracted around each object, all of them stacked into a
+three-dimensional array, and the centers are computed in bulk using one of the
+two algorithms available: the intensity-weighted centroid (similar to IRAF's
+'centroid' algorithm) or a Gaussian fit to the marginal distributions.
+
+Coordinates follow the IRAF convention: they are one-based, so the center of
+the first pixel of the image is (1, 1).
+
+"""
+
+from __future__ import division
+
+import numpy
+
+METHODS = ('weighted', 'gaussian')
+
+def box_size(cbox):
+    """ Return the (odd) width, in pixels, of the stamps for a centering box.
+
+    The centering box is always an odd number of pixels wide, so that it is
+    centered on the pixel where the object is. A width of, say, 5.5 pixels is
+    rounded down to 5; while that of 6 pixels is rounded up to 7.
+
+    """
+
+    half = int(cbox // 2)
+    return 2 * half + 1
+
+def stamps(data, x, y, size, fill = numpy.nan):
+    """ Extract square stamps around the objects, stacked in a 3-D array.
+
+    Return a three-element tuple: (1) a NumPy array of shape (n, size, size),
+    where 'n' is the number of objects, with the pixels of 'data' around the
+    x- and y-coordinates of each object, (2) and (3) the zero-based column and
+    row, respectively, in 'data' of the first pixel of each stamp. 'size' must
+    be an odd number. The pixels of the stamps that fall off the image are set
+    to 'fill'. All the stamps are extracted at once, with fancy indexing.
+
+    """
+
+    if not size % 2:
+        raise ValueError("size of stamps must be an odd number")
+
+    half = size // 2
+    x = numpy.asarray(x, dtype = numpy.float64)
+    y = numpy.asarray(y, dtype = numpy.float64)
+
+    # Zero-based indexes of the pixels where the objects are (NaN coordinates,
+    # if any, are moved far away, so that the whole stamp falls off the image)
+    center_cols = numpy.round(numpy.nan_to_num(x) - 1).astype(numpy.int64)
+    center_rows = numpy.round(numpy.nan_to_num(y) - 1).astype(numpy.int64)
+    bad = ~(numpy.isfinite(x) & numpy.isfinite(y))
+    center_cols[bad] = center_rows[bad] = -size
+
+    offsets = numpy.arange(-half, half + 1)
+    cols = center_cols[:, numpy.newaxis] + offsets
+    rows = center_rows[:, numpy.newaxis] + offsets
+
+    nrows, ncols = data.shape
+    valid_cols = (cols >= 0) & (cols < ncols)
+    valid_rows = (rows >= 0) & (rows < nrows)
+
+    dtype = numpy.result_type(data.dtype, numpy.asarray(fill).dtype)
+    cube = data[numpy.clip(rows, 0, nrows - 1)[:, :, numpy.newaxis],
+                numpy.clip(cols, 0, ncols - 1)[:, numpy.newaxis, :]]
+    cube = cube.astype(dtype)
+    valid = valid_rows[:, :, numpy.newaxis] & valid_cols[:, numpy.newaxis, :]
+    cube[~valid] = fill
+    return cube, cols[:, 0], rows[:, 0]
+
+def _weighted(cube):
+    """ Intensity-weighted centroids (in stamp coordinates) of the stamps.
+
+    As IRAF's 'centroid' algorithm does, only the pixels above the mean of
+    each stamp contribute, weighted by how much they exceed this mean.
+
+    """
+
+    finite = ~numpy.isnan(cube)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = numpy.nansum(cube, axis = (1, 2)) / finite.sum(axis = (1, 2))
+        weights = cube - means[:, numpy.newaxis, numpy.newaxis]
+        weights = numpy.where(weights > 0, weights, 0) # NaN becomes zero
+
+    offsets = numpy.arange(cube.shape[-1])
+    total = weights.sum(axis = (1, 2))
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        xc = (weights.sum(axis = 1) * offsets).sum(axis = 1) / total
+        yc = (weights.sum(axis = 2) * offsets).sum(axis = 1) / total
+    return xc, yc
+
+def _gaussian(cube):
+    """ Marginal-Gaussian centroids (in stamp coordinates) of the stamps.
+
+    Fit a Gaussian to the three points around the maximum of the marginal
+    distributions of each stamp (i.e., a parabola to their logarithms), with
+    the background (the minimum of each marginal) subtracted.
+
+    """
+
+    def fit(marginals):
+        size = marginals.shape[1]
+        marginals = marginals - marginals.min(axis = 1)[:, numpy.newaxis]
+        peaks = numpy.clip(marginals.argmax(axis = 1), 1, size - 2)
+        index = numpy.arange(len(marginals))
+        points = [marginals[index, peaks + shift] for shift in (-1, 0, 1)]
+        # Avoid the logarithm of zero for the background-level pixels
+        tiny = numpy.finfo(numpy.float64).tiny
+        a, b, c = [numpy.log(numpy.maximum(p, tiny)) for p in points]
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            offset = 0.5 * (a - c) / (a - 2 * b + c)
+        return peaks + offset
+
+    cube = numpy.where(numpy.isnan(cube), 0, cube)
+    return fit(cube.sum(axis = 1)), fit(cube.sum(axis = 2))
+
+def centroid(data, x, y, cbox, method = 'weighted'):
+    """ Refine the centers of the astronomical objects.
+
+    Compute the centroids of the astronomical objects, whose approximate
+    positions are given by 'x' and 'y' (two sequences or NumPy arrays with
+    their one-based coordinates), using a centering box 'cbox' pixels wide.
+    'method' must be 'weighted', for intensity-weighted centroids, or
+    'gaussian', to fit a Gaussian to the marginal distributions of each box.
+    Returns two NumPy arrays with the refined x- and y-coordinates.
+
+    The centers of the objects whose centroid cannot be determined (e.g., if
+    they fall off the image or there is no signal in their centering box) or
+    whose computed center falls outside of the centering box are not modified.
+
+    """
+
+    x = numpy.array(x, dtype = numpy.float64)
+    y = numpy.array(y, dtype = numpy.float64)
+    if not len(x):
+        return x, y
+
+    cube, first_cols, first_rows = stamps(data, x, y, box_size(cbox))
+    return refine(cube, first_cols, first_rows, x, y, method = method)
+
+def refine(cube, first_cols, first_rows, x, y, method = 'weighted'):
+    """ Refine the centers of the astronomical objects, given their stamps.
+
+    The core of centroid(), for those who already have the stamps around
+    the objects (e.g., a stamps.StampCube): 'cube' is a three-dimensional
+    array with one centering box per object, and 'first_cols' and 'first_rows'
+    the zero-based column and row of the first pixel of each one of them, as
+    returned by stamps(). 'x' and 'y' are the one-based coordinates of the
+    objects, returned unmodified for those whose center cannot be determined.
+
+    """
+
+    if method not in METHODS:
+        msg = "centering method must be one of %s, not '%s'"
+        raise ValueError(msg % (', '.join(METHODS), method))
+
+    x = numpy.asarray(x, dtype = numpy.float64)
+    y = numpy.asarray(y, dtype = numpy.float64)
+
+    if method == 'weighted':
+        xc, yc = _weighted(cube)
+    else:
+        xc, yc = _gaussian(cube)
+
+    # From stamp coordinates to one-based image coordinates
+    xc += first_cols + 1
+    yc += first_rows + 1
+
+    half = cube.shape[-1] / 2
+    good = numpy.isfinite(xc) & numpy.isfinite(yc)
+    good &= ~numpy.isnan(cube).all(axis = (1, 2))
+    with numpy.errstate(invalid = 'ignore'):
+        good &= (numpy.abs(xc - x) <= half) & (numpy.abs(yc - y) <= half)
+
+    return numpy.where(good, xc, x), numpy.where(good, yc, y)
@@ -0,0 +1,346 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Reprojection and co-addition of FITS images, in NumPy.
+
+The 'mosaic' command may assemble the images with Montage, which writes a
+reprojected copy of each one of them to disk before co-adding them. This
+module does the same in memory, one rectangular tile of the mosaic at a time,
+so that the tiles can be processed in parallel and only the part of each image
+that falls on them needs to be read:
+
+(1) The WCS of the mosaic is a gnomonic (TAN) projection, with North up and
+    East to the left, centered on the mean of the centers of the images and
+    with the pixel scale of the finest of them (see optimal_wcs()). Its size
+    is that of the smallest rectangle that contains all the images.
+
+(2) For each pixel of the tile, the coordinates of the image that fall on it
+    are computed (by transforming them exactly with the WCS on a coarse grid,
+    and interpolating linearly in between, as the WCS varies smoothly) and
+    the image is interpolated at them with scipy.ndimage.map_coordinates().
+    Pixel values are scaled by the ratio of the areas of the pixels of the
+    mosaic and the image, so that the flux of the sources is preserved.
+
+(3) Optionally, the differences between the backgrounds of the images are
+    removed: the median difference of each pair of overlapping images, on
+    the pixels of the mosaic where both of them are defined, is computed, and
+    the additive offsets that best reconcile all the differences (in the
+    sense of least squares) are subtracted (see background_offsets()).
+
+Throughout this module, pixel coordinates are zero-based, and boxes are
+four-element tuples (y0, y1, x0, x1) with the first and last (exclusive) row
+and column of a rectangular region of the mosaic.
+
+"""
+
+from __future__ import division
+
+import astropy.io.fits
+import astropy.wcs
+import collections
+import math
+import numpy
+import scipy.interpolate
+import scipy.ndimage
+import warnings
+
+# LEMON modules
+import crossmatch
+
+# The step, in pixels of the mosaic, of the grid on which coordinates are
+# transformed with the WCS. In between, they are linearly interpolated.
+GRID_STEP = 8
+
+COMBINE_METHODS = ('mean', 'median', 'count')
+
+# The maximum number of images kept open by load(), in each process
+LOAD_CACHE_SIZE = 32
+_load_cache = collections.OrderedDict()
+
+def load_wcs(header):
+    """ Return the astropy.wcs.WCS object for a FITS header. """
+
+    # Silence the warnings of non-standard keywords, such as the SIP
+    # distortion coefficients when CTYPE does not end in '-SIP'
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return astropy.wcs.WCS(header)
+
+def load(path):
+    """ Return the data and WCS of a FITS image.
+
+    Return a two-element tuple: (1) the data of the primary HDU, memory-mapped
+    if possible, so that only the parts of the image that are used are read
+    from disk, and (2) its astropy.wcs.WCS object. The last LOAD_CACHE_SIZE
+    images are cached, as each tile of a mosaic usually needs the same
+    images as the previous one.
+
+    """
+
+    try:
+        image = _load_cache.pop(path)
+    except KeyError:
+        with astropy.io.fits.open(path, memmap = True) as hdulist:
+            hdu = hdulist[0]
+            image = hdu.data, load_wcs(hdu.header)
+        while len(_load_cache) >= LOAD_CACHE_SIZE:
+            _load_cache.popitem(last = False)
+
+    _load_cache[path] = image
+    return image
+
+def pixel_scale(wcs, shape):
+    """ Return the pixel scale, in degrees, at the center of an image.
+
+    'shape' is the number of rows and columns of the image. This is the mean
+    of the angular size of the central pixel along both axes.
+
+    """
+
+    x, y = (shape[1] - 1) / 2, (shape[0] - 1) / 2
+    ra, dec = wcs.all_pix2world([x, x + 1, x], [y, y, y + 1], 0)
+    sizes = crossmatch.angular_distance(ra[0], dec[0], ra[1:], dec[1:])
+    return float(sizes.mean())
+
+def _edges(shape, npoints = 16):
+    """ Return the coordinates of points along the edges of an image. """
+
+    nrows, ncols = shape
+    xs = numpy.linspace(-0.5, ncols - 0.5, npoints)
+    ys = numpy.linspace(-0.5, nrows - 0.5, npoints)
+    left = numpy.zeros(npoints) - 0.5
+    x = numpy.concatenate((xs, xs, left, left + ncols))
+    y = numpy.concatenate((left, left + nrows, ys, ys))
+    return x, y
+
+def optimal_wcs(wcss, shapes, scale = None):
+    """ Return the WCS and shape of the mosaic of several images.
+
+    'wcss' and 'shapes' are two sequences, with the astropy.wcs.WCS object and
+    the number of rows and columns of each image. Return a two-element tuple:
+    (1) the WCS of a gnomonic projection, with North up, centered on the mean
+    of the centers of the images and with a pixel scale of 'scale' degrees or,
+    if None, the smallest pixel scale of the images, and (2) the shape of the
+    smallest mosaic that contains all the images.
+
+    """
+
+    ras, decs = [], []
+    for wcs, shape in zip(wcss, shapes):
+        x, y = (shape[1] - 1) / 2, (shape[0] - 1) / 2
+        ra, dec = wcs.all_pix2world([x], [y], 0)
+        ras.append(ra[0])
+        decs.append(dec[0])
+
+    # The mean of the unit vectors, so that the coordinates may wrap around
+    vector = crossmatch.unit_vectors(ras, decs).mean(axis = 0)
+    ra = math.degrees(math.atan2(vector[1], vector[0])) % 360
+    dec = math.degrees(math.atan2(vector[2], math.hypot(*vector[:2])))
+
+    if scale is None:
+        scale = min(pixel_scale(wcs, shape)
+                    for wcs, shape in zip(wcss, shapes))
+
+    mosaic = astropy.wcs.WCS(naxis = 2)
+    mosaic.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    mosaic.wcs.crval = [ra, dec]
+    mosaic.wcs.crpix = [1, 1] # (0, 0), zero-based
+    mosaic.wcs.cd = [[-scale, 0], [0, scale]]
+
+    xs, ys = [], []
+    for wcs, shape in zip(wcss, shapes):
+        ra, dec = wcs.all_pix2world(*(_edges(shape) + (0,)))
+        x, y = mosaic.wcs_world2pix(ra, dec, 0)
+        xs.append(x)
+        ys.append(y)
+
+    xs, ys = numpy.concatenate(xs), numpy.concatenate(ys)
+    x0, x1 = int(math.floor(xs.min() + 0.5)), int(math.ceil(xs.max() - 0.5))
+    y0, y1 = int(math.floor(ys.min() + 0.5)), int(math.ceil(ys.max() - 0.5))
+    mosaic.wcs.crpix = [1 - x0, 1 - y0]
+    return mosaic, (y1 - y0 + 1, x1 - x0 + 1)
+
+def footprint(wcs, shape, mosaic, mosaic_shape):
+    """ Return the box of the mosaic on which an image falls.
+
+    'wcs' and 'shape' are the astropy.wcs.WCS object and the number of rows
+    and columns of the image, and 'mosaic' and 'mosaic_shape' those of the
+    mosaic. Return the smallest box of the mosaic that contains the edges of
+    the image, or None if it does not overlap the mosaic.
+
+    """
+
+    ra, dec = wcs.all_pix2world(*(_edges(shape) + (0,)))
+    with numpy.errstate(invalid = 'ignore'):
+        x, y = mosaic.wcs_world2pix(ra, dec, 0)
+    # Points more than ninety degrees away cannot be projected
+    projected = numpy.isfinite(x) & numpy.isfinite(y)
+    if not projected.any():
+        return None
+    x, y = x[projected], y[projected]
+    x0 = max(int(math.floor(x.min() + 0.5)), 0)
+    x1 = min(int(math.ceil(x.max() - 0.5)) + 1, mosaic_shape[1])
+    y0 = max(int(math.floor(y.min() + 0.5)), 0)
+    y1 = min(int(math.ceil(y.max() - 0.5)) + 1, mosaic_shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return y0, y1, x0, x1
+
+def intersection(box1, box2):
+    """ Return the intersection of two boxes, or None if they do not overlap.
+    """
+
+    y0, x0 = max(box1[0], box2[0]), max(box1[2], box2[2])
+    y1, x1 = min(box1[1], box2[1]), min(box1[3], box2[3])
+    if y0 >= y1 or x0 >= x1:
+        return None
+    return y0, y1, x0, x1
+
+def tiles(shape, size):
+    """ Return the boxes of the square tiles, of 'size' pixels, of a mosaic.
+
+    The tiles of the last row and column are smaller if the number of rows
+    or columns of the mosaic is not a multiple of 'size'.
+
+    """
+
+    nrows, ncols = shape
+    return [(y0, min(y0 + size, nrows), x0, min(x0 + size, ncols))
+            for y0 in xrange(0, nrows, size)
+            for x0 in xrange(0, ncols, size)]
+
+def _grid(start, stop, step):
+    """ Return the points of a coarse grid, always including both ends. """
+    return numpy.append(numpy.arange(start, stop, step), stop)
+
+def reproject(data, wcs, mosaic, box, order = 1, stride = 1):
+    """ Interpolate an image at the pixels of a box of the mosaic.
+
+    'data' and 'wcs' are the pixels and astropy.wcs.WCS object of the image,
+    and 'mosaic' the astropy.wcs.WCS of the mosaic. Return a NumPy array with
+    the values of the image at every 'stride'-th row and column of 'box' of
+    the mosaic, interpolated with a spline of order 'order' (one, bilinear,
+    by default), and NaN for the pixels of the mosaic that do not fall on
+    the image. Values are not scaled by the areas of the pixels.
+
+    """
+
+    y0, y1, x0, x1 = box
+    rows = numpy.arange(y0, y1, stride)
+    cols = numpy.arange(x0, x1, stride)
+
+    # The exact transformation, on a coarse grid
+    step = GRID_STEP * stride
+    grid_rows, grid_cols = _grid(y0, y1, step), _grid(x0, x1, step)
+    x, y = numpy.meshgrid(grid_cols, grid_rows)
+    ra, dec = mosaic.all_pix2world(x, y, 0)
+    with warnings.catch_warnings(), numpy.errstate(invalid = 'ignore'):
+        warnings.simplefilter("ignore")
+        u, v = wcs.all_world2pix(ra, dec, 0, quiet = True)
+
+    # ... and linearly interpolated at every pixel
+    def interpolate(values):
+        values = numpy.where(numpy.isfinite(values), values, -1e30)
+        spline = scipy.interpolate.RectBivariateSpline(grid_rows, grid_cols,
+                                                       values, kx = 1, ky = 1)
+        return spline(rows, cols)
+
+    u, v = interpolate(u), interpolate(v)
+    nrows, ncols = data.shape
+    inside = (u >= -0.5) & (u <= ncols - 0.5) & \
+             (v >= -0.5) & (v <= nrows - 0.5)
+
+    values = numpy.empty(u.shape)
+    values.fill(numpy.nan)
+    if not inside.any():
+        return values
+
+    # Read only the part of the image that is needed, as 'data' may be
+    # memory-mapped, extended by the neighbours used by the spline.
+    u, v = numpy.clip(u, 0, ncols - 1), numpy.clip(v, 0, nrows - 1)
+    margin = order + 1
+    umin = max(int(math.floor(u[inside].min())) - margin, 0)
+    umax = min(int(math.ceil(u[inside].max())) + margin + 1, ncols)
+    vmin = max(int(math.floor(v[inside].min())) - margin, 0)
+    vmax = min(int(math.ceil(v[inside].max())) + margin + 1, nrows)
+    cut = numpy.asarray(data[vmin:vmax, umin:umax], dtype = numpy.float64)
+
+    coordinates = [v[inside] - vmin, u[inside] - umin]
+    kwargs = dict(order = order, mode = 'nearest', prefilter = order > 1)
+    values[inside] = scipy.ndimage.map_coordinates(cut, coordinates, **kwargs)
+    return values
+
+def overlap_difference(first, second, mosaic, box, nsamples = 65536):
+    """ Return the median difference between two images where they overlap.
+
+    'first' and 'second' are three-element tuples with the data, WCS and
+    the factor by which the values of each image are scaled (the ratio of
+    the areas of the pixels of the mosaic and the image), and 'box' the
+    region of the mosaic on which both fall. The images are compared, to save
+    time, on a subset of about 'nsamples' pixels of the box. Return a
+    two-element tuple: the median of the difference between the first and
+    the second image, and the number of pixels on which it was computed
+    (zero, and a NaN median, if there were none).
+
+    """
+
+    npixels = (box[1] - box[0]) * (box[3] - box[2])
+    stride = max(int(math.sqrt(npixels / nsamples)), 1)
+    values = []
+    for data, wcs, factor in (first, second):
+        args = data, wcs, mosaic, box
+        values.append(reproject(*args, stride = stride) * factor)
+    differences = values[0] - values[1]
+    differences = differences[numpy.isfinite(differences)]
+    if not differences.size:
+        return numpy.nan, 0
+    return float(numpy.median(differences)), int(differences.size)
+
+def background_offsets(nimages, differences):
+    """ Return the background offsets that reconcile the images.
+
+    'differences' is a sequence of four-element tuples (i, j, difference,
+    weight): the indexes of two overlapping images, the difference between
+    the background of the i-th and j-th images (see overlap_difference()) and
+    the weight of this difference, such as the number of pixels on which it
+    was computed. Return a NumPy array with the offset that must be subtracted
+    from each image so that the differences vanish, in the sense of weighted
+    least squares, and the mean offset is zero.
+
+    """
+
+    differences = [(i, j, diff, weight)
+                   for i, j, diff, weight in differences
+                   if numpy.isfinite(diff) and weight > 0]
+
+    # One equation for each pair of images, plus one (as heavy as the
+    # heaviest of them) for the mean offset, which must be zero
+    matrix = numpy.zeros((len(differences) + 1, nimages))
+    values = numpy.zeros(len(differences) + 1)
+    max_weight = 1
+    for row, (i, j, diff, weight) in enumerate(differences):
+        sqrt_weight = math.sqrt(weight)
+        matrix[row, i] = sqrt_weight
+        matrix[row, j] = -sqrt_weight
+        values[row] = diff * sqrt_weight
+        max_weight = max(max_weight, weight)
+    matrix[-1] = math.sqrt(max_weight)
+
+    return numpy.linalg.lstsq(matrix, values, rcond = -1)[0]
@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Vectorized cross-matching of catalogs of astronomical sources.
+
+Finding, for each source of a catalog, the nearest one in another catalog by
+computing the distance between every pair of sources takes time proportional
+to the product of their sizes. Instead, this module builds a k-d tree (with
+scipy.spatial.cKDTree) over the sources of the second catalog, so that the
+nearest neighbors of a million sources among another million are found in
+seconds. Celestial coordinates are converted to unit vectors in Cartesian
+space, where the Euclidean distance (the chord) is a monotonic function of the
+angular distance, so there are no problems at the poles or where the right
+ascension wraps around; pixel coordinates are matched in two dimensions, and
+one-dimensional values (such as the dates of observation of two light curves)
+with a binary search in the sorted values.
+
+All the functions return two arrays, with an element for each source of the
+first catalog: the index of the nearest source in the second catalog and the
+distance to it. Sources with no match, as there is none closer than the given
+radius, have an index of -1 and a distance of NaN.
+
+"""
+
+from __future__ import division
+
+import numpy
+import scipy.spatial
+
+def unit_vectors(ra, dec):
+    """ Return the unit vectors that point to the celestial coordinates.
+
+    'ra' and 'dec' are the right ascension and declination, in decimal
+    degrees. Returns a NumPy array of shape (n, 3), with the x-, y- and
+    z-coordinates of the unit vector of each one of the 'n' objects.
+
+    """
+
+    ra  = numpy.radians(numpy.asarray(ra, dtype = numpy.float64))
+    dec = numpy.radians(numpy.asarray(dec, dtype = numpy.float64))
+    cos_dec = numpy.cos(dec)
+    vectors = numpy.empty(ra.shape + (3,))
+    vectors[..., 0] = cos_dec * numpy.cos(ra)
+    vectors[..., 1] = cos_dec * numpy.sin(ra)
+    vectors[..., 2] = numpy.sin(dec)
+    return vectors.reshape(-1, 3)
+
+def _chord(angle):
+    """ Return the chord of a great-circle distance given in degrees. """
+    return 2 * numpy.sin(numpy.radians(numpy.minimum(angle, 180)) / 2)
+
+def _angle(chord):
+    """ Return the great-circle distance, in degrees, of a chord. """
+    return numpy.degrees(2 * numpy.arcsin(numpy.minimum(chord / 2, 1)))
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """ Return the angular distance, in degrees, between celestial coordinates.
+
+    The arguments, in decimal degrees, may be scalars or arrays, which are
+    broadcast against each other. Unlike the law of cosines (as used by
+    astromatic.Coordinates.distance()), the chord between the unit vectors is
+    accurate also for very small distances.
+
+    """
+
+    args = numpy.broadcast_arrays(ra1, dec1, ra2, dec2)
+    shape = args[0].shape
+    first = unit_vectors(*args[:2])
+    second = unit_vectors(*args[2:])
+    chord = numpy.sqrt(((first - second) ** 2).sum(axis = 1))
+    return _angle(chord).reshape(shape)
+
+def _kdtree(points):
+    """ Return a cKDTree of the points, or None if there are none.
+
+    Older versions of SciPy cannot build a cKDTree of zero points, so None
+    is returned instead, which _nearest() understands as an empty catalog.
+
+    """
+
+    if not len(points):
+        return None
+    return scipy.spatial.cKDTree(points)
+
+def _nearest(tree, points, radius):
+    """ Return the nearest neighbors, in a cKDTree, closer than 'radius'.
+
+    Returns the index (or -1) and the distance (or NaN) of the nearest point
+    of 'tree' to each one of 'points', an array of shape (n, m), provided that
+    it is closer (strictly) than 'radius', in the same units as the tree.
+    'tree' may be None, for an empty catalog, in which case nothing matches.
+
+    """
+
+    npoints = len(points)
+    if not npoints or tree is None:
+        indexes = numpy.zeros(npoints, dtype = numpy.int64) - 1
+        return indexes, numpy.zeros(npoints) + numpy.nan
+
+    distances, indexes = tree.query(points, distance_upper_bound = radius)
+    indexes = numpy.asarray(indexes, dtype = numpy.int64)
+    unmatched = ~(distances < radius)
+    indexes[unmatched] = -1
+    distances[unmatched] = numpy.nan
+    return indexes, distances
+
+
+class SkyMatcher(object):
+    """ Find the nearest neighbors of celestial coordinates in a catalog.
+
+    The k-d tree is built once, when the SkyMatcher is instantiated with the
+    right ascension and declination (in decimal degrees) of the sources of
+    the catalog, so it can be used to match as many catalogs as needed.
+
+    """
+
+    def __init__(self, ra, dec):
+        self._tree = _kdtree(unit_vectors(ra, dec))
+
+    def __len__(self):
+        return self._tree.n if self._tree is not None else 0
+
+    def match(self, ra, dec, radius):
+        """ Return the nearest neighbor of each object, if within 'radius'.
+
+        Return a two-element tuple of NumPy arrays: for each object whose right
+        ascension and declination are given in 'ra' and 'dec', (1) the index of
+        the nearest source of the catalog, and (2) the angular distance to it,
+        in degrees. If there is no source closer than 'radius' degrees, the
+        index is -1 and the distance NaN.
+
+        """
+
+        points = unit_vectors(ra, dec)
+        indexes, chords = _nearest(self._tree, points, _chord(radius))
+        return indexes, _angle(chords)
+
+
+class PixelMatcher(object):
+    """ Find the nearest neighbors of pixel coordinates in a catalog.
+
+    The same as SkyMatcher, but for the x- and y-coordinates of the sources,
+    in pixels, of the same image (or of images with the same orientation and
+    scale, once the offsets between them have been subtracted).
+
+    """
+
+    def __init__(self, x, y):
+        points = numpy.column_stack((numpy.ravel(x), numpy.ravel(y)))
+        self._tree = _kdtree(points.astype(numpy.float64))
+
+    def __len__(self):
+        return self._tree.n if self._tree is not None else 0
+
+    def match(self, x, y, radius):
+        """ Return the nearest neighbor of each object, if within 'radius'.
+
+        Return a two-element tuple of NumPy arrays: for each object whose
+        coordinates are 'x' and 'y', (1) the index of the nearest source of the
+        catalog and (2) the distance to it, in pixels. If there is no source
+        closer than 'radius' pixels, the index is -1 and the distance NaN.
+
+        """
+
+        points = numpy.column_stack((numpy.ravel(x), numpy.ravel(y)))
+        return _nearest(self._tree, points.astype(numpy.float64), radius)
+
+
+def match_sky(ra1, dec1, ra2, dec2, radius):
+    """ Match the first catalog of celestial coordinates to the second one.
+
+    For each object of the first catalog, return the index of the nearest one
+    in the second catalog and the angular distance, in degrees. Objects with
+    no match closer than 'radius' degrees get an index of -1 and a distance of
+    NaN. See SkyMatcher, to match several catalogs against the same one.
+
+    """
+
+    return SkyMatcher(ra2, dec2).match(ra1, dec1, radius)
+
+def match_pixels(x1, y1, x2, y2, radius):
+    """ Match the first catalog of pixel coordinates to the second one.
+
+    The same as match_sky(), but with the x- and y-coordinates of the objects,
+    and 'radius' and the returned distances in pixels. See PixelMatcher.
+
+    """
+
+    return PixelMatcher(x2, y2).match(x1, y1, radius)
+
+def match_values(values1, values2, radius):
+    """ Match one-dimensional values to the nearest ones in another array.
+
+    For each value in 'values1', return the index of the nearest value in
+    'values2' and the absolute difference between them. Values with no match
+    closer than 'radius' get an index of -1 and a distance of NaN. If two
+    values of 'values2' are equally near, the first one is returned.
+
+    """
+
+    values1 = numpy.asarray(values1, dtype = numpy.float64)
+    values2 = numpy.asarray(values2, dtype = numpy.float64)
+    indexes = numpy.zeros(len(values1), dtype = numpy.int64) - 1
+    distances = numpy.zeros(len(values1)) + numpy.nan
+    if not len(values1) or not len(values2):
+        return indexes, distances
+
+    # A stable sort, so that the first of several equal values is used
+    order = numpy.argsort(values2, kind = 'mergesort')
+    sorted_values = values2[order]
+
+    # The candidates are the values immediately to the left and right of
+    # where each value would be inserted in the sorted array
+    right = numpy.searchsorted(sorted_values, values1, side = 'left')
+    right = numpy.minimum(right, len(sorted_values) - 1)
+    left = numpy.maximum(right - 1, 0)
+    # The first of the equal values to the left, not the last one
+    left = numpy.searchsorted(sorted_values, sorted_values[left],
+                              side = 'left')
+    left_distances = numpy.abs(values1 - sorted_values[left])
+    right_distances = numpy.abs(values1 - sorted_values[right])
+
+    # On ties, the one that comes first in 'values2'
+    use_left = (left_distances < right_distances) | \
+               ((left_distances == right_distances) &
+                (order[left] < order[right]))
+    nearest = numpy.where(use_left, left, right)
+    nearest_distances = numpy.where(use_left, left_distances, right_distances)
+
+    matched = nearest_distances < radius
+    indexes[matched] = order[nearest[matched]]
+    distances[matched] = nearest_distances[matched]
+    return indexes, distances
@@ -41,7 +41,7 @@ import sqlite3
 import tempfile
 
 # LEMON modules
-import astromatic
+import crossmatch
 import json_parse
 import methods
 import passband
@@ -1123,6 +1123,68 @@ class LEMONdB(object):
             args = (star_id, unix_time, methods.utctime(unix_time), pfilter)
             raise DuplicatePhotometryError(msg % args)
 
+    def add_image_photometry(self, unix_time, pfilter, star_ids, magnitudes,
+                             snrs, pm_x = None, pm_y = None, pm_ids = ()):
+        """ Store, in bulk, the photometric records of an image.
+
+        This is the equivalent of calling LEMONdB.add_photometry() for each
+        star ID, magnitude and SNR in 'star_ids', 'magnitudes' and 'snrs' (three
+        sequences, such as NumPy arrays, of the same length), but the records
+        are inserted with a single executemany() statement and the image ID is
+        looked up only once. 'pm_ids' is a sequence with the IDs of the stars
+        for which the proper-motion corrected pixel coordinates, taken from the
+        same positions of 'pm_x' and 'pm_y' as the star ID in 'star_ids', must
+        also be stored, as LEMONdB.add_pm_correction() would do. Stars not
+        listed in 'star_ids' are ignored, even if they are in 'pm_ids'.
+
+        The database is modified atomically, so in case an error is encountered
+        it is left untouched. The exceptions raised are the same as those of
+        LEMONdB.add_photometry(): UnknownImageError, UnknownStarError and
+        DuplicatePhotometryError.
+
+        """
+
+        try:
+            image_id = self._get_image_id(unix_time, pfilter)
+        except KeyError, e:
+            raise UnknownImageError(str(e))
+
+        # Note the casts to Python's built-in types. Otherwise, if we get NumPy
+        # types, SQLite raises "sqlite3.InterfaceError: Error binding parameter
+        # - probably unsupported type"
+        star_ids = [int(x) for x in star_ids]
+        rows = [(None, id_, image_id, float(mag), float(snr))
+                for id_, mag, snr in zip(star_ids, magnitudes, snrs)]
+
+        pm_ids = set(int(x) for x in pm_ids)
+        pm_rows = []
+        if pm_ids:
+            for index, id_ in enumerate(star_ids):
+                if id_ in pm_ids:
+                    args = float(pm_x[index]), float(pm_y[index])
+                    pm_rows.append((None, id_, image_id) + args)
+
+        mark = self._savepoint()
+        try:
+            stmt = "INSERT INTO photometry VALUES (?, ?, ?, ?, ?)"
+            self._cursor.executemany(stmt, rows)
+            stmt = "INSERT INTO pm_corrections VALUES (?, ?, ?, ?, ?)"
+            self._cursor.executemany(stmt, pm_rows)
+            self._release(mark)
+
+        except sqlite3.IntegrityError:
+            self._rollback_to(mark)
+
+            unknown_ids = set(star_ids).difference(self.star_ids)
+            if unknown_ids:
+                msg = "star with ID = %d not in database" % min(unknown_ids)
+                raise UnknownStarError(msg)
+
+            msg = "photometry for one or more stars, Unix time = %4.f " \
+                  "(%s) and filter %s already in database"
+            args = (unix_time, methods.utctime(unix_time), pfilter)
+            raise DuplicatePhotometryError(msg % args)
+
     def get_photometry(self, star_id, pfilter):
         """ Return the photometric information of the star.
 
@@ -1651,18 +1713,13 @@ class LEMONdB(object):
             raise ValueError("database is empty")
 
         self._execute("SELECT id, ra, dec FROM stars")
+        star_ids, star_ra, star_dec = zip(*self._rows)
 
-        closest_id = None
-        closest_distance = float('inf')
-        coordinates = astromatic.Coordinates(ra, dec)
-        for star_id, star_ra, star_dec in self._rows:
-            star_coords = astromatic.Coordinates(star_ra, star_dec)
-            star_distance = coordinates.distance(star_coords)
-            if star_distance < closest_distance:
-                closest_id = star_id
-                closest_distance = star_distance
-
-        return closest_id, closest_distance
+        # The distances to all the stars at once; the first, if several
+        # stars are equally close
+        distances = crossmatch.angular_distance(ra, dec, star_ra, star_dec)
+        index = numpy.argmin(distances)
+        return star_ids[index], float(distances[index])
 
 def _add_metadata_property(name):
     """ Dynamically add a property to the LEMONdB class.
@@ -21,6 +21,7 @@
 """ Definition of the default options used by the different modules """
 
 import multiprocessing
+import os.path
 
 # LEMON modules
 import passband
@@ -48,6 +49,95 @@ desc['margin'] = \
 "is fewer than 'margin' pixels from any border (horizontal or vertical) of " \
 "the FITS image are not considered. [default: %default]"
 
+sextractor_catalog = 'FITS_LDAC'
+desc['sextractor_catalog'] = \
+"the format of the catalogs written by SExtractor: 'FITS_LDAC', a binary " \
+"table from which the detected sources are loaded without having to parse " \
+"them, or 'ASCII_HEAD', a text file [default: %default]"
+
+detector = 'sextractor'
+desc['detector'] = \
+"how the sources are detected in order to measure the FWHM and elongation " \
+"of the images: 'sextractor', running SExtractor, or 'native', a simpler " \
+"detector, written in NumPy and SciPy, that does not need a subprocess or " \
+"a catalog file, and that is much faster but does not deblend the sources " \
+"[default: %default]"
+
+header_index = os.path.expanduser('~/.lemon-headers.db')
+desc['header_index'] = \
+"the SQLite database where the headers of the FITS images are cached, so " \
+"that subsequent executions (of this or any other LEMON command) do not " \
+"need to read them again from disk. Entries are discarded as soon as the " \
+"FITS file is modified. Use an empty string to disable the cache " \
+"[default: %default]"
+
+quality_db = os.path.expanduser('~/.lemon-quality.db')
+desc['quality_db'] = \
+"the SQLite database where the quality metrics of the FITS images (FWHM, " \
+"elongation, number of sources and sky level) are stored by the 'seeing' " \
+"command, keyed by the contents of the image, so that other commands (such " \
+"as 'photometry' or 'annuli') do not need to compute them again. Use an " \
+"empty string to disable it [default: %default]"
+
+sextractor_cache = os.path.expanduser('~/.lemon-sextractor')
+desc['sextractor_cache'] = \
+"the directory where the SExtractor catalogs are cached, keyed by the " \
+"contents of the FITS image, the SExtractor configuration and the " \
+"saturation level, so that SExtractor does not need to be run again on the " \
+"same image, even if it has been copied or renamed. Use an empty string to " \
+"disable the cache and store, instead, the path to the catalog in the FITS " \
+"header [default: %default]"
+
+sextractor_cache_size = 1024
+desc['sextractor_cache_size'] = \
+"the maximum size, in MiB, of the SExtractor catalog cache (see " \
+"--sextractor-cache). When it is exceeded, the least recently used " \
+"catalogs are deleted [default: %default]"
+
+astrometry_cache = os.path.expanduser('~/.lemon-astrometry')
+desc['astrometry_cache'] = \
+"the directory where the astrometric solutions found by Astrometry.net are " \
+"cached, keyed by the contents of the FITS image and the options with which " \
+"it was solved, so that the same image is not solved again. Images that " \
+"could not be solved are remembered too, and not tried again until the " \
+"options change (or, if they exceeded the --timeout, until a longer one is " \
+"used). Use an empty string to disable the cache [default: %default]"
+
+astrometry_cache_size = 64
+desc['astrometry_cache_size'] = \
+"the maximum size, in MiB, of the astrometric solution cache (see " \
+"--astrometry-cache). When it is exceeded, the least recently used " \
+"solutions are deleted [default: %default]"
+
+prefetch = 4
+desc['prefetch'] = \
+"the number of FITS images to read in advance, in the background, while " \
+"the workers are processing the previous ones. This allows CPU and I/O to " \
+"overlap, which is specially useful when the images live on a slow or " \
+"remote file system, such as NFS. Use zero to disable it [default: %default]"
+
+scratch_dir = None
+desc['scratch_dir'] = \
+"the local directory to which the images read in advance (see --prefetch) " \
+"are copied. Each copy is deleted as soon as the image has been processed. " \
+"By default, images are only read into the page cache of the operating " \
+"system, instead of being copied to a scratch directory"
+
+scratch_budget = 2048
+desc['scratch_budget'] = \
+"the maximum amount of disk space, in MiB, used in the scratch directory " \
+"(see --scratch-dir) by the copies of the images read in advance " \
+"[default: %default]"
+
+min_tile = 5000
+desc['min_tile'] = \
+"when there are fewer images than cores (or, in general, for the last " \
+"images, if their number is not a multiple of the number of cores), split " \
+"each image into spatial tiles on which photometry is done in parallel, so " \
+"that all the cores are kept busy. This is the minimum number of " \
+"astronomical objects in each tile: images with fewer objects than this " \
+"value are never split [default: %default]"
+
 verbosity = 0
 desc['verbosity'] = \
 "increase the amount of information given during the execution. A single " \
@@ -0,0 +1,270 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A simple, in-process detector of astronomical sources.
+
+Running SExtractor only to estimate the FWHM, elongation and number of sources
+of an image requires a subprocess and a catalog file for each image. For these
+statistics, which only need the brightest unsaturated stars, this module offers
+a much simpler detector, written in NumPy and SciPy, that follows the same
+steps as SExtractor with the LEMON configuration (see sextractor/sextractor.sex)
+in a crude manner: the background and its noise are estimated on a coarse mesh
+of 64 x 64 pixels, median-filtered and interpolated; the background-subtracted
+image is convolved with the same 3 x 3 kernel and thresholded at 1.5 sigma; and
+the connected groups of at least five pixels above the threshold are labeled
+with scipy.ndimage. There is no deblending, and no cleaning of spurious
+detections. Everything is measured at once for all the sources, with
+numpy.bincount().
+
+Coordinates follow the SExtractor (and IRAF) convention: they are one-based,
+so the center of the first pixel of the image is (1, 1).
+
+"""
+
+from __future__ import division
+
+import numpy
+import scipy.ndimage
+
+# LEMON modules
+import astromatic
+import centroid
+
+# The convolution kernel, from sextractor/sextractor.conv
+KERNEL = numpy.array([[1, 2, 1],
+                      [2, 4, 2],
+                      [1, 2, 1]], dtype = numpy.float64)
+KERNEL /= KERNEL.sum()
+
+# The largest radius, in pixels, of the apertures where the flux radius of the
+# sources is measured.
+MAX_RADIUS = 25
+
+def _interpolation_matrix(size, ncells, cell):
+    """ Return the matrix that linearly interpolates a mesh along an axis.
+
+    Return an array of shape (size, ncells) that, multiplied by the values of
+    a mesh of 'ncells' cells of 'cell' pixels each along an axis, linearly
+    interpolates them to the 'size' pixels of the image along that axis. The
+    values of the mesh correspond to the center of each cell; beyond the
+    center of the first and last cells, they are constant.
+
+    """
+
+    position = (numpy.arange(size) + 0.5) / cell - 0.5
+    position = numpy.clip(position, 0, ncells - 1)
+    left = numpy.floor(position).astype(numpy.int64)
+    right = numpy.minimum(left + 1, ncells - 1)
+    weight = position - left
+
+    matrix = numpy.zeros((size, ncells))
+    pixels = numpy.arange(size)
+    matrix[pixels, left] = 1 - weight
+    matrix[pixels, right] += weight
+    return matrix
+
+def background(data, mesh = 64, filter_size = 3):
+    """ Estimate the background of an image and the standard deviation.
+
+    Divide the image into cells of approximately 'mesh' x 'mesh' pixels and
+    take the median and the standard deviation (estimated from the median
+    absolute deviation, so that stars do not affect it) of each one of them.
+    The two resulting coarse maps are median-filtered, with a window of
+    'filter_size' x 'filter_size' cells, and bilinearly interpolated to the
+    size of the image. Return a two-element tuple with both arrays, of the
+    same shape as 'data'.
+
+    """
+
+    data = numpy.asarray(data, dtype = numpy.float64)
+    nrows, ncols = data.shape
+    ny = max(nrows // mesh, 1)
+    nx = max(ncols // mesh, 1)
+    height = nrows // ny
+    width = ncols // nx
+
+    # Stack the pixels of each cell: (ny, nx, height * width)
+    cells = data[:ny * height, :nx * width]
+    cells = cells.reshape(ny, height, nx, width).swapaxes(1, 2)
+    cells = cells.reshape(ny, nx, height * width)
+
+    levels = numpy.median(cells, axis = 2)
+    deviations = numpy.abs(cells - levels[:, :, numpy.newaxis])
+    sigmas = 1.4826 * numpy.median(deviations, axis = 2)
+
+    kwargs = dict(size = filter_size, mode = 'nearest')
+    levels = scipy.ndimage.median_filter(levels, **kwargs)
+    sigmas = scipy.ndimage.median_filter(sigmas, **kwargs)
+
+    # Bilinear interpolation, as two matrix products
+    rows = _interpolation_matrix(nrows, ny, height)
+    cols = _interpolation_matrix(ncols, nx, width).T
+
+    def expand(mesh_values):
+        return numpy.dot(numpy.dot(rows, mesh_values), cols)
+
+    return expand(levels), expand(sigmas)
+
+def _flux_radius(data, x, y, radius):
+    """ Return the radius that encloses half of the flux of each source.
+
+    'data' is the background-subtracted image, 'x' and 'y' the one-based
+    coordinates of the sources, and 'radius' the radius of the circular
+    aperture, for each source, within which the total flux is measured. The
+    flux radius is linearly interpolated between the distances to the center
+    of the pixels, sorted by their distance, where half of the flux is reached.
+
+    """
+
+    size = 2 * int(numpy.ceil(radius.max())) + 1
+    cube, cols, rows = centroid.stamps(data, x, y, size, fill = 0)
+    nstars = len(cube)
+
+    # Distance from the center of each pixel of the stamps to the sources
+    offsets = numpy.arange(size)
+    dx = (cols[:, numpy.newaxis] + offsets + 1) - x[:, numpy.newaxis]
+    dy = (rows[:, numpy.newaxis] + offsets + 1) - y[:, numpy.newaxis]
+    distances = numpy.sqrt(dy[:, :, numpy.newaxis] ** 2 +
+                           dx[:, numpy.newaxis, :] ** 2)
+    distances = distances.reshape(nstars, -1)
+    fluxes = cube.reshape(nstars, -1)
+    fluxes = numpy.where(distances <= radius[:, numpy.newaxis], fluxes, 0)
+
+    # Cumulative flux, from the center of the sources outwards. Half of the
+    # flux of each pixel is assumed to be within the distance to its center.
+    order = numpy.argsort(distances, axis = 1)
+    index = numpy.arange(nstars)[:, numpy.newaxis]
+    distances = distances[index, order]
+    fluxes = fluxes[index, order]
+    cumulative = numpy.cumsum(fluxes, axis = 1) - fluxes / 2
+
+    half = fluxes.sum(axis = 1) / 2
+    last = numpy.argmax(cumulative >= half[:, numpy.newaxis], axis = 1)
+    first = numpy.maximum(last - 1, 0)
+    index = numpy.arange(nstars)
+    r0, r1 = distances[index, first], distances[index, last]
+    c0, c1 = cumulative[index, first], cumulative[index, last]
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        fraction = numpy.where(c1 > c0, (half - c0) / (c1 - c0), 1)
+    return r0 + numpy.clip(fraction, 0, 1) * (r1 - r0)
+
+def detect(data, saturation, threshold = 1.5, minarea = 5, nbrightest = 500):
+    """ Detect the sources in an image and return an astromatic.Catalog.
+
+    Detect the sources in 'data', a two-dimensional array, and return an
+    astromatic.Catalog with their coordinates, isophotal area, magnitude
+    (with a zero point of 25, as in the SExtractor configuration file),
+    signal-to-noise ratio and elongation. A source is saturated if any of its
+    pixels is equal to or above the 'saturation' level. The celestial
+    coordinates are not computed, and are set to NaN.
+
+    The FWHM is only measured (as twice the radius that encloses half of the
+    flux within a circular aperture) for the 'nbrightest' sources with the
+    largest flux; that of the others is NaN.
+
+    Keyword arguments:
+    threshold - the detection threshold, in units of the standard deviation
+                of the background noise.
+    minarea - the minimum number of pixels above the threshold of a source.
+    nbrightest - the number of sources whose FWHM is measured.
+
+    """
+
+    data = numpy.asarray(data, dtype = numpy.float64)
+    levels, sigmas = background(data)
+    subtracted = data - levels
+
+    filtered = scipy.ndimage.convolve(subtracted, KERNEL, mode = 'nearest')
+    # As in SExtractor, the threshold is relative to the standard deviation of
+    # the background of the image before it is convolved with the kernel.
+    mask = filtered > threshold * sigmas
+    labels, nlabels = scipy.ndimage.label(mask)
+
+    # Measure all the labels at once, using only the pixels above the
+    # threshold: numpy.bincount() sums the weights of the pixels with the
+    # same label. Label zero, the background, has no pixels.
+    pixels = numpy.flatnonzero(labels)
+    labels = labels.ravel()[pixels]
+    nbins = nlabels + 1
+
+    def total(weights):
+        return numpy.bincount(labels, weights = weights, minlength = nbins)
+
+    values = data.ravel()[pixels]
+    subtracted_values = subtracted.ravel()[pixels]
+    areas = numpy.bincount(labels, minlength = nbins)
+    flux = total(subtracted_values)
+    noise = numpy.sqrt(total(sigmas.ravel()[pixels] ** 2))
+    index = numpy.arange(1, nbins)
+    peaks = numpy.zeros(nbins)
+    if nlabels:
+        peaks[1:] = scipy.ndimage.maximum(values, labels, index)
+
+    # Intensity-weighted first and second moments, with only the positive
+    # pixels, for the centroid and the elongation of the sources
+    rows, cols = divmod(pixels, data.shape[1])
+    cols = cols + 1.0
+    rows = rows + 1.0
+    weights = numpy.maximum(subtracted_values, 0)
+    sum_w = total(weights)
+
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        x = total(weights * cols) / sum_w
+        y = total(weights * rows) / sum_w
+        x2 = total(weights * cols ** 2) / sum_w - x ** 2
+        y2 = total(weights * rows ** 2) / sum_w - y ** 2
+        xy = total(weights * cols * rows) / sum_w - x * y
+
+        # The semi-major and semi-minor axes are the square roots of the
+        # eigenvalues of the covariance matrix, as in SExtractor
+        mean = (x2 + y2) / 2
+        diff = numpy.sqrt(((x2 - y2) / 2) ** 2 + xy ** 2)
+        a = numpy.sqrt(numpy.maximum(mean + diff, 0))
+        b = numpy.sqrt(numpy.maximum(mean - diff, 0))
+        elongation = a / b
+        snr = flux / noise
+        mag = 25 - 2.5 * numpy.log10(flux)
+        keep = (areas >= minarea) & (sum_w > 0) & (b > 0)
+
+    keep[0] = False # the background
+    keep = numpy.flatnonzero(keep)
+
+    stars = numpy.empty(len(keep), dtype = astromatic.Catalog.DTYPE)
+    stars['x'] = x[keep]
+    stars['y'] = y[keep]
+    stars['alpha'] = numpy.nan
+    stars['delta'] = numpy.nan
+    stars['area'] = areas[keep]
+    stars['mag'] = mag[keep]
+    stars['saturated'] = peaks[keep] >= saturation
+    stars['snr'] = snr[keep]
+    stars['elongation'] = elongation[keep]
+    stars['fwhm'] = numpy.nan
+
+    # The flux radius of the brightest sources, within an aperture of five
+    # times their semi-major axis (and at least 3.5 pixels, the minimum radius
+    # of the Kron aperture in the SExtractor configuration file)
+    brightest = numpy.argsort(flux[keep])[::-1][:nbrightest]
+    radius = numpy.clip(5 * a[keep][brightest], 3.5, MAX_RADIUS)
+    if len(brightest):
+        args = subtracted, stars['x'][brightest], stars['y'][brightest], radius
+        stars['fwhm'][brightest] = 2 * _flux_radius(*args)
+
+    return astromatic.Catalog.from_array(stars)
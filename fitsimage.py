@@ -32,23 +32,30 @@ import astropy.io
 import astropy.wcs
 import calendar
 import collections
+import contextlib
 import datetime
 import fnmatch
+import gzip
 import hashlib
 import itertools
 import logging
+import multiprocessing.pool
 import numpy
 import numbers
 import os
 import os.path
 import pyfits
 import re
+import shutil
+import sqlite3
+import tempfile
 import warnings
 
 # LEMON modules
 import keywords
 import methods
 import passband
+import headerindex
 import style
 
 # Ignore the "adding a HIERARCH keyword" PyFITS warning that is emitted when
@@ -65,16 +72,264 @@ class NoWCSInformationError(ValueError):
     """ Raised if WCS information is not found in a FITS header. """
     pass
 
+# The maximum number of astropy.wcs.WCS objects kept in memory by each process,
+# and the cache, ordered from least to most recently used (see _get_wcs()).
+WCS_CACHE_SIZE = 64
+_wcs_cache = collections.OrderedDict()
+
+# The headerindex.HeaderIndex consulted by FITSImage, so that the header of
+# each image is read from disk only once, and the values that are derived from
+# it (such as the photometric filter) computed only once. Disabled by default:
+# LEMON commands enable it with set_header_index() (see --header-index).
+_header_index = None
+
+# The first two bytes of every gzip-compressed file
+GZIP_MAGIC = '\x1f\x8b'
+
+# The extensions of compressed FITS files, removed by splitext() along with
+# the extension of the uncompressed file: gzip-compressed files and those
+# compressed with fpack (tiled image compression, such as Rice).
+COMPRESSED_EXTENSIONS = ('.gz', '.fz')
+
+# The directory where compressed FITS images are decompressed for the external
+# tools (SExtractor, IRAF, Astrometry.net) that cannot read them, and the
+# maximum size, in bytes, of its contents. A tmpfs (/dev/shm) is used if it is
+# available, so that the decompressed images never touch the disk.
+DECOMPRESSION_DIR = None
+DECOMPRESSION_CACHE_SIZE = 2 * 1024 ** 3
+
+def splitext(path):
+    """ Split the path into a pair (root, ext), ignoring any compression.
+
+    Like os.path.splitext(), but the extension of compressed files (e.g.,
+    '.gz' or '.fz') is also removed from 'root', and not returned as part of
+    'ext'. For example, 'ferM_0013.fits.fz' returns ('ferM_0013', '.fits').
+    If there is no extension left after removing that of the compression,
+    '.fits' is returned, so that 'ferM_0013.fz' returns the same tuple.
+
+    """
+
+    root, ext = os.path.splitext(path)
+    if ext.lower() not in COMPRESSED_EXTENSIONS:
+        return root, ext
+    root, ext = os.path.splitext(root)
+    return root, ext or '.fits'
+
+def _decompression_dir():
+    """ Return the directory where compressed images are decompressed. """
+
+    if DECOMPRESSION_DIR is not None:
+        parent = DECOMPRESSION_DIR
+    elif os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        parent = '/dev/shm'
+    else:
+        parent = tempfile.gettempdir()
+
+    path = os.path.join(parent, 'lemon-decompressed-%d' % os.getuid())
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+def set_header_index(path):
+    """ Use the persistent header index stored at 'path'.
+
+    From now on, FITSImage objects take the header of the images from (and
+    store it into) the header index, instead of reading it from the file, as
+    long as the file has not changed since it was indexed. Also, the values
+    returned by FITSImage.date(), pfilter() and center_wcs() are cached in the
+    index. If 'path' is None or an empty string, the header index is disabled.
+    So it is, logging the error, if the database cannot be opened or created.
+
+    """
+
+    global _header_index
+    _header_index = None
+    if path:
+        try:
+            _header_index = headerindex.HeaderIndex(path)
+        except sqlite3.Error, e:
+            msg = "cannot open header index %s (%s), disabled"
+            logging.warning(msg % (path, e))
+
+class HeaderEdit(object):
+    """ A batch of changes to the header of a FITS image.
+
+    Objects of this class are returned by FITSImage.header_edit(), and record
+    the changes to be made to the header of the image: keywords to update or
+    delete and HISTORY records to add. These changes are applied immediately
+    to a copy of the in-memory header, so that errors are detected as soon as
+    possible, but they are not written to disk until HeaderEdit.flush() is
+    called, opening the FITS file only once, regardless of how many changes
+    were made to its header.
+
+    """
+
+    # The number of blank cards (one 2880-byte block) added at the end of the
+    # header every time that it grows beyond the size it has in the file. In
+    # this manner, as PyFITS uses these blank cards for new keywords, future
+    # changes will be written in place, without having to move the data.
+    PADDING = 2880 // pyfits.Card.length
+
+    def __init__(self, img):
+        self.img = img
+        self.header = img._header.copy()
+        self._changes = []
+
+    @staticmethod
+    def _update(header, keyword, value, comment):
+        header[keyword] = (value, comment)
+
+    @staticmethod
+    def _delete(header, keyword):
+        # Future versions of PyFITS (by 3.2 or 3.3, most probably) will raise
+        # KeyError when a non-existent keyword is deleted, just like a dict
+        # would, so we better get ready for this.
+        try:
+            del header[keyword]
+        except KeyError:
+            pass
+
+    @staticmethod
+    def _add_history(header, history):
+        header.add_history(history)
+
+    def _apply(self, header, function, *args):
+        """ Apply one of the changes to a header, ignoring PyFITS warnings.
+
+        Ignore the 'card is too long, comment is truncated' warning printed by
+        PyRAF in case, well, the comment is too long, and the DeprecationWarning
+        emitted by PyFITS when a non-existent keyword is deleted.
+
+        """
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            function(header, *args)
+
+    def update(self, keyword, value, comment = None):
+        """ Update the value of a FITS keyword, adding it if it does not exist.
+
+        See FITSImage.update_keyword() for further information. ValueError is
+        raised here if a HIERARCH keyword and its value are too long.
+
+        """
+
+        path = self.img.path
+        if len(keyword) > 8:
+            msg = "%s: keyword '%s' is longer than eight characters or " \
+                  "contains spaces; a HIERARCH card will be created"
+            logging.debug(msg % (path, keyword))
+
+        try:
+            args = keyword, value, comment
+            self._apply(self.header, self._update, *args)
+            self._changes.append((self._update, args))
+
+        except ValueError, e:
+
+            # ValueError is raised if a HIERARCH keyword is used and the total
+            # length (keyword, equal sign string and value) is greater than 80
+            # characters. The default exception message is a bit cryptic ("The
+            # keyword {...} with its value is too long"), so add some more
+            # information to help the user understand what went wrong.
+
+            pattern = "The keyword .*? with its value is too long"
+            if re.match(pattern, str(e)):
+                assert len(keyword) > 8
+                msg = ("%s: keyword '%s' could not be updated (\"%s\"). Note "
+                       "that PyFITS does not support CONTINUE for HIERARCH. "
+                       "In other words: if your keyword has more than eight "
+                       "characters or contains spaces, the total length of "
+                       "the keyword with its value cannot be longer than %d "
+                       "characters.")
+                args = path, keyword, str(e), pyfits.Card.length
+                logging.warning(msg % args)
+                raise ValueError(msg % args)
+            else:
+                # Different ValueError, re-raise it
+                msg = "%s: keyword '%s' could not be updated (%s)"
+                args = path, keyword, e
+                logging.warning(msg % args)
+                raise
+
+        msg = "%s: keyword '%s' to be updated to '%s'" % (path, keyword, value)
+        if comment:
+            msg += " with comment '%s'" % comment
+        logging.debug(msg)
+
+    def delete(self, keyword):
+        """ Delete a keyword, if present, from the header of the FITS image. """
+
+        self._apply(self.header, self._delete, keyword)
+        self._changes.append((self._delete, (keyword,)))
+
+    def add_history(self, history):
+        """ Add another record to the history of the FITS image. """
+
+        self._apply(self.header, self._add_history, history)
+        self._changes.append((self._add_history, (history,)))
+
+    def flush(self):
+        """ Write all the changes to the header of the FITS image.
+
+        Open the FITS file once, apply all the changes and close it. If the
+        header grows beyond the number of 2880-byte blocks that it occupies on
+        disk, blank cards are added at its end, so that the next time that it
+        is modified it will (most probably) be possible to do it in place. The
+        in-memory copy of the header of the FITSImage is updated.
+
+        """
+
+        if not self._changes:
+            return
+
+        path = self.img.path
+        self.img._discard_from_index()
+        handler = pyfits.open(path, mode = 'update')
+        msg = "%s: file opened to update header (%d changes)"
+        logging.debug(msg % (path, len(self._changes)))
+
+        try:
+            header = handler[self.img.hdu].header
+            size = len(header.tostring())
+            for function, args in self._changes:
+                self._apply(header, function, *args)
+
+            if len(header.tostring()) > size:
+                msg = "%s: header grows, adding %d blank cards as padding"
+                logging.debug(msg % (path, self.PADDING))
+                for _ in xrange(self.PADDING):
+                    header.append(pyfits.Card(), useblanks = False, bottom = True)
+
+            # Update in-memory copy of the FITS header
+            self.img._header = header
+            self._changes = []
+
+        except Exception, e:
+            msg = "%s: header could not be updated (%s)"
+            logging.warning(msg % (path, e))
+            raise
+
+        finally:
+            handler.close(output_verify = 'ignore')
+            msg = "%s: file closed" % path
+            logging.debug(msg)
+
 class FITSImage(object):
     """ Encapsulates a FITS image located in the filesystem. """
 
-    def __init__(self, path):
+    def __init__(self, path, memmap = False):
         """ Instantiation method for the FITSImage class.
 
         A copy of the header of the FITS file is kept in memory for fast access
         to its keywords. IOError is raised if 'path' does not exist or is not
         readable, and NonStardardFITS in case that it does not conform to the
-        FITS standard or it simply is not a FITS file at all.
+        FITS standard or it simply is not a FITS file at all. Only the primary
+        header is read from disk: the pixels are not loaded until they are
+        needed, the first time that the FITSImage.data property is accessed.
 
         FITS Standard Document:
         http://fits.gsfc.nasa.gov/fits_standard.html
@@ -94,78 +349,341 @@ class FITSImage(object):
         why we instruct PyFITS to ignore any FITS standard violations we come
         across (output_verify = 'ignore').
 
+        Compressed images are also supported: both gzip-compressed files
+        (e.g., '.fits.gz') and those compressed with fpack, using the tiled
+        image compression convention (e.g., Rice-compressed '.fits.fz'). In
+        the latter case, the primary HDU is empty, so the header and data of
+        the image are those of the first extension, which is stored in the
+        FITSImage.hdu attribute. The FITSImage.compression attribute is None
+        for uncompressed images and 'gzip' or 'tile' otherwise.
+
+        Keyword arguments:
+        memmap - memory-map the data of the image when the FITSImage.data
+                 property is accessed, instead of reading all of it into
+                 memory. Useful when only a small part of a large image is
+                 needed (e.g., the pixels around some astronomical objects).
+                 Ignored for compressed images, which are always decompressed
+                 in memory.
+
         """
 
         if not os.path.exists(path):
             raise IOError("file '%s' does not exist" % path)
 
         self.path = path
+        self.memmap = memmap
+        self.hdu = 0
+        self.compression = None
+        self._data = None
+
+        # Use the copy of the header stored in the persistent header index,
+        # if enabled and up to date, instead of reading it from the file.
+        # Along with it, we need to know in which HDU the image is stored.
+        header = None
+        if _header_index is not None and os.access(self.path, os.R_OK):
+            header = _header_index.header(self.path)
+            try:
+                self.hdu, self.compression = self._from_index('layout')
+            except KeyError:
+                header = None
 
+        if header is not None:
+            self._header = pyfits.Header.fromstring(header)
+        else:
+            self._read_header()
+            if _header_index is not None:
+                _header_index.add_header(self.path, self._header.tostring())
+                self._to_index('layout', (self.hdu, self.compression))
+
+        # Take the size of the image from the NAXISn keywords, instead of from
+        # the shape of the data array: PyFITS loads the HDUs lazily, so in this
+        # manner the pixels are never read from disk, but only the header.
         try:
-            # The file must be opened to make sure it is a standard FITS.
-            # We would rather use the with statement, but in that case we
-            # would not be able to set the output verification of close() to
-            # 'ignore'. Thus, the default option, 'exception', which raises
-            # an exception if any FITS standard is violated, would be used.
-            handler = pyfits.open(self.path, mode = 'readonly')
-            try:
+            naxis = self._header.get('NAXIS', 0)
+            axes = xrange(1, naxis + 1)
+            self.size = tuple(self._header['NAXIS%d' % n] for n in axes)
+        except KeyError, e:
+            msg = "%s (%s)" % (self.path, str(e))
+            raise NonStandardFITS(msg)
 
-                # This is kind of an ugly hack to make sure that all PyFITS
-                # versions are supported. Up to version 3.2, PyFITS returned
-                # the HDUs exactly as it saw them. This allowed us to check the
-                # existence and value of the 'SIMPLE' keyword in order to make
-                # sure the file conforms to the FITS standard. However, PyFITS
-                # 3.3 changed this, and now adds the keywords required for a
-                # minimal viable primary HDU: this means that the header will
-                # always contain the 'SIMPLE' keyword. Refer to this link for
-                # more info: https://github.com/spacetelescope/PyFITS/issues/94
+    def _read_header(self):
+        """ Read the primary header of the FITS image from disk.
 
-                try:
-                    type_ = pyfits.info(self.path, output=False)[0][2]
-                    if type_ == 'NonstandardHDU':
-                        # 'SIMPLE' exists but does not equal 'T'
-                        msg = "%s: value of 'SIMPLE' keyword is not 'T'"
-                        raise NonStandardFITS(msg % self.path)
-
-                except AttributeError as e:
-                    # 'SIMPLE' keyword does not exist
-                    error_msg = "'_ValidHDU' object has no attribute '_summary'"
-                    assert error_msg in str(e)
-                    msg = "%s: 'SIMPLE' keyword missing from header"
-                    raise NonStandardFITS(msg % self.path)
-
-                # A copy of the FITS header is kept in memory and the file is
-                # closed; otherwise we may run into trouble when working with
-                # thousands of images ("too many open files" and such). This
-                # approach gives us fast read-only access to the image header;
-                # if modified, we will have to take care of 'reloading' (call
-                # it synchronize, if you wish) the header.
-
-                self.size = handler[0].data.shape[::-1]
-                self._header = handler[0].header
-            finally:
-                handler.close(output_verify = 'ignore')
+        Store the header in self._header, raising IOError if we do not have
+        permission to open the file and NonStandardFITS if it does not conform
+        to the FITS standard (see FITSImage.__init__() for the details).
 
-        # PyFITS raises IOError if we do not have permission to open the file,
-        # if we attempt to open a non-FITS file, and also if we open one whose
-        # first keyword is not either SIMPLE or XTENSION. Nothing is raised if
-        # the value of SIMPLE is 'F'; that is why we had to specifically make
-        # sure it was 'T' a few lines above.
-        except IOError, e:
-            pyfits_msg = "Block does not begin with SIMPLE or XTENSION"
-            if str(e) == pyfits_msg:
+        """
+
+        # Raises IOError if we do not have permission to open the file. The
+        # file is opened only once: we check that it begins with 'SIMPLE' and
+        # then hand the same file object over to PyFITS to parse the header.
+        # Gzip-compressed files are decompressed on the fly, as they are read.
+        with open(self.path, 'rb') as raw_fd:
+
+            magic = raw_fd.read(len(GZIP_MAGIC))
+            raw_fd.seek(0)
+            if magic == GZIP_MAGIC:
+                self.compression = 'gzip'
+                fd = gzip.GzipFile(fileobj = raw_fd, mode = 'rb')
+            else:
+                fd = raw_fd
+
+            # This used to be done with pyfits.info(), re-opening the file, as
+            # PyFITS >= 3.3 adds the keywords required for a minimal viable
+            # primary HDU, which means that the header that it returns always
+            # contains the 'SIMPLE' keyword. Refer to this link for more info:
+            # https://github.com/spacetelescope/PyFITS/issues/94. Instead, read
+            # the first card (eighty characters) of the file and parse it.
+
+            first_card = fd.read(pyfits.Card.length)
+            if not first_card.startswith('SIMPLE'):
                 msg = "%s: 'SIMPLE' keyword missing from primary header"
                 raise NonStandardFITS(msg % self.path)
-            elif "Permission denied" in str(e):
-                raise
-            else:
+
+            try:
+                simple = pyfits.Card.fromstring(first_card).value
+            except Exception, e:
+                msg = "%s: 'SIMPLE' keyword cannot be parsed (%s)"
+                raise NonStandardFITS(msg % (self.path, str(e)))
+
+            if simple is not True:
+                msg = "%s: value of 'SIMPLE' keyword is not 'T'"
+                raise NonStandardFITS(msg % self.path)
+
+            fd.seek(0)
+
+            try:
+                # We would rather use the with statement, but in that case we
+                # would not be able to set the output verification of close()
+                # to 'ignore'. Thus, the default option, 'exception', which
+                # raises an exception if any FITS standard is violated, would
+                # be used.
+                handler = pyfits.open(fd, mode = 'readonly')
+                try:
+
+                    # A copy of the FITS header is kept in memory and the file
+                    # is closed; otherwise we may run into trouble when working
+                    # with thousands of images ("too many open files" and
+                    # such). This approach gives us fast read-only access to
+                    # the image header; if modified, we will have to take care
+                    # of 'reloading' (call it synchronize, if you wish) the
+                    # header.
+
+                    self._header = handler[0].header
+
+                    # Images compressed with fpack have an empty primary HDU,
+                    # followed by the compressed image (a binary table that
+                    # PyFITS presents as a CompImageHDU). Note that we do not
+                    # look beyond the primary HDU unless it has no data, as
+                    # otherwise the entire file would have to be read.
+                    if not self._header.get('NAXIS', 0):
+                        try:
+                            extension = handler[1]
+                        except IndexError:
+                            extension = None
+                        if isinstance(extension, pyfits.CompImageHDU):
+                            self.hdu = 1
+                            self.compression = 'tile'
+                            self._header = extension.header
+
+                finally:
+                    handler.close(output_verify = 'ignore')
+
+            # PyFITS raises IOError if we attempt to open a non-FITS file.
+            # Note that at this point we already know that the file begins
+            # with 'SIMPLE' and that its value is 'T'.
+            except IOError, e:
                 msg = "%s (%s)" % (self.path, str(e))
                 raise NonStandardFITS(msg)
 
+    @property
+    def data(self):
+        """ Return the pixels of the image, as a NumPy array.
+
+        The data of the primary HDU is read from disk the first time that this
+        property is accessed, and cached from then on, so that the pixels are
+        loaded only by those who actually need them. If the FITSImage object
+        was instantiated with memmap = True, the array is memory-mapped, so
+        only the pages of the file that are accessed are actually read.
+
+        """
+
+        if self._data is None:
+            memmap = self.memmap and not self.compression
+            kwargs = dict(mode = 'readonly', memmap = memmap)
+            handler = pyfits.open(self.path, **kwargs)
+            try:
+                self._data = handler[self.hdu].data
+            finally:
+                handler.close(output_verify = 'ignore')
+        return self._data
+
+    def decompress(self, dest_path):
+        """ Write an uncompressed copy of the FITS image to 'dest_path'.
+
+        The data is decompressed in memory and written, together with the
+        header, as the primary HDU of a new FITS file. Any existing file at
+        'dest_path' is overwritten. Works also for uncompressed images, which
+        are simply copied.
+
+        """
+
+        if not self.compression:
+            shutil.copy2(self.path, dest_path)
+            return
+
+        hdu = pyfits.PrimaryHDU(data = self.data, header = self._header)
+        if os.path.exists(dest_path):
+            os.unlink(dest_path)
+        hdu.writeto(dest_path, output_verify = 'ignore')
+
+    def compress(self, dest_path, method):
+        """ Write a compressed copy of the FITS image to 'dest_path'.
+
+        'method' must be 'gzip', to compress the entire file with gzip, or
+        'rice', to use the tiled image compression convention with the Rice
+        algorithm (as fpack does). Note that the latter is lossy for images
+        with floating-point pixels, which are quantized before compression.
+        Images already compressed with the same method are simply copied. Any
+        existing file at 'dest_path' is overwritten. The permission bits and
+        modification time of the image are copied too, as shutil.copy2() does.
+
+        """
+
+        if method not in ('gzip', 'rice'):
+            msg = "compression method must be 'gzip' or 'rice', not '%s'"
+            raise ValueError(msg % method)
+
+        if (method, self.compression) in (('gzip', 'gzip'), ('rice', 'tile')):
+            shutil.copy2(self.path, dest_path)
+            return
+
+        if os.path.exists(dest_path):
+            os.unlink(dest_path)
+
+        if method == 'gzip':
+            with self.plain_copy() as path, open(path, 'rb') as input_fd:
+                output_fd = gzip.open(dest_path, 'wb')
+                try:
+                    shutil.copyfileobj(input_fd, output_fd)
+                finally:
+                    output_fd.close()
+        else:
+            kwargs = dict(data = self.data, header = self._header,
+                          compression_type = 'RICE_1')
+            hdulist = pyfits.HDUList([pyfits.PrimaryHDU(),
+                                      pyfits.CompImageHDU(**kwargs)])
+            hdulist.writeto(dest_path, output_verify = 'ignore')
+
+        shutil.copystat(self.path, dest_path)
+
+    def _decompressed_path(self):
+        """ Return the path to the copy of the image in the cache directory.
+
+        The copies are identified by the path, size and modification time of
+        the compressed image. Note that the file may not exist yet.
+
+        """
+
+        stat = os.stat(self.path)
+        key = "%s:%d:%r" % (os.path.abspath(self.path),
+                            stat.st_size, stat.st_mtime)
+        root, ext = splitext(os.path.basename(self.path))
+        basename = "%s_%s%s" % (root, hashlib.sha1(key).hexdigest()[:16], ext)
+        return os.path.join(_decompression_dir(), basename)
+
+    def plain_path(self):
+        """ Return the path to an uncompressed version of the FITS image.
+
+        This is what must be given to the external tools (such as SExtractor,
+        IRAF or Astrometry.net) that do not support compressed images. For
+        uncompressed images, this is the path of the FITSImage itself; for
+        compressed ones, it is a copy in a cache directory (in tmpfs, if
+        available), decompressed the first time it is needed. The copies are
+        identified by the path, size and modification time of the compressed
+        image, and the least recently used ones are deleted when the size of
+        the cache exceeds DECOMPRESSION_CACHE_SIZE bytes. This means that the
+        copy may be deleted at any time by other processes: use plain_copy()
+        instead to give its path to an external tool.
+
+        """
+
+        if not self.compression:
+            return self.path
+
+        dest_path = self._decompressed_path()
+        directory, basename = os.path.split(dest_path)
+        root, ext = splitext(basename)
+
+        if os.path.exists(dest_path):
+            os.utime(dest_path, None) # most recently used now
+            return dest_path
+
+        # Decompress to a temporary file in the same directory and rename it,
+        # so that other processes never see a partial copy of the image.
+        kwargs = dict(prefix = '.', suffix = ext, dir = directory)
+        fd, tmp_path = tempfile.mkstemp(**kwargs)
+        os.close(fd)
+        try:
+            self.decompress(tmp_path)
+            os.rename(tmp_path, dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        msg = "%s: decompressed to %s"
+        logging.debug(msg % (self.path, dest_path))
+        args = directory, DECOMPRESSION_CACHE_SIZE
+        methods.evict_lru(*args, keep = dest_path)
+        return dest_path
+
+    @contextlib.contextmanager
+    def plain_copy(self):
+        """ A context manager that returns the path to an uncompressed image.
+
+        The same as plain_path(), but the copy of compressed images in the
+        cache directory is protected (see methods.pinned()) until the context
+        is exited, so that it is not deleted while an external tool may still
+        be reading it, no matter how many images are decompressed meanwhile.
+
+        """
+
+        if not self.compression:
+            yield self.path
+            return
+
+        with methods.pinned(self._decompressed_path()):
+            yield self.plain_path()
+
     def __repr__(self):
         """ The unambiguous string representation of a FITSImage object """
         return "%s(%r)" % (self.__class__.__name__, self.path)
 
+    def _from_index(self, key):
+        """ Return the value stored under 'key' in the header index.
+
+        Raises KeyError if the header index is disabled, if the value has not
+        been stored or if the image has been modified since it was indexed.
+
+        """
+
+        if _header_index is None:
+            raise KeyError(key)
+        return _header_index.get(self.path, key)
+
+    def _to_index(self, key, value):
+        """ Store a value in the header index, if it is enabled. """
+
+        if _header_index is not None:
+            _header_index.set(self.path, key, value)
+
+    def _discard_from_index(self):
+        """ Remove the image from the header index, as it is to be modified. """
+
+        if _header_index is not None:
+            _header_index.discard(self.path)
+
     def read_keyword(self, keyword):
         """ Read a keyword from the header of the FITS image.
 
@@ -192,6 +710,30 @@ class FITSImage(object):
             msg = "%s: keyword '%s' not found" % (self.path, keyword)
             raise KeyError(msg)
 
+    @contextlib.contextmanager
+    def header_edit(self):
+        """ Context manager to modify the header of the image in a single write.
+
+        Return a HeaderEdit object, on which any number of keywords can be
+        updated (HeaderEdit.update()) and deleted (HeaderEdit.delete()), and
+        HISTORY records added (HeaderEdit.add_history()). The changes are not
+        written to disk until the with statement exits, at which point the
+        file is opened only once. If an exception is raised inside the body
+        of the with statement, nothing is written. For example:
+
+        with img.header_edit() as header:
+            header.update('FWHM', 2.75, comment = "Full width at half maximum")
+            header.delete('OLDKEY')
+            header.add_history("Seeing computed by LEMON")
+
+        The in-memory copy of the header is also updated.
+
+        """
+
+        edit = HeaderEdit(self)
+        yield edit
+        edit.flush()
+
     def update_keyword(self, keyword, value, comment = None):
         """ Updates the value of a FITS keyword, adding it if it does not exist.
 
@@ -206,74 +748,16 @@ class FITSImage(object):
         support CONTINUE for HIERARCH. If the value is too long, therefore,
         make sure that the keyword does not need to be HIERARCH-ed.
 
+        Each call to this method writes the header to disk: use header_edit()
+        to modify several keywords at once.
+
         Keyword arguments:
         comment - the comment to be added to the keyword.
 
         """
 
-        if len(keyword) > 8:
-            msg = "%s: keyword '%s' is longer than eight characters or " \
-                  "contains spaces; a HIERARCH card will be created"
-            logging.debug(msg % (self.path, keyword))
-
-        handler = pyfits.open(self.path, mode = 'update')
-        msg = "%s: file opened to update '%s' keyword" % (self.path, keyword)
-        logging.debug(msg)
-
-        try:
-            header = handler[0].header
-
-            # Ignore the 'card is too long, comment is truncated' warning
-            # printed by PyRAF in case, well, the comment is too long.
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore')
-                header[keyword] = (value, comment)
-                args = self.path, keyword, value
-                msg = "%s: keyword '%s' updated to '%s'" % args
-                if comment:
-                    msg += " with comment '%s'" % comment
-                logging.debug(msg)
-
-            # Update in-memory copy of the FITS header
-            self._header = header
-
-        except ValueError, e:
-
-            # ValueError is raised if a HIERARCH keyword is used and the total
-            # length (keyword, equal sign string and value) is greater than 80
-            # characters. The default exception message is a bit cryptic ("The
-            # keyword {...} with its value is too long"), so add some more
-            # information to help the user understand what went wrong.
-
-            pattern = "The keyword .*? with its value is too long"
-            if re.match(pattern, str(e)):
-                assert len(keyword) > 8
-                msg = ("%s: keyword '%s' could not be updated (\"%s\"). Note "
-                       "that PyFITS does not support CONTINUE for HIERARCH. "
-                       "In other words: if your keyword has more than eight "
-                       "characters or contains spaces, the total length of "
-                       "the keyword with its value cannot be longer than %d "
-                       "characters.")
-                args = self.path, keyword, str(e), pyfits.Card.length
-                logging.warning(msg % args)
-                raise ValueError(msg % args)
-            else:
-                # Different ValueError, re-raise it
-                msg = "%s: keyword '%s' could not be updated (%s)"
-                args = self.path, keyword, e
-                logging.warning(msg % args)
-                raise
-
-        except Exception, e:
-            msg = "%s: keyword '%s' could not be updated (%s)"
-            args = self.path, keyword, e
-            logging.warning(msg % args)
-            raise
-
-        finally:
-            handler.close(output_verify = 'ignore')
-            msg = "%s: file closed" % self.path
-            logging.debug(msg)
+        with self.header_edit() as header:
+            header.update(keyword, value, comment = comment)
 
     def delete_keyword(self, keyword):
         """ Delete a keyword from the header of the FITS image.
@@ -284,28 +768,8 @@ class FITSImage(object):
 
         """
 
-        handler = pyfits.open(self.path, mode = 'update')
-        try:
-            header = handler[0].header
-            try:
-                # Ignore DeprecationWarning: "Deletion of non-existent
-                # keyword [...] In a future PyFITS version Header.__delitem__
-                # may be changed so that this raises a KeyError just like a
-                # dict would. Please update your code so that KeyErrors are
-                # caught and handled when deleting non-existent keywords.
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    del header[keyword]
-                # Update in-memory copy of the FITS header
-                self._header = header
-
-            # Future versions of PyFITS (by 3.2 or 3.3, most probably) will
-            # raise KeyError when a non-existent keyword is deleted, just
-            # like a dictionary would, so we better get ready for this.
-            except KeyError:
-                pass
-        finally:
-            handler.close(output_verify = 'ignore')
+        with self.header_edit() as header:
+            header.delete(keyword)
 
     def add_history(self, history):
         """ Add another record to the history of the FITS image.
@@ -314,17 +778,12 @@ class FITSImage(object):
         associated value; columns 9-80 may contain any ASCII text. The text
         should contain a history of steps and procedures associated with the
         processing of the associated data. Any number of HISTORY card images
-        may appear in a header. The in-memory copy of the header is not
-        updated.
+        may appear in a header.
 
         """
 
-        handler = pyfits.open(self.path, mode = 'update')
-        try:
-            header = handler[0].header
+        with self.header_edit() as header:
             header.add_history(history)
-        finally:
-            handler.close(output_verify = 'ignore')
 
     def date(self, date_keyword = 'DATE-OBS', time_keyword = 'TIME-OBS',
              exp_keyword = 'EXPTIME'):
@@ -367,6 +826,12 @@ class FITSImage(object):
 
         """
 
+        index_key = 'date:%s:%s:%s' % (date_keyword, time_keyword, exp_keyword)
+        try:
+            return self._from_index(index_key)
+        except KeyError:
+            pass
+
         # Throws KeyError is the specified keyword is not found in the header
         start_date_str = self.read_keyword(date_keyword).strip()
 
@@ -457,7 +922,9 @@ class FITSImage(object):
         seconds_fraction = float(start_date.strftime('.%f'))
         start_struct_time = start_date.utctimetuple()
         start_date = calendar.timegm(start_struct_time) + seconds_fraction
-        return start_date + half_exp_time
+        unix_time = start_date + half_exp_time
+        self._to_index(index_key, unix_time)
+        return unix_time
 
     def year(self, **kwargs):
         """ Return the date of observation (UTC) as a fractional year.
@@ -503,9 +970,17 @@ class FITSImage(object):
 
         """
 
+        index_key = 'pfilter:%s' % keyword
+        try:
+            return passband.Passband(self._from_index(index_key))
+        except KeyError:
+            pass
+
         try:
             pfilter_str = self.read_keyword(keyword)
-            return passband.Passband(pfilter_str)
+            pfilter = passband.Passband(pfilter_str)
+            self._to_index(index_key, str(pfilter))
+            return pfilter
         except passband.NonRecognizedPassband:
             kwargs = dict(path = self.path, keyword = keyword)
             raise passband.NonRecognizedPassband(pfilter_str, **kwargs)
@@ -623,7 +1098,7 @@ class FITSImage(object):
 
         str_char = ''
         basename = os.path.basename(self.path)
-        root = os.path.splitext(basename)[0]
+        root = splitext(basename)[0]
         for character in root:
             try:
                 int(character)
@@ -648,39 +1123,65 @@ class FITSImage(object):
         """ Returns the x, y coordinates of the central pixel of the image. """
         return list(int(round(x / 2)) for x in self.size)
 
-    @methods.memoize
     def _get_wcs(self):
-        """ Return the astropy.wcs.WCS object for the header of this image. """
+        """ Return the astropy.wcs.WCS object for the header of this image.
 
-        # astropy.wcs.WCS() is extremely slow (in the order of minutes) if we
-        # work with the in-memory FITS header (self._header). I cannot fathom
-        # the reason, but the problem goes away if we use astropy.io.fits to
-        # load the FITS header, as illustrated in the Astropy documentation:
-        # http://docs.astropy.org/en/stable/wcs/index.html
-        with astropy.io.fits.open(self.path) as hdulist:
-            header = hdulist[0].header
+        The WCS objects are stored in a bounded, per-process cache, keyed by
+        the identity of the file (absolute path, size, modification time and
+        inode), so that they are shared by all the FITSImage instances of the
+        same image and discarded if the file is modified.
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            return astropy.wcs.WCS(header)
+        """
 
-    def pix2world(self, x, y):
-        """ Transform pixel coordinates to world coordinates.
+        stat = os.stat(self.path)
+        key = (os.path.abspath(self.path), stat.st_size,
+               stat.st_mtime, stat.st_ino)
 
-        Return a two-element tuple with the right ascension and declination to
-        which the specified x- and y-coordinates correspond in the FITS image.
-        Raises NoWCSInformationError if the header of the FITS image does not
-        contain an astrometric solution -- i.e., if the astropy.wcs.WCS class
-        is unable to recognize it as such. This is something that should very
-        rarely happen, and almost positively caused by non-standard systems or
-        FITS keywords.
+        try:
+            wcs = _wcs_cache.pop(key)
+        except KeyError:
+
+            # astropy.wcs.WCS() is extremely slow (in the order of minutes) if
+            # we work with the in-memory FITS header (self._header). I cannot
+            # fathom the reason, but the problem goes away if we use
+            # astropy.io.fits to load the FITS header, as illustrated in the
+            # Astropy documentation:
+            # http://docs.astropy.org/en/stable/wcs/index.html
+            with astropy.io.fits.open(self.path) as hdulist:
+                header = hdulist[0].header
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                wcs = astropy.wcs.WCS(header)
+
+            # Evict the least recently used WCS object if the cache is full
+            while len(_wcs_cache) >= WCS_CACHE_SIZE:
+                _wcs_cache.popitem(last = False)
+
+        # (Re)insert it, so that it becomes the most recently used one
+        _wcs_cache[key] = wcs
+        return wcs
+
+    def _transform(self, method, u, v):
+        """ Apply a transformation of the WCS object to a pair of coordinates.
+
+        'method' is the name of the method of astropy.wcs.WCS to be used, such
+        as 'all_pix2world'. 'u' and 'v' may be two scalars (and a two-element
+        tuple of floats is returned) or two array-like objects of the same
+        length, in which case all the points are transformed in a single call
+        and two NumPy arrays are returned.
 
         """
 
-        coords = (x, y)
+        scalar = numpy.isscalar(u) and numpy.isscalar(v)
+        u = numpy.atleast_1d(numpy.asarray(u, dtype = numpy.float64))
+        v = numpy.atleast_1d(numpy.asarray(v, dtype = numpy.float64))
+        if u.shape != v.shape:
+            msg = "coordinate arrays must have the same shape (%s and %s)"
+            raise ValueError(msg % (u.shape, v.shape))
+
         wcs = self._get_wcs()
-        pixcrd = numpy.array([coords])
-        ra, dec = wcs.all_pix2world(pixcrd, 1)[0]
+        a, b = getattr(wcs, method)(u, v, 1)
 
         # We could use astropy.wcs.WCS.has_celestial for this, but as of today
         # [Tue Jan 20 2015] it is only available in the development version of
@@ -689,14 +1190,90 @@ class FITSImage(object):
         # will not be able to transform the pixel coordinates, and therefore
         # will return the same coordinates as the FITSImage.center attribute.
 
-        if (ra, dec) == coords:
+        if u.size and numpy.array_equal(a, u) and numpy.array_equal(b, v):
             msg = ("{0}: the header of the FITS image does not seem to "
                    "contain WCS information. You may want to make sure that "
                    "the image has been solved astrometrically, for example "
                    "with the 'astrometry' LEMON command.".format(self.path))
             raise NoWCSInformationError(msg)
 
-        return ra, dec
+        if scalar:
+            return float(a[0]), float(b[0])
+        return a, b
+
+    def pix2world(self, x, y):
+        """ Transform pixel coordinates to world coordinates.
+
+        Return a two-element tuple with the right ascension and declination to
+        which the specified x- and y-coordinates correspond in the FITS image.
+        'x' and 'y' may also be sequences (or NumPy arrays) of coordinates, in
+        which case all of them are transformed at once and two NumPy arrays,
+        with the right ascensions and declinations, are returned.
+
+        Raises NoWCSInformationError if the header of the FITS image does not
+        contain an astrometric solution -- i.e., if the astropy.wcs.WCS class
+        is unable to recognize it as such. This is something that should very
+        rarely happen, and almost positively caused by non-standard systems or
+        FITS keywords.
+
+        """
+
+        return self._transform('all_pix2world', x, y)
+
+    def world2pix(self, ra, dec):
+        """ Transform world coordinates to pixel coordinates.
+
+        The inverse of FITSImage.pix2world(): return a two-element tuple with
+        the x- and y-coordinates (one-based, as in IRAF) to which the specified
+        right ascension and declination correspond in the FITS image. 'ra' and
+        'dec' may also be sequences (or NumPy arrays), in which case two NumPy
+        arrays are returned. Raises NoWCSInformationError if the header of the
+        FITS image does not contain an astrometric solution.
+
+        """
+
+        return self._transform('all_world2pix', ra, dec)
+
+    def footprint(self, ra, dec, margin = 0):
+        """ Determine which celestial coordinates fall within the image.
+
+        'ra' and 'dec' are two sequences (or NumPy arrays) with the right
+        ascensions and declinations of the astronomical objects. Return a
+        boolean NumPy array, True for those objects that fall on the pixels of
+        the image (as given by NAXIS1 and NAXIS2) or at most
+        'margin' pixels away from its edges. All the coordinates are
+        transformed at once, with the core WCS transformation, as distortions
+        (if any) are assumed to be much smaller than the margin.
+
+        Objects more than ninety degrees away from the center of the image are
+        always outside of its footprint: the gnomonic (TAN) projection maps
+        them to the opposite side of the projection plane, so their pixel
+        coordinates could spuriously fall within the image. Raises
+        NoWCSInformationError if the header of the FITS image does not contain
+        an astrometric solution.
+
+        """
+
+        ra = numpy.atleast_1d(numpy.asarray(ra, dtype = numpy.float64))
+        dec = numpy.atleast_1d(numpy.asarray(dec, dtype = numpy.float64))
+        if not ra.size:
+            return numpy.zeros(ra.shape, dtype = bool)
+
+        def unit_vectors(ra, dec):
+            ra, dec = numpy.radians(ra), numpy.radians(dec)
+            return (numpy.cos(dec) * numpy.cos(ra),
+                    numpy.cos(dec) * numpy.sin(ra),
+                    numpy.sin(dec))
+
+        center = unit_vectors(*self.center_wcs())
+        points = unit_vectors(ra, dec)
+        near = sum(c * p for c, p in zip(center, points)) > 0
+
+        x, y = self._transform('wcs_world2pix', ra, dec)
+        with numpy.errstate(invalid = 'ignore'):
+            inside  = (x >= 0.5 - margin) & (x <= self.x_size + 0.5 + margin)
+            inside &= (y >= 0.5 - margin) & (y <= self.y_size + 0.5 + margin)
+        return near & inside
 
     def center_wcs(self):
         """ Return the world coordinates of the central pixel of the image.
@@ -719,8 +1296,16 @@ class FITSImage(object):
 
         """
 
+        index_key = 'center_wcs'
+        try:
+            return tuple(self._from_index(index_key))
+        except KeyError:
+            pass
+
         center = tuple(self.center)
-        return self.pix2world(*center)
+        ra, dec = self.pix2world(*center)
+        self._to_index(index_key, (ra, dec))
+        return ra, dec
 
     def has_wcs(self):
         """ Check whether the header of the image contains WCS information. """
@@ -783,13 +1368,46 @@ class FITSImage(object):
 
     @property
     def sha1sum(self):
-        """ Return the hexadecimal SHA-1 checksum of the FITS image """
+        """ Return the hexadecimal SHA-1 checksum of the FITS image.
+
+        The checksum is stored in the header index, if it is enabled, so that
+        the file does not have to be read again as long as it is not modified.
+
+        """
+
+        try:
+            return str(self._from_index('sha1sum'))
+        except KeyError:
+            pass
 
         sha1 = hashlib.sha1()
         with open(self.path, 'rb') as fd:
-            for line in fd:
-                sha1.update(line)
-            return sha1.hexdigest()
+            for chunk in iter(lambda: fd.read(1048576), ''):
+                sha1.update(chunk)
+
+        checksum = sha1.hexdigest()
+        self._to_index('sha1sum', checksum)
+        return checksum
+
+    @property
+    def data_sha1sum(self):
+        """ Return the hexadecimal SHA-1 checksum of the pixels of the image.
+
+        Unlike FITSImage.sha1sum, only the data of the image is hashed (once
+        decompressed, if needed), so the checksum does not change when the
+        header is modified. It is also stored in the header index, if enabled.
+
+        """
+
+        try:
+            return str(self._from_index('data_sha1sum'))
+        except KeyError:
+            pass
+
+        data = numpy.ascontiguousarray(self.data)
+        checksum = hashlib.sha1(data).hexdigest()
+        self._to_index('data_sha1sum', checksum)
+        return checksum
 
 
 class InputFITSFiles(collections.defaultdict):
@@ -855,15 +1473,24 @@ def find_files(paths, followlinks = True, pattern = None):
     pattern - the pattern, according to the rules used by the Unix shell (which
               are not the same as regular expressions) that the base name of a
               regular file must match to be considered when scanning the
-              paths. Non-matching files are ignored.
+              paths. Non-matching files are ignored. The extension of
+              compressed files (e.g., '.gz' or '.fz') is optional, so that
+              '*.fits' matches 'ferM_0013.fits.fz' too.
 
     """
 
+    def matches(basename):
+        if not pattern or fnmatch.fnmatch(basename, pattern):
+            return True
+        root, ext = os.path.splitext(basename)
+        if ext.lower() in COMPRESSED_EXTENSIONS:
+            return fnmatch.fnmatch(root, pattern)
+        return False
+
     files_paths = []
     for path in sorted(paths):
         if os.path.isfile(path):
-            basename = os.path.basename(path)
-            if not pattern or fnmatch.fnmatch(basename, pattern):
+            if matches(os.path.basename(path)):
                 files_paths.append(path)
 
         elif os.path.isdir(path):
@@ -877,3 +1504,119 @@ def find_files(paths, followlinks = True, pattern = None):
                                               pattern = pattern)
     return files_paths
 
+typename = 'HeaderInfo'
+field_names = "path, image, pfilter, date, keywords"
+class HeaderInfo(collections.namedtuple(typename, field_names)):
+    """ The information read from the primary header of a FITS file.
+
+    path - the path to the FITS file.
+    image - the FITSImage object, or None if the file could not be opened.
+    pfilter - the photometric filter, as a passband.Passband object, or None
+              if it was not read from the header.
+    date - the date of observation, in Unix time, or None if it was not read
+           from the header.
+    keywords - a dictionary mapping each of the FITS keywords that were read
+               to their values. Those not in the header are not in it either.
+
+    """
+    pass
+
+
+def _scan_header(args):
+    """ Function argument of imap() to read FITS headers in parallel.
+
+    'args' must be a five-element tuple with (1) the path to the FITS file, (2)
+    the keyword for the photometric filter, (3) a dictionary with the keyword
+    arguments for FITSImage.date(), (4) a sequence of FITS keywords to read,
+    and (5) whether errors must be ignored. Returns a HeaderInfo object. The
+    photometric filter and date of observation are None if the corresponding
+    arguments evaluate to False. If errors are ignored, fields which cannot be
+    read are set to None; otherwise, exceptions are propagated to the caller.
+
+    """
+
+    path, filterk, date_keywords, keywords, ignore_errors = args
+
+    try:
+        img = FITSImage(path)
+    except (IOError, NonStandardFITS), e:
+        if not ignore_errors:
+            raise
+        logging.debug("%s: ignored (%s)" % (path, str(e)))
+        return HeaderInfo(path, None, None, None, {})
+
+    pfilter = date = None
+
+    try:
+        if filterk:
+            pfilter = img.pfilter(filterk)
+            logging.debug("%s: filter = %s" % (path, pfilter))
+    except (KeyError, ValueError), e:
+        if not ignore_errors:
+            raise
+        logging.debug("%s: filter cannot be read (%s)" % (path, str(e)))
+
+    try:
+        if date_keywords:
+            date = img.date(**date_keywords)
+            msg = "%s: observation date: %.2f (%s)"
+            logging.debug(msg % (path, date, methods.utctime(date)))
+    except (KeyError, NonStandardFITS), e:
+        if not ignore_errors:
+            raise
+        logging.debug("%s: date cannot be read (%s)" % (path, str(e)))
+
+    values = {}
+    for keyword in keywords:
+        try:
+            values[keyword] = img.read_keyword(keyword)
+        except KeyError:
+            pass
+
+    return HeaderInfo(path, img, pfilter, date, values)
+
+def scan_headers(paths, filterk = None, date_keywords = None, keywords = (),
+                 ncores = None, ignore_errors = False):
+    """ Read the primary header of multiple FITS files in parallel.
+
+    Open each FITS file as a FITSImage object, read from its primary header the
+    photometric filter, the date of observation and any other FITS keyword we
+    need, and yield them as HeaderInfo objects, one for each path and in the
+    same order. Only the headers are read from disk, never the pixels. As most
+    of the time is spent waiting for I/O (especially if the files live on
+    network storage), the headers are read by a pool of threads, to which the
+    paths are handed out while the caller consumes the results -- so it may,
+    for example, update a progress bar after each file.
+
+    Keyword arguments:
+    filterk - the keyword for the photometric filter. If not given, the filter
+              is not read from the header and the 'pfilter' fields are None.
+    date_keywords - a dictionary with the keyword arguments to be passed down
+                    to FITSImage.date(). If not given, the date of observation
+                    is not read and the 'date' fields are None.
+    keywords - a sequence of FITS keywords to read from each header.
+    ncores - the number of threads in the pool. Defaults to the number of
+             CPUs in the system.
+    ignore_errors - by default, any exception raised while reading a header
+                    (e.g., NonStandardFITS, or KeyError if the filter keyword
+                    is missing) is propagated to the caller. If this argument
+                    is True, these errors are logged with level DEBUG and the
+                    field (or, if the file cannot be opened, all the fields
+                    but the path) set to None instead.
+
+    """
+
+    paths = list(paths)
+    if not paths:
+        return
+
+    args = ((path, filterk, date_keywords, keywords, ignore_errors)
+            for path in paths)
+
+    nthreads = min(ncores or multiprocessing.cpu_count(), len(paths))
+    pool = multiprocessing.pool.ThreadPool(nthreads)
+    try:
+        for info in pool.imap(_scan_header, args):
+            yield info
+    finally:
+        pool.terminate()
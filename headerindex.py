@@ -0,0 +1,241 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A persistent, on-disk index of the headers of FITS images.
+
+Most LEMON commands begin by reading the same keywords (the date of
+observation, the photometric filter, the exposure time, etc.) from the headers
+of the very same FITS images. With tens of thousands of files, re-opening each
+one of them over and over again is slow, so this module offers an SQLite
+database where the primary header of each image is stored, together with the
+values that are derived from it and that are expensive to compute, such as the
+photometric filter (a passband.Passband object) or the world coordinates of
+the center of the image.
+
+Each entry in the index is keyed by the absolute path of the image and records
+its size, modification time and inode number. Whenever one of these values
+changes (i.e., the file has been modified or replaced), the entry is considered
+to be stale and automatically discarded. The index is, thus, a cache: any error
+while writing to it is logged and ignored, as the values can always be read
+again from the FITS file. The same goes for errors while reading from it:
+they are logged and treated as if the image were not in the index.
+
+"""
+
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+
+class HeaderIndex(object):
+    """ An SQLite database that caches the headers of FITS images.
+
+    Two tables are used: 'files', which stores the primary header of each
+    image (as the string of 2880-byte blocks returned by Header.tostring())
+    together with the size, modification time and inode of the file, and
+    'derived', where any other JSON-serializable value that was computed from
+    the header (e.g., the date of observation) is stored under a key. Both are
+    invalidated when the file changes.
+
+    SQLite connections cannot be shared between threads or, after a fork(),
+    between processes, so each thread of each process opens its own connection
+    the first time that it accesses the index.
+
+    """
+
+    # Seconds to wait for the lock to go away if the database is being written
+    # by another process or thread; after that, the operation is abandoned.
+    TIMEOUT = 30
+
+    def __init__(self, path):
+        """ Connect to the index, creating it if it does not exist.
+
+        Raises sqlite3.Error if the database cannot be opened or created.
+
+        """
+
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self._local = threading.local()
+
+        with self._connection:
+            self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path   TEXT PRIMARY KEY,
+                size   INTEGER NOT NULL,
+                mtime  REAL NOT NULL,
+                inode  INTEGER NOT NULL,
+                header TEXT NOT NULL)
+            """)
+
+            self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS derived (
+                path  TEXT NOT NULL,
+                key   TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (path, key))
+            """)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    @property
+    def _connection(self):
+        """ Return the connection to the database for this thread/process. """
+
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            kwargs = dict(timeout = self.TIMEOUT)
+            self._local.connection = sqlite3.connect(self.path, **kwargs)
+            self._local.connection.text_factory = str
+            self._local.pid = pid
+        return self._local.connection
+
+    @staticmethod
+    def _stat(path):
+        """ Return the absolute path, size, mtime and inode of a file. """
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return path, stat.st_size, stat.st_mtime, stat.st_ino
+
+    def _is_fresh(self, path):
+        """ Return the absolute path of the file and whether its entry is valid.
+
+        Compare the size, modification time and inode of the file with those
+        stored in the index. The entry, if stale, is deleted. Raises OSError if
+        the file does not exist. If the index cannot be read, the error is
+        logged and the entry considered to be stale.
+
+        """
+
+        key = self._stat(path)
+        query = "SELECT size, mtime, inode FROM files WHERE path = ?"
+        try:
+            row = self._connection.execute(query, (key[0],)).fetchone()
+        except sqlite3.Error, e:
+            msg = "%s: cannot read from index %s (%s)"
+            logging.debug(msg % (key[0], self.path, e))
+            return key[0], False
+
+        if row is None:
+            return key[0], False
+        if tuple(row) != key[1:]:
+            self.discard(key[0])
+            return key[0], False
+        return key[0], True
+
+    def header(self, path):
+        """ Return the header of the FITS image stored in the index.
+
+        Return the string with the primary header of the image, as stored by
+        HeaderIndex.add_header(), or None if the image is not in the index or
+        if the file has changed since then.
+
+        """
+
+        path, fresh = self._is_fresh(path)
+        if not fresh:
+            return None
+        query = "SELECT header FROM files WHERE path = ?"
+        try:
+            row = self._connection.execute(query, (path,)).fetchone()
+        except sqlite3.Error, e:
+            msg = "%s: cannot read header from index %s (%s)"
+            logging.debug(msg % (path, self.path, e))
+            return None
+        return row[0] if row is not None else None
+
+    def add_header(self, path, header):
+        """ Store in the index the header (a string) of a FITS image.
+
+        Any previous entry for the file is replaced, and the values derived
+        from the old header removed from the index.
+
+        """
+
+        key = self._stat(path)
+        try:
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM derived WHERE path = ?", (key[0],))
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    key + (header,))
+        except sqlite3.Error, e:
+            msg = "%s: cannot add header to index %s (%s)"
+            logging.debug(msg % (key[0], self.path, e))
+
+    def get(self, path, key):
+        """ Return the value derived from the header of the image.
+
+        Return the (JSON-deserialized) value stored under 'key' for the FITS
+        image by HeaderIndex.set(). Raises KeyError if there is no such value
+        or if the file has changed since it was stored.
+
+        """
+
+        path, fresh = self._is_fresh(path)
+        if fresh:
+            query = "SELECT value FROM derived WHERE path = ? AND key = ?"
+            try:
+                row = self._connection.execute(query, (path, key)).fetchone()
+            except sqlite3.Error, e:
+                msg = "%s: cannot read '%s' from index %s (%s)"
+                logging.debug(msg % (path, key, self.path, e))
+                row = None
+            if row is not None:
+                return json.loads(row[0])
+        raise KeyError("%s: '%s' not in header index" % (path, key))
+
+    def set(self, path, key, value):
+        """ Store a JSON-serializable value derived from the header.
+
+        The value is stored only if the header of the image is in the index
+        (see HeaderIndex.add_header()) and the file has not changed since then.
+
+        """
+
+        path, fresh = self._is_fresh(path)
+        if not fresh:
+            return
+
+        try:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO derived VALUES (?, ?, ?)",
+                    (path, key, json.dumps(value)))
+        except sqlite3.Error, e:
+            msg = "%s: cannot store '%s' in index %s (%s)"
+            logging.debug(msg % (path, key, self.path, e))
+
+    def discard(self, path):
+        """ Remove from the index all the information about a FITS image. """
+
+        path = os.path.abspath(path)
+        try:
+            with self._connection:
+                for table in ('files', 'derived'):
+                    query = "DELETE FROM %s WHERE path = ?" % table
+                    self._connection.execute(query, (path,))
+        except sqlite3.Error, e:
+            msg = "%s: cannot remove from index %s (%s)"
+            logging.debug(msg % (path, self.path, e))
@@ -48,17 +48,17 @@ will be ignored.
 
 import collections
 import fnmatch
+import multiprocessing
 import numpy
-import operator
 import optparse
 import os.path
-import pyfits
 import re
 import shutil
 import sys
 
 # LEMON modules
 import customparser
+import defaults
 import keywords
 import fitsimage
 import methods
@@ -113,6 +113,27 @@ parser.add_option('--exact', action = 'store_true', default = False,
                   "added. The SHA-1 hash is used to verify that the copy of "
                   "the FITS images is identical.")
 
+parser.add_option('--compress', action = 'store', type = 'choice',
+                  dest = 'compress', default = None,
+                  choices = ['gzip', 'rice'],
+                  help = "compress the imported files, either with gzip (the "
+                  "entire file, adding the '.gz' extension) or using the "
+                  "tiled image compression convention with the Rice "
+                  "algorithm, as fpack does (adding the '.fz' extension). "
+                  "Rice compression is lossless for integer images, but "
+                  "quantizes (and therefore loses some precision of) those "
+                  "with floating-point pixels. Both compressed and "
+                  "uncompressed images are accepted as input by all the "
+                  "LEMON commands. Incompatible with --exact.")
+
+parser.add_option('--cores', action = 'store', type = 'int',
+                  dest = 'ncores', default = defaults.ncores,
+                  help = defaults.desc['ncores'])
+
+parser.add_option('--header-index', action = 'store', type = 'str',
+                  dest = 'header_index', default = defaults.header_index,
+                  help = defaults.desc['header_index'])
+
 key_group = optparse.OptionGroup(parser, "FITS Keywords",
                                  keywords.group_description)
 
@@ -145,6 +166,19 @@ key_group.add_option('--uik', action = 'store', type = 'str',
 parser.add_option_group(key_group)
 customparser.clear_metavars(parser)
 
+def median_counts(path):
+    """ Return the median number of counts of the pixels of a FITS image.
+
+    This is the function argument of map_async(), so that the median ADUs of
+    the images can be computed in parallel. The data of the primary HDU is
+    memory-mapped, so it is read from disk as NumPy needs it (unless the
+    image is compressed, in which case it is decompressed in memory).
+
+    """
+
+    img = fitsimage.FITSImage(path, memmap = True)
+    return float(numpy.median(img.data))
+
 def main(arguments = None):
     """ main() function, encapsulated in a method to allow for easy invokation.
 
@@ -166,6 +200,9 @@ def main(arguments = None):
         arguments = sys.argv[1:] # ignore argv[0], the script name
     (options, args) = parser.parse_args(args = arguments)
 
+    # Cache the headers of the FITS images in the persistent header index
+    fitsimage.set_header_index(options.header_index)
+
     # Print the help message and abort the execution if there are not two
     # positional arguments left after parsing the options, as the user must
     # specify the path to both the input and output directories.
@@ -177,6 +214,11 @@ def main(arguments = None):
         input_dirs = args[:-1]
         output_dir = args[-1]
 
+    if options.exact and options.compress:
+        print "%sError. The --exact and --compress options are mutually " \
+              "exclusive." % style.prefix
+        return 2
+
     # Make sure that all the input directories exist, abort otherwise.
     for path in input_dirs:
         if not os.path.exists(path):
@@ -210,15 +252,31 @@ def main(arguments = None):
     print "%sDetecting FITS images among the %d indexed regular files..." % \
           (style.prefix, len(files_paths))
 
+    # Read the primary header of all the files in parallel. Those that are not
+    # FITS files are ignored, and so are the dates of observation that cannot
+    # be read from the header: these images will be discarded later on, when
+    # the FITS files are sorted by their date.
+
+    date_keywords = dict(date_keyword = options.datek,
+                         time_keyword = options.timek,
+                         exp_keyword = options.exptimek)
+
+    kwargs = dict(date_keywords = date_keywords,
+                  keywords = [options.objectk],
+                  ncores = options.ncores,
+                  ignore_errors = True)
+
+    headers = fitsimage.scan_headers(files_paths, **kwargs)
+
     images_set = set()
+    img_headers = {} # map each FITSImage to its HeaderInfo
     methods.show_progress(0.0)
-    for path_index, path in enumerate(files_paths):
-        try:
-            images_set.add(fitsimage.FITSImage(path))
-            fraction = (path_index + 1) / len(files_paths) * 100
-            methods.show_progress(fraction)
-        except fitsimage.NonStandardFITS:
-            pass
+    for path_index, info in enumerate(headers):
+        if info.image is not None:
+            images_set.add(info.image)
+            img_headers[info.image] = info
+        fraction = (path_index + 1) / len(files_paths) * 100
+        methods.show_progress(fraction)
     else:
         methods.show_progress(100)
         print
@@ -270,51 +328,66 @@ def main(arguments = None):
     print "%sone of the following Unix patterns: %s ..." % \
           (style.prefix, options.objectn)
 
-    # We first test that the keyword exists (hence the pass for the KeyError
-    # exception, which means that the image is filtered out) and, after that,
-    # check whether its value matches one of the regular expressions which
-    # define the object names to be imported.
+    # We first test that the keyword exists (if it does not, the image is
+    # filtered out) and, after that, check whether its value matches one of
+    # the regular expressions which define the object names to be imported.
     object_set = set()
 
     # Keep the track of how many images are ignored for each reason
     saturated_excluded = 0
     non_match_excluded = 0
 
+    regexps = [re.compile(fnmatch.translate(pattern), re.IGNORECASE)
+               for pattern in options.objectn]
+
+    matches = {} # map each matching FITSImage to the matched pattern
     for img in images_set:
 
         try:
-            object_name = img.read_keyword(options.objectk)
-            for pattern in options.objectn:
-                regexp = re.compile(fnmatch.translate(pattern), re.IGNORECASE)
-                if regexp.match(object_name):
-                    # Even if the object name matchs, the median number of
-                    # counts must still be below the threshold, if any. If the
-                    # number of ADUs is irrelevant we can avoid having to
-                    # unnecessarily compute it.
-                    if options.max_counts:
-                        with pyfits.open(img.path, readonly = True) as hdu:
-                            median_counts = numpy.median(hdu[0].data)
-                        if median_counts > options.max_counts:
-                            print "%s%s excluded (matched, but saturated " \
-                                  "with %d ADUs)" % (style.prefix, img.path,
-                                                     median_counts)
-                            saturated_excluded += 1
-                            break
-
-                    # This point reached if median number of ADUs of image is
-                    # above the threshold or irrelevant, so it can be imported.
-                    print "%s%s imported (%s matches '%s')" % (style.prefix,
-                           img.path, object_name, pattern)
-
-                    object_set.add(img)
-                    break
-
-            else: # only executed if for loop exited cleanly
-                print "%s%s excluded (%s does not match anything)" % \
-                      (style.prefix, img.path, object_name)
-                non_match_excluded += 1
+            object_name = img_headers[img].keywords[options.objectk]
         except KeyError:
-            pass
+            continue
+
+        for pattern, regexp in zip(options.objectn, regexps):
+            if regexp.match(object_name):
+                matches[img] = pattern
+                break
+
+        else: # only executed if for loop exited cleanly
+            print "%s%s excluded (%s does not match anything)" % \
+                  (style.prefix, img.path, object_name)
+            non_match_excluded += 1
+
+    # Even if the object name matchs, the median number of counts must still
+    # be below the threshold, if any. If the number of ADUs is irrelevant we
+    # can avoid having to unnecessarily compute it. Otherwise, compute the
+    # median of the images that matched in parallel, using all the cores.
+
+    medians = {}
+    if options.max_counts and matches:
+        matching_imgs = list(matches.iterkeys())
+        pool = multiprocessing.Pool(options.ncores)
+        paths = [img.path for img in matching_imgs]
+        result = pool.map_async(median_counts, paths)
+        medians = dict(zip(matching_imgs, result.get()))
+        pool.close()
+        pool.join()
+
+    for img, pattern in matches.iteritems():
+
+        object_name = img_headers[img].keywords[options.objectk]
+        if img in medians and medians[img] > options.max_counts:
+            print "%s%s excluded (matched, but saturated " \
+                  "with %d ADUs)" % (style.prefix, img.path, medians[img])
+            saturated_excluded += 1
+            continue
+
+        # This point reached if median number of ADUs of image is
+        # below the threshold or irrelevant, so it can be imported.
+        print "%s%s imported (%s matches '%s')" % (style.prefix,
+               img.path, object_name, pattern)
+
+        object_set.add(img)
 
     if not saturated_excluded and not non_match_excluded:
         print "%sNo images were filtered out. Hooray!" % style.prefix
@@ -336,11 +409,11 @@ def main(arguments = None):
     print "%sSorting the FITS files by their date of observation " \
           "[keyword: %s]..." % (style.prefix, options.datek) ,
 
-    kwargs = dict(date_keyword = options.datek,
-                  time_keyword = options.timek,
-                  exp_keyword = options.exptimek)
-    get_date = operator.methodcaller('date', **kwargs)
-    sorted_imgs = sorted(object_set, key = get_date)
+    # The dates were read from the headers at the very beginning, in parallel:
+    # those that could not be parsed are None, so the images are discarded.
+    dated_imgs = [img for img in object_set if img_headers[img].date is not None]
+    get_date = lambda img: img_headers[img].date
+    sorted_imgs = sorted(dated_imgs, key = get_date)
 
     # Let the user know if one or more images could not be sorted (because of
     # problems when parsing the FITS keywords from which the observation date
@@ -405,9 +478,16 @@ def main(arguments = None):
 
         # i.e., 'ferM_' + '0000' + '.fits' = 'ferM_0000.fits'
         dest_name = '%s%0*d.fits' % (options.filename, ndigits, index)
+        # Compressed images keep the extension of their compression method
+        compression = options.compress or fits_file.compression
+        if compression:
+            dest_name += '.gz' if compression == 'gzip' else '.fz'
         dest_path = os.path.join(output_dir, dest_name)
 
-        shutil.copy2(fits_file.path, dest_path)
+        if options.compress:
+            fits_file.compress(dest_path, options.compress)
+        else:
+            shutil.copy2(fits_file.path, dest_path)
 
         # The permission bits have been copied, but we need to make sure
         # that the copy of the FITS file is always writable, no matter what
@@ -419,24 +499,27 @@ def main(arguments = None):
         # Add some information to the FITS header...
         if not options.exact:
 
-            msg1 = "File imported by LEMON on %s" % methods.utctime()
-            dest_img.add_history(msg1)
+            with dest_img.header_edit() as header:
+
+                msg1 = "File imported by LEMON on %s" % methods.utctime()
+                header.add_history(msg1)
 
-            # If the --uik option is given, store in this keyword the absolute
-            # path to the image of which we made a copy. This allows other
-            # LEMON commands, if necessary, to access the original FITS files
-            # in case the imported images are modified (e.g., bias subtraction
-            # or flat-fielding) before these other commands are executed.
+                # If the --uik option is given, store in this keyword the
+                # absolute path to the image of which we made a copy. This
+                # allows other LEMON commands, if necessary, to access the
+                # original FITS files in case the imported images are modified
+                # (e.g., bias subtraction or flat-fielding) before these other
+                # commands are executed.
 
-            if options.uncimgk:
+                if options.uncimgk:
 
-                comment = "before any calibration task"
-                dest_img.update_keyword(options.uncimgk,
-                                        os.path.abspath(dest_img.path),
-                                        comment = comment)
+                    comment = "before any calibration task"
+                    header.update(options.uncimgk,
+                                  os.path.abspath(dest_img.path),
+                                  comment = comment)
 
-                msg2 = "[Import] Original image: %s"
-                dest_img.add_history(msg2 % os.path.abspath(fits_file.path))
+                    msg2 = "[Import] Original image: %s"
+                    header.add_history(msg2 % os.path.abspath(fits_file.path))
 
         # ... unless we want an exact copy of the images. If that is the case,
         # verify that the SHA-1 checksum of the original and the copy matches
@@ -109,3 +109,58 @@ class CandidateAnnuli(collections.namedtuple(typename, field_names)):
             data[passband.Passband(pfilter)] = data.pop(pfilter)
 
         return data
+
+
+typename = 'Offset'
+field_names = "reference, x, y, rotation"
+class Offset(collections.namedtuple(typename, field_names)):
+    """ Encapsulate the offset between a FITS image and a reference.
+
+    The 'offsets' command registers the FITS images against a reference image,
+    finding the transformation that maps the coordinates of a source in the
+    reference to those in each image: a rotation around the center of the
+    reference image, and then a translation (see registration.transform()).
+
+    Fields:
+    reference - the path to the reference FITS image.
+    x - the offset along the x-axis, in pixels.
+    y - the offset along the y-axis, in pixels.
+    rotation - the rotation angle, in degrees, counterclockwise.
+
+    """
+
+    @staticmethod
+    def dump(offsets, path):
+        """ Save a series of Offset objects to a JSON file.
+
+        Serialize 'offsets' to a JSON file. It must be a dictionary which maps
+        the path to each FITS image to the corresponding Offset object. The
+        output file will be mercilessly overwritten if it already exists.
+
+        """
+
+        # As with CandidateAnnuli, convert the namedtuples to dictionaries
+        data = dict((img_path, offset._asdict())
+                    for img_path, offset in offsets.iteritems())
+
+        with open(path, 'wt') as fd:
+            kwargs = dict(indent=2, sort_keys=True)
+            json.dump(data, fd, **kwargs)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a series of Offset objects from a JSON file.
+
+        Deserialize a JSON file created with Offset.dump(), returning a
+        dictionary which maps the path to each FITS image to its Offset.
+
+        """
+
+        with open(path, 'rt') as fd:
+            data = json.load(fd)
+
+        offsets = {}
+        for img_path, values in data.iteritems():
+            values['reference'] = str(values['reference'])
+            offsets[str(img_path)] = cls(**values)
+        return offsets
@@ -94,6 +94,24 @@ desc['typek'] = \
 "keyword that identifies the type of image, with values such as 'dark', " \
 "'flat' or 'object', to cite some of the most common [default: %default]"
 
+xoffsetk = 'LEMON XOFFSET'
+desc['xoffsetk'] = \
+"keyword for the offset, in pixels, along the x-axis of the image with " \
+"respect to the reference image, written to the FITS header by the " \
+"'offsets' command [default: %default]"
+
+yoffsetk = 'LEMON YOFFSET'
+desc['yoffsetk'] = \
+"keyword for the offset, in pixels, along the y-axis of the image with " \
+"respect to the reference image, written to the FITS header by the " \
+"'offsets' command [default: %default]"
+
+rotationk = 'LEMON ROTATION'
+desc['rotationk'] = \
+"keyword for the rotation, in degrees, of the image with respect to the " \
+"reference image, written to the FITS header by the 'offsets' command " \
+"[default: %default]"
+
 # Used by seeing.FITSeeingImage to 'cache' the SExtractor catalog
 sex_catalog = 'SEX-CAT'
 sex_md5sum  = 'SEX-MD5'
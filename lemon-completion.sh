@@ -51,11 +51,25 @@ _lemon_seeing()
     fi
 }
 
+_lemon_offsets()
+{
+    local opts
+    opts="--overwrite --rotation --radius --update-headers --maximum --cores
+          --header-index --verbose --coaddk --xoffsetk --yoffsetk --rotationk"
+
+    if [[ ${cur} == -* ]]; then
+	_match "${opts}"
+    else
+	# Input FITS images / output JSON file
+        _filedir @($FITS_EXTS|$JSON_EXTS)
+    fi
+}
+
 _lemon_mosaic()
 {
     local opts
-    opts="--overwrite --background-match --no-reprojection --combine
-          --filter --cores --filterk"
+    opts="--overwrite --engine --background-match --no-reprojection --combine
+          --tile-size --filter --cores --filterk"
 
     if [[ ${cur} == -* ]]; then
 	_match "${opts}"
@@ -69,7 +83,8 @@ _lemon_mosaic()
 _lemon_astrometry()
 {
     local opts
-    opts="--radius --blind --timeout --suffix --cores -o --verbose --rak --deck"
+    opts="--radius --blind --timeout --schedule --hint-timeout --suffix
+          --cores -o --verbose --rak --deck"
 
     if [[ ${cur} == -* ]]; then
 	_match "${opts}"
@@ -150,7 +165,7 @@ _lemon()
     COMPREPLY=()
     cur="${COMP_WORDS[COMP_CWORD]}"
     prev="${COMP_WORDS[COMP_CWORD-1]}"
-    commands="import seeing astrometry mosaic annuli photometry
+    commands="import seeing offsets astrometry mosaic annuli photometry
     diffphot juicer"
 
     # The options that autocomplete depend on the LEMON command being
@@ -167,6 +182,10 @@ _lemon()
 	_lemon_seeing
 	return 0
         ;;
+    offsets)
+	_lemon_offsets
+	return 0
+	;;
     mosaic)
 	_lemon_mosaic
 	return 0
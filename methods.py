@@ -19,6 +19,8 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import contextlib
+import errno
+import fcntl
 import functools
 import logging
 import math
@@ -376,6 +378,43 @@ def split_by_diff(iterable, delta = 3):
     sublists.append(iterable)
     return reversed(sublists)
 
+def spatial_tiles(x, y, ntiles):
+    """ Split a set of points into (at most) 'ntiles' compact spatial tiles.
+
+    Sort the points by their y-coordinate and split them into about the square
+    root of 'ntiles' horizontal bands, and then each band, after sorting its
+    points by their x-coordinate, into tiles. In this manner, all the tiles
+    contain (almost) the same number of points, no matter how these are
+    distributed, and each one of them spans a compact region -- a contiguous
+    range of rows, which is what matters when the image is memory-mapped.
+    Returns a list of NumPy arrays with the indexes in 'x' and 'y' of the
+    points in each tile. Empty tiles are discarded.
+
+    """
+
+    x = numpy.asarray(x)
+    y = numpy.asarray(y)
+    if x.shape != y.shape:
+        msg = "coordinate arrays must have the same shape (%s and %s)"
+        raise ValueError(msg % (x.shape, y.shape))
+
+    ntiles = max(int(ntiles), 1)
+    nbands = int(round(math.sqrt(ntiles)))
+    # The number of tiles into which each band is split, and the index in the
+    # sorted points where each band begins: bands with one more tile than the
+    # others get proportionally more points.
+    per_band = [ntiles // nbands + (index < ntiles % nbands)
+                for index in xrange(nbands)]
+    bounds = numpy.cumsum([0] + per_band) * len(x) // ntiles
+
+    tiles = []
+    by_row = numpy.argsort(y, kind = 'mergesort')
+    for start, end, count in zip(bounds[:-1], bounds[1:], per_band):
+        band = by_row[start:end]
+        band = band[numpy.argsort(x[band], kind = 'mergesort')]
+        tiles.extend(t for t in numpy.array_split(band, count) if len(t))
+    return tiles
+
 def memoize(f):
     """ Minimalistic memoization decorator (*args / **kwargs)
     Based on: http://code.activestate.com/recipes/577219/ """
@@ -504,6 +543,145 @@ def clean_tmp_files(*paths):
                 msg = "Temporary file '%s' removed"
                 logging.debug(msg % path)
 
+# The ioctl() request that clones a file, sharing the data blocks until one of
+# the copies is modified (a 'reflink'), from <linux/fs.h>. Supported by, among
+# others, Btrfs and XFS; other file systems fail with EOPNOTSUPP or EXDEV.
+FICLONE = 0x40049409
+
+def link_or_copy(src, dst, hardlink = False):
+    """ Copy the file 'src' to 'dst', avoiding copying its data if possible.
+
+    If 'hardlink' is True, 'dst' is created as a hard link to 'src', so both
+    paths refer to the same file: any modification to one of them is seen in
+    the other. Otherwise, or if the hard link cannot be created (for example,
+    because the paths are on different file systems), a reflink is tried: a
+    copy that shares the data blocks with 'src' until either of them is
+    modified. If the file system does not support it, the file is copied.
+    The permission bits and times of 'src' are copied too, as shutil.copy2()
+    does. Returns how the file was copied: 'hardlink', 'reflink' or 'copy'.
+
+    """
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError, e:
+            msg = "cannot hard-link '%s' to '%s' (%s)"
+            logging.debug(msg % (src, dst, e))
+
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return 'reflink'
+    except (IOError, OSError), e:
+        msg = "cannot reflink '%s' to '%s' (%s)"
+        logging.debug(msg % (src, dst, e))
+
+    shutil.copy2(src, dst)
+    return 'copy'
+
+@contextlib.contextmanager
+def _directory_lock(directory, operation):
+    """ Hold an advisory lock (see fcntl.flock()) on a directory. """
+
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, operation)
+        yield
+    finally:
+        os.close(fd) # also releases the lock
+
+# The format of the names of the files that pin another one (see pinned()):
+# the basename of the pinned file, the PID of the process that pinned it and a
+# random suffix, so that the same file may be pinned more than once.
+PIN_FORMAT = ".%s.pin.%d."
+PIN_REGEXP = re.compile(r"^\.(?P<name>.+)\.pin\.(?P<pid>\d+)\.[^.]+$")
+
+def _pid_exists(pid):
+    """ Return whether there is a process with the given PID. """
+
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+@contextlib.contextmanager
+def pinned(path):
+    """ Protect a file from being deleted by evict_lru() while in use.
+
+    A context manager that creates, in the same directory as 'path', a hidden
+    file that tells evict_lru() not to delete 'path' until the context is
+    exited. The file need not exist yet when it is pinned: once the context
+    is entered, it can be (re)created and used safely. Pins whose process has
+    died are ignored and removed by evict_lru().
+
+    """
+
+    directory, basename = os.path.split(os.path.abspath(path))
+    with _directory_lock(directory, fcntl.LOCK_SH):
+        prefix = PIN_FORMAT % (basename, os.getpid())
+        fd, pin_path = tempfile.mkstemp(prefix = prefix, dir = directory)
+        os.close(fd)
+    try:
+        yield path
+    finally:
+        clean_tmp_files(pin_path)
+
+def evict_lru(directory, max_size, keep = None):
+    """ Delete the least recently used files until 'max_size' is not exceeded.
+
+    Files in 'directory' are deleted, oldest modification time first, until
+    their total size is at most 'max_size' bytes. Caches that use this
+    function must, therefore, update the modification time of their files
+    (e.g., with os.utime()) every time they are used. The file at path 'keep',
+    if any, counts towards 'max_size' but is never deleted, and neither are
+    those that have been pinned (see pinned()). Files whose names start with
+    a dot (by convention, temporary files that are still being written) are
+    ignored, and so are those that cannot be deleted or that have been
+    deleted by someone else.
+
+    """
+
+    # The lock guarantees that no file is pinned while we decide which ones
+    # to delete, so a file is either pinned before or never deleted after.
+    with _directory_lock(directory, fcntl.LOCK_EX):
+
+        entries = []
+        pins = set()
+        total = 0
+        for basename in os.listdir(directory):
+            path = os.path.join(directory, basename)
+            if basename.startswith('.'):
+                match = PIN_REGEXP.match(basename)
+                if match is not None:
+                    if _pid_exists(int(match.group('pid'))):
+                        pins.add(match.group('name'))
+                    else:
+                        clean_tmp_files(path) # stale pin
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # deleted by someone else
+            total += stat.st_size
+            if path != keep:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        for mtime, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            if os.path.basename(path) in pins:
+                continue
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
 class SharedCounter(object):
     """ A synchronized shared counter.
 
@@ -37,6 +37,7 @@ import operator
 import scipy.stats
 
 # LEMON modules
+import crossmatch
 import database
 import methods
 
@@ -312,15 +313,22 @@ class LEMONdBMiner(database.LEMONdB):
             phot1_points = list(self.get_light_curve(star_id, first_pfilter))
             phot2_points = list(self.get_light_curve(star_id, second_pfilter))
 
+            if not phot1_points:
+                return []
+            if not phot2_points:
+                return None
+
+            # Index of the closest point in time of the second curve, or -1
+            # if it is 'delta' or more seconds apart; on ties, the first one
+            times1 = [point[0] for point in phot1_points]
+            times2 = [point[0] for point in phot2_points]
+            indexes, _ = crossmatch.match_values(times1, times2, delta)
+
+            # Second element of the tuple (index = 1) is the magnitude
             matches = []
-            for point1 in phot1_points:
-                # Raises ValueError for empty sequences
-                closest = min(phot2_points,
-                              key = lambda x: abs(point1[0] - x[0]))
-
-                # Second element of the tuple (index = 1) is the magnitude
-                if abs(point1[0] - closest[0]) < delta: # we have a match!
-                    matches.append((point1[1], closest[1]))
+            for point1, index in zip(phot1_points, indexes):
+                if index != -1: # we have a match!
+                    matches.append((point1[1], phot2_points[index][1]))
 
             return matches
 
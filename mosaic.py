@@ -42,6 +42,9 @@ levels that are terrestrial or instrumental in origin [4]
 
 Note that montage_wrapper is not a replacement for the IPAC Montage mosaicking
 software, whose commands (such as mAdd or mProject) must be present in PATH.
+Alternatively, with --engine native, the images are reprojected and co-added
+by LEMON itself, in NumPy, one tile of the mosaic at a time and in parallel,
+without writing any intermediate FITS file to disk (see coadd.py).
 
 [1]_http://montage.ipac.caltech.edu/
 [2]_http://adsabs.harvard.edu/abs/2003ASPC..295..343B
@@ -50,17 +53,29 @@ software, whose commands (such as mAdd or mProject) must be present in PATH.
 
 """
 
+import astropy.io.fits
 import atexit
-import montage_wrapper as montage
+import collections
 import multiprocessing
+import numpy
 import optparse
 import os
 import os.path
+import pyfits
 import shutil
 import sys
 import tempfile
+import time
+import warnings
+
+# montage_wrapper is only needed by the Montage engine (see --engine)
+try:
+    import montage_wrapper as montage
+except ImportError:
+    montage = None
 
 # LEMON modules
+import coadd
 import customparser
 import defaults
 import fitsimage
@@ -74,38 +89,67 @@ parser.usage = "%prog [OPTION]... INPUT_IMGS... OUTPUT_IMG"
 parser.add_option('--overwrite', action = 'store_true', dest = 'overwrite',
                   help = "overwrite output image if it already exists")
 
+parser.add_option('--engine', action = 'store', type = 'choice',
+                  dest = 'engine', default = 'montage',
+                  choices = ['montage', 'native'],
+                  help = "how the images are reprojected and co-added: "
+                  "'montage', with the Montage toolkit, or 'native', in "
+                  "NumPy, which does not need Montage to be installed nor "
+                  "writes intermediate FITS files to disk, and distributes "
+                  "the tiles of the mosaic among the cores "
+                  "[default: %default]")
+
 parser.add_option('--background-match', action = 'store_true',
                   dest = 'background_match',
                   help = "include a background-matching step, thus removing "
                   "any discrepancies in brightness or background. Note that, "
                   "although an amazing feature of Montage, this makes the "
-                  "assembling of the images take remarkably longer.")
+                  "assembling of the images take remarkably longer. With "
+                  "--engine native, a constant offset is subtracted from "
+                  "each image, fitted to the median differences between the "
+                  "overlapping images, which are computed in parallel.")
 
 parser.add_option('--no-reprojection', action = 'store_false',
                   dest = 'reproject', default = True,
-                  help = "do not reproject the mosaic so that North is up.")
+                  help = "do not reproject the mosaic so that North is up. "
+                  "Ignored by --engine native, whose mosaic is always built "
+                  "with North up.")
 
-parser.add_option('--combine', action = 'store',
+parser.add_option('--combine', action = 'store', type = 'choice',
                   dest = 'combine', default = 'mean',
+                  choices = list(coadd.COMBINE_METHODS),
                   help = "how FITS images are combined - this should be one "
                   "of 'mean', 'median', or 'count'. For more details on how "
                   "Montage performs co-addition, see [4] [default: %default]")
 
+parser.add_option('--tile-size', action = 'store', type = 'int',
+                  dest = 'tile_size', default = 512,
+                  help = "the size, in pixels, of the side of the square "
+                  "tiles into which the mosaic is divided by --engine native. "
+                  "Each tile is reprojected and co-added by a different "
+                  "process [default: %default]")
+
 parser.add_option('--filter', action = 'store', type = 'passband',
                   dest = 'filter', default = None,
                   help = "do not combine all the FITS files given as input, "
                   "but only those taken in this photometric filter. " + \
                   defaults.desc['filter'])
 
+parser.add_option('--header-index', action = 'store', type = 'str',
+                  dest = 'header_index', default = defaults.header_index,
+                  help = defaults.desc['header_index'])
+
 parser.add_option('--cores', action = 'store', type = 'int',
                   dest = 'ncores', default = multiprocessing.cpu_count(),
                   help = "the number of MPI (Message Passing Interface) "
                   "processes to use with the Montage commands that support "
                   "parallelization. Note that this requires that the MPI "
                   "versions of the Montage commands be installed, which is "
-                  "not the case by default. This option defaults to the "
-                  "number of CPUs in the system, which are automatically "
-                  "detected [default: %default]")
+                  "not the case by default. With --engine native, the number "
+                  "of processes among which the tiles of the mosaic are "
+                  "distributed. This option defaults to the number of CPUs "
+                  "in the system, which are automatically detected "
+                  "[default: %default]")
 
 key_group = optparse.OptionGroup(parser, "FITS Keywords",
                                  keywords.group_description)
@@ -122,6 +166,238 @@ key_group.add_option('--filterk', action = 'store', type = 'str',
 parser.add_option_group(key_group)
 customparser.clear_metavars(parser)
 
+# An image combined by the native engine: the path to the (uncompressed) FITS
+# file, the box of the mosaic on which it falls (see coadd.footprint()) and
+# the factor by which its values are scaled, the ratio of the areas of the
+# pixels of the mosaic and of the image.
+Frame = collections.namedtuple('Frame', 'path box factor')
+
+# The state of the native engine, set by native_mosaic() before the pool of
+# workers is created, so that they inherit it: the list of Frames, the WCS of
+# the mosaic and the paths to the memory-mapped arrays (NumPy .npy files) with
+# the sum of the values, and their weights, of each pixel of the mosaic.
+frames = []
+mosaic_wcs = None
+arrays = None
+
+# The Queue global variable where the workers save their results
+queue = methods.Queue()
+
+def plain_link(img, dest_path):
+    """ Make an uncompressed version of a FITS image available at 'dest_path'.
+
+    'img' is a fitsimage.FITSImage. If it is compressed, it is decompressed to
+    'dest_path'; otherwise, 'dest_path' is a symbolic link to it. Unlike the
+    copies returned by FITSImage.plain_path(), which may be deleted from the
+    cache when other images are decompressed, these are kept for as long as
+    the caller needs them, so they can all be used at once.
+
+    """
+
+    if img.compression:
+        img.decompress(dest_path)
+    else:
+        os.symlink(os.path.abspath(img.path), dest_path)
+
+@methods.print_exception_traceback
+def parallel_overlap(args):
+    """ Compute the background difference between two overlapping images.
+
+    This method is intended to be used with a multiprocessing' pool of workers.
+    It receives a three-element tuple, the indexes in 'frames' of two images
+    and the box of the mosaic on which both fall, and returns a four-element
+    tuple: the two indexes, the median difference between the values of the
+    images and the number of pixels on which it was computed (see
+    coadd.overlap_difference()). The indexes are also put into the global
+    'queue', so that the progress bar can be updated.
+
+    """
+
+    first, second, box = args
+    images = []
+    for frame in (frames[first], frames[second]):
+        data, wcs = coadd.load(frame.path)
+        images.append((data, wcs, frame.factor))
+
+    difference, npixels = coadd.overlap_difference(images[0], images[1],
+                                                   mosaic_wcs, box)
+    queue.put((first, second))
+    return first, second, difference, npixels
+
+@methods.print_exception_traceback
+def parallel_tile(args):
+    """ Reproject and co-add the images that fall on a tile of the mosaic.
+
+    This method is intended to be used with a multiprocessing' pool of workers.
+    It receives a three-element tuple: (1) the box of the tile (see
+    coadd.tiles()), (2) the background offset to subtract from each of the
+    images in 'frames' and (3) how they are combined, one of
+    coadd.COMBINE_METHODS. Each image that overlaps the tile is reprojected
+    onto it, and its values accumulated into the memory-mapped arrays of the
+    sums and weights, which are then replaced by the combined value of each
+    pixel (NaN where no image falls) and the number of images. The tiles do
+    not overlap, so no locking is needed. The box is put into the global
+    'queue' when the tile is done.
+
+    """
+
+    box, offsets, combine = args
+    y0, y1, x0, x1 = box
+    tile = (slice(y0, y1), slice(x0, x1))
+    total = numpy.load(arrays[0], mmap_mode = 'r+')[tile]
+    weights = numpy.load(arrays[1], mmap_mode = 'r+')[tile]
+
+    stack = []
+    for index, frame in enumerate(frames):
+        if frame.box is None:
+            continue
+        region = coadd.intersection(frame.box, box)
+        if region is None:
+            continue
+
+        data, wcs = coadd.load(frame.path)
+        values = numpy.empty(total.shape)
+        values.fill(numpy.nan)
+        ry0, ry1, rx0, rx1 = region
+        pixels = (slice(ry0 - y0, ry1 - y0), slice(rx0 - x0, rx1 - x0))
+        reprojected = coadd.reproject(data, wcs, mosaic_wcs, region)
+        values[pixels] = reprojected * frame.factor - offsets[index]
+
+        valid = numpy.isfinite(values)
+        weights[valid] += 1
+        if combine == 'median':
+            stack.append(values)
+        else:
+            total[valid] += values[valid]
+
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        if combine == 'median':
+            if stack:
+                # All-NaN slices (where no image falls) raise RuntimeWarning
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    total[:] = numpy.nanmedian(stack, axis = 0)
+            else:
+                total[:] = numpy.nan
+        elif combine == 'count':
+            total[:] = weights
+        else:
+            total[:] = numpy.where(weights > 0, total / weights, numpy.nan)
+
+    total.flush()
+    weights.flush()
+    queue.put(box)
+
+def run(pool, function, iterable):
+    """ Map 'function' over 'iterable' in the pool, showing the progress. """
+
+    iterable = list(iterable)
+    result = pool.map_async(function, iterable)
+    methods.show_progress(0.0)
+    while not result.ready():
+        time.sleep(1)
+        methods.show_progress(queue.qsize() / len(iterable) * 100)
+
+    results = result.get() # reraise exceptions of the remote call, if any
+    methods.show_progress(100) # in case the queue was ready too soon
+    print
+    queue.clear()
+    return results
+
+def native_mosaic(images, output_path, options):
+    """ Reproject and co-add FITS images in NumPy, using a pool of workers.
+
+    'images' is a sequence of fitsimage.FITSImage objects, all of which must
+    have been astrometrically calibrated, and 'options' the optparse.Values
+    object returned by optparse.OptionParser.parse_args(). The mosaic is
+    written, as a double-precision FITS image, to 'output_path'.
+
+    """
+
+    global frames, mosaic_wcs, arrays
+
+    print "%sComputing the WCS of the mosaic..." % style.prefix ,
+    sys.stdout.flush()
+
+    kwargs = dict(suffix = "_LEMON_%d_mosaic" % os.getpid())
+    tmp_dir = tempfile.mkdtemp(**kwargs)
+    atexit.register(methods.clean_tmp_files, tmp_dir)
+
+    # Compressed images are decompressed to our temporary directory, and not
+    # to the cache of FITSImage: all of them are read until the very end, so
+    # none of the copies can be deleted to make room for the others.
+    paths = []
+    for index, img in enumerate(images):
+        root, ext = fitsimage.splitext(os.path.basename(img.path))
+        path = os.path.join(tmp_dir, "%d_%s%s" % (index, root, ext))
+        plain_link(img, path)
+        paths.append(path)
+
+    wcss, shapes = [], []
+    for path in paths:
+        header = astropy.io.fits.getheader(path)
+        wcss.append(coadd.load_wcs(header))
+        shapes.append((header['NAXIS2'], header['NAXIS1']))
+
+    mosaic_wcs, shape = coadd.optimal_wcs(wcss, shapes)
+    scale = coadd.pixel_scale(mosaic_wcs, shape)
+    frames = []
+    for path, wcs, image_shape in zip(paths, wcss, shapes):
+        box = coadd.footprint(wcs, image_shape, mosaic_wcs, shape)
+        factor = (scale / coadd.pixel_scale(wcs, image_shape)) ** 2
+        frames.append(Frame(path, box, factor))
+    print 'done.'
+
+    msg = "%sThe mosaic will have %d x %d pixels (%.3f arcsec per pixel)."
+    print msg % (style.prefix, shape[1], shape[0], scale * 3600)
+
+    # The sums and weights are memory-mapped, so that mosaics larger than
+    # the available memory can be built, and shared by all the workers.
+    arrays = (os.path.join(tmp_dir, 'sum.npy'),
+              os.path.join(tmp_dir, 'weights.npy'))
+    for path in arrays:
+        numpy.lib.format.open_memmap(path, mode = 'w+',
+                                     dtype = numpy.float64, shape = shape)
+
+    pool = multiprocessing.Pool(options.ncores)
+    offsets = numpy.zeros(len(frames))
+
+    if options.background_match:
+        pairs = []
+        for first in xrange(len(frames)):
+            for second in xrange(first + 1, len(frames)):
+                boxes = frames[first].box, frames[second].box
+                if None in boxes:
+                    continue
+                box = coadd.intersection(*boxes)
+                if box is not None:
+                    pairs.append((first, second, box))
+
+        msg = "%sMatching the backgrounds of %d pairs of overlapping images..."
+        print msg % (style.prefix, len(pairs))
+        if pairs:
+            differences = run(pool, parallel_overlap, pairs)
+            offsets = coadd.background_offsets(len(frames), differences)
+
+    boxes = coadd.tiles(shape, options.tile_size)
+    msg = "%sReprojecting and co-adding %d images, in %d tiles..."
+    print msg % (style.prefix, len(frames), len(boxes))
+    run(pool, parallel_tile,
+        ((box, offsets, options.combine) for box in boxes))
+    pool.close()
+    pool.join()
+
+    print "%sWriting the mosaic to %s..." % (style.prefix, output_path) ,
+    sys.stdout.flush()
+    header = pyfits.Header()
+    for card in mosaic_wcs.to_header().cards:
+        header[card.keyword] = (card.value, card.comment)
+    # Writable, as pyfits byte-swaps the array in place (and back) to write it
+    data = numpy.load(arrays[0], mmap_mode = 'r+')
+    pyfits.writeto(output_path, data, header, clobber = True)
+    print 'done.'
+
+
 def main(arguments = None):
     """ main() function, encapsulated in a method to allow for easy invokation.
 
@@ -143,6 +419,9 @@ def main(arguments = None):
         arguments = sys.argv[1:] # ignore argv[0], the script name
     (options, args) = parser.parse_args(args = arguments)
 
+    # Cache the headers of the FITS images in the persistent header index
+    fitsimage.set_header_index(options.header_index)
+
     # Print the help and abort the execution if there are fewer than three
     # positional arguments left, as the user must specify at least two FITS
     # images and the output mosaic into which they are assembled.
@@ -166,12 +445,21 @@ def main(arguments = None):
             print style.error_exit_message
             return 1
 
+    if options.engine == 'montage' and montage is None:
+        msg = "%sError. The montage_wrapper module is not installed."
+        print msg % style.prefix
+        print "%sUse --engine native, or install montage-wrapper." % \
+              style.prefix
+        print style.error_exit_message
+        return 1
+
     # Workaround for a bug in montage.mosaic() that raises an error ('mpirun
     # has exited due to process rank [...] without calling "finalize"...') if
     # mpi = True and background_match = True. Until this is fixed, we can only
     # use one core if the --background-match option is given by the user.
 
-    if options.background_match and options.ncores > 1:
+    if options.engine == 'montage' and options.background_match and \
+       options.ncores > 1:
         options.ncores = 1
         for msg in (
             "{0}Warning: --background-match is incompatible with --cores > 1.",
@@ -187,32 +475,29 @@ def main(arguments = None):
     msg = "%sMaking sure the %d input paths are FITS images..."
     print msg % (style.prefix, len(input_paths))
 
-    methods.show_progress(0.0)
-    for index, path in enumerate(input_paths):
-        # fitsimage.FITSImage.__init__() raises fitsimage.NonStandardFITS if
-        # one of the paths is not a standard-conforming FITS file.
-        try:
-            img = fitsimage.FITSImage(path)
-
-            # If we do not need to know the photometric filter (because the
-            # --filter was not given) do not read it from the FITS header.
-            # Instead, use None. This means that 'files', a dictionary, will
-            # only have a key, None, mapping to all the input FITS images.
-
-            if options.filter:
-                pfilter = img.pfilter(options.filterk)
-            else:
-                pfilter = None
+    # If we do not need to know the photometric filter (because the --filter
+    # was not given) do not read it from the FITS header. Instead, use None.
+    # This means that 'files', a dictionary, will only have a key, None,
+    # mapping to all the input FITS images. The headers are read in parallel.
 
-            files[pfilter].append(img)
+    filterk = options.filterk if options.filter else None
+    kwargs = dict(filterk = filterk, ncores = options.ncores)
+    headers = fitsimage.scan_headers(input_paths, **kwargs)
 
-        except fitsimage.NonStandardFITS:
-            print
-            msg = "'%s' is not a standard FITS file"
-            raise fitsimage.NonStandardFITS(msg % path)
+    methods.show_progress(0.0)
+    try:
+        for index, info in enumerate(headers):
+            files[info.pfilter].append(info.image)
+            percentage = (index + 1) / len(input_paths) * 100
+            methods.show_progress(percentage)
+
+    # fitsimage.FITSImage.__init__() raises fitsimage.NonStandardFITS if one
+    # of the paths is not a standard-conforming FITS file.
+    except fitsimage.NonStandardFITS, e:
+        print
+        msg = "not a standard FITS file (%s)"
+        raise fitsimage.NonStandardFITS(msg % str(e))
 
-        percentage = (index + 1) / len(input_paths) * 100
-        methods.show_progress(percentage)
     print # progress bar doesn't include newline
 
     # The --filter option allows the user to specify which FITS files, among
@@ -262,6 +547,11 @@ def main(arguments = None):
         # May raise NoWCSInformationError
         img.center_wcs()
 
+    if options.engine == 'native':
+        native_mosaic(list(files), output_path, options)
+        print "%sYou're done ^_^" % style.prefix
+        return 0
+
     # montage.mosaic() requires as first argument the directory containing the
     # input FITS images but, in order to maintain the same syntax across all
     # LEMON commands, we receive them as command-line arguments. Thus, create a
@@ -276,12 +566,12 @@ def main(arguments = None):
     input_dir = tempfile.mkdtemp(**kwargs)
     atexit.register(methods.clean_tmp_files, input_dir)
 
+    # Compressed images are decompressed to this directory, and not to the
+    # cache of FITSImage, from which the least recently used copies may be
+    # deleted before Montage reads them (see FITSImage.plain_path()).
     for img in files:
-        path = img.path
-        source = os.path.abspath(path)
-        basename = os.path.basename(path)
-        link_name = os.path.join(input_dir, basename)
-        os.symlink(source, link_name)
+        root, ext = fitsimage.splitext(os.path.basename(img.path))
+        plain_link(img, os.path.join(input_dir, root + ext))
 
     # The output of montage.mosaic() is another directory, to which several
     # files are written, so we need the path to a second temporary directory.
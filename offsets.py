@@ -0,0 +1,362 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+description = """
+Compute the offsets between each input FITS image and the reference image, in
+parallel, without having to solve them astrometrically. The translation is
+first found with the phase correlation (via FFT) of the sources of the images,
+and then refined by cross-matching the brightest stars detected in both images,
+also fitting, if the --rotation option is given, the rotation of the field. The
+offsets are saved to a JSON file and, optionally, to the FITS headers. Note
+that all the images must have been taken with the same instrument and binning,
+and overlap significantly with the reference image.
+
+"""
+
+import logging
+import multiprocessing
+import optparse
+import os.path
+import sys
+import time
+
+# LEMON modules
+import customparser
+import defaults
+import fitsimage
+import json_parse
+import keywords
+import methods
+import registration
+import style
+
+# The minimum number of stars that must be matched between an image and the
+# reference; with fewer, the registration is considered to have failed.
+MIN_MATCHES = 5
+
+class ReferenceImage(fitsimage.FITSImage):
+    """ The FITS image against which all the others are registered.
+
+    The FFT of the prepared image (see registration.prepare()) and the
+    coordinates of its brightest stars are computed only once, when the
+    object is instantiated, so that they can be used to register as many
+    FITS images as needed.
+
+    """
+
+    def __init__(self, path, maximum, coaddk = keywords.coaddk):
+        super(ReferenceImage, self).__init__(path)
+        data = self.data
+        self.shape = data.shape
+        self.pivot = registration.center(self.shape)
+        self.spectrum = registration.spectrum(registration.prepare(data))
+        saturation = self.saturation(maximum, coaddk = coaddk)
+        self.sources = registration.sources(data, saturation)
+
+    def register(self, img, maximum, radius, rotation = False,
+                 coaddk = keywords.coaddk):
+        """ Return the transformation from the reference to a FITS image.
+
+        Find the offsets (and, if 'rotation' is True, also the rotation) of
+        'img', a fitsimage.FITSImage, with respect to the reference image.
+        Return a six-element tuple: the x- and y-offsets, in pixels, the
+        rotation, in degrees, the height of the phase correlation peak, the
+        number of stars that were matched and the root mean square, in pixels,
+        of the residuals of the fit. 'radius' is the maximum distance,
+        in pixels, between two stars after the offsets of the phase
+        correlation are applied for them to be matched. Raises ValueError if
+        fewer than MIN_MATCHES stars can be matched.
+
+        """
+
+        data = img.data
+        spectrum = registration.spectrum(registration.prepare(data),
+                                         self.shape)
+        args = self.spectrum, spectrum, self.shape
+        dx, dy, peak = registration.phase_correlation(*args)
+
+        saturation = img.saturation(maximum, coaddk = coaddk)
+        sources = registration.sources(data, saturation)
+        args = self.sources, sources, self.pivot, (dx, dy, 0), radius
+        kwargs = dict(rotation = rotation, minmatches = MIN_MATCHES)
+        dx, dy, angle, nmatches, rms = registration.refine(*args, **kwargs)
+        return dx, dy, angle, peak, nmatches, rms
+
+
+# The ReferenceImage against which the images are registered. It is set by
+# main() before the pool of workers is created, so that they inherit it.
+reference = None
+
+# The Queue global variable where the workers save their results
+queue = methods.Queue()
+
+parser = customparser.get_parser(description)
+parser.usage = "%prog [OPTION]... REFERENCE_IMG INPUT_IMGS... OUTPUT_JSON_FILE"
+
+parser.add_option('--overwrite', action = 'store_true', dest = 'overwrite',
+                  help = "overwrite output JSON file if it already exists")
+
+parser.add_option('--rotation', action = 'store_true', dest = 'rotation',
+                  help = "fit not only the offsets of the images, but also "
+                  "their (small) rotation with respect to the reference "
+                  "image. The phase correlation only finds the translation, "
+                  "so rotations of more than a few tenths of a degree may "
+                  "prevent the stars at the edges from being matched")
+
+parser.add_option('--radius', action = 'store', type = 'float',
+                  dest = 'radius', default = 10,
+                  help = "the maximum distance, in pixels, between two stars "
+                  "of the input and reference images, once the offsets found "
+                  "by the phase correlation are applied, for them to be "
+                  "matched [default: %default]")
+
+parser.add_option('--update-headers', action = 'store_true',
+                  dest = 'update_headers',
+                  help = "write the offsets and rotation of each image to its "
+                  "FITS header (see the --xoffsetk, --yoffsetk and "
+                  "--rotationk options), in addition to the output JSON "
+                  "file. Note that the input images are modified")
+
+parser.add_option('--maximum', action = 'store', type = 'int',
+                  dest = 'maximum', default = defaults.maximum,
+                  help = defaults.desc['maximum'])
+
+parser.add_option('--cores', action = 'store', type = 'int',
+                  dest = 'ncores', default = defaults.ncores,
+                  help = defaults.desc['ncores'])
+
+parser.add_option('--header-index', action = 'store', type = 'str',
+                  dest = 'header_index', default = defaults.header_index,
+                  help = defaults.desc['header_index'])
+
+parser.add_option('-v', '--verbose', action = 'count',
+                  dest = 'verbose', default = defaults.verbosity,
+                  help = defaults.desc['verbosity'])
+
+key_group = optparse.OptionGroup(parser, "FITS Keywords",
+                                 keywords.group_description)
+
+key_group.add_option('--coaddk', action = 'store', type = 'str',
+                     dest = 'coaddk', default = keywords.coaddk,
+                     help = keywords.desc['coaddk'])
+
+key_group.add_option('--xoffsetk', action = 'store', type = 'str',
+                     dest = 'xoffsetk', default = keywords.xoffsetk,
+                     help = keywords.desc['xoffsetk'])
+
+key_group.add_option('--yoffsetk', action = 'store', type = 'str',
+                     dest = 'yoffsetk', default = keywords.yoffsetk,
+                     help = keywords.desc['yoffsetk'])
+
+key_group.add_option('--rotationk', action = 'store', type = 'str',
+                     dest = 'rotationk', default = keywords.rotationk,
+                     help = keywords.desc['rotationk'])
+
+parser.add_option_group(key_group)
+customparser.clear_metavars(parser)
+
+@methods.print_exception_traceback
+def parallel_offsets(args):
+    """ Compute the offsets of a FITS image with respect to the reference.
+
+    This method is intended to be used with a multiprocessing' pool of workers.
+    It receives a two-element tuple, the path of an image and the 'instance'
+    object returned by optparse's parse_args(), containing the values for all
+    the options of the program, and registers the image against the global
+    ReferenceImage 'reference'. Nothing is returned; instead, the result is
+    saved to the global variable 'queue' as a two-element tuple: (1) path of
+    the input image and (2) a json_parse.Offset object. Nothing is added to
+    'queue' in case an error is encountered.
+
+    """
+
+    path, options = args
+
+    try:
+        img = fitsimage.FITSImage(path)
+        kwargs = dict(rotation = options.rotation, coaddk = options.coaddk)
+        args = img, options.maximum, options.radius
+        result = reference.register(*args, **kwargs)
+        dx, dy, angle, peak, nmatches, rms = result
+
+    except fitsimage.NonStandardFITS:
+        logging.info("%s ignored (non-standard FITS)" % path)
+        return
+
+    # Raised if too few stars can be matched to those of the reference
+    except ValueError, e:
+        logging.info("%s ignored (%s)" % (path, str(e)))
+        return
+
+    logging.debug("%s: phase correlation peak = %.3f" % (path, peak))
+    msg = "%s: %d stars matched (rms = %.3f pixels)"
+    logging.debug(msg % (path, nmatches, rms))
+    msg = "%s: offsets = (%.3f, %.3f) pixels, rotation = %.4f degrees"
+    logging.debug(msg % (path, dx, dy, angle))
+    offset = json_parse.Offset(reference.path, dx, dy, angle)
+    queue.put((path, offset))
+
+def main(arguments = None):
+    """ main() function, encapsulated in a method to allow for easy invokation.
+
+    This method follows Guido van Rossum's suggestions on how to write Python
+    main() functions in order to make them more flexible. By encapsulating the
+    main code of the script in a function and making it take an optional
+    argument the script can be called not only from other modules, but also
+    from the interactive Python prompt.
+
+    Guido van van Rossum - Python main() functions:
+    http://www.artima.com/weblogs/viewpost.jsp?thread=4829
+
+    Keyword arguments:
+    arguments - the list of command line arguments passed to the script.
+
+    """
+
+    if arguments is None:
+        arguments = sys.argv[1:] # ignore argv[0], the script name
+    (options, args) = parser.parse_args(args = arguments)
+
+    # Adjust the logger level to WARNING, INFO or DEBUG, depending on the
+    # given number of -v options (none, one or two or more, respectively)
+    logging_level = logging.WARNING
+    if options.verbose == 1:
+        logging_level = logging.INFO
+    elif options.verbose >= 2:
+        logging_level = logging.DEBUG
+    logging.basicConfig(format = style.LOG_FORMAT, level = logging_level)
+
+    # Cache the headers of the FITS images in the persistent header index
+    fitsimage.set_header_index(options.header_index)
+
+    # Print the help and abort the execution if there are not three positional
+    # arguments left after parsing the options, as the user must specify the
+    # reference image, at least one input FITS file and the output JSON file.
+    if len(args) < 3:
+        parser.print_help()
+        return 2     # 2 is generally used for command line syntax errors
+    else:
+        reference_path = args[0]
+        input_paths = sorted(set(args[1:-1]))
+        output_json_path = args[-1]
+
+    if os.path.exists(output_json_path):
+        if not options.overwrite:
+            msg = "%sError. The output file '%s' already exists."
+            print msg % (style.prefix, output_json_path)
+            print style.error_exit_message
+            return 1
+
+    msg = "%sDetecting sources on the reference image %s..."
+    print msg % (style.prefix, reference_path) ,
+    sys.stdout.flush()
+    global reference
+    reference = ReferenceImage(reference_path, options.maximum,
+                               coaddk = options.coaddk)
+    print 'done.'
+
+    nsources = len(reference.sources[0])
+    msg = "%s: %d stars detected on the reference image"
+    logging.info(msg % (reference_path, nsources))
+    if nsources < MIN_MATCHES:
+        msg = "%sError. Only %d stars detected on the reference image."
+        print msg % (style.prefix, nsources)
+        print style.error_exit_message
+        return 1
+
+    # The offsets of the reference image are, by definition, zero
+    offsets = {}
+    if reference_path in input_paths:
+        input_paths.remove(reference_path)
+        offsets[reference_path] = json_parse.Offset(reference.path, 0, 0, 0)
+
+    msg = "%sRegistering the %d input FITS images..."
+    print msg % (style.prefix, len(input_paths))
+
+    if input_paths:
+        pool = multiprocessing.Pool(options.ncores)
+        map_async_args = ((path, options) for path in input_paths)
+        result = pool.map_async(parallel_offsets, map_async_args)
+
+        methods.show_progress(0.0)
+        while not result.ready():
+            time.sleep(1)
+            methods.show_progress(queue.qsize() / len(input_paths) * 100)
+            # Do not update the progress bar when debugging; instead, print
+            # it on a new line each time. This prevents the next logging
+            # message, if any, from being printed on the same line that the
+            # bar.
+            if logging_level < logging.WARNING:
+                print
+
+        result.get()      # reraise exceptions of the remote call, if any
+        methods.show_progress(100) # in case the queue was ready too soon
+        print
+
+    nregistered = queue.qsize()
+    for _ in xrange(nregistered):
+        path, offset = queue.get()
+        offsets[path] = offset
+
+    nfailed = len(input_paths) - nregistered
+    if nfailed:
+        msg = "%s%d images could not be registered (use -v for details)."
+        print msg % (style.prefix, nfailed)
+
+    if not offsets:
+        print "%sError. No FITS images were registered." % style.prefix
+        print style.error_exit_message
+        return 1
+
+    json_parse.Offset.dump(offsets, output_json_path)
+    msg = "%sOffsets of %d images saved to '%s'."
+    print msg % (style.prefix, len(offsets), output_json_path)
+
+    if options.update_headers:
+        msg = "%sWriting the offsets to the FITS headers..."
+        print msg % style.prefix ,
+        sys.stdout.flush()
+
+        for path, offset in sorted(offsets.iteritems()):
+            img = fitsimage.FITSImage(path)
+            with img.header_edit() as header:
+                msg = "Offsets computed by LEMON on %s" % methods.utctime()
+                header.add_history(msg)
+                msg = "[Offsets] Reference image: %s" % offset.reference
+                header.add_history(msg)
+                comment = "offset along the x-axis (pixels)"
+                header.update(options.xoffsetk, offset.x, comment = comment)
+                comment = "offset along the y-axis (pixels)"
+                header.update(options.yoffsetk, offset.y, comment = comment)
+                comment = "rotation (degrees)"
+                header.update(options.rotationk, offset.rotation,
+                              comment = comment)
+
+            args = path, options.xoffsetk, options.yoffsetk, options.rotationk
+            logging.debug("%s: FITS header updated (%s, %s and %s)" % args)
+        print 'done.'
+
+    print "%sYou're done ^_^" % style.prefix
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -47,6 +47,7 @@ import collections
 import hashlib
 import itertools
 import logging
+import math
 import multiprocessing
 import numpy
 import optparse
@@ -62,6 +63,7 @@ import warnings
 
 # LEMON modules
 import astromatic
+import centroid
 import customparser
 import database
 import defaults
@@ -69,6 +71,7 @@ import fitsimage
 import json_parse
 import keywords
 import methods
+import prefetch
 import qphot
 import seeing
 import style
@@ -87,8 +90,10 @@ def get_fwhm(img, options):
     """ Return the FWHM of the FITS image.
 
     Attempt to read the full width at half maximum from the header of the FITS
-    image (keyword options.fwhmk). If the keyword cannot be found, then compute
-    the FWHM by calling FITSeeingImage.fwhm(). In this manner, we can always
+    image (keyword options.fwhmk). If the keyword cannot be found, look it up
+    in the quality metrics store (see seeing.set_quality_db()) and, if it is
+    not there either, compute the metrics of the image by calling
+    FITSeeingImage.metrics(), and store them. In this manner, we can always
     call this method to get the FWHM of each image, without having to worry
     about whether it is in the header already. The 'img' argument must be a
     fitsimage.FITSImage object, while 'options' must be the optparse.Values
@@ -114,6 +119,15 @@ def get_fwhm(img, options):
         args = img.path, options.fwhmk
         logging.debug(msg % args)
 
+        try:
+            fwhm = seeing.stored_metrics(img, options).fwhm
+            msg = "%s: FWHM = %.3f (quality metrics store)"
+            logging.debug(msg % (img.path, fwhm))
+            return fwhm
+        except KeyError:
+            msg = "%s: FWHM not in the quality metrics store"
+            logging.debug(msg % img.path)
+
         if not isinstance(img, seeing.FITSeeingImage):
 
             msg = "%s: type of argument 'img' is not FITSeeingImage ('%s')"
@@ -124,20 +138,108 @@ def get_fwhm(img, options):
             logging.debug(msg % img.path)
 
             args = (img.path, options.maximum, options.margin)
-            kwargs = dict(coaddk = options.coaddk)
+            kwargs = dict(coaddk = options.coaddk, detector = options.detector)
             img = seeing.FITSeeingImage(*args, **kwargs)
 
-        msg = "%s: calling FITSeeingImage.fwhm() to compute FWHM"
+        msg = "%s: calling FITSeeingImage.metrics() to compute FWHM"
         logging.debug(msg % img.path)
 
         mode = 'mean' if options.mean else 'median'
         kwargs = dict(per = options.per, mode = mode)
-        fwhm = img.fwhm(**kwargs)
+        metrics = img.metrics(**kwargs)
+        seeing.store_metrics(img, options, metrics)
 
-        msg = "%s: FITSeeingImage.fwhm() returned %.3f"
-        args = img.path, fwhm
+        msg = "%s: FITSeeingImage.metrics() returned FWHM = %.3f"
+        args = img.path, metrics.fwhm
         logging.debug(msg % args)
-        return fwhm
+        return metrics.fwhm
+
+@methods.print_exception_traceback
+def parallel_fwhm(args):
+    """ Function argument of map_async() to compute the FWHM in parallel.
+
+    Receives a two-element tuple, the path to a FITS image and the
+    optparse.Values object returned by optparse.OptionParser.parse_args(),
+    and returns the FWHM of the image, as returned by get_fwhm().
+
+    """
+
+    path, options = args
+    return get_fwhm(fitsimage.FITSImage(path), options)
+
+def get_fwhms(paths, options):
+    """ Return a dictionary that maps each FITS image to its FWHM.
+
+    The FWHM of each image in 'paths' is read from its header, if possible;
+    the rest of the images are given to a pool of options.ncores workers,
+    where the FWHM is looked up in the quality metrics store or, if missing,
+    computed (see get_fwhm()). 'options' must be the optparse.Values object
+    returned by optparse.OptionParser.parse_args().
+
+    """
+
+    fwhms = {}
+    missing = []
+    for path in paths:
+        img = fitsimage.FITSImage(path)
+        try:
+            fwhms[path] = img.read_keyword(options.fwhmk)
+            msg = "%s: FWHM = %.3f (keyword '%s')"
+            logging.debug(msg % (path, fwhms[path], options.fwhmk))
+        except KeyError:
+            missing.append(path)
+
+    if missing:
+        msg = "%d images without keyword '%s', FWHM computed in parallel"
+        logging.debug(msg % (len(missing), options.fwhmk))
+        pool = multiprocessing.Pool(options.ncores)
+        map_async_args = ((path, options) for path in missing)
+        result = pool.map_async(parallel_fwhm, map_async_args)
+        fwhms.update(zip(missing, result.get()))
+        pool.close()
+        pool.join()
+
+    return fwhms
+
+def footprint_ids(image, pparams, options):
+    """ Return the IDs of the objects within the footprint of the FITS image.
+
+    Return a NumPy array with the indexes in options.coordinates of the
+    objects within the footprint of the fitsimage.FITSImage 'image', plus a
+    margin as wide as the outer radius of the sky annulus defined by the
+    database.PhotometricParameters 'pparams' (so that the objects right at the
+    edges are measured exactly as before). The objects with known proper
+    motions are placed where they were at the time of observation, as in
+    qphot.run(), since high proper-motion stars may have moved well beyond
+    the margin since the epoch of the coordinates.
+
+    """
+
+    margin = pparams.annulus + pparams.dannulus
+    coords = qphot.exact_coordinates(image, options.coordinates,
+                                     options.epoch, options.datek,
+                                     options.timek, options.exptimek)
+    inside = image.footprint(coords.ra, coords.dec, margin = margin)
+    star_ids = numpy.flatnonzero(inside)
+    msg = "%s: %d out of %d objects within the footprint of the image"
+    logging.debug(msg % (image.path, len(star_ids), len(coords)))
+    return star_ids
+
+@methods.print_exception_traceback
+def parallel_saturation_mask(args):
+    """ Function argument of map() to make saturation masks in parallel.
+
+    Receives a two-element tuple, a fitsimage.FITSImage object and the
+    optparse.Values object returned by optparse.OptionParser.parse_args(), and
+    returns the path to the saturation mask of the image, made with the same
+    saturation level that parallel_photometry() uses (see
+    qphot.saturation_mask()). The caller must delete it when done.
+
+    """
+
+    image, options = args
+    maximum = image.saturation(options.maximum, coaddk = options.coaddk)
+    return qphot.saturation_mask(image, maximum, options.uncimgk)
 
 @methods.print_exception_traceback
 def parallel_photometry(args):
@@ -145,23 +247,35 @@ def parallel_photometry(args):
 
     This will be the first argument passed to multiprocessing.Pool.map_async(),
     which chops the iterable into a number of chunks that are submitted to the
-    process pool as separate tasks. 'args' must be a three-element tuple with
+    process pool as separate tasks. 'args' must be a five-element tuple with
     (1) a fitsimage.FITSImage object, (2) a database.PhotometricParameters
-    object and (3) 'options', the optparse.Values object returned by
-    optparse.OptionParser.parse_args().
+    object, (3) 'options', the optparse.Values object returned by
+    optparse.OptionParser.parse_args(), (4) a NumPy array with the IDs
+    (indexes in options.coordinates) of the objects to measure, or None to
+    measure all those within the footprint of the image (see footprint_ids())
+    and (5) the path to the saturation mask of the image, or None to let
+    qphot.run() make it. In the former case, the array is usually a spatial
+    tile of the image, so that several workers can do photometry on the same
+    image simultaneously, sharing the same mask (see
+    parallel_saturation_mask()).
 
     This function does photometry (qphot.run()) on the astronomical objects of
     the FITS image listed in options.coordinates, using the aperture, annulus
     and dannulus defined by the PhotometricParameters object. The result is
-    another three-element tuple, which is put into the module-level 'queue'
-    object, a process shared queue. This tuple contains (1) a database.Image
-    object, (2) a database.PhotometricParameters object and (3) a qphot.QPhot
-    object -- therefore mapping each FITS file and the parameters used for
-    photometry to the measurements returned by qphot.
+    a four-element tuple, which is put into the module-level 'queue' object,
+    a process shared queue. This tuple contains (1) a database.Image
+    object, (2) a database.PhotometricParameters object, (3) a NumPy array
+    with the IDs (indexes in options.coordinates) of the objects on which
+    photometry was done and (4) a NumPy structured array, with dtype
+    qphot.DTYPE, with the measurements returned by qphot for each one of
+    them -- therefore mapping each FITS file and the parameters used for
+    photometry to the photometry of each astronomical object. The array is
+    much cheaper to pickle and send through the queue than a qphot.QPhot
+    object, a list of as many namedtuples as there are objects.
 
     """
 
-    image, pparams, options = args
+    image, pparams, options, star_ids, satur_mask = args
 
     logging.debug("Doing photometry on %s" % image.path)
     msg = "%s: qphot aperture: %.3f"
@@ -176,11 +290,32 @@ def parallel_photometry(args):
     args = (image.path, maximum)
     logging.debug(msg % args)
 
+    # Do photometry only on the objects within the footprint of the image:
+    # with dithered or mosaicked observations, many of those listed in
+    # options.coordinates may be off the chip. Their IDs, the indexes in
+    # options.coordinates, are sent along with the result.
+    if star_ids is None:
+        star_ids = footprint_ids(image, pparams, options)
+    else:
+        msg = "%s: doing photometry on a tile of %d objects"
+        logging.debug(msg % (image.path, len(star_ids)))
+
     logging.info("Running qphot on %s" % image.path)
-    args = (image, options.coordinates, options.epoch,
+    args = (image, options.coordinates[star_ids], options.epoch,
             pparams.aperture, pparams.annulus, pparams.dannulus, maximum,
             options.datek, options.timek, options.exptimek, options.uncimgk)
-    img_qphot = qphot.run(*args, cbox=options.cbox)
+
+    # The image is only read into the page cache in advance (the path of the
+    # FITSImage is stored in the database, so it cannot be a local copy). Only
+    # the first of its tiles counts as taken from the Prefetcher, however many
+    # of them there are, so the read-ahead does not run too far ahead.
+    with prefetch.acquire(image.path):
+        if len(star_ids):
+            img_qphot = qphot.run(*args, cbox=options.cbox,
+                                  centering=options.centering,
+                                  satur_mask=satur_mask).to_array()
+        else:
+            img_qphot = numpy.empty(0, dtype = qphot.DTYPE)
     logging.info("Finished running qphot on %s" % image.path)
 
     msg = "%s: qphot.run() returned %d records"
@@ -219,7 +354,7 @@ def parallel_photometry(args):
 
     args = (image.path, pfilter, unix_time, object_, airmass, gain, ra, dec)
     db_image = database.Image(*args)
-    queue.put((db_image, pparams, img_qphot))
+    queue.put((db_image, pparams, star_ids, img_qphot))
     msg = "%s: photometry result put into global queue"
     logging.debug(msg % image.path)
 
@@ -259,6 +394,22 @@ parser.add_option('--cbox', action = 'store', type = 'float',
                   "and want photometry to be done without any centering, you "
                   "may set this option to zero [default: %default]")
 
+parser.add_option('--centering', action = 'store', type = 'choice',
+                  dest = 'centering', default = 'iraf',
+                  choices = ('iraf',) + centroid.METHODS,
+                  help = "the algorithm used to find the accurate center of "
+                  "the astronomical objects within the centering box (see "
+                  "--cbox). 'iraf' lets IRAF's qphot compute it, while "
+                  "'weighted' (intensity-weighted centroid) and 'gaussian' "
+                  "(Gaussian fit to the marginal distributions) compute the "
+                  "centers of all the objects at once, with NumPy. With "
+                  "these two methods, IRAF is not used at all: the pixels "
+                  "around the objects are read only once, and the aperture "
+                  "photometry, the sky annulus and the saturation check are "
+                  "also computed with NumPy, emulating IRAF's qphot. "
+                  "Available options: %s [default: %%default]" %
+                  ', '.join(('iraf',) + centroid.METHODS))
+
 parser.add_option('--maximum', action = 'store', type = 'int',
                   dest = 'maximum', default = defaults.maximum,
                   help = defaults.desc['maximum'])
@@ -291,6 +442,31 @@ parser.add_option('--cores', action = 'store', type = 'int',
                   dest = 'ncores', default = defaults.ncores,
                   help = defaults.desc['ncores'])
 
+parser.add_option('--min-tile', action = 'store', type = 'int',
+                  dest = 'min_tile', default = defaults.min_tile,
+                  help = defaults.desc['min_tile'])
+
+parser.add_option('--header-index', action = 'store', type = 'str',
+                  dest = 'header_index', default = defaults.header_index,
+                  help = defaults.desc['header_index'])
+
+parser.add_option('--sextractor-cache', action = 'store', type = 'str',
+                  dest = 'sextractor_cache', default = defaults.sextractor_cache,
+                  help = defaults.desc['sextractor_cache'])
+
+parser.add_option('--sextractor-cache-size', action = 'store', type = 'int',
+                  dest = 'sextractor_cache_size',
+                  default = defaults.sextractor_cache_size,
+                  help = defaults.desc['sextractor_cache_size'])
+
+parser.add_option('--quality-db', action = 'store', type = 'str',
+                  dest = 'quality_db', default = defaults.quality_db,
+                  help = defaults.desc['quality_db'])
+
+parser.add_option('--prefetch', action = 'store', type = 'int',
+                  dest = 'prefetch', default = defaults.prefetch,
+                  help = defaults.desc['prefetch'])
+
 parser.add_option('-v', '--verbose', action = 'count',
                   dest = 'verbose', default = defaults.verbosity,
                   help = defaults.desc['verbosity'])
@@ -415,6 +591,11 @@ fwhm_group.add_option('--snr-percentile', action = 'store', type = 'float',
 
 fwhm_group.add_option('--mean', action = 'store_true', dest = 'mean',
                       help = defaults.desc['mean'])
+
+fwhm_group.add_option('--detector', action = 'store', type = 'choice',
+                      dest = 'detector', default = defaults.detector,
+                      choices = list(seeing.DETECTORS),
+                      help = defaults.desc['detector'])
 parser.add_option_group(fwhm_group)
 
 key_group = optparse.OptionGroup(parser, "FITS Keywords",
@@ -499,6 +680,17 @@ def main(arguments = None):
         logging_level = logging.DEBUG
     logging.basicConfig(format = style.LOG_FORMAT, level = logging_level)
 
+    # Cache the headers of the FITS images in the persistent header index
+    fitsimage.set_header_index(options.header_index)
+
+    # ... and the SExtractor catalogs in the catalog cache
+    max_size = options.sextractor_cache_size * 1024 ** 2
+    catalog_cache = \
+        seeing.set_catalog_cache(options.sextractor_cache, max_size)
+
+    # ... and read the FWHM of the images from the quality metrics store
+    seeing.set_quality_db(options.quality_db)
+
     # Print the help and abort the execution if there are not three positional
     # arguments left after parsing the options, as the user must specify the
     # sources image, at least one (only one?) image on which to do photometry
@@ -673,23 +865,25 @@ def main(arguments = None):
     msg = "%sExamining the headers of the %s FITS files given as input..."
     print msg % (style.prefix, len(input_paths))
 
-    def get_date(img):
-        """ Return the date() of a FITSImage object """
-        return img.date(date_keyword = options.datek,
-                        time_keyword = options.timek,
-                        exp_keyword = options.exptimek)
+    date_keywords = dict(date_keyword = options.datek,
+                         time_keyword = options.timek,
+                         exp_keyword = options.exptimek)
 
     files = fitsimage.InputFITSFiles()
     img_dates = {}
 
-    methods.show_progress(0.0)
-    for index, img_path in enumerate(input_paths):
-        img = fitsimage.FITSImage(img_path)
-        pfilter = img.pfilter(options.filterk)
-        files[pfilter].append(img_path)
+    # The headers are read in parallel, by a pool of threads, but the results
+    # are returned in order, as they become available, so that the progress
+    # bar can be updated as they are received.
+    kwargs = dict(filterk = options.filterk,
+                  date_keywords = date_keywords,
+                  ncores = options.ncores)
+    headers = fitsimage.scan_headers(input_paths, **kwargs)
 
-        date = get_date(img)
-        img_dates[img_path] = date
+    methods.show_progress(0.0)
+    for index, info in enumerate(headers):
+        files[info.pfilter].append(info.path)
+        img_dates[info.path] = info.date
 
         percentage = (index + 1) / len(input_paths) * 100
         methods.show_progress(percentage)
@@ -968,9 +1162,12 @@ def main(arguments = None):
             msg = "%sDetected %d sources on which to do photometry."
             print msg % (style.prefix, len(sources_img))
 
-    # Use 'options.coordinates' as the name of the list of Coordinates objects,
+    # Use 'options.coordinates' as the name of the coordinates of the objects,
     # independently of whether the --coordinates option has been used or not.
-    options.coordinates = sources_coordinates
+    # They are stored as an astromatic.CoordinatesArray, so that the proper
+    # motion correction is applied to all of them at once in each image.
+    options.coordinates = \
+        astromatic.CoordinatesArray.from_coordinates(sources_coordinates)
 
     print style.prefix
     msg = "%sNeed to determine the instrumental magnitude of each source."
@@ -1054,7 +1251,8 @@ def main(arguments = None):
     with warnings.catch_warnings():
         kwargs = dict(category = qphot.MissingFITSKeyword)
         warnings.filterwarnings('ignore', **kwargs)
-        sources_phot = qphot.run(*qphot_args, cbox=options.cbox)
+        sources_phot = qphot.run(*qphot_args, cbox=options.cbox,
+                                 centering=options.centering)
 
     print 'done.'
 
@@ -1065,7 +1263,7 @@ def main(arguments = None):
     # positive detections by SExtractor, or if incorrect coordinates, that do
     # not correspond to any object, are given with the --coordinates option.
     #
-    # Delete from options.coordinates (well, it is in actuality a new list,
+    # Delete from options.coordinates (well, it is in actuality a new array,
     # which we then assign to this name) the coordinates of the objects that
     # are INDEF (i.e., whose magnitude is None). This is possible because the
     # order of the QPhotResult objects contained in the QPhot object returned
@@ -1075,20 +1273,14 @@ def main(arguments = None):
     print msg % style.prefix ,
     sys.stdout.flush()
 
-    ignored_counter = 0
-    non_ignored_counter = 0
     original_size = len(sources_phot)
 
     assert len(options.coordinates) == len(sources_phot)
-    it = itertools.izip(options.coordinates, sources_phot)
-
-    options.coordinates = []
-    for coord, object_phot in it:
-        if object_phot.mag is not None:
-            options.coordinates.append(coord)
-            non_ignored_counter += 1
-        else:
-            ignored_counter += 1
+    non_indef = numpy.array([object_phot.mag is not None
+                             for object_phot in sources_phot], dtype = bool)
+    options.coordinates = options.coordinates[non_indef]
+    non_ignored_counter = int(non_indef.sum())
+    ignored_counter = original_size - non_ignored_counter
 
     # Delete INDEF photometric measurements, in-place
     for index in xrange(len(sources_phot) - 1, -1, -1):
@@ -1127,7 +1319,8 @@ def main(arguments = None):
         with warnings.catch_warnings():
             kwargs = dict(category = qphot.MissingFITSKeyword)
             warnings.filterwarnings('ignore', **kwargs)
-            non_INDEF_phot = qphot.run(*qphot_args, cbox=options.cbox)
+            non_INDEF_phot = qphot.run(*qphot_args, cbox=options.cbox,
+                                       centering=options.centering)
 
         assert sources_phot == non_INDEF_phot
         print 'done.'
@@ -1289,20 +1482,15 @@ def main(arguments = None):
             print msg % (style.prefix, options.annulus)
             msg = "%sSky annulus, width = %.2f x FWHM pixels"
             print msg % (style.prefix, options.dannulus)
+            individual_fwhms = get_fwhms(images, options)
 
         elif not fixed_annuli:
             msg = "%sCalculating the median FWHM for this filter..."
             print msg % style.prefix ,
             sys.stdout.flush()
 
-            pfilter_fwhms = []
-            for path in images:
-                img = fitsimage.FITSImage(path)
-                img_fwhm = get_fwhm(img, options)
-                logging.debug("%s: FWHM = %.3f" % (img.path, img_fwhm))
-                pfilter_fwhms.append(img_fwhm)
-
-            fwhm = numpy.median(pfilter_fwhms)
+            pfilter_fwhms = get_fwhms(images, options)
+            fwhm = numpy.median(pfilter_fwhms.values())
             print 'done.'
 
             aperture = fwhm * options.aperture
@@ -1335,6 +1523,12 @@ def main(arguments = None):
             msg = "%sSky annulus, width = %.3f pixels"
             print msg % (style.prefix, dannulus)
 
+        # Read the next images into the page cache while the workers do
+        # photometry on the previous ones. The Prefetcher must be installed
+        # before the pool is created, so that the workers inherit it.
+        prefetcher = prefetch.Prefetcher(images, options.prefetch)
+        prefetch.set_prefetcher(prefetcher)
+
         # The task of doing photometry on a series of images is inherently
         # parallelizable; use a pool of workers to which to assign the images.
         pool = multiprocessing.Pool(options.ncores)
@@ -1351,7 +1545,7 @@ def main(arguments = None):
 
             """
 
-            fwhm = get_fwhm(img, options)
+            fwhm = individual_fwhms[img.path]
             aperture = fwhm * options.aperture
             annulus  = fwhm * options.annulus
             dannulus = fwhm * options.dannulus
@@ -1384,10 +1578,62 @@ def main(arguments = None):
         else:
             qphot_params = fwhm_derived_params
 
-        def map_async_args():
-            for path in images:
-                img = fitsimage.FITSImage(path)
-                yield (img, qphot_params(img), options)
+        # Photometry is done in parallel on different images but, if there
+        # are not enough of them to keep all the cores busy (e.g., a few
+        # wide-field images with hundreds of thousands of objects), some
+        # images are also split into spatial tiles on which the workers do
+        # photometry simultaneously. These are the last images, so that their
+        # tiles fill the cores that would otherwise have sat idle during the
+        # last round of images. The number of objects in each tile must be at
+        # least --min-tile, as every call to qphot has some overhead.
+
+        ntiled = len(images) % options.ncores
+        tiles_per_image = 1
+        if ntiled:
+            tiles_per_image = int(math.ceil(options.ncores / ntiled))
+
+        # For each image, a list with the IDs of the objects in each one of
+        # its tiles, or [None] if photometry is done on the entire image.
+        plan = []
+        for index, path in enumerate(images):
+            img = fitsimage.FITSImage(path)
+            pparams = qphot_params(img)
+            if tiles_per_image < 2 or index < len(images) - ntiled:
+                plan.append((img, pparams, [None]))
+                continue
+
+            star_ids = footprint_ids(img, pparams, options)
+            ntiles = len(star_ids) // max(options.min_tile, 1)
+            ntiles = max(min(ntiles, tiles_per_image), 1)
+            msg = "%s: splitting %d objects into %d spatial tiles"
+            logging.debug(msg % (path, len(star_ids), ntiles))
+
+            coords = options.coordinates
+            ra, dec = coords.ra[star_ids], coords.dec[star_ids]
+            x, y = img.world2pix(ra, dec)
+            tiles = methods.spatial_tiles(x, y, ntiles)
+            plan.append((img, pparams, [star_ids[tile] for tile in tiles]))
+
+        # With --centering iraf, qphot.run() checks for saturation doing
+        # photometry on a mask of the entire image, made with imexpr. For the
+        # images split into tiles, make the mask once (all of them at the same
+        # time, in parallel) instead of once per tile, and share it.
+        tiled = [img for img, _, tiles in plan if len(tiles) > 1]
+        masks = {}
+        if options.centering == 'iraf' and tiled:
+            map_args = ((img, options) for img in tiled)
+            paths = pool.map(parallel_saturation_mask, map_args)
+            masks = dict(zip((img.path for img in tiled), paths))
+            msg = "%d saturation masks shared among the tiles"
+            logging.debug(msg % len(masks))
+
+        tasks = []
+        for img, pparams, tiles in plan:
+            satur_mask = masks.get(img.path)
+            for star_ids in tiles:
+                tasks.append((img, pparams, options, star_ids, satur_mask))
+        msg = "%d photometry tasks for %d images"
+        logging.debug(msg % (len(tasks), len(images)))
 
         # Unlike the sources image, the options.exptimek FITS keyword is *not*
         # optional for the images on which we do photometry: qphot() needs it
@@ -1397,132 +1643,104 @@ def main(arguments = None):
         # there are no duplicate observation dates. There is no need to turn
         # the MissingFITSKeyword warning into an exception.
 
-        result = pool.map_async(parallel_photometry, map_async_args())
+        # One task per chunk, so that the tiles of the same image (which are
+        # consecutive) are not submitted together to the same worker.
+        prefetcher.start()
+        result = pool.map_async(parallel_photometry, tasks, chunksize = 1)
         methods.show_progress(0.0)
         while not result.ready():
             time.sleep(1)
-            methods.show_progress(queue.qsize() / len(images) * 100)
+            methods.show_progress(queue.qsize() / len(tasks) * 100)
             # Do not update the progress bar when debugging; instead, print it
             # on a new line each time. This prevents the next logging message,
             # if any, from being printed on the same line that the bar.
             if logging_level < logging.WARNING:
                 print
 
-        result.get() # reraise exceptions of the remote call, if any
+        try:
+            result.get() # reraise exceptions of the remote call, if any
+        finally:
+            prefetcher.stop()
+            prefetch.set_prefetcher(None)
+            methods.clean_tmp_files(*masks.values())
         methods.show_progress(100) # in case the queue was ready too soon
         print
+        prefetcher.log_stats()
 
         msg = "%sStoring photometric measurements in the database..."
         print msg % style.prefix
         sys.stdout.flush()
 
+        # The IDs of the astronomical objects with known proper motions, for
+        # which we also have to store the x- and y-coordinates where photometry
+        # was done. Stars were stored in the LEMONdB in the same order as in
+        # options.coordinates, so their IDs are also their indexes.
+        pm_ids = numpy.flatnonzero(options.coordinates.pm_mask)
+
+        # Merge the photometry of the different tiles of each image, in case
+        # it was split: all the measurements must be stored at once.
+        qphot_results = collections.OrderedDict()
+        for _ in xrange(queue.qsize()):
+            db_image, pparams, img_ids, img_phot = queue.get()
+            qphot_results.setdefault(db_image.path, []).append(
+                (db_image, pparams, img_ids, img_phot))
+
         methods.show_progress(0)
-        qphot_results = (queue.get() for x in xrange(queue.qsize()))
-        for index, args in enumerate(qphot_results):
+        for index, tiles in enumerate(qphot_results.itervalues()):
 
-            db_image, pparams, img_qphot = args
+            db_image, pparams = tiles[0][:2]
+            img_ids = numpy.concatenate([tile[2] for tile in tiles])
+            img_phot = numpy.concatenate([tile[3] for tile in tiles])
             logging.debug("Storing image %s in database" % db_image.path)
             output_db.add_image(db_image)
             logging.debug("Image %s successfully stored" % db_image.path)
 
-            # Now store each photometric measurement
-            for object_id, object_phot in enumerate(img_qphot):
-                # INDEF photometric measurements have a magnitude of None, and
-                # those with at least one saturated pixel in the aperture have
-                # a magnitude of infinity. In both cases the measurement is
-                # useless for our photometric purposes and can be ignored.
-                if object_phot.mag is None:
-                    msg = "%s: object %d is INDEF (None)"
-                    args = db_image.path, object_id
-                    logging.debug(msg % args)
-                    continue
-
-                elif object_phot.mag == float('infinity'):
-                    msg = "%s: object %d is saturated (infinity)"
-                    args = db_image.path, object_id
-                    logging.debug(msg % args)
-                    continue
-
-                else:
-                    msg = "%s: object %d magnitude = %f"
-                    args = db_image.path, object_id, object_phot.mag
-                    logging.debug(msg % args)
-
-                # Photometric measurements with a signal-to-noise ratio less
-                # than or equal to one are ignored -- not only because these
-                # measurements are anything but reliable, but also because such
-                # values are outside of the domain of the function that
-                # converts SNRs to errors in magnitudes.
-                object_snr = object_phot.snr(db_image.gain)
-                if object_snr <= 1:
-                    msg = "%s: object %d ignored (SNR = %f <= 1)"
-                    args = db_image.path, object_id, object_snr
-                    logging.debug(msg % args)
-                    continue
-
-                else:
-                    msg = "%s: object %d SNR = %f"
-                    args = db_image.path, object_id, object_snr
-                    logging.debug(msg % args)
-
-                    msg = "%s: storing measurement for object %d in database"
-                    args = db_image.path, object_id
-                    logging.debug(msg % args)
-
-                    args = (object_id,
-                            db_image.unix_time,
-                            db_image.pfilter,
-                            object_phot.mag,
-                            object_snr)
-
-                    output_db.add_photometry(*args)
-
-                    msg = "%s: measurement for object %d successfully stored"
-                    args = db_image.path, object_id
-                    logging.debug(msg % args)
-
-                    # Store the pixel (x and y) coordinates where photometry
-                    # has been done. Useful mostly, if not exclusively, for
-                    # debugging purposes, in case we need or want to make sure
-                    # the measurement was taken at the proper-motion corrected
-                    # coordinates.
-
-                    pm_ra, pm_dec = output_db.get_star(object_id)[5:7]
-
-                    if not pm_ra and not pm_dec:
-
-                        msg = "%s: object %d does not have proper motion"
-                        args = db_image.path, object_id
-                        logging.debug(msg % args)
-
-                    else:
-
-                        assert pm_ra  is not None
-                        assert pm_dec is not None
-
-                        msg = "%s: object %d pm_ra = %f (x = %f)"
-                        args = db_image.path, object_id, pm_ra, object_phot.x
-                        logging.debug(msg % args)
-
-                        msg = "%s: object %d pm_dec = %f (y = %f)"
-                        args = db_image.path, object_id, pm_dec, object_phot.y
-                        logging.debug(msg % args)
-
-                        msg = "%s: storing proper-motion corrections for object %d"
-                        args = db_image.path, object_id
-                        logging.debug(msg % args)
-
-                        args = (object_id,
-                                db_image.unix_time,
-                                db_image.pfilter,
-                                object_phot.x,
-                                object_phot.y)
-
-                        output_db.add_pm_correction(*args)
-
-                        msg = "%s: proper-motion correction for object %d sucessfully stored"
-                        args = db_image.path, object_id
-                        logging.debug(msg % args)
+            # INDEF photometric measurements have a magnitude of NaN, and
+            # those with at least one saturated pixel in the aperture are
+            # flagged as such. In both cases the measurement is useless for
+            # our photometric purposes and can be ignored.
+            indef = numpy.isnan(img_phot['mag'])
+            saturated = img_phot['saturated'] & ~indef
+            msg = "%s: %d objects are INDEF (NaN)"
+            logging.debug(msg % (db_image.path, indef.sum()))
+            msg = "%s: %d objects are saturated"
+            logging.debug(msg % (db_image.path, saturated.sum()))
+
+            # Photometric measurements with a signal-to-noise ratio less than
+            # or equal to one are ignored -- not only because these
+            # measurements are anything but reliable, but also because such
+            # values are outside of the domain of the function that converts
+            # SNRs to errors in magnitudes.
+            snrs = qphot.snr(img_phot, db_image.gain)
+            noisy = (snrs <= 1) & ~indef & ~saturated
+            msg = "%s: %d objects ignored (SNR <= 1)"
+            logging.debug(msg % (db_image.path, noisy.sum()))
+
+            valid = ~(indef | saturated | noisy)
+            star_ids = img_ids[valid]
+            msg = "%s: storing measurements for %d objects in database"
+            logging.debug(msg % (db_image.path, len(star_ids)))
+
+            # Store also the pixel (x and y) coordinates where photometry has
+            # been done for the objects with proper motions. Useful mostly, if
+            # not exclusively, for debugging purposes, in case we need or want
+            # to make sure the measurement was taken at the proper-motion
+            # corrected coordinates.
+
+            valid_phot = img_phot[valid]
+            args = (db_image.unix_time,
+                    db_image.pfilter,
+                    star_ids,
+                    valid_phot['mag'],
+                    snrs[valid])
+
+            kwargs = dict(pm_x = valid_phot['x'],
+                          pm_y = valid_phot['y'],
+                          pm_ids = pm_ids)
+
+            output_db.add_image_photometry(*args, **kwargs)
+            msg = "%s: measurements successfully stored"
+            logging.debug(msg % db_image.path)
 
             methods.show_progress(100 * (index + 1) / len(images))
             if logging_level < logging.WARNING:
@@ -1568,6 +1786,8 @@ def main(arguments = None):
     output_db.commit()
 
     methods.owner_writable(output_db_path, False) # chmod u-w
+    if catalog_cache is not None:
+        catalog_cache.log_stats()
     print "%sYou're done ^_^" % style.prefix
     return 0
 
@@ -0,0 +1,409 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Asynchronous prefetching of the FITS images processed by a pool of workers.
+
+The LEMON commands that process images in parallel (seeing, photometry and
+astrometry) submit them, in order, to a multiprocessing pool, whose workers
+read each image only after they are done with the previous one. When images
+live on a slow or remote file system (e.g., NFS), CPU and I/O never overlap.
+This module offers a Prefetcher, which runs a few read-ahead threads in the
+parent process that stay up to 'depth' images ahead of the workers, either
+reading them into the page cache or copying them to a local scratch directory,
+whose total size is bounded by a budget. The workers use acquire() to get the
+path to the image they have to work on -- the staged copy, if it is available,
+or the original file -- and the Prefetcher counts the hits and misses.
+
+The state shared by the parent and the workers (which images have been staged
+and which ones have been taken by a worker) is kept in shared memory, which is
+inherited by the child processes: the Prefetcher must be installed with
+set_prefetcher() before the pool is created, and start() called afterwards.
+
+"""
+
+from __future__ import division
+
+import contextlib
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+# Access pattern advice for posix_fadvise(), from <fcntl.h> on Linux
+POSIX_FADV_SEQUENTIAL = 2
+
+def _get_fadvise():
+    """ Return posix_fadvise(), or None if it is not available.
+
+    Use os.posix_fadvise() if it exists (Python >= 3.3); otherwise, call the
+    function of the C library through ctypes.
+
+    """
+
+    try:
+        return os.posix_fadvise
+    except AttributeError:
+        pass
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        function = libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None
+
+    function.argtypes = [ctypes.c_int, ctypes.c_int64,
+                         ctypes.c_int64, ctypes.c_int]
+    function.restype = ctypes.c_int
+    return function
+
+_fadvise = _get_fadvise()
+
+def read_ahead(path, chunk_size = 1048576):
+    """ Read a file into the page cache of the operating system.
+
+    Advise the kernel that the file is going to be read sequentially (so that
+    it uses a more aggressive read-ahead, if posix_fadvise() is available) and
+    read it, in chunks of 'chunk_size' bytes, discarding the data. Return the
+    number of bytes that were read.
+
+    """
+
+    nbytes = 0
+    with open(path, 'rb') as fd:
+        if _fadvise is not None:
+            _fadvise(fd.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+        while True:
+            chunk = fd.read(chunk_size)
+            if not chunk:
+                break
+            nbytes += len(chunk)
+    return nbytes
+
+
+class Prefetcher(object):
+    """ Stage the next images of a pool of workers while the others are used.
+
+    The read-ahead threads of a Prefetcher go through 'paths', in the same
+    order in which the images are submitted to the pool of workers, and
+    prepare each image as soon as it is at most 'depth' images ahead of the
+    number of images that the workers have already taken (see acquire()). If
+    'scratch_dir' is None, the images are read into the page cache of the
+    operating system; otherwise, they are copied to this directory, as long as
+    the total size of the copies not yet released by the workers does not
+    exceed 'budget' bytes. Images larger than the budget are only read into
+    the page cache. A 'depth' of zero disables the prefetching.
+
+    """
+
+    # Seconds that a read-ahead thread sleeps before checking again whether
+    # the workers have made enough progress for it to prepare the next image.
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, paths, depth, scratch_dir = None,
+                 budget = None, threads = 2):
+
+        self.paths = list(paths)
+        self.depth = depth
+        self.scratch_dir = scratch_dir
+        self.budget = budget
+        self.nthreads = threads
+
+        # Copies go to a temporary directory within 'scratch_dir', so that
+        # several executions can share the same scratch directory.
+        self._root = None
+        if scratch_dir is not None and depth:
+            if not os.path.isdir(scratch_dir):
+                os.makedirs(scratch_dir)
+            kwargs = dict(prefix = 'lemon_prefetch_', dir = scratch_dir)
+            self._root = tempfile.mkdtemp(**kwargs)
+
+        # The index of the first occurrence of each image in 'paths'
+        self._indexes = {}
+        for index, path in enumerate(self.paths):
+            self._indexes.setdefault(os.path.abspath(path), index)
+
+        # Shared memory, inherited by the workers after the fork() -- all of it
+        # protected by the same lock, so that an image cannot be staged and
+        # taken by a worker at the same time.
+        nimages = max(len(self.paths), 1)
+        self._lock = multiprocessing.Lock()
+        self._staged = multiprocessing.RawArray(ctypes.c_bool, nimages)
+        self._taken = multiprocessing.RawArray(ctypes.c_bool, nimages)
+        self._ntaken = multiprocessing.RawValue(ctypes.c_long, 0)
+        self._used = multiprocessing.RawValue(ctypes.c_longlong, 0)
+        self._hits = multiprocessing.RawValue(ctypes.c_long, 0)
+        self._misses = multiprocessing.RawValue(ctypes.c_long, 0)
+
+        # Only used by the read-ahead threads, in the parent process: the
+        # index of the next image to prepare, and that of the only image that
+        # may be waiting for its turn (so that images are staged in order)
+        self._next = 0
+        self._turn = 0
+        self._next_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def hits(self):
+        """ The number of images that were already staged when acquired. """
+        return self._hits.value
+
+    @property
+    def misses(self):
+        """ The number of images that were not staged when acquired. """
+        return self._misses.value
+
+    @property
+    def hit_rate(self):
+        """ The fraction of acquired images that were staged, or None. """
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    @property
+    def used(self):
+        """ The size, in bytes, of the copies in the scratch directory. """
+        return self._used.value
+
+    def _scratch_path(self, index):
+        """ Return the path to the copy of the index-th image. """
+
+        # Each copy goes to its own directory, so that the basename is not
+        # modified (e.g., astrometry_net() uses it to name its output files).
+        basename = os.path.basename(self.paths[index])
+        return os.path.join(self._root, str(index), basename)
+
+    def _discard_copy(self, index, size):
+        """ Delete the copy of the index-th image from the scratch dir. """
+
+        path = self._scratch_path(index)
+        shutil.rmtree(os.path.dirname(path), ignore_errors = True)
+        with self._lock:
+            self._used.value -= size
+
+    def _wait_turn(self, index, size):
+        """ Wait until the index-th image can be staged.
+
+        Return True when the image is at most 'depth' images ahead of those
+        taken by the workers, and (if it is to be copied) there is room for it
+        within the budget; False if it has already been taken, or if the
+        Prefetcher was stopped. The space in the budget is reserved. Images
+        wait for their turn in order, so that the budget is never taken by
+        an image while the workers are still waiting for a previous one.
+
+        """
+
+        while not self._stop.is_set():
+            with self._next_lock:
+                turn = self._turn
+            if index != turn:
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            with self._lock:
+                if self._taken[index]:
+                    return False
+                if index < self._ntaken.value + self.depth:
+                    if size is None:
+                        return True
+                    # Always room for one image, however little the budget
+                    if self.budget is None or not self._used.value or \
+                       self._used.value + size <= self.budget:
+                        self._used.value += size
+                        return True
+            time.sleep(self.POLL_INTERVAL)
+        return False
+
+    def _stage(self, index):
+        """ Read the index-th image into the page cache or the scratch dir. """
+
+        path = self.paths[index]
+        size = None
+        if self._root is not None and os.path.isfile(path):
+            size = os.path.getsize(path)
+            if self.budget is not None and size > self.budget:
+                msg = "%s: larger than the scratch budget, not copied"
+                logging.debug(msg % path)
+                size = None
+
+        ready = self._wait_turn(index, size)
+        # Now it is the turn of the next image
+        with self._next_lock:
+            self._turn = index + 1
+        if not ready:
+            return
+
+        if size is None:
+            read_ahead(path)
+            logging.debug("%s: read into the page cache" % path)
+        else:
+            copy_path = self._scratch_path(index)
+            try:
+                os.makedirs(os.path.dirname(copy_path))
+                # Copy to a temporary name and then rename, so that a partial
+                # copy is never seen as staged
+                tmp_path = copy_path + '.part'
+                shutil.copy2(path, tmp_path)
+                os.rename(tmp_path, copy_path)
+            except (IOError, OSError):
+                self._discard_copy(index, size)
+                raise
+            msg = "%s: copied to %s"
+            logging.debug(msg % (path, copy_path))
+
+        with self._lock:
+            if not self._taken[index]:
+                self._staged[index] = True
+                return
+
+        # Taken by a worker (a miss) while we were copying it
+        if size is not None:
+            self._discard_copy(index, size)
+
+    def _run(self):
+        """ The body of the read-ahead threads. """
+
+        while not self._stop.is_set():
+            with self._next_lock:
+                index = self._next
+                self._next += 1
+            if index >= len(self.paths):
+                return
+            try:
+                self._stage(index)
+            except (IOError, OSError), e:
+                msg = "%s: cannot prefetch (%s)"
+                logging.debug(msg % (self.paths[index], e))
+
+    def start(self):
+        """ Start the read-ahead threads.
+
+        This must be done after the pool of workers has been created, as the
+        threads of the parent process are not (and should not be) inherited
+        by the child processes.
+
+        """
+
+        if not self.depth or not self.paths:
+            return
+
+        for _ in xrange(self.nthreads):
+            thread = threading.Thread(target = self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Stop the read-ahead threads and delete the copies not used. """
+
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        if self._root is not None:
+            for index in xrange(len(self.paths)):
+                if self._staged[index] and not self._taken[index]:
+                    size = os.path.getsize(self._scratch_path(index))
+                    self._discard_copy(index, size)
+            # Anything else left behind, such as partial copies
+            shutil.rmtree(self._root, ignore_errors = True)
+
+    @contextlib.contextmanager
+    def acquire(self, path):
+        """ Context manager that returns the path to a prefetched image.
+
+        To be used by the workers: return the path to the copy of the image in
+        the scratch directory, if it was already staged, or the original path
+        otherwise. The copy is deleted on exit from the body of the with
+        statement. Images not known by the Prefetcher are counted as misses.
+        An image may be acquired more than once (e.g., by several workers
+        doing photometry on different tiles of it), but only the first time
+        counts: it is neither a hit nor a miss, and the workers are not
+        considered to have advanced any further. The copy belongs to whoever
+        acquired the image first, so the original path is returned.
+
+        """
+
+        index = self._indexes.get(os.path.abspath(path))
+        with self._lock:
+            if index is None:
+                staged = False
+                self._misses.value += 1
+            elif not self._taken[index]:
+                staged = self._staged[index]
+                self._taken[index] = True
+                self._ntaken.value += 1
+                if staged:
+                    self._hits.value += 1
+                else:
+                    self._misses.value += 1
+            else:
+                # Already acquired: the copy, if any, is not ours to use
+                staged = False
+
+        if not staged or self._root is None:
+            yield path
+            return
+
+        copy_path = self._scratch_path(index)
+        size = os.path.getsize(copy_path)
+        try:
+            yield copy_path
+        finally:
+            self._discard_copy(index, size)
+
+    def log_stats(self):
+        """ Log, at the INFO level, the hit and miss statistics. """
+
+        if self.hit_rate is None:
+            return
+        msg = "Prefetching: %d hits, %d misses (hit rate: %.1f%%)"
+        logging.info(msg % (self.hits, self.misses, self.hit_rate * 100))
+
+
+# The Prefetcher used by acquire(), in the parent process and in the workers.
+# Installed by set_prefetcher(), before the pool of workers is created.
+_prefetcher = None
+
+def set_prefetcher(prefetcher):
+    """ Install the Prefetcher used by acquire(); None to uninstall it. """
+
+    global _prefetcher
+    _prefetcher = prefetcher
+
+@contextlib.contextmanager
+def acquire(path):
+    """ Return the path to the prefetched image, if prefetching is enabled.
+
+    Use Prefetcher.acquire() of the Prefetcher installed with set_prefetcher()
+    or, if there is none, simply return 'path'.
+
+    """
+
+    if _prefetcher is None:
+        yield path
+    else:
+        with _prefetcher.acquire(path) as local_path:
+            yield local_path
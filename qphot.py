@@ -35,6 +35,7 @@ import collections
 import itertools
 import logging
 import math
+import numpy
 import os
 import os.path
 import re
@@ -43,8 +44,10 @@ import tempfile
 import warnings
 
 # LEMON modules
+import astromatic
 import fitsimage
 import methods
+import stamps
 
 # Tell PyRAF to skip all graphics initialization and run in terminal-only mode.
 # Otherwise we will get annoying warning messages (such as "could not open
@@ -160,6 +163,46 @@ class QPhotResult(collections.namedtuple(typename, field_names)):
             return (self.flux * gain) / math.sqrt(self.sum * gain)
 
 
+# The photometry of an image, as returned by the workers that do photometry in
+# parallel, is a NumPy structured array with a record for each astronomical
+# object. This is much more compact than a list of QPhotResult objects, which
+# would have to be pickled and sent through the queue object by object. INDEF
+# magnitudes and standard deviations are stored as NaN, not as None.
+
+DTYPE = numpy.dtype([('x', numpy.float64),
+                     ('y', numpy.float64),
+                     ('mag', numpy.float64),
+                     ('sum', numpy.float64),
+                     ('flux', numpy.float64),
+                     ('stdev', numpy.float64),
+                     ('saturated', numpy.bool_)])
+
+def snr(records, gain):
+    """ Return the signal-to-noise ratios of an array of measurements.
+
+    This is the vectorized version of QPhotResult.snr(): 'records' must be a
+    NumPy structured array with (at least) the 'sum' and 'flux' fields, such
+    as that returned by QPhot.to_array(). Returns an array with the SNR of
+    each photometric measurement, zero where the sum is zero and negative
+    where the sum is negative. Raises ValueError if 'gain' is not positive.
+
+    """
+
+    if gain <= 0:
+        raise ValueError("CCD gain must be a positive value")
+
+    sum_ = numpy.asarray(records['sum'], dtype = numpy.float64) * gain
+    flux = numpy.asarray(records['flux'], dtype = numpy.float64) * gain
+
+    snrs = numpy.zeros(sum_.shape, dtype = numpy.float64)
+    positive = sum_ > 0
+    negative = sum_ < 0
+    snrs[positive] = flux[positive] / numpy.sqrt(sum_[positive])
+    snrs[negative] = -(numpy.abs(flux[negative]) /
+                       numpy.sqrt(numpy.abs(sum_[negative])))
+    return snrs
+
+
 class QPhot(list):
     """ The photometry of an image, as returned by IRAF's qphot.
 
@@ -173,46 +216,61 @@ class QPhot(list):
 
     """
 
-    def __init__(self, img_path, coords_path):
+    def __init__(self, img_path, coordinates):
         """ Instantiation method for the QPhot class.
 
         img_path - path to the FITS image on which to do photometry.
-        coords_path - path to the text file with the celestial coordinates
-                      (right ascension and declination) of the astronomical
-                      objects to be measured. These objects must be listed one
-                      per line, in two columns. Note that this class does *not*
-                      apply proper-motion correction, so the coordinates must
-                      be corrected before being written to the file. In case
-                      the proper motions of the objects are listed in the file,
-                      in columns third and fourth, ValueError is raised.
+        coordinates - the celestial coordinates (right ascension and
+                      declination) of the astronomical objects to be measured,
+                      as an astromatic.CoordinatesArray or any iterable of
+                      astromatic.Coordinates objects. Note that this class does
+                      *not* apply proper-motion correction, so the coordinates
+                      must be corrected beforehand: ValueError is raised if one
+                      or more objects have a non-zero proper motion. For
+                      backwards compatibility, the path to a text file where
+                      the objects are listed one per line, in two columns, is
+                      also accepted. In that case, ValueError is raised if the
+                      proper motions of the objects are listed in the file, in
+                      columns third and fourth.
 
         """
 
         super(list, self).__init__()
         self.image = fitsimage.FITSImage(img_path)
-        self.coords_path = coords_path
-
-        for ra, dec, pm_ra, pm_dec in methods.load_coordinates(self.coords_path):
-            if ra == 0 and dec == 0:
-                msg = (
-                  "the right ascension and declination of one or more "
-                  "astronomical objects in '%s' is zero. This is a very bad "
-                  "sign: these are the celestial coordinates that SExtractor "
-                  "uses for sources detected on a FITS image that has not been "
-                  "calibrated astrometrically (may that be your case?), and "
-                  "without that it is impossible to do photometry on the "
-                  "desired coordinates" % self.coords_path)
-                # Emit warning only once
-                warnings.warn(msg)
-                break
-
-            if pm_ra is not None or pm_dec is not None:
-                msg = ("at least one object in the '%s' file lists its proper "
-                       "motions. This is not allowed. The coordinates must be "
-                       "written to the file already adjusted for their proper "
-                       "motions, as this class cannot apply any correction" %
-                       self.coords_path)
-                raise ValueError(msg)
+
+        if isinstance(coordinates, basestring):
+            coords_path = coordinates
+            coordinates = []
+            for ra, dec, pm_ra, pm_dec in methods.load_coordinates(coords_path):
+                if pm_ra is not None or pm_dec is not None:
+                    msg = ("at least one object in the '%s' file lists its "
+                           "proper motions. This is not allowed. The "
+                           "coordinates must be written to the file already "
+                           "adjusted for their proper motions, as this class "
+                           "cannot apply any correction" % coords_path)
+                    raise ValueError(msg)
+                coordinates.append(astromatic.Coordinates(ra, dec))
+
+        self.coordinates = \
+            astromatic.CoordinatesArray.from_coordinates(coordinates)
+
+        if self.coordinates.has_pm:
+            msg = ("at least one object has a proper motion. This is not "
+                   "allowed. The coordinates must be already adjusted for "
+                   "their proper motions, as this class cannot apply any "
+                   "correction")
+            raise ValueError(msg)
+
+        if ((self.coordinates.ra == 0) & (self.coordinates.dec == 0)).any():
+            msg = (
+              "the right ascension and declination of one or more "
+              "astronomical objects to be measured on '%s' is zero. This is a "
+              "very bad sign: these are the celestial coordinates that "
+              "SExtractor uses for sources detected on a FITS image that has "
+              "not been calibrated astrometrically (may that be your case?), "
+              "and without that it is impossible to do photometry on the "
+              "desired coordinates" % img_path)
+            warnings.warn(msg)
 
     @property
     def path(self):
@@ -223,6 +281,28 @@ class QPhot(list):
         """ Remove all the photometric measurements. """
         del self[:]
 
+    def to_array(self):
+        """ Return the photometric measurements as a NumPy structured array.
+
+        The returned array has dtype qphot.DTYPE and one record for each
+        QPhotResult object, preserving their order. Magnitudes and standard
+        deviations that are None (INDEF) are stored as NaN, while the
+        'saturated' field is True for those objects whose magnitude is
+        positive infinity (see qphot.run()).
+
+        """
+
+        array = numpy.empty(len(self), dtype = DTYPE)
+        for index, object_phot in enumerate(self):
+            mag = object_phot.mag
+            stdev = object_phot.stdev
+            array[index] = (object_phot.x, object_phot.y,
+                            numpy.nan if mag is None else mag,
+                            object_phot.sum, object_phot.flux,
+                            numpy.nan if stdev is None else stdev,
+                            mag == float('infinity'))
+        return array
+
     def run(self, annulus, dannulus, aperture, exptimek, cbox = 0):
         """ Run IRAF's qphot on the FITS image.
 
@@ -242,16 +322,16 @@ class QPhot(list):
         approach to doing photometry is to use photometry(), a convenience
         function defined below.
 
-        In the first step, photometry is done, using qphot, on the astronomical
-        objects whose coordinates have been listed, one per line, in the text
-        file passed as an argument to QPhot.__init__(). The output of this IRAF
-        task is saved to temporary file (a), an APPHOT text database from which
-        'txdump' extracts the fields to another temporary file, (b). Then this
-        file is parsed, the information of each of its lines, one per object,
-        used in order to create a QPhotResult object. All previous photometric
-        measurements are lost every time this method is run. All the temporary
-        files (a, b) are guaranteed to be deleted on exit, even if an error is
-        encountered.
+        In the first step, the coordinates passed to QPhot.__init__() are
+        written to a temporary text file (a), as this is the only input that
+        IRAF's qphot accepts, and photometry is done on them. The output of
+        this IRAF task is saved to temporary file (b), an APPHOT text database
+        from which 'txdump' extracts the fields to another temporary file, (c).
+        Then this file is parsed, the information of each of its lines, one per
+        object, used in order to create a QPhotResult object. All previous
+        photometric measurements are lost every time this method is run. All
+        the temporary files (a, b, c) are guaranteed to be deleted on exit,
+        even if an error is encountered.
 
         An important note: you may find extremely confusing that, although the
         input that this method accepts are celestial coordinates (the right
@@ -300,6 +380,12 @@ class QPhot(list):
         self.clear() # empty object
 
         try:
+            # The coordinates file needed by IRAF's qphot
+            root, _ = os.path.splitext(os.path.basename(self.path))
+            coords_path = write_coords_file(self.coordinates,
+                                            prefix = root + '_',
+                                            suffix = '.coords')
+
             # Temporary file to which the APPHOT text database produced by
             # qphot will be saved. Even if empty, it must be deleted before
             # calling qphot. Otherwise, an error message, stating that the
@@ -317,21 +403,25 @@ class QPhot(list):
             # Filter this stream so that, if this message is written, it is
             # captured and issued as a MissingFITSkeyword warning instead.
 
-            # Note the two whitespaces before 'Keyword'
-            regexp = ("Warning: Image (?P<msg>{0}  Keyword: {1} "
-                      "not found)".format(self.path, exptimek))
+            # IRAF cannot read compressed images
+            with self.image.plain_copy() as iraf_path:
+
+                # Note the two whitespaces before 'Keyword'
+                regexp = ("Warning: Image (?P<msg>{0}  Keyword: {1} "
+                          "not found)".format(iraf_path, exptimek))
 
-            args = sys.stderr, regexp, MissingFITSKeyword
-            stderr = methods.StreamToWarningFilter(*args)
+                args = sys.stderr, regexp, MissingFITSKeyword
+                stderr = methods.StreamToWarningFilter(*args)
 
-            # Run qphot on the image and save the output to our temporary file.
-            kwargs = dict(cbox = cbox, annulus = annulus, dannulus = dannulus,
-                          aperture = aperture, coords = self.coords_path,
-                          output = qphot_output, exposure = exptimek,
-                          wcsin = 'world', interactive = 'no',
-                          Stderr = stderr)
+                # Run qphot on the image, saving the output to our temporary
+                # file. The copy of the image is not deleted until it is done.
+                kwargs = dict(cbox = cbox, annulus = annulus,
+                              dannulus = dannulus, aperture = aperture,
+                              coords = coords_path, output = qphot_output,
+                              exposure = exptimek, wcsin = 'world',
+                              interactive = 'no', Stderr = stderr)
 
-            apphot.qphot(self.path, **kwargs)
+                apphot.qphot(iraf_path, **kwargs)
 
             # Make sure the output was written to where we said
             assert os.path.exists(qphot_output)
@@ -429,8 +519,13 @@ class QPhot(list):
         finally:
 
             # Remove temporary files. The try-except is necessary because an
-            # exception may be raised before 'qphot_output' and 'txdump_output'
-            # have been defined.
+            # exception may be raised before 'coords_path', 'qphot_output' and
+            # 'txdump_output' have been defined.
+
+            try:
+                methods.clean_tmp_files(coords_path)
+            except NameError:
+                pass
 
             try:
                 methods.clean_tmp_files(qphot_output)
@@ -445,55 +540,233 @@ class QPhot(list):
         return len(self)
 
 
-def get_coords_file(coordinates, year, epoch):
-    """ Return a coordinates file with the exact positions of the objects.
+def write_coords_file(coordinates, **kwargs):
+    """ Write the coordinates of the objects to a temporary text file.
+
+    The right ascension and declination of 'coordinates', an instance of
+    astromatic.CoordinatesArray, are written to a temporary text file, one
+    astronomical object per line and in two columns, as expected by IRAF. The
+    keyword arguments are passed down to tempfile.mkstemp(). Returns the path
+    to the temporary file: the user of this function is responsible for
+    deleting the file when done with it.
+
+    """
 
-    Loop over 'coordinates', an iterable of astromatic.Coordinates objects, and
-    apply proper motion correction, obtaining their exact positions for a given
-    date. These proper-motion corrected coordinates are written to a temporary
-    text file, listed one astronomical object per line and in two columns:
-    right ascension and declination. Returns the path to the temporary file.
-    The user of this function is responsible for deleting the file when done
-    with it.
+    kwargs['text'] = True
+    fd, path = tempfile.mkstemp(**kwargs)
+    with os.fdopen(fd, 'w') as fd:
+        columns = numpy.column_stack((coordinates.ra, coordinates.dec))
+        numpy.savetxt(fd, columns, fmt = '%.10f', delimiter = '\t')
+    return path
 
-    Both 'year' and 'epoch' may be decimal numbers, such as 2014.25 for April
-    1, 2014 (since, in common years, April 1 is the 91st day of the year, and
-    91 / 365 = 0.24931507 = ~0.25). Please refer to the documentation of the
-    Coordinates.get_exact_coordinates() method for further information.
+def exact_coordinates(img, coordinates, epoch, datek, timek, exptimek):
+    """ Return the coordinates of the objects at the time of observation.
+
+    Apply proper-motion correction to 'coordinates' (an iterable of
+    astromatic.Coordinates objects, of the given 'epoch') for the date of
+    observation of 'img', a fitsimage.FITSImage, and return them as an
+    astromatic.CoordinatesArray. 'datek', 'timek' and 'exptimek' are the
+    keywords for the date and time of observation and the exposure time, as
+    in run(). Raises KeyError if one or more of the objects have a known
+    proper motion but the date of observation cannot be read.
 
     """
 
-    kwargs = dict(prefix = '%f_' % year,
-                  suffix = '_J%d.coords' % epoch,
-                  text = True)
+    kwargs = dict(date_keyword = datek,
+                  time_keyword = timek,
+                  exp_keyword = exptimek)
 
-    fd, path = tempfile.mkstemp(**kwargs)
-    fmt = '\t'.join(['%.10f', '%.10f\n'])
+    # The date of observation is only actually needed when we need to apply
+    # proper motion corrections. Therefore, don't call FITSImage.year() unless
+    # one or more of the astronomical objects have a proper motion (which is
+    # precomputed by astromatic.CoordinatesArray, so no loop is needed).
+    # This avoids an unnecessary KeyError exception when we do photometry on a
+    # FITS image without the 'datek' or 'timek' keywords (for example, a mosaic
+    # created with IPAC's Montage): when that happens we cannot apply proper
+    # motion corrections, that's right, but that's not an issue if none of our
+    # objects have a known proper motion.
 
-    for coord in coordinates:
+    coordinates = astromatic.CoordinatesArray.from_coordinates(coordinates)
+    if not coordinates.has_pm:
+        return coordinates
 
-        # Do not apply any correction if pm_ra and pm_dec are None (which means
-        # that the proper motion of the object is unknown) or zero (because in
-        # this case the coordinates are always the same). Make sure also that
-        # either none or both proper motions are None: we cannot know one but
-        # not the other!
+    try:
+        year = img.year(**kwargs)
 
-        if None in (coord.pm_ra, coord.pm_dec):
-            assert coord.pm_ra  is None
-            assert coord.pm_dec is None
+    except KeyError as e:
+        # Include the missing FITS keyword in the exception message
+        regexp = "keyword '(?P<keyword>.*?)' not found"
+        match = re.search(regexp, str(e))
+        assert match is not None
+        msg = ("{0}: keyword '{1}' not found. It is needed in order "
+               "to be able to apply proper-motion correction, as one "
+               "or more astronomical objects have known proper motions"
+               .format(img.path, match.group('keyword')))
+        raise KeyError(msg)
 
-        if coord.pm_ra or coord.pm_dec:
-            coord = coord.get_exact_coordinates(year, epoch = epoch)
+    return coordinates.get_exact_coordinates(year, epoch = epoch)
 
-        os.write(fd, fmt % coord[:2])
+def _original_path(img, uncimgk):
+    """ Return the path to the image on which saturation is to be checked.
 
-    os.close(fd)
-    return path
+    This is the image stored in the 'uncimgk' keyword of the header of 'img',
+    a fitsimage.FITSImage, or the image itself if 'uncimgk' is an empty string
+    or None (see run()). Raises IOError if the image does not exist.
+
+    """
+
+    if not uncimgk:
+        return img.path
+
+    orig_img_path = img.read_keyword(uncimgk)
+    if not os.path.exists(orig_img_path):
+        msg = "image %s (keyword '%s' of image %s) does not exist"
+        args = orig_img_path, uncimgk, img.path
+        raise IOError(msg % args)
+    return orig_img_path
+
+def saturation_mask(img, maximum, uncimgk):
+    """ Make the saturation mask of a FITS image with IRAF's imexpr.
+
+    Write to a temporary file a FITS image with the same size as 'img', a
+    fitsimage.FITSImage, whose pixels are one where those of the image are
+    above 'maximum' ADUs, and zero elsewhere. Saturation is checked for on the
+    image stored in the 'uncimgk' keyword, if any, as run() does. Return the
+    path to the mask, which the caller is responsible for deleting.
+
+    """
+
+    orig_img_path = _original_path(img, uncimgk)
+
+    # Temporary file to which the saturation mask is saved
+    basename = os.path.basename(orig_img_path)
+    mkstemp_prefix = "%s_satur_mask_%d_ADUS_" % (basename, maximum)
+    kwargs = dict(prefix = mkstemp_prefix,
+                  suffix = '.fits', text = True)
+    mask_fd, satur_mask_path = tempfile.mkstemp(**kwargs)
+    os.close(mask_fd)
+
+    # IRAF's imexpr won't overwrite the file. Instead, it will raise an
+    # IrafError exception stating that "IRAF task terminated abnormally
+    # ERROR (1121, "FXF: EOF encountered while reading FITS file".
+    os.unlink(satur_mask_path)
+
+    # The expression that will be given to 'imexpr'. The space after the
+    # colon is needed to avoid sexigesimal interpretation. 'a' is the first
+    # and only operand, linked to our image at the invokation of the task.
+    expr = "a>%d ? 1 : 0" % maximum
+    logging.debug("%s: imexpr = '%s'" % (img.path, expr))
+    logging.debug("%s: a = %s" % (img.path, orig_img_path))
+    logging.info("%s: Running IRAF's imexpr..." % img.path)
+    try:
+        with fitsimage.FITSImage(orig_img_path).plain_copy() as iraf_path:
+            pyraf.iraf.images.imexpr(expr, a = iraf_path,
+                                     output = satur_mask_path, verbose = 'yes',
+                                     Stdout = methods.LoggerWriter('debug'))
+    except:
+        methods.clean_tmp_files(satur_mask_path)
+        raise
+
+    assert os.path.exists(satur_mask_path)
+
+    msg = "%s: IRAF's imexpr OK" % img.path
+    logging.info(msg)
+    msg = "%s: IRAF's imexpr output = %s"
+    logging.debug(msg % (img.path, satur_mask_path))
+    return satur_mask_path
+
+# The maximum size, in bytes, of the stamps.StampCube used by
+# stamp_photometry(): the objects are measured in chunks, so that the stamps,
+# which grow with the square of the outer radius of the sky annulus, never
+# exceed this value no matter how many objects there are.
+STAMPS_MAX_SIZE = 64 * 1024 ** 2
+
+# The magnitude zero point used by IRAF's qphot (the 'zmag' parameter)
+ZMAG = 25
+
+def stamp_photometry(img, coordinates, aperture, annulus, dannulus, maximum,
+                     exptimek, orig_img_path = None, cbox = 0,
+                     centering = 'weighted'):
+    """ Do photometry on a FITS image with NumPy, instead of with IRAF.
+
+    The NumPy equivalent of QPhot.run() and the saturation check done by
+    run(), for the same arguments: the pixels around the objects are read
+    once into a stamps.StampCube, as large as the sky annulus, from which
+    (1) the centers are refined, if 'cbox' is not zero, with the 'centering'
+    method (see centroid.METHODS), (2) the sums in the aperture and (3) the
+    sky level are computed as in IRAF's qphot, for all the objects at once
+    (see StampCube.aperture_sum() and StampCube.sky()). Saturation is checked
+    for on 'orig_img_path', if given and other than the path of 'img'. The
+    objects are measured in chunks, so that the stamps never take more than
+    STAMPS_MAX_SIZE bytes. Returns a QPhot object.
+
+    """
+
+    coordinates = astromatic.CoordinatesArray.from_coordinates(coordinates)
+    img_qphot = QPhot(img.path, coordinates)
+
+    try:
+        exptime = img.read_keyword(exptimek)
+    except KeyError:
+        msg = ("%s: keyword '%s' not found, so magnitudes will not be "
+               "normalized by the exposure time" % (img.path, exptimek))
+        warnings.warn(msg, MissingFITSKeyword)
+        exptime = 1
+
+    # The objects may move up to half the centering box when re-centered
+    radius = max(annulus + dannulus, aperture + 0.5) + cbox / 2 + 1
+    size = 2 * int(math.ceil(radius)) + 1
+    chunk = max(STAMPS_MAX_SIZE // (size ** 2 * 8), 1)
+    logging.debug("%s: stamps of %d x %d pixels, %d objects at a time" %
+                  (img.path, size, size, chunk))
+
+    ra, dec = coordinates.ra, coordinates.dec
+    for start in xrange(0, len(coordinates), chunk):
+        window = slice(start, start + chunk)
+        x, y = img.world2pix(ra[window], dec[window])
+        cube = stamps.StampCube.from_image(img.path, x, y, radius)
+        if cbox:
+            x, y = cube.centroid(cbox, method = centering)
+
+        sum_, area = cube.aperture_sum(aperture, x, y)
+        sky, stdev = cube.sky(annulus, dannulus, x, y)
+        flux = sum_ - area * sky
+
+        # The pixels of the original image are only read if it is not the
+        # one where photometry is done, as they may differ due to the
+        # calibration steps (e.g., flat-fielding).
+        if orig_img_path and orig_img_path != img.path:
+            cube = stamps.StampCube.from_image(orig_img_path, cube.x, cube.y,
+                                               cube.radius)
+        saturated = cube.saturated(aperture, maximum, x, y)
+
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            mags = ZMAG - 2.5 * numpy.log10(flux / exptime)
+
+        # Objects that IRAF would report as INDEF have a magnitude (and
+        # standard deviation) of None, and a sum and flux of zero.
+        sum_ = numpy.nan_to_num(sum_)
+        flux = numpy.nan_to_num(flux)
+        for index in xrange(len(x)):
+            if saturated[index]:
+                mag = float('infinity')
+            elif numpy.isfinite(mags[index]):
+                mag = float(mags[index])
+            else:
+                mag = None
+            sky_stdev = float(stdev[index])
+            if numpy.isnan(sky_stdev):
+                sky_stdev = None
+            args = (float(x[index]), float(y[index]), mag,
+                    float(sum_[index]), float(flux[index]), sky_stdev)
+            img_qphot.append(QPhotResult(*args))
+
+    return img_qphot
 
 def run(img, coordinates, epoch,
         aperture, annulus, dannulus, maximum,
         datek, timek, exptimek, uncimgk,
-        cbox = 0):
+        cbox = 0, centering = 'iraf', satur_mask = None):
     """ Do photometry on a FITS image.
 
     This convenience function does photometry on a FITSImage object, applying
@@ -507,8 +780,9 @@ def run(img, coordinates, epoch,
 
     Arguments:
     img - the fitsimage.FITSImage object on which to do photometry.
-    coordinates - an iterable of astromatic.Coordinates objects, one for each
-                  astronomical object to be measured.
+    coordinates - an astromatic.CoordinatesArray, or an iterable of
+                  astromatic.Coordinates objects, one for each astronomical
+                  object to be measured.
     epoch - the epoch of the coordinates of the astronomical objects, used to
             compute the proper-motion correction. Must be an integer, such as
             2000 for J2000.
@@ -550,51 +824,39 @@ def run(img, coordinates, epoch,
            coordinates, but instead where IRAF has determined that the actual,
            accurate center of each object is. This is usually a good thing, and
            helps improve the photometry.
+    centering - the algorithm used to compute the accurate centers when
+                'cbox' is not zero: 'iraf' lets IRAF's qphot do it, star by
+                star, while 'weighted' (intensity-weighted centroids) and
+                'gaussian' (Gaussian fit to the marginal distributions) use
+                the vectorized centroid module, refining the positions of all
+                the objects at once before photometry is done. These refined
+                positions are then used directly both for the photometry and
+                for the saturation check. With any method other than 'iraf',
+                IRAF is not used at all: the pixels around all the objects are
+                read only once, into a stamps.StampCube as large as the sky
+                annulus, from which the centers, the sums in the aperture, the
+                sky and the saturation check are all computed with NumPy (see
+                stamp_photometry()).
+    satur_mask - the path to the saturation mask of the image, as returned by
+                 saturation_mask(), used when 'centering' is 'iraf'. If None,
+                 the mask is made (and deleted when done) by this function.
+                 Making it once is cheaper when photometry is done on several
+                 subsets of the objects of the same image, as the mask covers
+                 the entire image regardless of the objects that are measured.
 
     """
 
-    kwargs = dict(date_keyword = datek,
-                  time_keyword = timek,
-                  exp_keyword = exptimek)
-
-    # The date of observation is only actually needed when we need to apply
-    # proper motion corrections. Therefore, don't call FITSImage.year() unless
-    # one or more of the astromatic.Coordinates objects have a proper motion.
-    # This avoids an unnecessary KeyError exception when we do photometry on a
-    # FITS image without the 'datek' or 'timek' keywords (for example, a mosaic
-    # created with IPAC's Montage): when that happens we cannot apply proper
-    # motion corrections, that's right, but that's not an issue if none of our
-    # objects have a known proper motion.
+    # The proper-motion corrected objects coordinates. Note that they are
+    # not written to disk here: QPhot.run() does that, as IRAF needs them.
+    coordinates = exact_coordinates(img, coordinates, epoch,
+                                    datek, timek, exptimek)
 
-    for coord in coordinates:
+    if centering != 'iraf':
+        args = (img, coordinates, aperture, annulus, dannulus, maximum,
+                exptimek, _original_path(img, uncimgk), cbox, centering)
+        return stamp_photometry(*args)
 
-        if coord.pm_ra or coord.pm_dec:
-            try:
-                year = img.year(**kwargs)
-                break
-
-            except KeyError as e:
-                # Include the missing FITS keyword in the exception message
-                regexp = "keyword '(?P<keyword>.*?)' not found"
-                match = re.search(regexp, str(e))
-                assert match is not None
-                msg = ("{0}: keyword '{1}' not found. It is needed in order "
-                       "to be able to apply proper-motion correction, as one "
-                       "or more astronomical objects have known proper motions"
-                       .format(img.path, match.group('keyword')))
-                raise KeyError(msg)
-
-        else:
-            # No object has a known proper motion, so don't call
-            # FITSImage.year().  Use the same value as the epoch, so that when
-            # get_coords_file() below applies the proper motion correction the
-            # input and output coordinates are the same.
-            year = epoch
-
-    # The proper-motion corrected objects coordinates
-    coords_path = get_coords_file(coordinates, year, epoch)
-
-    img_qphot = QPhot(img.path, coords_path)
+    img_qphot = QPhot(img.path, coordinates)
     img_qphot.run(annulus, dannulus, aperture, exptimek, cbox=cbox)
 
     # How do we know whether one or more pixels in the aperture are above a
@@ -603,48 +865,11 @@ def run(img, coordinates, epoch,
     # photometry using the same aperture. If we get a non-zero flux, we know it
     # has saturation: http://iraf.net/forum/viewtopic.php?showtopic=1466068
 
-    if not uncimgk:
-        orig_img_path = img.path
-
-    else:
-        orig_img_path = img.read_keyword(uncimgk)
-        if not os.path.exists(orig_img_path):
-            msg = "image %s (keyword '%s' of image %s) does not exist"
-            args = orig_img_path, uncimgk, img.path
-            raise IOError(msg % args)
+    own_mask = satur_mask is None
+    if own_mask:
+        satur_mask = saturation_mask(img, maximum, uncimgk)
 
     try:
-        # Temporary file to which the saturation mask is saved
-        basename = os.path.basename(orig_img_path)
-        mkstemp_prefix = "%s_satur_mask_%d_ADUS_" % (basename, maximum)
-        kwargs = dict(prefix = mkstemp_prefix,
-                      suffix = '.fits', text = True)
-        mask_fd, satur_mask_path = tempfile.mkstemp(**kwargs)
-        os.close(mask_fd)
-
-        # IRAF's imexpr won't overwrite the file. Instead, it will raise an
-        # IrafError exception stating that "IRAF task terminated abnormally
-        # ERROR (1121, "FXF: EOF encountered while reading FITS file".
-        os.unlink(satur_mask_path)
-
-        # The expression that will be given to 'imexpr'. The space after the
-        # colon is needed to avoid sexigesimal interpretation. 'a' is the first
-        # and only operand, linked to our image at the invokation of the task.
-        expr = "a>%d ? 1 : 0" % maximum
-        logging.debug("%s: imexpr = '%s'" % (img.path, expr))
-        logging.debug("%s: a = %s" % (img.path, orig_img_path))
-        logging.info("%s: Running IRAF's imexpr..." % img.path)
-        pyraf.iraf.images.imexpr(expr, a = orig_img_path,
-                                 output = satur_mask_path, verbose = 'yes',
-                                 Stdout = methods.LoggerWriter('debug'))
-
-        assert os.path.exists(satur_mask_path)
-
-        msg = "%s: IRAF's imexpr OK" % img.path
-        logging.info(msg)
-        msg = "%s: IRAF's imexpr output = %s"
-        logging.debug(msg % (img.path, satur_mask_path))
-
         # Now we just do photometry again, on the same pixels, but this time on
         # the saturation mask. Those objects for which we get a non-zero flux
         # will be known to be saturated and their magnitude set to infinity.
@@ -657,29 +882,20 @@ def run(img, coordinates, epoch,
         # to convert them back to right ascension and declination.
 
         if cbox:
+            # Transform the coordinates of all the objects at once
+            centered = img_qphot.to_array()
+            ra, dec = img.pix2world(centered['x'], centered['y'])
+            coordinates = astromatic.CoordinatesArray(ra, dec)
 
-            root, _ = os.path.splitext(os.path.basename(img.path))
-            kwargs = dict(prefix = root + '_',
-                          suffix = '_satur.coords',
-                          text = True)
-
-            os.unlink(coords_path)
-            fd, coords_path = tempfile.mkstemp(**kwargs)
-            for object_phot in img_qphot:
-                centered_x, centered_y = object_phot.x, object_phot.y
-                ra, dec = img.pix2world(centered_x, centered_y)
-                os.write(fd, "{0} {1}\n".format(ra, dec))
-            os.close(fd)
-
-        mask_qphot = QPhot(satur_mask_path, coords_path)
+        mask_qphot = QPhot(satur_mask, coordinates)
         # No centering this time: if cbox != 0 the accurate centers for each
         # astronomical object have been computed using the centroid centering
         # algorithm, so we're already feeding run() with the accurate values.
         mask_qphot.run(annulus, dannulus, aperture, exptimek, cbox=0)
-        os.unlink(coords_path)
 
         assert len(img_qphot) == len(mask_qphot)
-        for object_phot, object_mask in itertools.izip(img_qphot, mask_qphot):
+        it = enumerate(itertools.izip(img_qphot, mask_qphot))
+        for index, (object_phot, object_mask) in it:
 
             if __debug__:
 
@@ -697,15 +913,11 @@ def run(img, coordinates, epoch,
 
             if object_mask.flux > 0:
                 object_phot = object_phot._replace(mag = float('infinity'))
+                img_qphot[index] = object_phot
     finally:
-
-        # Remove saturation mask. The try-except is necessary because an
-        # exception may be raised before 'satur_mask_path' is defined.
-
-        try:
-            methods.clean_tmp_files(satur_mask_path)
-        except NameError:
-            pass
+        # Remove the saturation mask, unless it was given by the caller
+        if own_mask:
+            methods.clean_tmp_files(satur_mask)
 
     return img_qphot
 
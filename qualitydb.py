@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A persistent, on-disk store of the quality metrics of FITS images.
+
+The 'seeing' command measures the FWHM, elongation and number of sources of
+each image, but only the FWHM is written to the FITS header. The 'photometry'
+and 'annuli' commands need the FWHM again and, if the keyword is not there,
+have to detect the sources once more. This module offers an SQLite database
+where all the metrics of each image are stored, so that they are computed
+only once.
+
+The metrics are keyed by the SHA-1 hash of the pixels of the image (see
+FITSImage.data_sha1sum), so that they are found even if the image is copied,
+renamed or its header modified (e.g., by the 'astrometry' command), and by a
+string that describes how they were measured (the saturation level, margin,
+detector, etc.), as different settings give different values. As with the
+header index, the store is a cache: any error while writing to it is logged
+and ignored, as the metrics can always be computed again, and any error while
+reading from it is logged and treated as if the metrics were not stored.
+
+"""
+
+import collections
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+
+# The quality metrics of a FITS image: the FWHM and elongation of the stars,
+# the number of sources that were detected and the median level of the sky.
+Metrics = collections.namedtuple('Metrics', 'fwhm elongation nstars sky')
+
+class QualityDB(object):
+    """ An SQLite database that stores the quality metrics of FITS images.
+
+    SQLite connections cannot be shared between threads or, after a fork(),
+    between processes, so each thread of each process opens its own connection
+    the first time that it accesses the database.
+
+    """
+
+    # Seconds to wait for the lock to go away if the database is being written
+    # by another process or thread; after that, the operation is abandoned.
+    TIMEOUT = 30
+
+    def __init__(self, path):
+        """ Connect to the database, creating it if it does not exist.
+
+        Raises sqlite3.Error if the database cannot be opened or created.
+
+        """
+
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self._local = threading.local()
+
+        with self._connection:
+            self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS metrics (
+                sha1sum    TEXT NOT NULL,
+                settings   TEXT NOT NULL,
+                fwhm       REAL NOT NULL,
+                elongation REAL NOT NULL,
+                nstars     INTEGER NOT NULL,
+                sky        REAL NOT NULL,
+                PRIMARY KEY (sha1sum, settings))
+            """)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    @property
+    def _connection(self):
+        """ Return the connection to the database for this thread/process. """
+
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            kwargs = dict(timeout = self.TIMEOUT)
+            self._local.connection = sqlite3.connect(self.path, **kwargs)
+            self._local.connection.text_factory = str
+            self._local.pid = pid
+        return self._local.connection
+
+    def __len__(self):
+        query = "SELECT COUNT(*) FROM metrics"
+        try:
+            return self._connection.execute(query).fetchone()[0]
+        except sqlite3.Error, e:
+            logging.debug("cannot read from %s (%s)" % (self.path, e))
+            return 0
+
+    def get(self, sha1sum, settings):
+        """ Return the Metrics of an image.
+
+        Return the Metrics stored by QualityDB.add() for the image whose
+        pixels have the SHA-1 hash 'sha1sum', measured with 'settings'.
+        Raises KeyError if they are not in the database, or if it cannot be
+        read (e.g., because it is locked), logging the error.
+
+        """
+
+        query = ("SELECT fwhm, elongation, nstars, sky FROM metrics "
+                 "WHERE sha1sum = ? AND settings = ?")
+        try:
+            args = query, (sha1sum, settings)
+            row = self._connection.execute(*args).fetchone()
+        except sqlite3.Error, e:
+            msg = "%s: cannot read metrics from %s (%s)"
+            logging.debug(msg % (sha1sum, self.path, e))
+            row = None
+        if row is None:
+            msg = "%s: metrics (%s) not in %s" % (sha1sum, settings, self.path)
+            raise KeyError(msg)
+        return Metrics(*row)
+
+    def add(self, sha1sum, settings, metrics):
+        """ Store the Metrics of an image, replacing any previous value. """
+
+        try:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?)",
+                    (sha1sum, settings) + tuple(metrics))
+        except sqlite3.Error, e:
+            msg = "%s: cannot store metrics in %s (%s)"
+            logging.debug(msg % (sha1sum, self.path, e))
@@ -0,0 +1,302 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Registration of images of the same field, without astrometry.
+
+Aligning the images of a night does not require solving each one of them
+astrometrically: as they are all taken with the same instrument, the offsets
+(and, if the field rotates, the small rotation) between each image and a
+reference are enough. This module finds them in two steps:
+
+(1) Phase correlation. The normalized cross-power spectrum of two images,
+    computed with the FFT, is transformed back to an array that peaks at
+    the translation between them. Only the pixels of the sources, above the
+    background, are used, so that the gradients of the sky do not matter,
+    and isolated hot pixels (which would peak at zero offset) are removed.
+    The spectrum is smoothed with a Gaussian, so that the peak is Gaussian
+    too and its position can be interpolated to a fraction of a pixel.
+
+(2) Refinement. The sources detected in the reference (see detection.py),
+    moved by the translation of the first step, are cross-matched to those
+    of the image, and the least-squares translation (and, optionally,
+    rotation around the center of the reference) between them is found.
+    This is repeated a few times, with the matches of the last fit.
+
+The transformation maps the coordinates (x, y) of a source in the reference
+to (x', y') in the image: x' = cx + cos(t) * (x - cx) - sin(t) * (y - cy) + dx
+and y' = cy + sin(t) * (x - cx) + cos(t) * (y - cy) + dy, where (cx, cy) is the
+center of the reference (see center()), (dx, dy) the offset and 't' the
+rotation angle. As in detection.py, coordinates are one-based.
+
+"""
+
+from __future__ import division
+
+import math
+import numpy
+import scipy.ndimage
+
+# LEMON modules
+import crossmatch
+import detection
+
+# The standard deviation, in pixels, of the Gaussian with which the peak of
+# the phase correlation is smoothed.
+PEAK_SIGMA = 1.0
+
+def prepare(data, threshold = 3):
+    """ Return the image to be phase-correlated: only the sources.
+
+    Subtract the background from 'data' and set to zero all the pixels below
+    'threshold' times the standard deviation of the background (see
+    detection.background()). Isolated pixels, such as hot pixels and most
+    cosmic rays, are removed with a morphological opening.
+
+    """
+
+    data = numpy.asarray(data, dtype = numpy.float64)
+    levels, sigmas = detection.background(data)
+    subtracted = data - levels
+    subtracted = scipy.ndimage.grey_opening(subtracted, size = (2, 2))
+    subtracted[subtracted < threshold * sigmas] = 0
+    return subtracted
+
+def _resize(data, shape):
+    """ Crop or pad with zeros a two-dimensional array to 'shape'. """
+
+    if data.shape == shape:
+        return data
+    resized = numpy.zeros(shape, dtype = data.dtype)
+    nrows = min(shape[0], data.shape[0])
+    ncols = min(shape[1], data.shape[1])
+    resized[:nrows, :ncols] = data[:nrows, :ncols]
+    return resized
+
+def spectrum(data, shape = None):
+    """ Return the FFT of a prepared image, cropped or padded to 'shape'. """
+
+    if shape is not None:
+        data = _resize(data, shape)
+    return numpy.fft.rfft2(data)
+
+def _window(shape, sigma):
+    """ Return the Gaussian, in the frequency domain, of an rfft2() array. """
+
+    rows = numpy.fft.fftfreq(shape[0])[:, numpy.newaxis]
+    cols = numpy.fft.rfftfreq(shape[1])[numpy.newaxis, :]
+    return numpy.exp(-2 * (math.pi * sigma) ** 2 * (rows ** 2 + cols ** 2))
+
+def _interpolate(values, index):
+    """ Return the offset of the peak of a Gaussian from three values.
+
+    Fit a parabola to the logarithm of the values at index - 1, 'index' and
+    index + 1 (wrapping around the edges of the array) and return the offset,
+    in [-0.5, 0.5], of its vertex with respect to 'index'.
+
+    """
+
+    size = len(values)
+    if size < 3:
+        return 0.0
+    a, b, c = [values[(index + step) % size] for step in (-1, 0, 1)]
+    if min(a, b, c) <= 0:
+        return 0.0
+    a, b, c = numpy.log([a, b, c])
+    denominator = a - 2 * b + c
+    if denominator >= 0:
+        return 0.0
+    return float(numpy.clip(0.5 * (a - c) / denominator, -0.5, 0.5))
+
+def phase_correlation(reference, data, shape):
+    """ Return the translation between two images, by phase correlation.
+
+    'reference' and 'data' are the FFTs of two prepared images (see prepare()
+    and spectrum()), both cropped or padded to 'shape'. Return a three-element
+    tuple: the x- and y-offsets, in pixels, of the sources of the second image
+    with respect to those of the first, and the height of the correlation
+    peak, which is one if the images are identical but for a translation by
+    an integer number of pixels, and decreases as they differ. The offsets are
+    in the range [-n/2, n/2), where 'n' is the size of the images along that
+    axis.
+
+    """
+
+    if reference.shape != data.shape:
+        msg = "spectra of different shape (%s and %s)"
+        raise ValueError(msg % (reference.shape, data.shape))
+
+    nrows, ncols = shape
+    cross = data * numpy.conj(reference)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        cross /= numpy.abs(cross)
+    cross[~numpy.isfinite(cross)] = 0
+    window = _window(shape, PEAK_SIGMA)
+    surface = numpy.fft.irfft2(cross * window, shape)
+    # The height of the peak if the images were identical
+    height = numpy.fft.irfft2(window, shape)[0, 0]
+
+    row, col = numpy.unravel_index(numpy.argmax(surface), shape)
+    dy = row + _interpolate(surface[:, col], row)
+    dx = col + _interpolate(surface[row, :], col)
+    if dy >= nrows / 2:
+        dy -= nrows
+    if dx >= ncols / 2:
+        dx -= ncols
+    return dx, dy, surface[row, col] / height
+
+def center(shape):
+    """ Return the (one-based) x- and y-coordinates of the center of an image.
+
+    This is the point around which the rotation of the image is applied by
+    transform(), given the shape (number of rows and columns) of the image.
+
+    """
+
+    return (shape[1] + 1) / 2, (shape[0] + 1) / 2
+
+def transform(x, y, center, dx, dy, rotation = 0):
+    """ Return the coordinates in the image of those in the reference.
+
+    Apply to the coordinates 'x' and 'y' of the reference the rotation, in
+    degrees, around 'center' (a two-element tuple), and then the offsets
+    'dx' and 'dy'. Return two NumPy arrays, with the new x- and y-coordinates.
+
+    """
+
+    x = numpy.asarray(x, dtype = numpy.float64) - center[0]
+    y = numpy.asarray(y, dtype = numpy.float64) - center[1]
+    angle = math.radians(rotation)
+    cos, sin = math.cos(angle), math.sin(angle)
+    new_x = center[0] + cos * x - sin * y + dx
+    new_y = center[1] + sin * x + cos * y + dy
+    return new_x, new_y
+
+def transform_wcs(wcs, center, dx, dy, rotation = 0):
+    """ Return the WCS of the image, given that of the reference.
+
+    'wcs' is a dictionary that maps the keywords of the reference pixel and
+    linear transformation matrix of the WCS of the reference (CRPIX1, CRPIX2,
+    CD1_1, CD1_2, CD2_1 and CD2_2) to their values. Return a dictionary with
+    the same keywords, but for the image to which the coordinates of the
+    reference are mapped by transform(), given the same arguments: the
+    reference pixel is moved, and the matrix rotated in the opposite direction,
+    so that the celestial coordinates of each star are still the same.
+    Raises KeyError if any of the keywords is missing.
+
+    """
+
+    x, y = transform(wcs['CRPIX1'], wcs['CRPIX2'], center, dx, dy, rotation)
+    matrix = numpy.array([[wcs['CD1_1'], wcs['CD1_2']],
+                          [wcs['CD2_1'], wcs['CD2_2']]], dtype = numpy.float64)
+    angle = math.radians(rotation)
+    cos, sin = math.cos(angle), math.sin(angle)
+    matrix = numpy.dot(matrix, [[cos, sin], [-sin, cos]])
+
+    return dict(CRPIX1 = float(x), CRPIX2 = float(y),
+                CD1_1 = float(matrix[0, 0]), CD1_2 = float(matrix[0, 1]),
+                CD2_1 = float(matrix[1, 0]), CD2_2 = float(matrix[1, 1]))
+
+def fit(x1, y1, x2, y2, center, rotation = False):
+    """ Return the least-squares transformation between two sets of points.
+
+    Return a three-element tuple with the x- and y-offsets and the rotation,
+    in degrees, that best map (in the sense of least squares) the coordinates
+    'x1' and 'y1' to 'x2' and 'y2' (see transform()). If 'rotation' is False,
+    only the offsets are fitted, and the rotation is zero.
+
+    """
+
+    x1 = numpy.asarray(x1, dtype = numpy.float64) - center[0]
+    y1 = numpy.asarray(y1, dtype = numpy.float64) - center[1]
+    x2 = numpy.asarray(x2, dtype = numpy.float64) - center[0]
+    y2 = numpy.asarray(y2, dtype = numpy.float64) - center[1]
+
+    if not rotation:
+        return float(numpy.mean(x2 - x1)), float(numpy.mean(y2 - y1)), 0.0
+
+    # The rotation that best aligns the centered points (the two-dimensional
+    # case of the Kabsch algorithm), and then the offset of the centroids
+    u1, v1 = x1 - x1.mean(), y1 - y1.mean()
+    u2, v2 = x2 - x2.mean(), y2 - y2.mean()
+    angle = math.atan2((u1 * v2 - v1 * u2).sum(), (u1 * u2 + v1 * v2).sum())
+    cos, sin = math.cos(angle), math.sin(angle)
+    dx = x2.mean() - (cos * x1.mean() - sin * y1.mean())
+    dy = y2.mean() - (sin * x1.mean() + cos * y1.mean())
+    return float(dx), float(dy), math.degrees(angle)
+
+def refine(reference, image, center, offset, radius, rotation = False,
+           niter = 3, minmatches = 3):
+    """ Refine a transformation by cross-matching the sources of two images.
+
+    'reference' and 'image' are two-element tuples with the x- and
+    y-coordinates of the sources detected in each image, and 'offset' a
+    three-element tuple with the initial x- and y-offsets and rotation.
+    Move the sources of the reference, match each one to the nearest source
+    of the image within 'radius' pixels and fit() the transformation between
+    them; this is repeated 'niter' times, each one starting from the last fit
+    and with a radius of three times the root mean square of its residuals
+    (but never larger than 'radius'). Returns a five-element tuple: the x-
+    and y-offsets, the rotation, the number of matched sources and the root
+    mean square, in pixels, of the residuals of the last fit. Raises
+    ValueError if fewer than 'minmatches' sources can be matched.
+
+    """
+
+    matcher = crossmatch.PixelMatcher(*image)
+    dx, dy, angle = offset
+    nmatches = 0
+    rms = 0.0
+    for _ in xrange(niter):
+        x, y = transform(reference[0], reference[1], center, dx, dy, angle)
+        indexes, distances = matcher.match(x, y, radius)
+        matched = indexes != -1
+        nmatches = int(matched.sum())
+        if nmatches < minmatches:
+            msg = "only %d sources matched within %.2f pixels"
+            raise ValueError(msg % (nmatches, radius))
+
+        indexes = indexes[matched]
+        x1 = numpy.asarray(reference[0])[matched]
+        y1 = numpy.asarray(reference[1])[matched]
+        x2 = numpy.asarray(image[0])[indexes]
+        y2 = numpy.asarray(image[1])[indexes]
+        dx, dy, angle = fit(x1, y1, x2, y2, center, rotation = rotation)
+
+        x, y = transform(x1, y1, center, dx, dy, angle)
+        rms = math.sqrt(numpy.mean((x - x2) ** 2 + (y - y2) ** 2))
+        radius = min(radius, max(3 * rms, 0.5))
+
+    return dx, dy, angle, nmatches, rms
+
+def sources(data, saturation, nbrightest = 200, threshold = 5):
+    """ Return the coordinates of the brightest unsaturated sources.
+
+    Detect the sources in 'data' above 'threshold' times the noise of the
+    background and return two NumPy arrays, with the x- and y-coordinates of
+    the 'nbrightest' brightest ones whose peak is below 'saturation'.
+
+    """
+
+    kwargs = dict(threshold = threshold, nbrightest = 0)
+    catalog = detection.detect(data, saturation, **kwargs)
+    stars = catalog.stars[~catalog['saturated']]
+    stars = stars[numpy.argsort(stars['mag'], kind = 'mergesort')]
+    stars = stars[:nbrightest]
+    return stars['x'].copy(), stars['y'].copy()
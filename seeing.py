@@ -32,7 +32,6 @@ number of sources is at a given percentile and which has the best FWHM.
 
 """
 
-import atexit
 import logging
 import multiprocessing
 import numpy
@@ -41,20 +40,124 @@ import os
 import os.path
 import scipy.stats
 import scipy.signal
-import shutil
+import sqlite3
 import sys
-import tempfile
 import time
 
 # LEMON modules
 import astromatic
+import catalogcache
 import customparser
 import defaults
+import detection
 import fitsimage
 import keywords
 import methods
+import prefetch
+import qualitydb
 import style
 
+# The values accepted by the 'detector' argument of FITSeeingImage
+DETECTORS = ('sextractor', 'native')
+
+# The catalogcache.CatalogCache where FITSeeingImage looks up the SExtractor
+# catalogs, and stores them after running SExtractor. Disabled by default; the
+# LEMON commands enable it with set_catalog_cache() (see --sextractor-cache).
+_catalog_cache = None
+
+def set_catalog_cache(directory, max_size):
+    """ Cache the SExtractor catalogs in 'directory', up to 'max_size' bytes.
+
+    Return the catalogcache.CatalogCache that FITSeeingImage uses from now on.
+    If 'directory' is None or an empty string, the cache is disabled and None
+    is returned. This must be done before the pool of workers is created, so
+    that they inherit the cache and its hits and misses are counted.
+
+    """
+
+    global _catalog_cache
+    if directory:
+        _catalog_cache = catalogcache.CatalogCache(directory, max_size)
+    else:
+        _catalog_cache = None
+    return _catalog_cache
+
+# The qualitydb.QualityDB where the quality metrics of the images are stored,
+# so that they are not computed again. Disabled by default; the LEMON commands
+# enable it with set_quality_db() (see --quality-db).
+_quality_db = None
+
+def set_quality_db(path):
+    """ Store the quality metrics of the images in the database at 'path'.
+
+    Return the qualitydb.QualityDB used by stored_metrics() and store_metrics()
+    from now on. If 'path' is None or an empty string, the store is disabled
+    and None is returned. So it is, logging the error, if the database cannot
+    be opened or created.
+
+    """
+
+    global _quality_db
+    _quality_db = None
+    if path:
+        try:
+            _quality_db = qualitydb.QualityDB(path)
+        except sqlite3.Error, e:
+            msg = "cannot open quality database %s (%s), disabled"
+            logging.warning(msg % (path, e))
+    return _quality_db
+
+def quality_settings(img, options):
+    """ Return how the quality metrics of a FITS image are measured.
+
+    Return a string that identifies the settings with which the metrics of
+    'img', a fitsimage.FITSImage, are measured: the detector, the effective
+    saturation level (which depends on the number of coadds), the margin, the
+    SNR percentile, the mode (median or mean) and, if SExtractor is used, the
+    MD5 hash of its configuration. 'options' is the optparse.Values object
+    of a LEMON command with the same options as 'seeing' for these values.
+
+    """
+
+    mode = 'mean' if options.mean else 'median'
+    satur_level = img.saturation(options.maximum, coaddk = options.coaddk)
+    settings = "detector=%s;satur=%s;margin=%d;per=%r;mode=%s"
+    args = (options.detector, satur_level, options.margin,
+            float(options.per), mode)
+    settings %= args
+    if options.detector == 'sextractor':
+        sex_options = dict(SATUR_LEVEL = str(satur_level))
+        sex_md5sum = astromatic.sextractor_md5sum(options = sex_options)
+        settings += ";sextractor=%s" % sex_md5sum
+    return settings
+
+def stored_metrics(img, options):
+    """ Return the qualitydb.Metrics of a FITS image stored in the database.
+
+    Look up the metrics of 'img', a fitsimage.FITSImage, measured with the
+    settings in 'options' (see quality_settings()). Raises KeyError if they
+    are not stored or if the store is disabled (see set_quality_db()).
+
+    """
+
+    if _quality_db is None:
+        raise KeyError("quality metrics store disabled")
+    settings = quality_settings(img, options)
+    return _quality_db.get(img.data_sha1sum, settings)
+
+def store_metrics(img, options, metrics):
+    """ Store the qualitydb.Metrics of a FITS image, if the store is enabled.
+
+    The metrics of 'img', a fitsimage.FITSImage, are stored under the settings
+    in 'options' (see quality_settings()).
+
+    """
+
+    if _quality_db is not None:
+        settings = quality_settings(img, options)
+        _quality_db.add(img.data_sha1sum, settings, metrics)
+        logging.debug("%s: quality metrics stored (%s)" % (img.path, settings))
+
 class FITSeeingImage(fitsimage.FITSImage):
     """ High-level interface to the SExtractor catalog of each FITS image.
 
@@ -68,14 +171,18 @@ class FITSeeingImage(fitsimage.FITSImage):
 
     """
 
-    def __init__(self, path, maximum, margin, coaddk = keywords.coaddk):
+    def __init__(self, path, maximum, margin, coaddk = keywords.coaddk,
+                 catalog_type = defaults.sextractor_catalog, readonly = False,
+                 detector = defaults.detector):
         """ Instantiation method for the FITSeeingImage class.
 
         The path to the SExtractor catalog is read from the FITS header: if the
         keyword is not found, or if it is present but refers to a non-existent
         file, SExtractor has to be executed again. Even if the catalog exists,
         however, the MD5 of the SExtractor configuration files that were used
-        when the catalog was created must be the same.
+        when the catalog was created must be the same. If the catalog cache is
+        enabled (see set_catalog_cache()), the catalog is looked up there,
+        instead, and the FITS header is not modified.
 
         The 'maximum' parameter determines the pixel value above which it is
         considered saturated. This value depends not only on the CCD, but also
@@ -90,21 +197,63 @@ class FITSeeingImage(fitsimage.FITSImage):
         on the reference image. Stars whose center is fewer than this number of
         pixels from any border of the FITS image are not considered.
 
+        The 'catalog_type' argument is the format of the SExtractor catalog,
+        'FITS_LDAC' or 'ASCII_HEAD', and overrides the definition of
+        CATALOG_TYPE. Both formats can be loaded by astromatic.Catalog, but
+        the former, being binary, is much faster to read.
+
+        If 'readonly' is True, the FITS header is never modified, even if the
+        catalog cache is disabled: the path to the catalog and the MD5 hash
+        are only available as the 'catalog_path' and 'sex_md5sum' attributes,
+        so that the caller can store them elsewhere.
+
+        The 'detector' argument selects how the sources are detected: either
+        running 'sextractor' or with the 'native' detector of the detection
+        module, which works in memory. In the latter case, there is no catalog
+        file, and both the 'catalog_path' and 'sex_md5sum' attributes are None.
+
         """
 
+        if detector not in DETECTORS:
+            msg = "'detector' must be one of %s" % ', '.join(DETECTORS)
+            raise ValueError(msg)
+
         super(FITSeeingImage, self).__init__(path)
         self.margin = margin
         msg = "%s: width of margin: %d pixels" % (self.path, self.margin)
         logging.debug(msg)
 
-        # Compute the MD5 hash of the SExtractor configuration files and this
-        # saturation level, which overrides the definition of SATUR_LEVEL.
+        self.detector = detector
         satur_level = self.saturation(maximum, coaddk = coaddk)
-        options = dict(SATUR_LEVEL = str(satur_level))
-        sex_md5sum = astromatic.sextractor_md5sum(options = options)
+        self._satur_level = satur_level
+        if detector == 'native':
+            self.catalog_path = self.sex_md5sum = None
+            return
+
+        # Compute the MD5 hash of the SExtractor configuration files, this
+        # saturation level and the catalog type, which override the definition
+        # of SATUR_LEVEL and CATALOG_TYPE, respectively.
+        options = dict(SATUR_LEVEL = str(satur_level),
+                       CATALOG_TYPE = catalog_type)
+        self.sex_md5sum = sex_md5sum = \
+            astromatic.sextractor_md5sum(options = options)
         msg = "%s: SExtractor MD5 hash: %s" % (self.path, sex_md5sum)
         logging.debug(msg)
 
+        # If the catalog cache is enabled, the catalog is looked up there, by
+        # the contents of the image, instead of by the path in the FITS header
+        if _catalog_cache is not None:
+            args = self.sha1sum, sex_md5sum, satur_level
+            key = catalogcache.CatalogCache.key(*args)
+            self.catalog_path = _catalog_cache.get(key)
+            if self.catalog_path is not None:
+                msg = "%s: catalog found in cache (%s)"
+                logging.debug(msg % (self.path, self.catalog_path))
+            else:
+                catalog_path = self._run_sextractor(options)
+                self.catalog_path = _catalog_cache.add(key, catalog_path)
+            return
+
         try:
 
             try:
@@ -152,34 +301,48 @@ class FITSeeingImage(fitsimage.FITSImage):
             logging.debug(msg % self.path)
 
         except (KeyError, IOError, ValueError):
+            self.catalog_path = self._run_sextractor(options)
+            if readonly:
+                return
 
-            msg = ("%s: could not reuse an existing, on-disk cached catalog; "
-                   "SExtractor must be run") % self.path
-            logging.debug(msg)
+            try:
+                # Update the FITS header with the path and MD5; give up
+                # silently in case we do not have permissions to do it
+                # (IOError) or if the length of the HIERARCH keyword, equal
+                # sign and value is longer than 80 characters (ValueError,
+                # see FITSImage.update_keyword() for details). The cast to
+                # str is needed because PyFITS has complained sometimes
+                # about "illegal values" if it receives a Unicode string.
+                with self.header_edit() as header:
+                    header.update(keywords.sex_catalog, str(self.catalog_path))
+                    header.update(keywords.sex_md5sum, sex_md5sum)
+            except (IOError, ValueError):
+                pass
+
+    def _run_sextractor(self, options):
+        """ Run SExtractor on the image and return the path to the catalog.
+
+        'options' is the dictionary of SExtractor parameters that override the
+        definition in the configuration files (see astromatic.sextractor()).
 
-             # Redirect standard and error outputs to null device
-            with open(os.devnull, 'wt') as fd:
-                logging.info("%s: running SExtractor" % self.path)
+        """
 
-                self.catalog_path = \
-                    astromatic.sextractor(self.path, options = options,
-                                          stdout = fd, stderr = fd)
+        msg = ("%s: could not reuse an existing, on-disk cached catalog; "
+               "SExtractor must be run") % self.path
+        logging.debug(msg)
 
-                logging.debug("%s: SExtractor OK" % self.path)
+        # Redirect standard and error outputs to null device
+        with open(os.devnull, 'wt') as fd:
+            logging.info("%s: running SExtractor" % self.path)
 
-                try:
-                    # Update the FITS header with the path and MD5; give up
-                    # silently in case we do not have permissions to do it
-                    # (IOError) or if the length of the HIERARCH keyword, equal
-                    # sign and value is longer than 80 characters (ValueError,
-                    # see FITSImage.update_keyword() for details). The cast to
-                    # str is needed because PyFITS has complained sometimes
-                    # about "illegal values" if it receives a Unicode string.
-                    self.update_keyword(keywords.sex_catalog, str(self.catalog_path))
-                    self.update_keyword(keywords.sex_md5sum, sex_md5sum)
-                except (IOError, ValueError):
-                    pass
+            # SExtractor cannot read compressed images
+            with self.plain_copy() as path:
+                catalog_path = \
+                    astromatic.sextractor(path, options = options,
+                                          stdout = fd, stderr = fd)
 
+            logging.debug("%s: SExtractor OK" % self.path)
+            return catalog_path
 
     @property
     @methods.memoize
@@ -196,43 +359,31 @@ class FITSeeingImage(fitsimage.FITSImage):
         speed up our code. Note that this means that on-disk modifications of
         the catalog (although this is something you should not be doing,
         anyway) will not be reflected after the first call to this method.
+        With the native detector, the sources are detected here, in memory.
 
         """
 
-        # Catalogs are a subclass of tuple and cannot therefore be modified, so
-        # we need to use a list comprehension first, to identify the stars that
-        # are not too close to the edges, and use from_sequence() to create a
-        # new Catalog instance with the selected stars.
-
-        self._ignored_sources = 0
-        catalog = astromatic.Catalog(self.catalog_path)
+        if self.detector == 'native':
+            msg = "%s: detecting sources (native detector)" % self.path
+            logging.info(msg)
+            catalog = detection.detect(self.data, self._satur_level)
+        else:
+            catalog = astromatic.Catalog(self.catalog_path)
         logging.info("Removing from the catalog objects too close to the "
                      "edges of %s" % self.path)
         logging.debug("Margin width: %d pixels" % self.margin)
         logging.debug("Image size: (%d, %d)" % self.size)
 
-        non_discarded = []
-        for star in catalog:
-            logger_msg = "Star at %.3f, %.3f " % (star.x, star.y)
-            if star.x < self.margin or \
-               star.x > (self.x_size - self.margin) or \
-               star.y < self.margin or \
-               star.y > (self.y_size - self.margin):
-                   logging.debug(logger_msg + "ignored -- too close to edges")
-                   self._ignored_sources += 1
-            else:
-                non_discarded.append(star)
-                logging.debug(logger_msg + "OK -- inside of margins")
-
-        if __debug__:
-            assert len(catalog) == len(non_discarded) + self._ignored_sources
-            for star in non_discarded:
-                assert star.x >= self.margin
-                assert star.x <= (self.x_size - self.margin)
-                assert star.y >= self.margin
-                assert star.y <= (self.y_size - self.margin)
+        # Boolean mask, computed at once for all the stars in the catalog
+        x = catalog['x']
+        y = catalog['y']
+        inside = (x >= self.margin) & (x <= (self.x_size - self.margin)) & \
+                 (y >= self.margin) & (y <= (self.y_size - self.margin))
 
-        return astromatic.Catalog.from_sequence(*non_discarded)
+        self._ignored_sources = int((~inside).sum())
+        msg = "%s: %d stars ignored -- too close to edges"
+        logging.debug(msg % (self.path, self._ignored_sources))
+        return catalog[inside]
 
     def __len__(self):
         """ Return the number of stars detected by SExtractor in the image """
@@ -264,11 +415,11 @@ class FITSeeingImage(fitsimage.FITSImage):
 
     @property
     def coordinates(self):
-        """ Return a list with the celestial coordinates of the stars.
+        """ Return the celestial coordinates of the stars.
 
-        This method returns a list containing a Coordinates object for each
-        astronomical source that was detected by SExtractor and not ignored
-        because of its proximity to the image edge.
+        This method returns an astromatic.CoordinatesArray with the coordinates
+        of each astronomical source that was detected by SExtractor and not
+        ignored because of its proximity to the image edge.
 
         """
         return self.catalog.get_sky_coordinates()
@@ -294,13 +445,27 @@ class FITSeeingImage(fitsimage.FITSImage):
 
         """
 
-        snrs = [star.snr for star in self if not star.saturated]
-        if not snrs:
+        catalog = self.catalog
+        snrs = catalog['snr'][~catalog['saturated']]
+        if not len(snrs):
             raise ValueError("no stars available to compute the percentile SNR of '%s'" % self.path)
 
         # If empty, scoteatpercentile would raise IndexError
         return scipy.stats.scoreatpercentile(snrs, per)
 
+    def _best_stars(self, per):
+        """ Return a boolean mask with the unsaturated, not noisy stars.
+
+        The SNR at the 'per' percentile (see snr_percentile()) is the minimum
+        SNR that a star must have for it to be taken into account when the
+        FWHM or elongation of the image as a whole is calculated.
+
+        """
+
+        catalog = self.catalog
+        snr = self.snr_percentile(per)
+        return ~catalog['saturated'] & (catalog['snr'] >= snr)
+
     def fwhm(self, per = 50, mode = 'median'):
         """ Return the median (or mean) FWHM of the stars in the image.
 
@@ -341,20 +506,12 @@ class FITSeeingImage(fitsimage.FITSImage):
         if mode not in ('median', 'mean'):
             raise ValueError("'mode' must be 'median' or 'mean'")
 
-        # Find the signal-to-noise ratio of the image at the 'per' percentile.
-        # This will be the minimum SNR that a star must have for its FWHM to be
-        # taken into account when calculating the FWHM of the image as a whole.
-        snr = self.snr_percentile(per)
-
-        fwhms = []
-        for star in self:
-            # Ignore saturated and noisy stars
-            if star.saturated or star.snr < snr:
-                continue
-            else:
-                fwhms.append(star.fwhm)
-
-        if not fwhms:
+        # Ignore saturated stars and those whose signal-to-noise ratio is below
+        # that of the image at the 'per' percentile.
+        # The native detector does not measure the FWHM of the faintest sources
+        fwhms = self.catalog['fwhm'][self._best_stars(per)]
+        fwhms = fwhms[~numpy.isnan(fwhms)]
+        if not len(fwhms):
             # Exception needed, NumPy would return NaN for an empty list
             raise ValueError("no stars available to compute the FWHM")
 
@@ -404,18 +561,8 @@ class FITSeeingImage(fitsimage.FITSImage):
         if mode not in ('median', 'mean'):
             raise ValueError("'mode' must be 'median' or 'mean'")
 
-        # Find the signal-to-noise ratio of the image at the 'per' percentile.
-        snr = self.snr_percentile(per)
-
-        elongations = []
-        for star in self:
-            # Ignore saturated and noisy stars
-            if star.saturated or star.snr < snr:
-                continue
-            else:
-                elongations.append(star.elongation)
-
-        if not elongations:
+        elongations = self.catalog['elongation'][self._best_stars(per)]
+        if not len(elongations):
             # Exception needed, NumPy would return NaN for an empty list
             raise ValueError("no stars available to compute the elongation")
 
@@ -425,6 +572,21 @@ class FITSeeingImage(fitsimage.FITSImage):
             assert mode == 'mean'
             return numpy.mean(elongations)
 
+    def metrics(self, per = 50, mode = 'median'):
+        """ Return the quality metrics of the image, as a qualitydb.Metrics.
+
+        The FWHM and elongation are those returned by FITSeeingImage.fwhm()
+        and FITSeeingImage.elongation(), to which the 'per' and 'mode' keyword
+        arguments are passed, the number of sources is that of stars within
+        the margins, and the sky level is the median of the pixels.
+
+        """
+
+        fwhm = self.fwhm(per = per, mode = mode)
+        elongation = self.elongation(per = per, mode = mode)
+        sky = float(numpy.median(self.data))
+        return qualitydb.Metrics(fwhm, elongation, len(self), sky)
+
 # This Queue is global -- this works, but note that we could have
 # passed its reference to the function managed by pool.map_async.
 # See http://stackoverflow.com/a/3217427/184363
@@ -449,6 +611,17 @@ parser.add_option('--margin', action = 'store', type = 'int',
                   dest = 'margin', default = defaults.margin,
                   help = defaults.desc['margin'])
 
+parser.add_option('--sextractor-catalog', action = 'store', type = 'choice',
+                  dest = 'sextractor_catalog',
+                  default = defaults.sextractor_catalog,
+                  choices = ['FITS_LDAC', 'ASCII_HEAD'],
+                  help = defaults.desc['sextractor_catalog'])
+
+parser.add_option('--detector', action = 'store', type = 'choice',
+                  dest = 'detector', default = defaults.detector,
+                  choices = list(DETECTORS),
+                  help = defaults.desc['detector'])
+
 parser.add_option('--snr-percentile', action = 'store', type = 'float',
                   dest = 'per', default = defaults.snr_percentile,
                   help = defaults.desc['snr_percentile'])
@@ -470,6 +643,16 @@ parser.add_option('--suffix', action = 'store', type = 'str',
                   help = "string to be appended to output images, before "
                   "the file extension, of course [default: %default]")
 
+parser.add_option('--hardlink', action = 'store_true', dest = 'hardlink',
+                  help = "create the output images as hard links to the input "
+                  "images, instead of copying them. As they share the FITS "
+                  "header with the input images, which are never modified, "
+                  "the HISTORY and --fwhmk keywords are not written. Images "
+                  "that cannot be hard-linked (e.g., the output directory is "
+                  "on a different file system) are copied, as usual. Without "
+                  "this option, images are cloned (a copy-on-write reflink) "
+                  "if the file system supports it")
+
 parser.add_option('--overwrite', action = 'store_true', dest = 'overwrite',
                   help = "overwrite any output file if it already exists")
 
@@ -477,6 +660,35 @@ parser.add_option('--cores', action = 'store', type = 'int',
                   dest = 'ncores', default = defaults.ncores,
                   help = defaults.desc['ncores'])
 
+parser.add_option('--header-index', action = 'store', type = 'str',
+                  dest = 'header_index', default = defaults.header_index,
+                  help = defaults.desc['header_index'])
+
+parser.add_option('--sextractor-cache', action = 'store', type = 'str',
+                  dest = 'sextractor_cache', default = defaults.sextractor_cache,
+                  help = defaults.desc['sextractor_cache'])
+
+parser.add_option('--sextractor-cache-size', action = 'store', type = 'int',
+                  dest = 'sextractor_cache_size',
+                  default = defaults.sextractor_cache_size,
+                  help = defaults.desc['sextractor_cache_size'])
+
+parser.add_option('--quality-db', action = 'store', type = 'str',
+                  dest = 'quality_db', default = defaults.quality_db,
+                  help = defaults.desc['quality_db'])
+
+parser.add_option('--prefetch', action = 'store', type = 'int',
+                  dest = 'prefetch', default = defaults.prefetch,
+                  help = defaults.desc['prefetch'])
+
+parser.add_option('--scratch-dir', action = 'store', type = 'str',
+                  dest = 'scratch_dir', default = defaults.scratch_dir,
+                  help = defaults.desc['scratch_dir'])
+
+parser.add_option('--scratch-budget', action = 'store', type = 'int',
+                  dest = 'scratch_budget', default = defaults.scratch_budget,
+                  help = defaults.desc['scratch_budget'])
+
 parser.add_option('-v', '--verbose', action = 'count',
                   dest = 'verbose', default = defaults.verbosity,
                   help = defaults.desc['verbosity'])
@@ -553,11 +765,10 @@ def parallel_sextractor(args):
     mean (depending whether the --mean option was given) FWHM and elongation of
     the stars in the image is also computed. Nothing is returned; instead, the
     result is saved to the global variable 'queue' as a five-element tuple: (1)
-    path of the input image, (2) path of the temporary output image (a copy of
-    the input image, with the path to the SExtractor catalog and the MD5 hash
-    of the configuration files written to its header), (3) FWHM, (4) elongation
-    and (5) number of objects that were detected by SExtractor. Nothing is
-    added to 'queue' in case an error is encountered.
+    path of the input image, (2) a two-element tuple with the path to the
+    SExtractor catalog and the MD5 hash of the configuration files, (3) FWHM,
+    (4) elongation and (5) number of objects that were detected by SExtractor.
+    Nothing is added to 'queue' in case an error is encountered.
 
     """
 
@@ -566,28 +777,26 @@ def parallel_sextractor(args):
 
     try:
 
-        # FITSeeingImage.__init__() writes to the header of the FITS image the
-        # path to the SExtractor catalog and the MD5 hash of the configuration
-        # files. Work on a copy of the input image so as not to modify it.
-        kwargs = dict(prefix = '%s_' % os.path.basename(path),
-                      suffix = '.fits')
-        fd, output_path = tempfile.mkstemp(**kwargs)
-        os.close(fd)
-        shutil.copy2(path, output_path)
-
-        # Allow FITSeeingImage.__init__() to write to the FITS header
-        methods.owner_writable(output_path, True) # chmod u+w
-
-        args = output_path, options.maximum, options.margin
-        kwargs = dict(coaddk = options.coaddk)
-        image = FITSeeingImage(*args, **kwargs)
-        fwhm = image.fwhm(per = options.per, mode = mode)
+        # Run SExtractor on the input image itself (or on its prefetched copy),
+        # which is never modified: the catalog is stored in the cache or, if
+        # it is disabled, its path and the MD5 hash of the configuration files
+        # are returned and written to the header of the output image.
+        with prefetch.acquire(path) as local_path:
+            args = local_path, options.maximum, options.margin
+            kwargs = dict(coaddk = options.coaddk,
+                          catalog_type = options.sextractor_catalog,
+                          readonly = True, detector = options.detector)
+            image = FITSeeingImage(*args, **kwargs)
+            metrics = image.metrics(per = options.per, mode = mode)
+            store_metrics(image, options, metrics)
+
+        fwhm, elong, nstars, sky = metrics
         logging.debug("%s: FWHM = %.3f" % (path, fwhm))
-        elong = image.elongation(per = options.per, mode = mode)
         logging.debug("%s: Elongation = %.3f" % (path, elong))
-        nstars = len(image)
         logging.debug("%s: %d sources detected" % (path, nstars))
-        queue.put((path, output_path, fwhm, elong, nstars))
+        logging.debug("%s: sky level = %.3f" % (path, sky))
+        catalog = image.catalog_path, image.sex_md5sum
+        queue.put((path, catalog, fwhm, elong, nstars))
 
     except fitsimage.NonStandardFITS:
         logging.info("%s ignored (non-standard FITS)" % path)
@@ -627,6 +836,14 @@ def main(arguments = None):
         logging_level = logging.DEBUG
     logging.basicConfig(format = style.LOG_FORMAT, level = logging_level)
 
+    # Cache the headers of the FITS images in the persistent header index
+    fitsimage.set_header_index(options.header_index)
+
+    # ... and the SExtractor catalogs in the catalog cache
+    max_size = options.sextractor_cache_size * 1024 ** 2
+    catalog_cache = set_catalog_cache(options.sextractor_cache, max_size)
+    set_quality_db(options.quality_db)
+
     # Print the help and abort the execution if there are not two positional
     # arguments left after parsing the options, as the user must specify at
     # least one (only one?) input FITS file and the output directory
@@ -646,11 +863,26 @@ def main(arguments = None):
 
     print "%s%d paths given as input, on which sources will be detected." % \
           (style.prefix, len(input_paths))
-    print "%sRunning SExtractor on all the FITS images..." % style.prefix
+    if options.detector == 'native':
+        msg = "%sDetecting sources on all the FITS images..."
+    else:
+        msg = "%sRunning SExtractor on all the FITS images..."
+    print msg % style.prefix
+
+    # Read the next images in advance while the workers run SExtractor on
+    # the previous ones. The Prefetcher must be installed before the pool is
+    # created, so that the workers inherit it, and started afterwards.
+    input_files = [path for path in input_paths if os.path.isfile(path)]
+    budget = options.scratch_budget * 1024 ** 2
+    prefetcher = prefetch.Prefetcher(input_files, options.prefetch,
+                                     scratch_dir = options.scratch_dir,
+                                     budget = budget)
+    prefetch.set_prefetcher(prefetcher)
 
     # Use a pool of workers and run SExtractor on the images in parallel!
     pool = multiprocessing.Pool(options.ncores)
-    map_async_args = ((path, options) for path in input_paths if os.path.isfile(path))
+    prefetcher.start()
+    map_async_args = ((path, options) for path in input_files)
     result = pool.map_async(parallel_sextractor, map_async_args)
 
     methods.show_progress(0.0)
@@ -663,9 +895,16 @@ def main(arguments = None):
         if logging_level < logging.WARNING:
             print
 
-    result.get()      # reraise exceptions of the remote call, if any
+    try:
+        result.get()      # reraise exceptions of the remote call, if any
+    finally:
+        prefetcher.stop()
+        prefetch.set_prefetcher(None)
     methods.show_progress(100) # in case the queue was ready too soon
     print
+    prefetcher.log_stats()
+    if catalog_cache is not None:
+        catalog_cache.log_stats()
 
     # Three sets, to keep the track of all the images on which SExtractor
     # has been run and also of which have been discarded because of their
@@ -674,10 +913,11 @@ def main(arguments = None):
     fwhm_discarded = set()
     elong_discarded = set()
 
-    # Dictionary mapping each input image to the temporary output file: a copy
-    # of the input image but whose FITS header has been updated with the path
-    # to the SExtractor catalog and the MD5 hash of the configuration files.
-    seeing_tmp_paths = dict()
+    # Dictionary mapping each input image to a two-element tuple: the path to
+    # the SExtractor catalog and the MD5 hash of the configuration files. They
+    # are written to the header of the output image if the catalog cache is
+    # disabled, as otherwise the catalog can be found there.
+    catalogs = dict()
 
     # Extract the four-element tuples (path to the image, FWHM, elongation and
     # number of sources detected by SExtractor) from the multiprocessing' queue
@@ -688,17 +928,9 @@ def main(arguments = None):
     nstars = {}
 
     for _ in xrange(queue.qsize()):
-        path, output_tmp_path, fwhm, elong, stars = queue.get()
+        path, catalog, fwhm, elong, stars = queue.get()
         all_images.add(path)
-        seeing_tmp_paths[path] = output_tmp_path
-
-        # The clean-up function cannot be registered in parallel_sextractor()
-        # because it would remove the temporary FITS file when the process
-        # terminates (instead of when our program exits, which is what we
-        # need). Do it here, to make sure that whatever happens next these
-        # temporary files are always deleted.
-        atexit.register(methods.clean_tmp_files, output_tmp_path)
-
+        catalogs[path] = catalog
         fwhms[path]  = fwhm
         elongs[path] = elong
         nstars[path] = stars
@@ -849,8 +1081,9 @@ def main(arguments = None):
     # Finally, copy all the FITS images to the output directory
     processed = 0
     for path in sorted(all_images):
-        # Add the suffix to the basename of the FITS image
-        root, ext = os.path.splitext(os.path.basename(path))
+        # Add the suffix to the basename of the FITS image (which is no longer
+        # compressed, if it originally was)
+        root, ext = fitsimage.splitext(os.path.basename(path))
         output_filename = root + options.suffix + ext
         logging.debug("Basename '%s' + '%s' becomes '%s'" % \
                      (path, options.suffix, output_filename))
@@ -901,21 +1134,45 @@ def main(arguments = None):
             print style.error_exit_message
             return 1
 
+        # Never write to an existing file (--overwrite), which may be a hard
+        # link to one of the input images
+        if os.path.exists(output_path):
+            os.unlink(output_path)
+
+        # Compressed images are decompressed, while the others are linked or
+        # cloned, so that their data does not need to be copied
+        input_img = fitsimage.FITSImage(path)
+        if input_img.compression:
+            input_img.decompress(output_path)
+            how = 'decompressed'
         else:
-            src = seeing_tmp_paths[path]
-            shutil.move(src, output_path)
-
-        methods.owner_writable(output_path, True) # chmod u+w
-        logging.debug("%s copied to %s" % (path, output_path))
-        output_img = fitsimage.FITSImage(output_path)
-        output_img.add_history(history_msg1)
-        output_img.add_history(history_msg2)
-        logging.debug("%s: FITS header updated (HISTORY keywords)" % path)
-
-        # Copy the FWHM to the FITS header, for future reference
-        comment = "Margin = %d, SNR percentile = %.3f" % (options.margin, options.per)
-        output_img.update_keyword(options.fwhmk, fwhms[path], comment = comment)
-        logging.debug("%s: FITS header updated (%s keyword)" % (path, options.fwhmk))
+            how = methods.link_or_copy(path, output_path,
+                                       hardlink = options.hardlink)
+        logging.debug("%s copied to %s (%s)" % (path, output_path, how))
+
+        # A hard link shares the header with the input image, which must not
+        # be modified; otherwise, update the header, only once.
+        if how != 'hardlink':
+            methods.owner_writable(output_path, True) # chmod u+w
+            output_img = fitsimage.FITSImage(output_path)
+            with output_img.header_edit() as header:
+                header.add_history(history_msg1)
+                header.add_history(history_msg2)
+
+                # Copy the FWHM to the FITS header, for future reference
+                comment = "Margin = %d, SNR percentile = %.3f" % (options.margin, options.per)
+                header.update(options.fwhmk, fwhms[path], comment = comment)
+
+                # The catalog is not in the cache, so store its path and MD5
+                # hash in the header, where FITSeeingImage will look for them
+                # (there is no catalog at all with the native detector)
+                catalog_path, sex_md5sum = catalogs[path]
+                if catalog_cache is None and catalog_path is not None:
+                    header.update(keywords.sex_catalog, str(catalog_path))
+                    header.update(keywords.sex_md5sum, sex_md5sum)
+
+            args = path, options.fwhmk
+            logging.debug("%s: FITS header updated (HISTORY and %s keywords)" % args)
 
         print "%sFITS image %s saved to %s" % (style.prefix, path, output_path)
         processed += 1
@@ -0,0 +1,231 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+import math
+import numpy
+
+# LEMON modules
+import centroid
+import fitsimage
+
+class StampCube(object):
+    """ The postage stamps around all the astronomical objects in an image.
+
+    A three-dimensional NumPy array, of shape (nstars, size, size), with the
+    pixels around each astronomical object, extracted at once (and only once)
+    from the image. It is sized so that it can be shared by all the per-image
+    measurements that need the pixels near the objects -- for example, the
+    centroiding and the saturation check --, which then become reductions
+    over the array instead of loops over the objects. Pixels that fall off the
+    image are NaN.
+
+    Attributes:
+    cube - the (nstars, size, size) array with the stamps.
+    x, y - the one-based coordinates of the objects, around which the stamps
+           were extracted (centered on the pixel where each object is).
+    cols, rows - the zero-based column and row, in the image, of the first
+                 pixel of each stamp.
+
+    """
+
+    def __init__(self, data, x, y, radius):
+        """ Extract the stamps from a two-dimensional array.
+
+        'x' and 'y' are the one-based coordinates of the objects, and 'radius'
+        the distance, in pixels, from the center of each stamp to its edges.
+        This should be the radius of the largest region that is to be used in
+        any of the measurements, such as the outer radius of the sky annulus.
+
+        """
+
+        self.x = numpy.array(x, dtype = numpy.float64)
+        self.y = numpy.array(y, dtype = numpy.float64)
+        self.radius = int(math.ceil(radius))
+        size = 2 * self.radius + 1
+        self.cube, self.cols, self.rows = \
+            centroid.stamps(data, self.x, self.y, size)
+
+    @classmethod
+    def from_image(cls, path, x, y, radius):
+        """ Extract the stamps from a FITS image, memory-mapping its data.
+
+        Only the pages of the file that contain the pixels around the objects
+        are actually read from disk, in a single pass.
+
+        """
+
+        img = fitsimage.FITSImage(path, memmap = True)
+        return cls(img.data, x, y, radius)
+
+    def __len__(self):
+        return len(self.cube)
+
+    @property
+    def size(self):
+        """ The width (and height) of the stamps, in pixels. """
+        return self.cube.shape[-1]
+
+    def centroid(self, cbox, method = 'weighted'):
+        """ Refine the centers of the astronomical objects.
+
+        Compute the centroids of the objects, using a centering box of width
+        'cbox' pixels, taken from the center of each stamp. See centroid.py
+        for the available methods. Returns two NumPy arrays with the refined,
+        one-based x- and y-coordinates.
+
+        """
+
+        box = min(centroid.box_size(cbox), self.size)
+        start = (self.size - box) // 2
+        window = slice(start, start + box)
+        cube = self.cube[:, window, window]
+        args = cube, self.cols + start, self.rows + start, self.x, self.y
+        return centroid.refine(*args, method = method)
+
+    def _offsets(self, x, y):
+        """ Return the offsets from (x, y) to the center of each pixel.
+
+        Return two arrays, the differences along the x- and y-axes between the
+        center of each pixel of the stamps and the coordinates of the object,
+        which broadcast to the shape of the cube: (nstars, 1, size) for the
+        x-axis and (nstars, size, 1) for the y-axis.
+
+        """
+
+        offsets = numpy.arange(self.size)
+        # One-based coordinates of the centers of the pixels of each stamp
+        pixel_x = (self.cols + 1)[:, numpy.newaxis] + offsets
+        pixel_y = (self.rows + 1)[:, numpy.newaxis] + offsets
+        dx = pixel_x - numpy.asarray(x, dtype = numpy.float64)[:, numpy.newaxis]
+        dy = pixel_y - numpy.asarray(y, dtype = numpy.float64)[:, numpy.newaxis]
+        return dx[:, numpy.newaxis, :], dy[:, :, numpy.newaxis]
+
+    def _distances(self, x, y):
+        """ Return the distance from (x, y) to each pixel of the stamps.
+
+        Return an array with the same shape as the cube, where each element is
+        the distance from the coordinates of the object to the point, within
+        the pixel, that is closest to them. If this value is smaller than the
+        radius of an aperture, the pixel is (at least partially) in it.
+
+        """
+
+        dx, dy = self._offsets(x, y)
+        dx = numpy.maximum(numpy.abs(dx) - 0.5, 0)
+        dy = numpy.maximum(numpy.abs(dy) - 0.5, 0)
+        return numpy.sqrt(dx ** 2 + dy ** 2)
+
+    def _coordinates(self, x, y):
+        """ Return 'x' and 'y', or the centers of the stamps if None. """
+
+        if x is None:
+            x = self.x
+        if y is None:
+            y = self.y
+        return x, y
+
+    def aperture_sum(self, aperture, x = None, y = None):
+        """ Return the sum of the pixels within a circular aperture.
+
+        Return two NumPy arrays, with the total number of counts within the
+        aperture, of radius 'aperture' pixels, centered at 'x' and 'y' (by
+        default, the coordinates around which the stamps were extracted) and
+        the area of the aperture, in pixels. As in IRAF's apphot, pixels on the
+        edge of the aperture are weighted by the fraction of them within it,
+        approximated as the radius plus half a pixel minus the distance to
+        their center. The sum is NaN for the objects with one or more pixels of
+        the aperture off the image.
+
+        """
+
+        x, y = self._coordinates(x, y)
+        dx, dy = self._offsets(x, y)
+        weights = numpy.clip(aperture + 0.5 - numpy.sqrt(dx ** 2 + dy ** 2),
+                             0, 1)
+        # Multiplying NaN by a zero weight would give NaN, so use where()
+        inside = weights > 0
+        values = numpy.where(inside, self.cube, 0) * weights
+        axes = (1, 2)
+        return values.sum(axis = axes), weights.sum(axis = axes)
+
+    def sky(self, annulus, dannulus, x = None, y = None,
+            ksigma = 3, maxiter = 10):
+        """ Compute the level of the sky in a circular annulus.
+
+        Return two NumPy arrays with the sky level, per pixel, and its standard
+        deviation. The annulus, centered at 'x' and 'y' (by default, the
+        coordinates around which the stamps were extracted), has an inner
+        radius of 'annulus' pixels and a width of 'dannulus' pixels, and those
+        pixels whose centers fall within it are used. As with the 'mode'
+        algorithm of IRAF's qphot, pixels deviating more than 'ksigma' standard
+        deviations from the mean are iteratively rejected, up to 'maxiter'
+        times, and the sky estimated as 3 * median - 2 * mean (or the mean, if
+        it is smaller than the median). Objects whose annulus has no valid
+        pixels (for example, off the image) have a sky of NaN.
+
+        """
+
+        x, y = self._coordinates(x, y)
+        dx, dy = self._offsets(x, y)
+        distances = numpy.sqrt(dx ** 2 + dy ** 2)
+        in_annulus = (distances >= annulus) & \
+                     (distances <= annulus + dannulus)
+
+        shape = len(self), -1
+        valid = (in_annulus & numpy.isfinite(self.cube)).reshape(shape)
+        values = numpy.where(valid, self.cube.reshape(shape), 0)
+        values = numpy.ma.masked_array(values, mask = ~valid)
+
+        for _ in xrange(maxiter):
+            mean = values.mean(axis = 1)[:, numpy.newaxis]
+            sigma = values.std(axis = 1)[:, numpy.newaxis]
+            rejected = (numpy.abs(values - mean) > ksigma * sigma)
+            rejected = rejected.filled(False)
+            if not rejected.any():
+                break
+            values = numpy.ma.masked_where(rejected, values)
+
+        mean = values.mean(axis = 1)
+        median = numpy.ma.median(values, axis = 1)
+        mode = numpy.ma.where(mean < median, mean, 3 * median - 2 * mean)
+        stdev = values.std(axis = 1)
+        return (numpy.ma.filled(mode.astype(numpy.float64), numpy.nan),
+                numpy.ma.filled(stdev.astype(numpy.float64), numpy.nan))
+
+    def saturated(self, aperture, maximum, x = None, y = None):
+        """ Determine which astronomical objects are saturated.
+
+        Return a boolean NumPy array, True for those objects that have one or
+        more pixels above the 'maximum' level (in ADUs) in the aperture, of
+        radius 'aperture' pixels, centered at 'x' and 'y'. These are, by
+        default, the coordinates around which the stamps were extracted, but
+        the refined centers of the objects may also be given. A pixel is in the
+        aperture if any part of it falls inside it, which is equivalent to
+        doing photometry on a saturation mask and checking for a non-zero flux.
+
+        """
+
+        x, y = self._coordinates(x, y)
+        in_aperture = self._distances(x, y) < aperture
+        with numpy.errstate(invalid = 'ignore'):
+            above = self.cube > maximum # NaN is never above the maximum
+        return (above & in_aperture).any(axis = (1, 2))
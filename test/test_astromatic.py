@@ -190,6 +190,58 @@ class CoordinatesTest(unittest.TestCase):
         self.assertIs(coords.pm_dec, None)
 
 
+class CoordinatesArrayTest(unittest.TestCase):
+
+    def test_init(self):
+
+        # Barnard's Star, IOK 1 (no proper motion) and an object whose
+        # proper motion is unknown (None in Coordinates, NaN in the array)
+        barnard = Coordinates(269.452075, 4.693391, -0.79858, 10.32812)
+        iok1 = Coordinates(200.999170, 27.415500)
+        unknown = Coordinates(10.5, -20.25, None, None)
+        coords = [barnard, iok1, unknown]
+
+        array = astromatic.CoordinatesArray.from_coordinates(coords)
+        self.assertEqual(len(array), 3)
+        self.assertEqual(list(array), coords)
+        self.assertEqual(array[0], barnard)
+        self.assertEqual(array[2], unknown)
+        self.assertIs(array[2].pm_ra, None)
+        self.assertTrue(numpy.isnan(array.pm_dec[2]))
+        self.assertEqual(list(array.pm_mask), [True, False, False])
+        self.assertTrue(array.has_pm)
+        self.assertIs(astromatic.CoordinatesArray.from_coordinates(array), array)
+
+        # Slices and boolean masks return a new CoordinatesArray
+        subset = array[numpy.array([False, True, True])]
+        self.assertIsInstance(subset, astromatic.CoordinatesArray)
+        self.assertEqual(list(subset), [iok1, unknown])
+        self.assertFalse(subset.has_pm)
+        self.assertEqual(list(array[:1]), [barnard])
+
+        with self.assertRaises(ValueError):
+            astromatic.CoordinatesArray([1, 2], [3, 4], [5, 6], [7])
+
+    def test_get_exact_coordinates(self):
+
+        coords = [Coordinates(269.452075, 4.693391, -0.79858, 10.32812),
+                  Coordinates(77.791453, -44.938748, 6.50508, -5.73084),
+                  Coordinates(200.999170, 27.415500),
+                  Coordinates(10.5, -20.25, None, None)]
+
+        array = astromatic.CoordinatesArray.from_coordinates(coords)
+        for year in (2000, 2005, 2014.5, 1975.35, 1905.49180328):
+            exact = array.get_exact_coordinates(year, epoch = 1950)
+            self.assertFalse(exact.has_pm)
+            for index, coord in enumerate(coords):
+                if coord.pm_ra is None:
+                    expected = coord
+                else:
+                    expected = coord.get_exact_coordinates(year, epoch = 1950)
+                self.assertAlmostEqual(exact.ra[index],  expected.ra)
+                self.assertAlmostEqual(exact.dec[index], expected.dec)
+
+
 class StarTest(unittest.TestCase):
 
     X_COORD_RANGE = (1, 2048)
@@ -279,7 +331,14 @@ class CatalogTest(unittest.TestCase):
             else:
                 self.assertFalse(is_saturated)
 
+        # The vectorized version returns a boolean array
+        flags = numpy.arange(256)
+        saturated = Catalog.flag_saturated(flags)
+        self.assertEqual(saturated.dtype, numpy.bool_)
+        self.assertEqual(set(flags[saturated]), saturated_flags)
+
         # Flags outside of the range raise ValueError
+        self.assertRaises(ValueError, Catalog.flag_saturated, [4, 256])
         self.assertRaises(ValueError, Catalog.flag_saturated, -2)
         self.assertRaises(ValueError, Catalog.flag_saturated, -1)
         self.assertRaises(ValueError, Catalog.flag_saturated, 256)
@@ -391,6 +450,80 @@ class CatalogTest(unittest.TestCase):
         self.assertEqual(type(faint_catalog), Catalog)
         self.assertEqual(list(faint_catalog), list(stars))
 
+    def test_columns(self):
+
+        catalog = Catalog(self.SAMPLE_CATALOG_PATH)
+        self.assertEqual(catalog.stars.dtype, Catalog.DTYPE)
+        self.assertEqual(len(catalog['x']), len(catalog))
+
+        # The columns match the values of the Stars, in the same order
+        for field in Catalog.DTYPE.names:
+            values = [getattr(star, field) for star in catalog]
+            self.assertEqual(list(catalog[field]), values)
+
+        # The structured array cannot be modified
+        with self.assertRaises(ValueError):
+            catalog['x'][0] = 0
+
+        # Boolean masks (and integer arrays) return a new Catalog
+        saturated = catalog[catalog['saturated']]
+        self.assertEqual(type(saturated), Catalog)
+        self.assertTrue(len(saturated))
+        self.assertTrue(all(star.saturated for star in saturated))
+        self.assertEqual(list(saturated),
+                         [star for star in catalog if star.saturated])
+        selected = catalog[numpy.array([126, 0])]
+        self.assertEqual(list(selected), [catalog[126], catalog[0]])
+        self.assertEqual(catalog[-1], catalog[126])
+        with self.assertRaises(IndexError):
+            catalog[127]
+
+    def test_fits_ldac(self):
+
+        # Convert the SExtractor catalog to the FITS_LDAC format, with the
+        # sources in the binary table of the LDAC_OBJECTS extension
+        catalog = Catalog(self.SAMPLE_CATALOG_PATH)
+        with open(self.SAMPLE_CATALOG_PATH, 'rt') as fd:
+            contents = [line.split() for line in fd]
+        rows = numpy.array([line for line in contents if line[0] != '#'],
+                           dtype = numpy.float64)
+
+        columns = []
+        for name in Catalog.PARAMETERS:
+            index = Catalog._find_column(contents, name)
+            format_ = 'J' if name in ('ISOAREAF_IMAGE', 'FLAGS') else 'D'
+            array = rows[:, index]
+            columns.append(pyfits.Column(name = name, format = format_,
+                                         array = array))
+
+        table = pyfits.BinTableHDU.from_columns(columns)
+        table.name = Catalog.LDAC_OBJECTS
+        imhead = pyfits.BinTableHDU.from_columns([pyfits.Column(name = 'Field Header Card',
+                                                 format = '80A',
+                                                 array = ['END'])])
+        imhead.name = 'LDAC_IMHEAD'
+        hdulist = pyfits.HDUList([pyfits.PrimaryHDU(), imhead, table])
+
+        with tempfile.NamedTemporaryFile(suffix = '.cat') as fd:
+            hdulist.writeto(fd.name, clobber = True)
+            ldac = Catalog(fd.name)
+            self.assertEqual(ldac.path, fd.name)
+            self.assertEqual(len(ldac), 127)
+            self.assertEqual(ldac, catalog)
+            self.assertEqual(list(ldac), list(catalog))
+
+            # ValueError if a parameter is missing...
+            table.columns.del_col('FLUX_RADIUS')
+            table = pyfits.BinTableHDU.from_columns(table.columns)
+            table.name = Catalog.LDAC_OBJECTS
+            hdulist = pyfits.HDUList([pyfits.PrimaryHDU(), imhead, table])
+            hdulist.writeto(fd.name, clobber = True)
+            self.assertRaises(ValueError, Catalog, fd.name)
+
+            # ... or if there is no LDAC_OBJECTS table
+            pyfits.PrimaryHDU().writeto(fd.name, clobber = True)
+            self.assertRaises(ValueError, Catalog, fd.name)
+
     def test_get_sky_coordinates(self):
 
         catalog = Catalog(self.SAMPLE_CATALOG_PATH)
@@ -542,6 +675,32 @@ class SExtractorFunctionsTest(unittest.TestCase):
         with self.assertRaises(TypeError):
             astromatic.sextractor_md5sum(**kwargs)
 
+    def test_sextractor_md5sum_modified(self):
+
+        # The configuration files are read only once, but the MD5 hash must
+        # change as soon as any of them is modified, even if its path is the
+        # same. Again, mock the module-level variable to refer to a copy.
+
+        path = astromatic.SEXTRACTOR_CONFIG
+        copy_path = get_nonexistent_path(ext = os.path.splitext(path)[1])
+        shutil.copy2(path, copy_path)
+
+        try:
+            with mock.patch.object(astromatic, 'SEXTRACTOR_CONFIG', copy_path):
+                checksum = astromatic.sextractor_md5sum()
+                self.assertEqual(checksum, astromatic.sextractor_md5sum())
+                with open(copy_path, 'at') as fd:
+                    fd.write("# useless comment\n")
+                self.assertNotEqual(checksum, astromatic.sextractor_md5sum())
+
+            # The options do not modify the cached hash of the files
+            options = {'SATUR_LEVEL' : '45000'}
+            first = astromatic.sextractor_md5sum(options)
+            self.assertEqual(first, astromatic.sextractor_md5sum(options))
+
+        finally:
+            os.unlink(copy_path)
+
     def test_sextractor_version(self):
 
         # We have no other way of knowing the SExtractor version that is
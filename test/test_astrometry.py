@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division
+
+import numpy
+import os
+import pyfits
+import shutil
+import tempfile
+
+# LEMON modules
+from test import unittest
+import astrometry
+import fitsimage
+
+class SchedulingTest(unittest.TestCase):
+
+    # A 200 x 100 image, with a scale of 0.5 arcsec per pixel
+    SHAPE = (100, 200)
+    SCALE = 0.5
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(suffix = '_astrometry')
+        self.options = astrometry.parser.parse_args([])[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def image(self, name, ra = None, dec = None, wcs = None):
+        """ Write a FITS image, with the coordinates and (maybe) a WCS. """
+
+        path = os.path.join(self.directory, name)
+        header = pyfits.Header()
+        if ra is not None:
+            header['RA'] = ra
+            header['DEC'] = dec
+        if wcs is not None:
+            crval1, crval2 = wcs
+            header['CTYPE1'] = 'RA---TAN'
+            header['CTYPE2'] = 'DEC--TAN'
+            header['CRVAL1'] = crval1
+            header['CRVAL2'] = crval2
+            header['CRPIX1'] = (self.SHAPE[1] + 1) / 2
+            header['CRPIX2'] = (self.SHAPE[0] + 1) / 2
+            header['CD1_1'] = -self.SCALE / 3600
+            header['CD1_2'] = 0.0
+            header['CD2_1'] = 0.0
+            header['CD2_2'] = self.SCALE / 3600
+        data = numpy.zeros(self.SHAPE, dtype = numpy.float32)
+        pyfits.writeto(path, data, header)
+        return path
+
+    def test_solved_field(self):
+
+        path = self.image('solved.fits', wcs = (83.82, -5.39))
+        field = astrometry.solved_field(path)
+        self.assertAlmostEqual(field.ra, 83.82, delta = 1e-3)
+        self.assertAlmostEqual(field.dec, -5.39, delta = 1e-3)
+        self.assertAlmostEqual(field.scale, self.SCALE, delta = 1e-4)
+        # Half the diagonal of the image, give or take a pixel, as the
+        # center is that of FITSImage.center, rounded to an integer
+        diagonal = numpy.hypot(*self.SHAPE) * self.SCALE / 3600
+        pixel = self.SCALE / 3600
+        self.assertAlmostEqual(field.radius, diagonal / 2, delta = pixel)
+
+        path = self.image('unsolved.fits')
+        with self.assertRaises(fitsimage.NoWCSInformationError):
+            astrometry.solved_field(path)
+
+    def test_seed_order(self):
+
+        paths = [self.image('a.fits'),
+                 self.image('b.fits', ra = 83.8, dec = -5.4),
+                 self.image('c.fits'),
+                 self.image('d.fits', ra = 83.9, dec = -5.3)]
+
+        # The images with coordinates first, otherwise in the same order
+        expected = [paths[1], paths[3], paths[0], paths[2]]
+        self.assertEqual(astrometry.seed_order(paths, self.options), expected)
+
+        # Coordinates are ignored with --blind
+        self.options.blind = True
+        self.assertEqual(astrometry.seed_order(paths, self.options), paths)
+
+    def test_neighbour_hints(self):
+
+        paths = [self.image('a.fits'),
+                 self.image('b.fits'),
+                 self.image('c.fits', ra = 10.0, dec = 20.0),
+                 self.image('d.fits', ra = 83.8, dec = -5.4),
+                 self.image('e.fits')]
+
+        # Nothing solved, no hints
+        self.assertEqual(astrometry.neighbour_hints(paths, {}, self.options),
+                         {})
+
+        first = astrometry.Field(83.80, -5.40, 0.05, 0.5)
+        last = astrometry.Field(83.85, -5.35, 0.04, 0.6)
+        fields = {paths[0] : first, paths[4] : last}
+        hints = astrometry.neighbour_hints(paths, fields, self.options)
+        self.assertEqual(sorted(hints), sorted(paths[1:4]))
+
+        # The nearest solved image, in the order of 'paths'
+        timeout = self.options.hint_timeout
+        self.assertEqual(hints[paths[1]],
+                         astrometry.Hints(83.80, -5.40, 0.1, 0.5, timeout))
+        self.assertEqual(hints[paths[3]],
+                         astrometry.Hints(83.85, -5.35, 0.08, 0.6, timeout))
+
+        # The coordinates in the header are those of a different field
+        self.assertEqual(hints[paths[2]],
+                         astrometry.Hints(10.0, 20.0, self.options.radius,
+                                          0.5, timeout))
+
+        # The time limit is never longer than --timeout
+        self.options.timeout = timeout // 2
+        hints = astrometry.neighbour_hints(paths, fields, self.options)
+        self.assertEqual(hints[paths[1]].timeout, self.options.timeout)
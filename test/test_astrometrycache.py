@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division
+
+import os
+import pyfits
+import shutil
+import tempfile
+
+# LEMON modules
+from test import unittest
+from astrometrycache import AstrometryCache, header_cards
+
+class AstrometryCacheTest(unittest.TestCase):
+
+    # The cards of a (fake) astrometric solution
+    CARDS = [('CTYPE1', 'RA---TAN', 'TAN (gnomic) projection'),
+             ('CTYPE2', 'DEC--TAN', 'TAN (gnomic) projection'),
+             ('CRVAL1', 123.456, ''), ('CRVAL2', -12.5, ''),
+             ('IMAGEW', 2048, 'Image width, in pixels.'),
+             ('WCSAXES', 2, '')]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(suffix = '_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_header_cards(self):
+
+        input_header = pyfits.Header()
+        input_header['OBJECT'] = 'Trapezium'
+        input_header['EXPTIME'] = (120.0, 'seconds')
+        input_header['CRVAL1'] = 0.0
+        input_header.add_history('Reduced')
+
+        output_header = input_header.copy()
+        output_header['EXPTIME'] = (120.0, 'a different comment')
+        output_header['CRVAL1'] = 123.456
+        output_header['CTYPE1'] = ('RA---TAN', 'TAN (gnomic) projection')
+        output_header['SIMPLE'] = True
+        output_header.add_comment('Solved by Astrometry.net')
+        output_header.add_history('Solved')
+        output_header.add_blank()
+
+        # Only the new cards, and those whose value changed
+        cards = header_cards(input_header, output_header)
+        expected = [('CRVAL1', 123.456, ''),
+                    ('CTYPE1', 'RA---TAN', 'TAN (gnomic) projection'),
+                    ('SIMPLE', True, '')]
+        self.assertEqual(cards, expected)
+        self.assertEqual(header_cards(input_header, input_header), [])
+
+    def test_key(self):
+
+        key = AstrometryCache.key
+        self.assertTrue(key('ab12', 'ra=None').startswith('ab12_'))
+        self.assertEqual(key('ab12', 'ra=None'), key('ab12', 'ra=None'))
+        # Both the checksum and the settings give a different key
+        keys = set([key('ab12', 'ra=None'), key('ab13', 'ra=None'),
+                    key('ab12', 'ra=1.0')])
+        self.assertEqual(len(keys), 3)
+
+    def test_solution(self):
+
+        cache = AstrometryCache(self.directory, 1024 ** 2)
+        with self.assertRaises(KeyError):
+            cache.get_solution('foo')
+
+        path = cache.add_solution('foo', self.CARDS)
+        self.assertEqual(os.path.dirname(path), self.directory)
+        self.assertEqual(os.listdir(self.directory), ['foo.json'])
+        cards = cache.get_solution('foo')
+        self.assertEqual(cards, self.CARDS)
+        # Strings, not unicode, as loaded by JSON
+        for card in cards:
+            self.assertEqual(type(card[0]), str)
+        self.assertEqual(type(cards[0][1]), str)
+
+        # The time limit does not matter if the image was solved
+        self.assertEqual(cache.get_solution('foo', timeout = None), self.CARDS)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+        # The solution is persistent
+        cache = AstrometryCache(self.directory, 1024 ** 2)
+        self.assertEqual(cache.get_solution('foo'), self.CARDS)
+
+    def test_unsolved(self):
+
+        cache = AstrometryCache(self.directory, 1024 ** 2)
+
+        # Astrometry.net gave up on the image: never tried again...
+        cache.add_unsolved('foo')
+        self.assertEqual(cache.get_solution('foo', timeout = 60), None)
+        self.assertEqual(cache.get_solution('foo', timeout = None), None)
+
+        # ... unless it is solved with other options (i.e., another key)
+        with self.assertRaises(KeyError):
+            cache.get_solution('bar')
+
+        # The image exceeded the time limit: tried again with a longer one
+        cache.add_unsolved('bar', timeout = 60)
+        self.assertEqual(cache.get_solution('bar', timeout = 30), None)
+        self.assertEqual(cache.get_solution('bar', timeout = 60), None)
+        with self.assertRaises(KeyError):
+            cache.get_solution('bar', timeout = 120)
+        with self.assertRaises(KeyError):
+            cache.get_solution('bar', timeout = None)
+
+        # ... in which case it may solve, replacing the previous result
+        cache.add_solution('bar', self.CARDS)
+        self.assertEqual(cache.get_solution('bar', timeout = 30), self.CARDS)
+
+        # Records that must be tried again are misses, not hits
+        self.assertEqual(cache.hits, 5)
+        self.assertEqual(cache.misses, 3)
+
+    def test_corrupt(self):
+
+        cache = AstrometryCache(self.directory, 1024 ** 2)
+        path = cache.add_solution('foo', self.CARDS)
+        with open(path, 'wt') as fd:
+            fd.write('{"solved": tr')
+        with self.assertRaises(KeyError):
+            cache.get_solution('foo')
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 1)
+
+    def test_eviction(self):
+
+        # Room for two solutions only
+        cache = AstrometryCache(self.directory, 1024 ** 2)
+        for index, key in enumerate('abc'):
+            path = cache.add_solution(key, self.CARDS)
+            os.utime(path, (1000 + index, 1000 + index))
+            cache.max_size = 2 * os.path.getsize(path)
+
+        with self.assertRaises(KeyError):
+            cache.get_solution('a')
+        self.assertEqual(cache.get_solution('b'), self.CARDS)
+        self.assertEqual(cache.get_solution('c'), self.CARDS)
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+import multiprocessing
+import os
+import os.path
+import shutil
+import tempfile
+
+# LEMON modules
+from test import unittest
+import catalogcache
+
+# The CatalogCache used by lookup(), inherited by the pool of workers
+cache = None
+
+def lookup(key):
+    """ Function argument of map() for the pool of workers. """
+    return cache.get(key)
+
+
+class CatalogCacheTest(unittest.TestCase):
+
+    SIZE = 1000 # bytes
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(suffix = '_cache')
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.tmp_dir)
+
+    def make_catalog(self, char):
+        """ Return the path to a new catalog of SIZE bytes. """
+
+        fd, path = tempfile.mkstemp(suffix = '.cat', dir = self.tmp_dir)
+        os.write(fd, char * self.SIZE)
+        os.close(fd)
+        return path
+
+    def test_key(self):
+
+        key = catalogcache.CatalogCache.key
+        self.assertEqual(key('ab12', 'cd34', 50000), 'ab12_cd34_50000')
+        # Any of the three values gives a different key
+        keys = set([key('ab12', 'cd34', 50000), key('ab13', 'cd34', 50000),
+                    key('ab12', 'cd35', 50000), key('ab12', 'cd34', 45000)])
+        self.assertEqual(len(keys), 4)
+
+    def test_get_and_add(self):
+
+        directory = os.path.join(self.directory, 'new')
+        cache = catalogcache.CatalogCache(directory, 10 * self.SIZE)
+        self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(cache.hit_rate, None)
+
+        self.assertEqual(cache.get('foo'), None)
+        catalog_path = self.make_catalog('a')
+        path = cache.add('foo', catalog_path)
+        self.assertEqual(os.path.dirname(path), directory)
+        # The catalog is moved to the cache
+        self.assertFalse(os.path.exists(catalog_path))
+        with open(path, 'rb') as fd:
+            self.assertEqual(fd.read(), 'a' * self.SIZE)
+
+        self.assertEqual(cache.get('foo'), path)
+        self.assertEqual(cache.get('bar'), None)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+        self.assertAlmostEqual(cache.hit_rate, 1 / 3)
+
+        # A catalog with the same key replaces the previous one
+        self.assertEqual(cache.add('foo', self.make_catalog('b')), path)
+        with open(path, 'rb') as fd:
+            self.assertEqual(fd.read(), 'b' * self.SIZE)
+        self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+
+    def test_eviction(self):
+
+        # Room for only three catalogs
+        cache = catalogcache.CatalogCache(self.directory, 3 * self.SIZE)
+        for index, key in enumerate('abc'):
+            path = cache.add(key, self.make_catalog(key))
+            os.utime(path, (1000 + index, 1000 + index))
+
+        # Using a catalog makes it the most recently used one
+        self.assertNotEqual(cache.get('a'), None)
+        cache.add('d', self.make_catalog('d'))
+        self.assertEqual(cache.get('b'), None)
+        for key in 'acd':
+            self.assertNotEqual(cache.get(key), None)
+
+        # The catalog just added is kept, even if larger than the cache
+        cache = catalogcache.CatalogCache(self.directory, self.SIZE // 2)
+        path = cache.add('e', self.make_catalog('e'))
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(path)])
+
+    def test_pool(self):
+
+        global cache
+        cache = catalogcache.CatalogCache(self.directory, 10 * self.SIZE)
+        cache.add('a', self.make_catalog('a'))
+
+        pool = multiprocessing.Pool(2)
+        try:
+            result = pool.map(lookup, ['a', 'b', 'a', 'c'], chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(result[1], None)
+        self.assertEqual(result[0], result[2])
+        # Hits and misses are counted across processes
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 2)
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import random
+
+# LEMON modules
+from test import unittest
+import centroid
+
+NITERS = 25  # How many times random-data tests cases are run
+
+def gaussian_stars(shape, x, y, sigma = 1.5, peak = 5000, sky = 100):
+    """ Return an image with Gaussian stars at the (one-based) coordinates. """
+
+    rows, cols = numpy.indices(shape)
+    data = numpy.zeros(shape) + sky
+    for x0, y0 in zip(x, y):
+        distance = (cols + 1 - x0) ** 2 + (rows + 1 - y0) ** 2
+        data += peak * numpy.exp(-distance / (2 * sigma ** 2))
+    return data
+
+
+class CentroidTest(unittest.TestCase):
+
+    def test_box_size(self):
+        self.assertEqual(centroid.box_size(5), 5)
+        self.assertEqual(centroid.box_size(5.5), 5)
+        self.assertEqual(centroid.box_size(6), 7)
+        self.assertEqual(centroid.box_size(0), 1)
+
+    def test_stamps(self):
+
+        data = numpy.arange(100, dtype = numpy.float64).reshape(10, 10)
+        cube, cols, rows = centroid.stamps(data, [5, 1, 30], [3, 1, 2], 3)
+        self.assertEqual(cube.shape, (3, 3, 3))
+        self.assertEqual(list(cols), [3, -1, 28])
+        self.assertEqual(list(rows), [1, -1, 0])
+
+        # The pixel at (x, y) = (5, 3) is data[2, 4]
+        numpy.testing.assert_array_equal(cube[0], data[1:4, 3:6])
+        # Pixels off the image are NaN
+        self.assertTrue(numpy.isnan(cube[1][0]).all())
+        self.assertTrue(numpy.isnan(cube[1][:, 0]).all())
+        numpy.testing.assert_array_equal(cube[1][1:, 1:], data[:2, :2])
+        self.assertTrue(numpy.isnan(cube[2]).all())
+
+        with self.assertRaises(ValueError):
+            centroid.stamps(data, [5], [5], 4)
+
+    def test_centroid(self):
+
+        shape = (200, 300)
+        for _ in xrange(NITERS):
+            # Five stars, far enough from each other so as not to overlap
+            x = numpy.array([random.uniform(10, 50) + 60 * i for i in xrange(5)])
+            y = numpy.array([random.uniform(10, 190) for _ in xrange(5)])
+            data = gaussian_stars(shape, x, y)
+
+            # Start one pixel away from the true center
+            x0, y0 = x + random.choice([-1, 1]), y + random.choice([-1, 1])
+            for method in centroid.METHODS:
+                xc, yc = centroid.centroid(data, x0, y0, 7, method = method)
+                numpy.testing.assert_allclose(xc, x, atol = 0.1)
+                numpy.testing.assert_allclose(yc, y, atol = 0.1)
+
+        # Objects off the image are not modified
+        data = gaussian_stars(shape, [50], [50])
+        xc, yc = centroid.centroid(data, [-100, 50.5], [50, 50.5], 5)
+        self.assertEqual(xc[0], -100)
+        self.assertEqual(yc[0], 50)
+        self.assertAlmostEqual(xc[1], 50, places = 1)
+
+        with self.assertRaises(ValueError):
+            centroid.centroid(data, [50], [50], 5, method = 'iraf')
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division
+
+import astropy.wcs
+import numpy
+
+# LEMON modules
+from test import unittest
+import coadd
+
+# A scale of one arcsecond per pixel
+SCALE = 1 / 3600
+
+def tan_wcs(ra, dec, shape, rotation = 0):
+    """ Return a TAN WCS, rotated 'rotation' degrees, centered on the image.
+    """
+
+    angle = numpy.radians(rotation)
+    cos, sin = numpy.cos(angle), numpy.sin(angle)
+    wcs = astropy.wcs.WCS(naxis = 2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [(shape[1] + 1) / 2, (shape[0] + 1) / 2]
+    wcs.wcs.cd = numpy.dot([[-SCALE, 0], [0, SCALE]],
+                           [[cos, -sin], [sin, cos]])
+    return wcs
+
+
+class CoaddTest(unittest.TestCase):
+
+    SHAPE = (60, 80)
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(7)
+
+    def test_tiles_and_intersection(self):
+
+        boxes = coadd.tiles((100, 250), 64)
+        self.assertEqual(len(boxes), 8)
+        self.assertEqual(boxes[0], (0, 64, 0, 64))
+        self.assertEqual(boxes[3], (0, 64, 192, 250))
+        self.assertEqual(boxes[-1], (64, 100, 192, 250))
+        # The tiles cover the mosaic, without overlapping
+        covered = numpy.zeros((100, 250), dtype = int)
+        for y0, y1, x0, x1 in boxes:
+            covered[y0:y1, x0:x1] += 1
+        self.assertTrue((covered == 1).all())
+
+        intersection = coadd.intersection
+        self.assertEqual(intersection((0, 10, 0, 10), (5, 20, 8, 9)),
+                         (5, 10, 8, 9))
+        self.assertEqual(intersection((0, 10, 0, 10), (0, 10, 0, 10)),
+                         (0, 10, 0, 10))
+        self.assertIsNone(intersection((0, 10, 0, 10), (10, 20, 0, 10)))
+        self.assertIsNone(intersection((0, 10, 0, 10), (0, 10, 12, 20)))
+
+    def test_optimal_wcs(self):
+
+        # Two images, side by side, one of them rotated
+        shape = self.SHAPE
+        wcss = [tan_wcs(150.0, 2.0, shape),
+                tan_wcs(150.0 + 60 * SCALE, 2.0, shape, rotation = 10)]
+        mosaic, mosaic_shape = coadd.optimal_wcs(wcss, [shape, shape])
+
+        self.assertAlmostEqual(coadd.pixel_scale(mosaic, mosaic_shape),
+                               SCALE, delta = SCALE * 1e-3)
+        # North is up and East to the left
+        cd = mosaic.wcs.cd
+        self.assertTrue(cd[0, 0] < 0 and cd[1, 1] > 0)
+        self.assertEqual(cd[0, 1], 0)
+
+        # Both images are within the mosaic, and touch its edges
+        boxes = [coadd.footprint(wcs, shape, mosaic, mosaic_shape)
+                 for wcs in wcss]
+        self.assertEqual(min(box[0] for box in boxes), 0)
+        self.assertEqual(max(box[1] for box in boxes), mosaic_shape[0])
+        self.assertEqual(min(box[2] for box in boxes), 0)
+        self.assertEqual(max(box[3] for box in boxes), mosaic_shape[1])
+        self.assertTrue(120 < mosaic_shape[1] < 160)
+
+        # An image far away does not fall on the mosaic
+        far = tan_wcs(10.0, -30.0, shape)
+        self.assertIsNone(coadd.footprint(far, shape, mosaic, mosaic_shape))
+
+    def test_reproject(self):
+
+        shape = self.SHAPE
+        data = self.random.uniform(0, 100, shape)
+        wcs = tan_wcs(150.0, 2.0, shape)
+
+        # Onto the same WCS, the pixels are the same
+        box = (0, shape[0], 0, shape[1])
+        values = coadd.reproject(data, wcs, wcs, box)
+        self.assertTrue(numpy.allclose(values, data))
+
+        # Onto a mosaic shifted by (3, 5) pixels
+        mosaic = wcs.deepcopy()
+        mosaic.wcs.crpix = [wcs.wcs.crpix[0] + 3, wcs.wcs.crpix[1] + 5]
+        box = (0, shape[0] + 5, 0, shape[1] + 3)
+        values = coadd.reproject(data, wcs, mosaic, box)
+        self.assertTrue(numpy.allclose(values[5:, 3:], data))
+        self.assertTrue(numpy.isnan(values[:5]).all())
+        self.assertTrue(numpy.isnan(values[:, :3]).all())
+
+        # Every other pixel of a region of it
+        values = coadd.reproject(data, wcs, mosaic, (10, 20, 13, 30),
+                                 stride = 2)
+        self.assertTrue(numpy.allclose(values, data[5:15:2, 10:27:2]))
+
+        # Half a pixel away, bilinear interpolation gives the mean
+        mosaic.wcs.crpix = [wcs.wcs.crpix[0] + 0.5, wcs.wcs.crpix[1]]
+        values = coadd.reproject(data, wcs, mosaic, (0, 10, 1, 11))
+        expected = (data[:10, :10] + data[:10, 1:11]) / 2
+        self.assertTrue(numpy.allclose(values, expected))
+
+    def test_background_offsets(self):
+
+        shape = self.SHAPE
+        data = self.random.normal(100, 5, shape)
+        wcs = tan_wcs(150.0, 2.0, shape)
+        box = (0, shape[0], 0, shape[1])
+        first = data + 20, wcs, 1
+        second = data, wcs, 1
+        difference, npixels = coadd.overlap_difference(first, second,
+                                                       wcs, box)
+        self.assertAlmostEqual(difference, 20)
+        self.assertEqual(npixels, shape[0] * shape[1])
+
+        # The scale factors of the images are applied
+        second = data, wcs, 0.5
+        difference, npixels = coadd.overlap_difference(first, second, wcs,
+                                                       box, nsamples = 100)
+        self.assertAlmostEqual(difference, 20 + numpy.median(data) / 2,
+                               delta = 2)
+        self.assertTrue(100 <= npixels < 200)
+
+        # Three images, with the backgrounds at 10, 40 and 25
+        levels = numpy.array([10, 40, 25])
+        differences = [(0, 1, -30, 100), (1, 2, 15, 50), (0, 2, -15, 10),
+                       (0, 2, numpy.nan, 0)]
+        offsets = coadd.background_offsets(3, differences)
+        self.assertTrue(numpy.allclose(offsets, levels - levels.mean()))
+        self.assertTrue(numpy.allclose(coadd.background_offsets(2, []), 0))
@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division
+
+import numpy
+
+# LEMON modules
+from test import unittest
+import astromatic
+import crossmatch
+
+class CrossmatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(7)
+
+    def random_sky(self, size):
+        """ Return random coordinates, uniformly distributed over the sky. """
+        ra = self.random.uniform(0, 360, size)
+        dec = numpy.degrees(numpy.arcsin(self.random.uniform(-1, 1, size)))
+        return ra, dec
+
+    def test_unit_vectors(self):
+        vectors = crossmatch.unit_vectors([0, 90, 45, 180], [0, 0, 90, -90])
+        expected = [[1, 0, 0], [0, 1, 0], [0, 0, 1], [0, 0, -1]]
+        self.assertTrue(numpy.allclose(vectors, expected))
+
+        ra, dec = self.random_sky(100)
+        vectors = crossmatch.unit_vectors(ra, dec)
+        norms = numpy.sqrt((vectors ** 2).sum(axis = 1))
+        self.assertTrue(numpy.allclose(norms, 1))
+
+    def test_angular_distance(self):
+
+        distance = crossmatch.angular_distance
+        self.assertAlmostEqual(distance(10, 20, 10, 20), 0)
+        self.assertAlmostEqual(distance(0, 0, 180, 0), 180)
+        self.assertAlmostEqual(distance(0, 90, 0, -90), 180)
+        # The right ascension wraps around; it does not matter at the poles
+        self.assertAlmostEqual(distance(359.5, 0, 0.5, 0), 1)
+        self.assertAlmostEqual(distance(0, 89.5, 180, 89.5), 1)
+        self.assertAlmostEqual(distance(37, -90, 251, -90), 0)
+        # Accurate also for very small distances (~0.0036 arcsec)
+        self.assertAlmostEqual(distance(10, 0, 10 + 1e-6, 0) / 1e-6, 1)
+
+        # The same as the law of cosines, with arrays and scalars
+        ra1, dec1 = self.random_sky(50)
+        ra2, dec2 = self.random_sky(50)
+        distances = distance(ra1, dec1, ra2, dec2)
+        self.assertEqual(distances.shape, (50,))
+        for index in xrange(50):
+            first = astromatic.Coordinates(ra1[index], dec1[index])
+            second = astromatic.Coordinates(ra2[index], dec2[index])
+            expected = first.distance(second)
+            self.assertAlmostEqual(distances[index], expected, places = 7)
+            self.assertAlmostEqual(distance(ra1[index], dec1[index], ra2, dec2)
+                                   [index], expected, places = 7)
+
+    def test_match_sky(self):
+
+        ra2, dec2 = self.random_sky(2000)
+        ra1, dec1 = self.random_sky(500)
+        radius = 3
+        indexes, distances = crossmatch.match_sky(ra1, dec1, ra2, dec2, radius)
+        self.assertEqual(indexes.shape, (500,))
+        self.assertEqual(distances.shape, (500,))
+
+        # The same result as computing the distance to all the sources
+        for index in xrange(len(ra1)):
+            args = ra1[index], dec1[index], ra2, dec2
+            all_distances = crossmatch.angular_distance(*args)
+            closest = numpy.argmin(all_distances)
+            if all_distances[closest] < radius:
+                self.assertEqual(indexes[index], closest)
+                self.assertAlmostEqual(distances[index],
+                                       all_distances[closest], places = 9)
+            else:
+                self.assertEqual(indexes[index], -1)
+                self.assertTrue(numpy.isnan(distances[index]))
+
+        # Some of each, with this radius
+        self.assertTrue(0 < (indexes == -1).sum() < len(indexes))
+
+    def test_sky_matcher(self):
+
+        # Perturbed copies of the same catalog, with the order shuffled
+        ra, dec = self.random_sky(1000)
+        matcher = crossmatch.SkyMatcher(ra, dec)
+        self.assertEqual(len(matcher), 1000)
+        for _ in xrange(3):
+            order = self.random.permutation(len(ra))
+            offset = 0.5 / 3600 # degrees
+            other_ra = ra[order] + self.random.uniform(-offset, offset, 1000)
+            other_dec = dec[order] + self.random.uniform(-offset, offset, 1000)
+            indexes, distances = matcher.match(other_ra, other_dec, 2 / 3600)
+            self.assertTrue(numpy.all(indexes == order))
+            self.assertTrue(numpy.all(distances < 2 / 3600))
+
+    def test_match_pixels(self):
+
+        x1, y1 = [10, 20, 500], [10, 40, 500]
+        x2, y2 = [19.5, 300, 10.2, 11], [40.5, 300, 9.9, 10]
+        indexes, distances = crossmatch.match_pixels(x1, y1, x2, y2, 5)
+        self.assertEqual(list(indexes), [2, 0, -1])
+        self.assertAlmostEqual(distances[0], numpy.hypot(0.2, 0.1))
+        self.assertAlmostEqual(distances[1], numpy.hypot(0.5, 0.5))
+        self.assertTrue(numpy.isnan(distances[2]))
+
+        # The radius is strict
+        indexes, distances = crossmatch.match_pixels([0], [0], [3], [4], 5)
+        self.assertEqual(list(indexes), [-1])
+        indexes, distances = crossmatch.match_pixels([0], [0], [3], [4], 5.01)
+        self.assertEqual(list(indexes), [0])
+        self.assertAlmostEqual(distances[0], 5)
+
+    def test_empty(self):
+
+        for x1, x2 in (([], [1, 2]), ([1, 2], []), ([], [])):
+            indexes, distances = crossmatch.match_pixels(x1, x1, x2, x2, 1)
+            self.assertEqual(len(indexes), len(x1))
+            self.assertTrue(numpy.all(indexes == -1))
+            self.assertTrue(numpy.all(numpy.isnan(distances)))
+            indexes, distances = crossmatch.match_sky(x1, x1, x2, x2, 1)
+            self.assertEqual(len(indexes), len(x1))
+            self.assertTrue(numpy.all(indexes == -1))
+            indexes, distances = crossmatch.match_values(x1, x2, 1)
+            self.assertEqual(len(indexes), len(x1))
+            self.assertTrue(numpy.all(indexes == -1))
+
+    def test_match_values(self):
+
+        values2 = [5, 1, 9, 3, 3, 7]
+        values1 = [0, 2, 3, 4, 6, 9.9, 12]
+        indexes, distances = crossmatch.match_values(values1, values2, 2)
+        # On ties, the first value in 'values2' is used
+        self.assertEqual(list(indexes), [1, 1, 3, 0, 0, 2, -1])
+        expected = [1, 1, 0, 1, 1, 0.9]
+        self.assertTrue(numpy.allclose(distances[:-1], expected))
+        self.assertTrue(numpy.isnan(distances[-1]))
+
+        # The radius is strict
+        indexes, _ = crossmatch.match_values([0], [2], 2)
+        self.assertEqual(list(indexes), [-1])
+
+        # The same result as min() with the absolute difference as key
+        values1 = self.random.randint(0, 100, 300).astype(float)
+        values2 = self.random.randint(0, 100, 200).astype(float)
+        indexes, distances = crossmatch.match_values(values1, values2, 3)
+        for value, index, distance in zip(values1, indexes, distances):
+            closest = min(xrange(len(values2)),
+                          key = lambda x: abs(value - values2[x]))
+            if abs(value - values2[closest]) < 3:
+                self.assertEqual(index, closest)
+                self.assertEqual(distance, abs(value - values2[closest]))
+            else:
+                self.assertEqual(index, -1)
@@ -1627,6 +1627,67 @@ class LEMONdBTest(unittest.TestCase):
         empty_star = db.get_photometry(star_id, johnson_V)
         self.assertEqual(len(empty_star), 0)
 
+    def test_add_image_photometry(self):
+
+        db = LEMONdB(':memory:')
+        johnson_V = passband.Passband('V')
+
+        star_ids = range(4)
+        for id_ in star_ids:
+            star_info = self.random_star_info(id_ = id_)
+            # Only the last star has proper motions
+            star_info[6:8] = (0.1, -0.3) if id_ == 3 else (None, None)
+            db.add_star(*star_info)
+
+        img = ImageTest.random(johnson_V)
+        db.add_image(img)
+
+        # Photometry of all the stars but the first one; the arguments may
+        # be NumPy arrays, with NumPy data types, such as those we get from
+        # the structured arrays returned by the photometry workers.
+        ids = numpy.array([1, 2, 3])
+        mags = numpy.array([12.5, 13.1, 11.7])
+        snrs = numpy.array([200, 150, 350])
+        xs = numpy.array([10.5, 20.5, 30.5])
+        ys = numpy.array([15.5, 25.5, 35.5])
+
+        args = img.unix_time, img.pfilter, ids, mags, snrs
+        kwargs = dict(pm_x = xs, pm_y = ys, pm_ids = [3])
+        db.add_image_photometry(*args, **kwargs)
+
+        self.assertEqual(len(db.get_photometry(0, johnson_V)), 0)
+        for id_, mag, snr in zip(ids, mags, snrs):
+            star = db.get_photometry(id_, johnson_V)
+            self.assertEqual(len(star), 1)
+            self.assertEqual(star.time(0), img.unix_time)
+            self.assertEqual(star.mag(0), mag)
+            self.assertEqual(star.snr(0), snr)
+
+        pm_correction = db.get_pm_correction(3, img.unix_time, img.pfilter)
+        self.assertEqual(pm_correction, (30.5, 35.5))
+        pm_correction = db.get_pm_correction(2, img.unix_time, img.pfilter)
+        self.assertEqual(pm_correction, (None, None))
+
+        # The database is modified atomically: if any of the records cannot
+        # be stored, none of them are. Star with ID = 0 has no photometry yet,
+        # but that of star 1 was already added, so DuplicatePhotometryError.
+        args = img.unix_time, img.pfilter, [0, 1], [14.2, 12.5], [90, 200]
+        with self.assertRaises(DuplicatePhotometryError):
+            db.add_image_photometry(*args)
+        self.assertEqual(len(db.get_photometry(0, johnson_V)), 0)
+
+        # UnknownStarError if one or more IDs are not in the database...
+        args = img.unix_time, img.pfilter, [0, 4], [14.2, 12.5], [90, 200]
+        with self.assertRaises(UnknownStarError):
+            db.add_image_photometry(*args)
+        self.assertEqual(len(db.get_photometry(0, johnson_V)), 0)
+
+        # ... and UnknownImageError if the image is not in the database
+        nonexistent_unix_time = different_runix_time([img.unix_time])
+        args = nonexistent_unix_time, img.pfilter, [0], [14.2], [90]
+        with self.assertRaises(UnknownImageError):
+            db.add_image_photometry(*args)
+
     def test_pfilters_and_star_pfilters(self):
 
         db = LEMONdB(':memory:')
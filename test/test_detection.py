@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+import numpy
+
+# LEMON modules
+from test import unittest
+from test.test_centroid import gaussian_stars
+import astromatic
+import detection
+
+class DetectionTest(unittest.TestCase):
+
+    # A grid of 5 x 4 well-separated stars, on a noisy background
+    SHAPE = (400, 500)
+    SIGMA = 1.5
+    SKY = 100
+    NOISE = 5
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(1)
+        cols, rows = numpy.meshgrid(numpy.arange(50, 500, 100),
+                                    numpy.arange(50, 400, 100))
+        self.x = cols.ravel() + self.random.uniform(-0.5, 0.5, cols.size)
+        self.y = rows.ravel() + self.random.uniform(-0.5, 0.5, rows.size)
+
+    def noisy(self, data):
+        return data + self.random.normal(0, self.NOISE, data.shape)
+
+    def test_background(self):
+
+        # A linear gradient is recovered, and so is the noise
+        rows, cols = numpy.indices(self.SHAPE)
+        sky = 100 + 0.05 * cols + 0.02 * rows
+        levels, sigmas = detection.background(self.noisy(sky))
+        self.assertEqual(levels.shape, self.SHAPE)
+        self.assertEqual(sigmas.shape, self.SHAPE)
+        inner = (slice(64, -64), slice(64, -64))
+        self.assertTrue(numpy.abs(levels - sky)[inner].max() < 1.5)
+        self.assertAlmostEqual(numpy.median(sigmas), self.NOISE, delta = 0.3)
+
+        # The stars do not affect the background
+        data = gaussian_stars(self.SHAPE, self.x, self.y, sky = self.SKY)
+        levels, sigmas = detection.background(self.noisy(data))
+        self.assertTrue(numpy.abs(levels - self.SKY).max() < 1)
+
+    def test_detect(self):
+
+        data = gaussian_stars(self.SHAPE, self.x, self.y,
+                              sigma = self.SIGMA, sky = self.SKY)
+        catalog = detection.detect(self.noisy(data), saturation = 10000)
+        self.assertTrue(isinstance(catalog, astromatic.Catalog))
+        self.assertEqual(len(catalog), len(self.x))
+
+        # Match each star to the nearest detection
+        order = numpy.lexsort((catalog['x'], catalog['y'] // 100))
+        stars = catalog.stars[order]
+        numpy.testing.assert_allclose(stars['x'], self.x, atol = 0.05)
+        numpy.testing.assert_allclose(stars['y'], self.y, atol = 0.05)
+
+        # For a Gaussian profile, twice the flux radius is the FWHM
+        fwhm = 2 * numpy.sqrt(2 * numpy.log(2)) * self.SIGMA
+        numpy.testing.assert_allclose(stars['fwhm'], fwhm, rtol = 0.1)
+        self.assertAlmostEqual(numpy.median(stars['fwhm']) / fwhm, 1,
+                               delta = 0.02)
+        numpy.testing.assert_allclose(stars['elongation'], 1, atol = 0.1)
+        self.assertFalse(stars['saturated'].any())
+        self.assertTrue((stars['snr'] > 100).all())
+        self.assertTrue((stars['area'] >= 5).all())
+        self.assertTrue(numpy.isnan(stars['alpha']).all())
+        self.assertTrue(numpy.isnan(stars['delta']).all())
+
+        # Brighter stars, smaller magnitudes
+        bright = gaussian_stars(self.SHAPE, self.x[:1], self.y[:1],
+                                sigma = self.SIGMA, peak = 20000, sky = 0)
+        catalog2 = detection.detect(self.noisy(data + bright), 10000)
+        index = numpy.argmin(catalog2['mag'])
+        self.assertAlmostEqual(catalog2[index].x, self.x[0], delta = 0.05)
+        self.assertTrue(catalog2[index].saturated)
+        self.assertEqual(catalog2['saturated'].sum(), 1)
+
+    def test_detect_elongation(self):
+
+        # A star twice as long along the x-axis as along the y-axis
+        rows, cols = numpy.indices(self.SHAPE)
+        x0, y0 = 250.3, 200.7
+        exponent = ((cols + 1 - x0) / (2 * self.SIGMA)) ** 2 + \
+                   ((rows + 1 - y0) / self.SIGMA) ** 2
+        data = self.SKY + 5000 * numpy.exp(-exponent / 2)
+        catalog = detection.detect(self.noisy(data), saturation = 10000)
+        self.assertEqual(len(catalog), 1)
+        self.assertAlmostEqual(catalog[0].elongation, 2, delta = 0.2)
+
+    def test_detect_nbrightest(self):
+
+        # Only the FWHM of the brightest stars is measured
+        data = gaussian_stars(self.SHAPE, self.x, self.y, sky = self.SKY)
+        catalog = detection.detect(self.noisy(data), 10000, nbrightest = 3)
+        self.assertEqual(len(catalog), len(self.x))
+        self.assertEqual(numpy.isfinite(catalog['fwhm']).sum(), 3)
+
+    def test_detect_empty(self):
+
+        data = self.noisy(numpy.zeros(self.SHAPE) + self.SKY)
+        catalog = detection.detect(data, saturation = 10000)
+        self.assertEqual(len(catalog), 0)
+        self.assertEqual(catalog.stars.dtype, astromatic.Catalog.DTYPE)
@@ -186,6 +186,48 @@ class FITSImageTest(unittest.TestCase):
             with self.assertRaises(fitsimage.NonStandardFITS):
                 FITSImage(text_path)
 
+    def test_data(self):
+        for memmap in (False, True):
+            path = self.random_data()[0]
+            with FITSImage(path, memmap = memmap) as img:
+                # Pixels are not read until the property is first accessed
+                self.assertEqual(img._data, None)
+                pixels = pyfits.getdata(path)
+                self.assertEqual(img.data.shape, pixels.shape)
+                self.assertTrue((img.data == pixels).all())
+                self.assertTrue(img.data is img.data)
+
+    def test_data_sha1sum(self):
+
+        path = self.random_data()[0]
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            img = FITSImage(path)
+            checksum = img.data_sha1sum
+            self.assertEqual(len(checksum), 40)
+
+            # Modifying the header changes the SHA-1 of the file, not that of
+            # the data -- which is also the same if the image is compressed
+            sha1sum = img.sha1sum
+            img.update_keyword('OBJECT', 'Bel Riose')
+            img = FITSImage(path)
+            self.assertNotEqual(img.sha1sum, sha1sum)
+            self.assertEqual(img.data_sha1sum, checksum)
+
+            compressed_path = os.path.join(tmp_dir, 'image.fits.gz')
+            img.compress(compressed_path, 'gzip')
+            comp_img = FITSImage(compressed_path)
+            self.assertEqual(comp_img.data_sha1sum, checksum)
+
+            # Different pixels, different checksum
+            other_path = self.random_data()[0]
+            self.assertNotEqual(FITSImage(other_path).data_sha1sum, checksum)
+            os.unlink(other_path)
+
+        finally:
+            os.unlink(path)
+            shutil.rmtree(tmp_dir)
+
     def test_repr(self):
         with self.random() as img1:
             self.assertEqual(img1.path, eval(repr(img1)).path)
@@ -648,3 +690,291 @@ class FITSImageTest(unittest.TestCase):
         with self.assertRaises(KeyError):
             with self.random() as img:
                 img.dec(dec_kwd)
+
+    def test_scan_headers(self):
+
+        # Three random FITS images, the last one without the filter keyword,
+        # and a text file, which is not a FITS file and cannot be opened.
+        kwargs = [dict(FILTER = 'Johnson V', OBJECT = 'M101',
+                       EXPTIME = 30, DATE_OBS = '2014-01-18T20:42:03'),
+                  dict(FILTER = 'Cousins I', OBJECT = 'M101',
+                       EXPTIME = 45, DATE_OBS = '2014-01-18T21:05:11'),
+                  dict(OBJECT = 'M51', EXPTIME = 45)]
+
+        paths = []
+        for keywords in kwargs:
+            # 'DATE-OBS' cannot be used as a keyword argument
+            if 'DATE_OBS' in keywords:
+                keywords['DATE-OBS'] = keywords.pop('DATE_OBS')
+            paths.append(self.random_data(**keywords)[0])
+
+        with tempfile.NamedTemporaryFile(suffix = '.fits', delete = False) as fd:
+            fd.write("Lorem ipsum dolor sit amet,\n")
+            paths.append(fd.name)
+
+        try:
+            date_keywords = dict(date_keyword = 'DATE-OBS',
+                                 exp_keyword = 'EXPTIME')
+
+            kwargs = dict(filterk = 'FILTER',
+                          date_keywords = date_keywords,
+                          keywords = ['OBJECT', 'AIRMASS'],
+                          ncores = 2,
+                          ignore_errors = True)
+
+            headers = list(fitsimage.scan_headers(paths, **kwargs))
+            self.assertEqual([info.path for info in headers], paths)
+
+            for info in headers[:-1]:
+                img = fitsimage.FITSImage(info.path)
+                self.assertEqual(info.image.path, img.path)
+                self.assertEqual(info.image.size, img.size)
+                self.assertEqual(info.keywords['OBJECT'],
+                                 img.read_keyword('OBJECT'))
+                # Keywords not in the header are not in the dictionary
+                self.assertFalse('AIRMASS' in info.keywords)
+
+            for info in headers[:2]:
+                img = fitsimage.FITSImage(info.path)
+                self.assertEqual(info.pfilter, img.pfilter('FILTER'))
+                self.assertEqual(info.date, img.date(**date_keywords))
+
+            # Fields that cannot be read are set to None...
+            self.assertEqual(headers[2].pfilter, None)
+            self.assertEqual(headers[2].date, None)
+            self.assertEqual(headers[3].image, None)
+
+            # ... unless errors are not ignored
+            kwargs['ignore_errors'] = False
+            with self.assertRaises(KeyError):
+                list(fitsimage.scan_headers(paths[:3], **kwargs))
+            with self.assertRaises(fitsimage.NonStandardFITS):
+                list(fitsimage.scan_headers(paths[3:], **kwargs))
+
+            # The filter and date are not read unless we ask for them
+            headers = fitsimage.scan_headers(paths[:3])
+            for info in headers:
+                self.assertEqual(info.pfilter, None)
+                self.assertEqual(info.date, None)
+                self.assertEqual(info.keywords, {})
+
+        finally:
+            for path in paths:
+                os.unlink(path)
+
+    def test_header_index(self):
+
+        fd, index_path = tempfile.mkstemp(suffix = '.db')
+        os.close(fd)
+        try:
+            fitsimage.set_header_index(index_path)
+            index = fitsimage._header_index
+            path, x_size, y_size = self.random_data(FILTER = 'Johnson V')
+
+            # The header is stored in the index the first time the image is
+            # opened, and read from there (and not from disk) the second time
+            self.assertEqual(index.header(path), None)
+            img = FITSImage(path)
+            self.assertNotEqual(index.header(path), None)
+            img = FITSImage(path)
+            self.assertEqual(img.size, (x_size, y_size))
+            self.assertEqual(img.read_keyword('FILTER'), 'Johnson V')
+
+            # Derived values are also cached...
+            pfilter = img.pfilter('FILTER')
+            self.assertEqual(index.get(path, 'pfilter:FILTER'), str(pfilter))
+            self.assertEqual(img.pfilter('FILTER'), pfilter)
+
+            # ... until the file is modified, which invalidates the entry
+            img.update_keyword('FILTER', 'Johnson B')
+            self.assertEqual(index.header(path), None)
+            with self.assertRaises(KeyError):
+                index.get(path, 'pfilter:FILTER')
+            img = FITSImage(path)
+            self.assertEqual(str(img.pfilter('FILTER')), 'Johnson B')
+
+            # Replacing the file (different inode) also invalidates it
+            other_path = self.random_data(FILTER = 'Johnson R')[0]
+            os.rename(other_path, path)
+            self.assertEqual(index.header(path), None)
+            self.assertEqual(str(FITSImage(path).pfilter('FILTER')), 'Johnson R')
+            os.unlink(path)
+
+            # An index that cannot be opened is disabled, not an error
+            fitsimage.set_header_index('/proc/nonexistent/index.db')
+            self.assertEqual(fitsimage._header_index, None)
+
+        finally:
+            fitsimage.set_header_index(None)
+            os.unlink(index_path)
+
+    def test_header_edit(self):
+
+        with self.random(OBSERVER = 'Hari Seldon', OLDKEY = 1) as img:
+
+            with img.header_edit() as header:
+                header.update('OBJECT', 'Terminus', comment = "Foundation")
+                header.update('observer', 'Gaal Dornick')
+                header.delete('OLDKEY')
+                header.delete('NOSUCHKEY') # no exception raised
+                header.add_history("Seldon crisis")
+
+                # Nothing is written to disk until the with statement exits
+                on_disk = pyfits.getheader(img.path)
+                self.assertNotIn('OBJECT', on_disk)
+                self.assertIn('OLDKEY', on_disk)
+
+            for hdr in (img._header, pyfits.getheader(img.path)):
+                self.assertEqual(hdr['OBJECT'], 'Terminus')
+                self.assertEqual(hdr.comments['OBJECT'], "Foundation")
+                self.assertEqual(hdr['OBSERVER'], 'Gaal Dornick')
+                self.assertNotIn('OLDKEY', hdr)
+                self.assertIn("Seldon crisis", str(hdr['HISTORY']))
+
+            # If an exception is raised, no change is made to the header
+            with self.assertRaises(ZeroDivisionError):
+                with img.header_edit() as header:
+                    header.update('OBJECT', 'Trantor')
+                    1 / 0
+            self.assertEqual(img.read_keyword('OBJECT'), 'Terminus')
+            self.assertEqual(pyfits.getheader(img.path)['OBJECT'], 'Terminus')
+
+            # The header has been padded with blank cards, so adding a few
+            # keywords does not need to move the data section of the file.
+            size = os.path.getsize(img.path)
+            with img.header_edit() as header:
+                for index in xrange(5):
+                    header.update('KEY%d' % index, index)
+            self.assertEqual(os.path.getsize(img.path), size)
+            self.assertEqual(img.read_keyword('KEY4'), 4)
+            numpy.testing.assert_array_equal(img.data, pyfits.getdata(img.path))
+
+    def test_pix2world_and_world2pix(self):
+
+        wcs_keywords = dict(CTYPE1 = 'RA---TAN', CTYPE2 = 'DEC--TAN',
+                            CRVAL1 = 83.63, CRVAL2 = 22.01,
+                            CRPIX1 = 50.0, CRPIX2 = 50.0,
+                            CDELT1 = -0.0001, CDELT2 = 0.0001)
+
+        with self.random(**wcs_keywords) as img:
+            ra, dec = img.pix2world(50, 50)
+            self.assertIsInstance(ra, float)
+            self.assertAlmostEqual(ra, 83.63)
+            self.assertAlmostEqual(dec, 22.01)
+
+            # Arrays of coordinates are transformed at once
+            x = numpy.random.uniform(1, img.x_size, size = 100)
+            y = numpy.random.uniform(1, img.y_size, size = 100)
+            ra, dec = img.pix2world(x, y)
+            self.assertEqual(ra.shape, (100,))
+            self.assertAlmostEqual(ra[7], img.pix2world(x[7], y[7])[0])
+            x2, y2 = img.world2pix(ra, dec)
+            numpy.testing.assert_allclose(x2, x)
+            numpy.testing.assert_allclose(y2, y)
+            with self.assertRaises(ValueError):
+                img.pix2world(x, y[:-1])
+
+            # The WCS object is shared by all the instances of the image
+            self.assertIs(img._get_wcs(), FITSImage(img.path)._get_wcs())
+
+        with self.random() as img:
+            with self.assertRaises(fitsimage.NoWCSInformationError):
+                img.pix2world(*img.center)
+            with self.assertRaises(fitsimage.NoWCSInformationError):
+                img.world2pix([1, 2, 3], [4, 5, 6])
+
+    def test_footprint(self):
+
+        wcs_keywords = dict(CTYPE1 = 'RA---TAN', CTYPE2 = 'DEC--TAN',
+                            CRVAL1 = 83.63, CRVAL2 = 22.01,
+                            CRPIX1 = 50.0, CRPIX2 = 50.0,
+                            CDELT1 = -0.0001, CDELT2 = 0.0001)
+
+        with self.random(**wcs_keywords) as img:
+            x = numpy.array([1, img.x_size, 0, img.x_size + 4, 1])
+            y = numpy.array([img.y_size, 1, 1, 1, -20])
+            ra, dec = img.pix2world(x, y)
+            footprint = img.footprint(ra, dec)
+            self.assertEqual(list(footprint), [True, True, False, False, False])
+            footprint = img.footprint(ra, dec, margin = 4.5)
+            self.assertEqual(list(footprint), [True, True, True, True, False])
+
+            # The antipode of the center is projected onto the center of the
+            # image by the TAN projection, but it is not within the footprint
+            ra, dec = img.center_wcs()
+            antipode = (ra + 180) % 360, -dec
+            self.assertEqual(list(img.footprint(*zip(antipode))), [False])
+            self.assertEqual(len(img.footprint([], [])), 0)
+
+    def test_compressed(self):
+
+        tmp_dir = tempfile.mkdtemp()
+        fitsimage.DECOMPRESSION_DIR = tmp_dir
+        try:
+            path = os.path.join(tmp_dir, 'ferM_0013.fits')
+            pixels = numpy.random.random_integers(0, 65535, size = (150, 200))
+            hdu = pyfits.PrimaryHDU(pixels.astype(numpy.int32))
+            hdu.header['OBJECT'] = 'Salvor Hardin'
+            hdu.writeto(path)
+            img = fitsimage.FITSImage(path)
+            self.assertEqual(img.compression, None)
+            self.assertEqual(img.plain_path(), path)
+
+            for method, compression, hdu in (('gzip', 'gzip', 0),
+                                             ('rice', 'tile', 1)):
+                ext = '.gz' if method == 'gzip' else '.fz'
+                compressed_path = path + ext
+                img.compress(compressed_path, method)
+                self.assertLess(os.path.getsize(compressed_path),
+                                os.path.getsize(path))
+
+                comp_img = fitsimage.FITSImage(compressed_path, memmap = True)
+                self.assertEqual(comp_img.compression, compression)
+                self.assertEqual(comp_img.hdu, hdu)
+                self.assertEqual(comp_img.size, img.size)
+                object_ = comp_img.read_keyword('OBJECT')
+                self.assertEqual(object_, 'Salvor Hardin')
+                # Lossless, as the pixels are integers
+                numpy.testing.assert_array_equal(comp_img.data, pixels)
+                self.assertEqual(comp_img.prefix, 'ferM_')
+
+                # The header of compressed images can be modified...
+                with comp_img.header_edit() as header:
+                    header.update('OBJECT', 'Hober Mallow')
+                comp_img = fitsimage.FITSImage(compressed_path)
+                object_ = comp_img.read_keyword('OBJECT')
+                self.assertEqual(object_, 'Hober Mallow')
+
+                # ... and an uncompressed copy is used by external tools
+                plain_path = comp_img.plain_path()
+                self.assertTrue(plain_path.startswith(tmp_dir))
+                self.assertEqual(os.path.splitext(plain_path)[1], '.fits')
+                plain_img = fitsimage.FITSImage(plain_path)
+                self.assertEqual(plain_img.compression, None)
+                self.assertEqual(plain_img.read_keyword('OBJECT'),
+                                 'Hober Mallow')
+                numpy.testing.assert_array_equal(plain_img.data, pixels)
+                self.assertEqual(comp_img.plain_path(), plain_path)
+                os.unlink(plain_path)
+
+            with self.assertRaises(ValueError):
+                img.compress(path + '.bz2', 'bzip2')
+
+            # The extension of the compression is optional in the pattern
+            paths = fitsimage.find_files([tmp_dir], pattern = '*.fits')
+            self.assertEqual(sorted(paths),
+                             [path, path + '.fz', path + '.gz'])
+
+        finally:
+            fitsimage.DECOMPRESSION_DIR = None
+            shutil.rmtree(tmp_dir)
+
+    def test_splitext(self):
+        self.assertEqual(fitsimage.splitext('ferM_0013.fits'),
+                         ('ferM_0013', '.fits'))
+        self.assertEqual(fitsimage.splitext('/caha/ferM_0013.fits.fz'),
+                         ('/caha/ferM_0013', '.fits'))
+        self.assertEqual(fitsimage.splitext('ferM_0013.fit.gz'),
+                         ('ferM_0013', '.fit'))
+        self.assertEqual(fitsimage.splitext('ferM_0013.fz'),
+                         ('ferM_0013', '.fits'))
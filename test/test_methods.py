@@ -24,6 +24,8 @@ import StringIO
 import operator
 import os
 import random
+import shutil
+import tempfile
 import warnings
 
 # LEMON modules
@@ -275,6 +277,90 @@ class MethodsFunctionsTests(unittest.TestCase):
         self.assertEqual(None, methods.func_catchall(foo_except))
         self.assertEqual(None, methods.func_catchall(operator.div, 1, 0))
 
+    def test_spatial_tiles(self):
+
+        for ntiles in (1, 2, 3, 5, 8, 9, 16):
+            x = [random.uniform(1, 2048) for _ in xrange(1000)]
+            y = [random.uniform(1, 2048) for _ in xrange(1000)]
+            tiles = methods.spatial_tiles(x, y, ntiles)
+            self.assertEqual(len(tiles), ntiles)
+
+            # Each point is in exactly one tile...
+            indexes = sorted(index for tile in tiles for index in tile)
+            self.assertEqual(indexes, range(len(x)))
+            # ... and all the tiles have (almost) the same number of points
+            sizes = [len(tile) for tile in tiles]
+            self.assertLessEqual(max(sizes) - min(sizes), 2)
+
+        # With few points, there are no empty tiles
+        self.assertEqual(len(methods.spatial_tiles([1, 2], [3, 4], 4)), 2)
+        self.assertEqual(methods.spatial_tiles([], [], 4), [])
+        with self.assertRaises(ValueError):
+            methods.spatial_tiles([1, 2], [3], 2)
+
+    def test_link_or_copy(self):
+
+        directory = tempfile.mkdtemp()
+        try:
+            src = os.path.join(directory, 'src')
+            with open(src, 'wb') as fd:
+                fd.write('x' * 100)
+            os.chmod(src, 0444)
+
+            dst = os.path.join(directory, 'hardlink')
+            self.assertEqual(methods.link_or_copy(src, dst, hardlink = True),
+                             'hardlink')
+            self.assertTrue(os.path.samefile(src, dst))
+
+            # A reflink, if supported by the file system, or a regular copy
+            dst = os.path.join(directory, 'copy')
+            how = methods.link_or_copy(src, dst)
+            self.assertIn(how, ('reflink', 'copy'))
+            self.assertFalse(os.path.samefile(src, dst))
+            with open(dst, 'rb') as fd:
+                self.assertEqual(fd.read(), 'x' * 100)
+            # The permission bits are copied too
+            self.assertEqual(os.stat(src).st_mode, os.stat(dst).st_mode)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_evict_lru(self):
+
+        directory = tempfile.mkdtemp()
+        try:
+            # Five 100-byte files, the first one the least recently used
+            paths = []
+            for index in xrange(5):
+                path = os.path.join(directory, 'file_%d' % index)
+                with open(path, 'wb') as fd:
+                    fd.write('x' * 100)
+                os.utime(path, (1000 + index, 1000 + index))
+                paths.append(path)
+
+            # Hidden files (temporary) and 'keep' are never deleted
+            hidden = os.path.join(directory, '.partial')
+            with open(hidden, 'wb') as fd:
+                fd.write('x' * 1000)
+
+            methods.evict_lru(directory, 300, keep = paths[0])
+            remaining = [path for path in paths if os.path.exists(path)]
+            self.assertEqual(remaining, [paths[0], paths[3], paths[4]])
+            self.assertTrue(os.path.exists(hidden))
+
+            # Pinned files are not deleted either, until they are unpinned
+            with methods.pinned(paths[3]):
+                methods.evict_lru(directory, 0)
+                self.assertEqual(os.path.exists(paths[3]), True)
+                self.assertEqual(os.path.exists(paths[4]), False)
+
+            # Pins of processes that no longer exist are ignored, and removed
+            stale = os.path.join(directory, '.file_3.pin.%d.x' % (2 ** 22 + 1))
+            open(stale, 'w').close()
+            methods.evict_lru(directory, 0)
+            self.assertEqual(os.listdir(directory), ['.partial'])
+        finally:
+            shutil.rmtree(directory)
+
 
 class StreamToWarningFilterTest(unittest.TestCase):
 
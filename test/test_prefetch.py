@@ -0,0 +1,183 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+# LEMON modules
+from test import unittest
+import prefetch
+
+def read_file(path):
+    """ Function argument of map() for the pool of workers. """
+
+    with prefetch.acquire(path) as local_path:
+        with open(local_path, 'rb') as fd:
+            return local_path, fd.read()
+
+
+class PrefetchTest(unittest.TestCase):
+
+    NFILES = 8
+    SIZE = 4096 # bytes
+
+    def setUp(self):
+        self.input_dir = tempfile.mkdtemp(suffix = '_input')
+        self.scratch_dir = tempfile.mkdtemp(suffix = '_scratch')
+        self.paths = []
+        for index in xrange(self.NFILES):
+            path = os.path.join(self.input_dir, 'image_%d.fits' % index)
+            with open(path, 'wb') as fd:
+                fd.write(chr(index) * self.SIZE)
+            self.paths.append(path)
+
+    def tearDown(self):
+        prefetch.set_prefetcher(None)
+        shutil.rmtree(self.input_dir)
+        shutil.rmtree(self.scratch_dir)
+
+    def wait_staged(self, prefetcher, index):
+        """ Wait (at most five seconds) until the image has been staged. """
+
+        for _ in xrange(50):
+            if prefetcher._staged[index]:
+                return
+            time.sleep(0.1)
+        self.fail("image %d was not staged" % index)
+
+    def test_read_ahead(self):
+        self.assertEqual(prefetch.read_ahead(self.paths[0]), self.SIZE)
+        self.assertEqual(prefetch.read_ahead(self.paths[0], 1000), self.SIZE)
+
+    def test_page_cache(self):
+
+        prefetcher = prefetch.Prefetcher(self.paths, 2)
+        prefetcher.start()
+        try:
+            for index, path in enumerate(self.paths):
+                self.wait_staged(prefetcher, index)
+                # The original file is used, as it is not copied anywhere
+                with prefetcher.acquire(path) as local_path:
+                    self.assertEqual(local_path, path)
+        finally:
+            prefetcher.stop()
+
+        self.assertEqual(prefetcher.hits, self.NFILES)
+        self.assertEqual(prefetcher.misses, 0)
+        self.assertEqual(prefetcher.hit_rate, 1)
+
+    def test_scratch_dir(self):
+
+        # Room for only two images in the scratch directory
+        budget = 2 * self.SIZE
+        args = self.paths, 4
+        kwargs = dict(scratch_dir = self.scratch_dir, budget = budget)
+        prefetcher = prefetch.Prefetcher(*args, **kwargs)
+        prefetcher.start()
+
+        try:
+            for index, path in enumerate(self.paths[:-1]):
+                self.wait_staged(prefetcher, index)
+                self.assertLessEqual(prefetcher.used, budget)
+                with prefetcher.acquire(path) as local_path:
+                    self.assertNotEqual(local_path, path)
+                    self.assertEqual(os.path.basename(local_path),
+                                     os.path.basename(path))
+                    with open(local_path, 'rb') as fd:
+                        self.assertEqual(fd.read(), chr(index) * self.SIZE)
+                # The copy is deleted as soon as it is released
+                self.assertFalse(os.path.exists(local_path))
+
+        finally:
+            prefetcher.stop()
+
+        self.assertEqual(prefetcher.hits, self.NFILES - 1)
+        self.assertEqual(prefetcher.used, 0)
+        # Nothing is left in the scratch directory
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+        # The last image was never acquired, and unknown images are misses
+        with prefetcher.acquire('/nonexistent.fits') as local_path:
+            self.assertEqual(local_path, '/nonexistent.fits')
+        self.assertEqual(prefetcher.misses, 1)
+
+    def test_acquire_again(self):
+
+        kwargs = dict(scratch_dir = self.scratch_dir)
+        prefetcher = prefetch.Prefetcher(self.paths, 1, **kwargs)
+        prefetcher.start()
+        try:
+            self.wait_staged(prefetcher, 0)
+            path = self.paths[0]
+            with prefetcher.acquire(path) as local_path:
+                self.assertNotEqual(local_path, path)
+                # e.g., another tile of the same image: the original file
+                for _ in xrange(3):
+                    with prefetcher.acquire(path) as again_path:
+                        self.assertEqual(again_path, path)
+                self.assertTrue(os.path.exists(local_path))
+        finally:
+            prefetcher.stop()
+
+        # Only the first time counts, and the workers did not go further
+        self.assertEqual(prefetcher.hits, 1)
+        self.assertEqual(prefetcher.misses, 0)
+        self.assertEqual(prefetcher._ntaken.value, 1)
+
+    def test_disabled(self):
+
+        kwargs = dict(scratch_dir = self.scratch_dir)
+        prefetcher = prefetch.Prefetcher(self.paths, 0, **kwargs)
+        prefetcher.start()
+        with prefetcher.acquire(self.paths[0]) as local_path:
+            self.assertEqual(local_path, self.paths[0])
+        prefetcher.stop()
+        self.assertEqual(prefetcher.hit_rate, 0)
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+        # Without a Prefetcher, acquire() returns the same path
+        with prefetch.acquire(self.paths[0]) as local_path:
+            self.assertEqual(local_path, self.paths[0])
+
+    def test_pool(self):
+
+        kwargs = dict(scratch_dir = self.scratch_dir)
+        prefetcher = prefetch.Prefetcher(self.paths, 3, **kwargs)
+        prefetch.set_prefetcher(prefetcher)
+        pool = multiprocessing.Pool(2)
+        prefetcher.start()
+
+        try:
+            result = pool.map(read_file, self.paths, chunksize = 1)
+        finally:
+            prefetcher.stop()
+            pool.close()
+            pool.join()
+
+        for index, (local_path, data) in enumerate(result):
+            self.assertEqual(data, chr(index) * self.SIZE)
+
+        # Hits and misses are counted across processes
+        self.assertEqual(prefetcher.hits + prefetcher.misses, self.NFILES)
+        self.assertEqual(os.listdir(self.scratch_dir), [])
@@ -20,7 +20,7 @@
 
 import astropy.wcs
 import itertools
-import operator
+import numpy
 import os.path
 import pyfits
 import random
@@ -80,53 +80,86 @@ class QPhotTest(unittest.TestCase):
         exptimek = 'EXPOSURE',
         uncimgk = None)
 
-    def test_get_coords_file(self):
-
-        def c(*args):
-            """ Return an astromatic.Coordinates object """
-            return astromatic.Coordinates(*args)
-
-        coordinates = (
-            c(316.724802,  38.74944,   4.16831,   3.2692),    # 61 Cygni A
-            c(316.730266,  38.742056,  4.1069,    3.14468),   # 61 Cygni B
-            c(165.834142,  35.96988,  -0.58027,  -4.76585),   # Lalande 21185
-            c(152.11717,   12.3065,   -0.000114, -0.000126),  # Leo I
-            c(346.466817, -35.853069,  6.7682,    1.32752),   # HD 217987
-            c(348.992913,  31.462856,  None,      None),      # WASP-10 b
-            c( 97.19046,   38.962963)                         # HD 45350 b
-            )
-
-        # There is no need to write code to test that proper-motion correction
-        # is correctly calculated: we do already have a unit test for exactly
-        # that: Coordinates.get_exact_coordinates(). Parse the output file of
-        # get_coords_file() and make sure that the coordinates written to it
-        # match those returned by get_exact_coordinates() for the same year
-        # and epoch.
+    def test_qphot_init(self):
 
-        for _ in xrange(NITERS):
-
-            year  = random.uniform(1900, 2050)
-            epoch = random.choice([1950, 2000])
-
-            # The proper-motion corrected astromatic.Coordinates objects. We
-            # only correct those objects with proper motions (that is, those
-            # for which both 'pm_ra' and 'pm_dec' are not None neither zero).
+        # QPhot accepts the coordinates in memory, as a CoordinatesArray or
+        # as an iterable of Coordinates objects, and also (for backwards
+        # compatibility) the path to a text file with the coordinates.
 
-            func = operator.methodcaller('get_exact_coordinates', year, epoch)
-            has_pm = lambda c: c.pm_ra and c.pm_dec
-            expected = (func(x) if has_pm(x) else x for x in coordinates)
+        img_path = test.test_fitsimage.FITSImageTest.random_data()[0]
+        try:
+            coords = [astromatic.Coordinates(random.uniform(0, 360),
+                                             random.uniform(-90, 90))
+                      for _ in xrange(NITERS)]
 
-            output_path = qphot.get_coords_file(coordinates, year, epoch)
+            array = astromatic.CoordinatesArray.from_coordinates(coords)
+            self.assertIs(qphot.QPhot(img_path, array).coordinates, array)
+            img_qphot = qphot.QPhot(img_path, coords)
+            self.assertEqual(list(img_qphot.coordinates), coords)
 
+            coords_path = qphot.write_coords_file(array)
             try:
-                # The coordinates written by get_coords_file(), returned as
-                # four-element tuples (ra, dec, pm_ra, pm_dec)
-                output = methods.load_coordinates(output_path)
-                for c1, c2 in zip(output, expected):
-                    self.assertAlmostEqual(c1[0], c2.ra)
-                    self.assertAlmostEqual(c1[1], c2.dec)
+                img_qphot = qphot.QPhot(img_path, coords_path)
+                numpy.testing.assert_allclose(img_qphot.coordinates.ra, array.ra)
+                numpy.testing.assert_allclose(img_qphot.coordinates.dec, array.dec)
             finally:
-                os.unlink(output_path)
+                os.unlink(coords_path)
+
+            # The coordinates must be already corrected for proper motions
+            coords.append(astromatic.Coordinates(1, 2, 0.5, 0.5))
+            with self.assertRaises(ValueError):
+                qphot.QPhot(img_path, coords)
+
+        finally:
+            os.unlink(img_path)
+
+    def test_snr_and_to_array(self):
+
+        # qphot.snr(), the vectorized version of QPhotResult.snr(), must
+        # return the same values, also for zero and negative sums; and the
+        # records of QPhot.to_array() must match the QPhotResult objects.
+
+        for _ in xrange(NITERS):
+
+            img_qphot = qphot.QPhot.__new__(qphot.QPhot)
+            for index in xrange(random.randint(1, 50)):
+                x, y = random.uniform(1, 2048), random.uniform(1, 2048)
+                mag = random.choice([None, float('infinity'),
+                                     random.uniform(10, 20)])
+                sum_ = random.choice([0, random.uniform(-1e4, 1e6)])
+                flux = random.uniform(-1e3, 1e6)
+                stdev = random.choice([None, random.uniform(0, 10)])
+                args = x, y, mag, sum_, flux, stdev
+                img_qphot.append(qphot.QPhotResult(*args))
+
+            gain = random.uniform(0.5, 5)
+            array = img_qphot.to_array()
+            snrs = qphot.snr(array, gain)
+            self.assertEqual(array.dtype, qphot.DTYPE)
+            self.assertEqual(len(array), len(img_qphot))
+
+            for object_phot, record, snr in zip(img_qphot, array, snrs):
+                self.assertAlmostEqual(object_phot.snr(gain), snr)
+                self.assertEqual(object_phot.x, record['x'])
+                self.assertEqual(object_phot.y, record['y'])
+                self.assertEqual(object_phot.sum, record['sum'])
+                self.assertEqual(object_phot.flux, record['flux'])
+
+                if object_phot.mag is None:
+                    self.assertTrue(numpy.isnan(record['mag']))
+                else:
+                    self.assertEqual(object_phot.mag, record['mag'])
+
+                saturated = object_phot.mag == float('infinity')
+                self.assertEqual(saturated, record['saturated'])
+
+                if object_phot.stdev is None:
+                    self.assertTrue(numpy.isnan(record['stdev']))
+                else:
+                    self.assertEqual(object_phot.stdev, record['stdev'])
+
+        with self.assertRaises(ValueError):
+            qphot.snr(array, 0)
 
     def test_qphot_run(self):
 
@@ -252,6 +285,102 @@ class QPhotTest(unittest.TestCase):
             for phot, expected_phot in zip(result, ngc2264_expected_output):
                 self.assertEqual(phot, expected_phot)
 
+    def test_exact_coordinates(self):
+
+        barnard = astromatic.Coordinates(269.452075, 4.693391, -0.79858, 10.32812)
+        vega = astromatic.Coordinates(279.234735, 38.783689)
+        kwargs = dict(datek = 'DATE-OBS', timek = None, exptimek = 'EXPOSURE')
+
+        with tempfile.NamedTemporaryFile(suffix = '.fits') as fd:
+            header = pyfits.Header()
+            header['DATE-OBS'] = '2026-07-26T05:27:00'
+            header['EXPOSURE'] = 60
+            data = numpy.zeros((10, 10), dtype = numpy.float32)
+            pyfits.writeto(fd.name, data, header, clobber = True)
+            img = fitsimage.FITSImage(fd.name)
+            year = img.year(exp_keyword = 'EXPOSURE')
+
+            # Over 26 years, Barnard's Star moves more than four arcminutes
+            coords = qphot.exact_coordinates(img, [barnard, vega], 2000,
+                                             **kwargs)
+            self.assertIsInstance(coords, astromatic.CoordinatesArray)
+            expected = barnard.get_exact_coordinates(year)
+            self.assertAlmostEqual(coords.ra[0], expected.ra)
+            self.assertAlmostEqual(coords.dec[0], expected.dec)
+            self.assertTrue(coords.dec[0] - barnard.dec > 260 / 3600.0)
+            self.assertAlmostEqual(coords.ra[1], vega.ra)
+            self.assertAlmostEqual(coords.dec[1], vega.dec)
+
+            # The date is only needed if some object has a proper motion
+            img.delete_keyword('DATE-OBS')
+            coords = qphot.exact_coordinates(img, [vega], 2000, **kwargs)
+            self.assertAlmostEqual(coords.ra[0], vega.ra)
+            with self.assertRaises(KeyError):
+                qphot.exact_coordinates(img, [barnard], 2000, **kwargs)
+
+    def test_stamp_photometry(self):
+
+        # Three stars (the last one saturated), and a fourth off the image
+        x = numpy.array([50.3, 120.2, 150.0, 500.0])
+        y = numpy.array([60.7, 140.9, 50.0, 500.0])
+        peaks = numpy.array([2000, 8000, 50000, 1000])
+        sigma = 1.5
+        rows, cols = numpy.indices((200, 200))
+        data = numpy.random.RandomState(5).normal(100, 3, (200, 200))
+        for x0, y0, peak in zip(x, y, peaks):
+            distance = (cols + 1 - x0) ** 2 + (rows + 1 - y0) ** 2
+            data += peak * numpy.exp(-distance / (2 * sigma ** 2))
+
+        wcs = astropy.wcs.WCS(naxis = 2)
+        wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        wcs.wcs.crval = [83.8, -5.4]
+        wcs.wcs.crpix = [100, 100]
+        wcs.wcs.cdelt = [-1 / 3600.0, 1 / 3600.0]
+        header = pyfits.Header()
+        for card in wcs.to_header().cards:
+            header[card.keyword] = card.value
+        header['EXPTIME'] = 10
+
+        with tempfile.NamedTemporaryFile(suffix = '.fits') as fd:
+            pyfits.writeto(fd.name, data, header, clobber = True)
+            img = fitsimage.FITSImage(fd.name)
+            # Start one pixel away from the true centers
+            coordinates = astromatic.CoordinatesArray(*wcs.all_pix2world(
+                x + 1, y - 1, 1))
+
+            args = img, coordinates, 6, 10, 5, 30000, 'EXPTIME'
+            result = qphot.stamp_photometry(*args, cbox = 5)
+            self.assertEqual(len(result), 4)
+
+            fluxes = 2 * numpy.pi * sigma ** 2 * peaks
+            for index in xrange(2):
+                object_phot = result[index]
+                self.assertAlmostEqual(object_phot.x, x[index], delta = 0.1)
+                self.assertAlmostEqual(object_phot.y, y[index], delta = 0.1)
+                self.assertAlmostEqual(object_phot.flux / fluxes[index], 1,
+                                       delta = 0.02)
+                self.assertAlmostEqual(object_phot.stdev, 3, delta = 0.5)
+                mag = 25 - 2.5 * numpy.log10(object_phot.flux / 10)
+                self.assertAlmostEqual(object_phot.mag, mag)
+
+            self.assertEqual(result[2].mag, float('infinity'))
+            self.assertEqual(result[3].mag, None)
+            self.assertEqual(result[3].stdev, None)
+
+            array = result.to_array()
+            self.assertEqual(list(array['saturated']),
+                             [False, False, True, False])
+
+            # The objects are measured in chunks, with the same result
+            qphot.STAMPS_MAX_SIZE, max_size = 1, qphot.STAMPS_MAX_SIZE
+            try:
+                chunked = qphot.stamp_photometry(*args, cbox = 5)
+            finally:
+                qphot.STAMPS_MAX_SIZE = max_size
+            for field in qphot.DTYPE.names:
+                numpy.testing.assert_array_equal(chunked.to_array()[field],
+                                                 array[field])
+
     def test_qphot_run_proper_motions(self):
 
         # Do photometry on Barnard's Star, the star with the largest-known
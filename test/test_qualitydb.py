@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+
+# LEMON modules
+from test import unittest
+from qualitydb import Metrics, QualityDB
+
+# The QualityDB used by store(), inherited by the pool of workers
+database = None
+
+def store(index):
+    """ Function argument of map() for the pool of workers. """
+    metrics = Metrics(index / 2.0, 1.1, index, 100.0)
+    database.add('sha1_%d' % index, 'settings', metrics)
+
+
+class QualityDBTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix = '.db')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_get_and_add(self):
+
+        db = QualityDB(self.path)
+        self.assertEqual(len(db), 0)
+        with self.assertRaises(KeyError):
+            db.get('ab12', 'detector=native')
+
+        metrics = Metrics(fwhm = 3.25, elongation = 1.12,
+                          nstars = 517, sky = 1524.5)
+        db.add('ab12', 'detector=native', metrics)
+        self.assertEqual(db.get('ab12', 'detector=native'), metrics)
+        self.assertEqual(len(db), 1)
+
+        # The metrics are keyed by both the checksum and the settings
+        with self.assertRaises(KeyError):
+            db.get('ab12', 'detector=sextractor')
+        with self.assertRaises(KeyError):
+            db.get('cd34', 'detector=native')
+
+        other = Metrics(2.5, 1.05, 611, 1498.0)
+        db.add('ab12', 'detector=sextractor', other)
+        self.assertEqual(len(db), 2)
+        self.assertEqual(db.get('ab12', 'detector=sextractor'), other)
+        self.assertEqual(db.get('ab12', 'detector=native'), metrics)
+
+        # Previous values are replaced...
+        db.add('ab12', 'detector=native', other)
+        self.assertEqual(len(db), 2)
+        self.assertEqual(db.get('ab12', 'detector=native'), other)
+
+        # ... and persistent
+        db = QualityDB(self.path)
+        self.assertEqual(db.get('ab12', 'detector=sextractor'), other)
+
+        # A database that cannot be opened raises sqlite3.Error...
+        with self.assertRaises(sqlite3.Error):
+            QualityDB('/proc/nonexistent/quality.db')
+
+        # ... but errors while reading from it are just misses
+        db._connection.execute("DROP TABLE metrics")
+        self.assertEqual(len(db), 0)
+        with self.assertRaises(KeyError):
+            db.get('ab12', 'detector=sextractor')
+
+    def test_pool(self):
+
+        # The workers open their own connection to the database
+        global database
+        database = QualityDB(self.path)
+        pool = multiprocessing.Pool(4)
+        pool.map(store, range(20))
+        pool.close()
+        pool.join()
+
+        self.assertEqual(len(database), 20)
+        for index in range(20):
+            metrics = database.get('sha1_%d' % index, 'settings')
+            self.assertEqual(metrics.nstars, index)
+            self.assertEqual(metrics.fwhm, index / 2.0)
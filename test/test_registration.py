@@ -0,0 +1,214 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division
+
+import numpy
+import os
+import tempfile
+
+# LEMON modules
+from test import unittest
+from test.test_centroid import gaussian_stars
+import json_parse
+import registration
+
+class RegistrationTest(unittest.TestCase):
+
+    SHAPE = (256, 320)
+    SKY = 100
+    NOISE = 5
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(11)
+        # Random stars, but not too close to the edges of the image
+        nstars = 40
+        self.x = self.random.uniform(30, self.SHAPE[1] - 30, nstars)
+        self.y = self.random.uniform(30, self.SHAPE[0] - 30, nstars)
+        self.center = registration.center(self.SHAPE)
+
+    def image(self, dx = 0, dy = 0, rotation = 0):
+        """ Return a noisy image with the stars, transformed. """
+        args = self.x, self.y, self.center, dx, dy, rotation
+        x, y = registration.transform(*args)
+        data = gaussian_stars(self.SHAPE, x, y, sky = self.SKY)
+        return data + self.random.normal(0, self.NOISE, self.SHAPE)
+
+    def test_center(self):
+        self.assertEqual(registration.center((100, 200)), (100.5, 50.5))
+        self.assertEqual(registration.center((5, 5)), (3, 3))
+
+    def test_prepare(self):
+
+        data = self.image()
+        data[10, 10] = 50000 # a hot pixel
+        prepared = registration.prepare(data)
+        self.assertEqual(prepared.shape, self.SHAPE)
+        self.assertEqual(prepared[10, 10], 0)
+        # The background is removed, but not the stars
+        self.assertTrue((prepared >= 0).all())
+        self.assertTrue(numpy.median(prepared) == 0)
+        row, col = int(round(self.y[0])) - 1, int(round(self.x[0])) - 1
+        self.assertTrue(prepared[row, col] > 1000)
+
+    def test_phase_correlation(self):
+
+        reference = registration.spectrum(registration.prepare(self.image()))
+        for dx, dy in [(0, 0), (7, -3), (-20.4, 11.7), (45.25, 30.5)]:
+            prepared = registration.prepare(self.image(dx, dy))
+            spectrum = registration.spectrum(prepared, self.SHAPE)
+            args = reference, spectrum, self.SHAPE
+            x, y, peak = registration.phase_correlation(*args)
+            self.assertAlmostEqual(x, dx, delta = 0.25)
+            self.assertAlmostEqual(y, dy, delta = 0.25)
+            self.assertTrue(0.1 < peak <= 1.0)
+
+        # Images of a different size are cropped or padded
+        prepared = registration.prepare(self.image(5, 5))
+        spectrum = registration.spectrum(prepared[:200, :300], self.SHAPE)
+        args = reference, spectrum, self.SHAPE
+        x, y, _ = registration.phase_correlation(*args)
+        self.assertAlmostEqual(x, 5, delta = 0.25)
+        self.assertAlmostEqual(y, 5, delta = 0.25)
+
+        with self.assertRaises(ValueError):
+            args = reference, spectrum[:10], self.SHAPE
+            registration.phase_correlation(*args)
+
+    def test_transform_and_fit(self):
+
+        x, y = registration.transform([1, 3], [2, 2], (2, 2), 0, 0, 90)
+        self.assertTrue(numpy.allclose(x, [2, 2]))
+        self.assertTrue(numpy.allclose(y, [1, 3]))
+
+        for dx, dy, rotation in [(0, 0, 0), (3.5, -2.25, 0), (-10, 4, 0.75)]:
+            args = self.x, self.y, self.center, dx, dy, rotation
+            x, y = registration.transform(*args)
+            args = self.x, self.y, x, y, self.center
+            fitted = registration.fit(*args, rotation = True)
+            self.assertTrue(numpy.allclose(fitted, (dx, dy, rotation)))
+            if not rotation:
+                fitted = registration.fit(*args)
+                self.assertTrue(numpy.allclose(fitted, (dx, dy, 0)))
+
+    def test_transform_wcs(self):
+
+        # Astrometry.net-like WCS, with a scale of 0.5 arcsec per pixel
+        wcs = dict(CRPIX1 = 140.2, CRPIX2 = 95.7,
+                   CD1_1 = -1.38e-4, CD1_2 = 1.2e-6,
+                   CD2_1 = 1.1e-6, CD2_2 = 1.39e-4)
+
+        def intermediate(wcs, x, y):
+            """ The projection plane coordinates of the pixels """
+            u, v = x - wcs['CRPIX1'], y - wcs['CRPIX2']
+            return (wcs['CD1_1'] * u + wcs['CD1_2'] * v,
+                    wcs['CD2_1'] * u + wcs['CD2_2'] * v)
+
+        # The stars must have the same coordinates in both images
+        expected = intermediate(wcs, self.x, self.y)
+        for dx, dy, rotation in ((0, 0, 0), (8.2, -3.1, 0), (-20, 7, 0.4)):
+            args = self.center, dx, dy, rotation
+            new_wcs = registration.transform_wcs(wcs, *args)
+            x, y = registration.transform(self.x, self.y, *args)
+            coords = intermediate(new_wcs, x, y)
+            self.assertTrue(numpy.allclose(coords, expected,
+                                           rtol = 0, atol = 1e-12))
+
+        # A pure translation just moves the reference pixel
+        new_wcs = registration.transform_wcs(wcs, self.center, 5, -2)
+        self.assertAlmostEqual(new_wcs['CRPIX1'], 145.2)
+        self.assertAlmostEqual(new_wcs['CRPIX2'], 93.7)
+        self.assertEqual(new_wcs['CD1_2'], wcs['CD1_2'])
+
+        del wcs['CD2_1']
+        with self.assertRaises(KeyError):
+            registration.transform_wcs(wcs, self.center, 1, 1)
+
+    def test_refine(self):
+
+        # The stars of the image are a shuffled, perturbed subset of those
+        # of the reference, plus some that are not there
+        dx, dy, rotation = 12.3, -4.6, 0.3
+        args = self.x, self.y, self.center, dx, dy, rotation
+        x, y = registration.transform(*args)
+        x = numpy.append(x[5:] + self.random.normal(0, 0.05, 35), [50, 60])
+        y = numpy.append(y[5:] + self.random.normal(0, 0.05, 35), [50, 90])
+        order = self.random.permutation(len(x))
+        image = x[order], y[order]
+        reference = self.x, self.y
+
+        # Starting from the translation only, as after phase correlation
+        args = reference, image, self.center, (12, -5, 0), 5
+        result = registration.refine(*args, rotation = True)
+        self.assertAlmostEqual(result[0], dx, delta = 0.05)
+        self.assertAlmostEqual(result[1], dy, delta = 0.05)
+        self.assertAlmostEqual(result[2], rotation, delta = 0.01)
+        self.assertEqual(result[3], 35)
+        self.assertLess(result[4], 0.15)
+
+        # Without rotation, the offsets are still close
+        result = registration.refine(*args)
+        self.assertAlmostEqual(result[0], dx, delta = 0.5)
+        self.assertAlmostEqual(result[1], dy, delta = 0.5)
+        self.assertEqual(result[2], 0)
+
+        # Too far away from the initial guess
+        args = reference, image, self.center, (100, 100, 0), 5
+        with self.assertRaises(ValueError):
+            registration.refine(*args)
+
+    def test_sources(self):
+
+        # A grid of 5 x 4 well-separated stars, increasingly brighter
+        cols, rows = numpy.meshgrid(numpy.arange(40, 320, 60),
+                                    numpy.arange(40, 256, 60))
+        x, y = cols.ravel(), rows.ravel()
+        data = numpy.zeros(self.SHAPE) + self.SKY
+        for index in xrange(len(x)):
+            peak = 1000 * (index + 1)
+            data += gaussian_stars(self.SHAPE, [x[index]], [y[index]],
+                                   peak = peak, sky = 0)
+        data += self.random.normal(0, self.NOISE, self.SHAPE)
+
+        sources = registration.sources(data, 50000)
+        self.assertEqual(len(sources[0]), 20)
+        # The brightest ones first
+        self.assertTrue(numpy.allclose(sources[0], x[::-1], atol = 0.1))
+        self.assertTrue(numpy.allclose(sources[1], y[::-1], atol = 0.1))
+
+        # Saturated stars are ignored...
+        sources = registration.sources(data, 15500)
+        self.assertTrue(numpy.allclose(sources[0], x[14::-1], atol = 0.1))
+        # ... and only the brightest are returned
+        sources = registration.sources(data, 50000, nbrightest = 3)
+        self.assertTrue(numpy.allclose(sources[0], x[:-4:-1], atol = 0.1))
+
+    def test_offset_json(self):
+
+        offsets = {'a.fits' : json_parse.Offset('a.fits', 0, 0, 0),
+                   'b.fits' : json_parse.Offset('a.fits', 1.5, -2.25, 0.01)}
+        fd, path = tempfile.mkstemp(suffix = '.json')
+        os.close(fd)
+        try:
+            json_parse.Offset.dump(offsets, path)
+            self.assertEqual(json_parse.Offset.load(path), offsets)
+        finally:
+            os.unlink(path)
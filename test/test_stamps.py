@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import os
+import pyfits
+import tempfile
+
+# LEMON modules
+from test import unittest
+from test.test_centroid import gaussian_stars
+import centroid
+import stamps
+
+class StampCubeTest(unittest.TestCase):
+
+    def test_init(self):
+
+        data = numpy.arange(400, dtype = numpy.float64).reshape(20, 20)
+        x, y = [5, 10.4, 1], [5, 12.6, 20]
+        cube = stamps.StampCube(data, x, y, 2.5)
+        self.assertEqual(len(cube), 3)
+        self.assertEqual(cube.size, 7)
+        self.assertEqual(cube.cube.shape, (3, 7, 7))
+        # (x, y) = (5, 5) is data[4, 4], at the center of the first stamp
+        numpy.testing.assert_array_equal(cube.cube[0], data[1:8, 1:8])
+        self.assertEqual(cube.cube[1][3, 3], data[12, 9])
+        self.assertTrue(numpy.isnan(cube.cube[2][:, 0]).all())
+        self.assertTrue(numpy.isnan(cube.cube[2][-1]).all())
+
+        # The same stamps are extracted from a FITS image
+        fd, path = tempfile.mkstemp(suffix = '.fits')
+        os.close(fd)
+        try:
+            pyfits.writeto(path, data, clobber = True)
+            from_image = stamps.StampCube.from_image(path, x, y, 2.5)
+            numpy.testing.assert_array_equal(from_image.cube[:2], cube.cube[:2])
+        finally:
+            os.unlink(path)
+
+    def test_centroid(self):
+
+        x = numpy.array([30.3, 75.8, 150.1])
+        y = numpy.array([20.6, 90.2, 50.5])
+        data = gaussian_stars((120, 200), x, y)
+        cube = stamps.StampCube(data, x + 1, y - 1, 15)
+        for method in centroid.METHODS:
+            xc, yc = cube.centroid(7, method = method)
+            expected = centroid.centroid(data, x + 1, y - 1, 7, method = method)
+            numpy.testing.assert_allclose(xc, expected[0])
+            numpy.testing.assert_allclose(yc, expected[1])
+            numpy.testing.assert_allclose(xc, x, atol = 0.1)
+
+    def test_saturated(self):
+
+        data = numpy.zeros((50, 50))
+        data[24, 24] = 1000 # the pixel at (x, y) = (25, 25)
+        x, y = [25, 30, 35, 25], [25, 25, 25, 27.5]
+        cube = stamps.StampCube(data, x, y, 10)
+        saturated = cube.saturated(3, 500)
+        self.assertEqual(list(saturated), [True, False, False, True])
+        self.assertFalse(cube.saturated(3, 1000).any())
+
+        # The pixel (25, 25) spans from 24.5 to 25.5: the nearest point to
+        # (29, 25) is at a distance of 3.5 pixels, within an aperture of 4
+        saturated = cube.saturated(4, 500, x = [25, 29, 29.6, 25],
+                                           y = [25, 25, 25, 25])
+        self.assertEqual(list(saturated), [True, True, False, True])
+
+    def test_aperture_sum_and_sky(self):
+
+        random = numpy.random.RandomState(3)
+        data = random.normal(100, 5, (80, 80))
+        data[40, 40] += 5000 # the pixel at (x, y) = (41, 41)
+        data[14, 49:51] = 1e6 # in the sky annulus of the fourth object
+        x, y = [41, 10, 79, 41], [41, 10, 79, 15]
+        cube = stamps.StampCube(data, x, y, 16)
+
+        sums, areas = cube.aperture_sum(4)
+        # Edge pixels are weighted, so the area is close to that of a circle
+        numpy.testing.assert_allclose(areas, numpy.pi * 4 ** 2, rtol = 0.01)
+        self.assertAlmostEqual(sums[0] - areas[0] * 100, 5000, delta = 150)
+        self.assertAlmostEqual(sums[1] / areas[1], 100, delta = 2)
+        # Part of the aperture of the third object falls off the image
+        self.assertTrue(numpy.isnan(sums[2]))
+
+        sky, stdev = cube.sky(8, 5)
+        numpy.testing.assert_allclose(sky, 100, atol = 2)
+        numpy.testing.assert_allclose(stdev, 5, atol = 1)
+        # Without rejection, the bright pixels would dominate the sky
+        sky = cube.sky(8, 5, maxiter = 0)[0]
+        self.assertTrue(abs(sky[3] - 100) > 1000)
+
+        # Moving the center of the aperture away from the star
+        sums = cube.aperture_sum(4, x = [50, 10, 79, 41],
+                                 y = [41, 10, 79, 15])[0]
+        self.assertAlmostEqual(sums[0] / areas[0], 100, delta = 2)
+
+        # No valid pixels in the annulus
+        cube = stamps.StampCube(data, [-100], [-100], 16)
+        sky, stdev = cube.sky(8, 5)
+        self.assertTrue(numpy.isnan(sky[0]) and numpy.isnan(stdev[0]))